@@ -0,0 +1,28 @@
+# Generated by Django 3.1.7 on 2026-10-17 13:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0040_delete_structurecomplexprotein'),
+        ('angles', '0012_residueangle_rotation_angle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureAnglesBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=32)),
+                ('build_time', models.FloatField(null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='structure.structure')),
+            ],
+            options={
+                'db_table': 'structure_angles_build',
+            },
+        ),
+    ]
@@ -40,6 +40,17 @@ class ResidueAngle(models.Model):
         db_table = 'residue_angles'
         unique_together = ("residue", "structure")
 
+
+class StructureAnglesBuild(models.Model):
+    # fingerprint of the coordinates and residue annotation the angles and distances were computed from
+    structure = models.OneToOneField('structure.Structure', on_delete=models.CASCADE)
+    content_hash = models.CharField(max_length=32)
+    build_time = models.FloatField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta():
+        db_table = 'structure_angles_build'
+
 def get_angle_averages(pdbs,s_lookup,normalized = False, standard_deviation = False, split_by_amino_acid = False, forced_class_a = False):
     start_time = time.time()
     pdbs_upper = [pdb.upper() for pdb in pdbs]
@@ -0,0 +1,179 @@
+from django.conf import settings
+from django.db.models import Prefetch
+
+from structure.models import Structure, StructureExtraProteins
+
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# columns of the export, ligands and signalling proteins are flattened into lists
+COLUMNS = [
+    ('pdb_code', 'string'),
+    ('protein', 'string'),
+    ('family', 'string'),
+    ('species', 'string'),
+    ('preferred_chain', 'string'),
+    ('resolution', 'float'),
+    ('publication_date', 'string'),
+    ('type', 'string'),
+    ('state', 'string'),
+    ('distance', 'float'),
+    ('publication', 'string'),
+    ('representative', 'bool'),
+    ('ligand_names', 'list'),
+    ('ligand_types', 'list'),
+    ('ligand_functions', 'list'),
+    ('ligand_pdb', 'list'),
+    ('ligand_smiles', 'list'),
+    ('signalling_protein_type', 'string'),
+    ('signalling_protein_entry_names', 'list'),
+    ('signalling_protein_chains', 'list'),
+]
+
+
+class StructureExport:
+    """Structure table export for bulk downloads, written by build_structure_export.
+
+    Rows are sorted by publication date and stored as gzipped JSON lines and, when pyarrow is installed, as Parquet.
+    The ETag of each file is kept in a small metadata file next to it.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'structure_export'])
+    files = {'jsonl': 'structures.jsonl.gz', 'parquet': 'structures.parquet'}
+    meta_file = 'meta.json'
+
+    logger = logging.getLogger('build')
+
+    @classmethod
+    def rows(cls):
+        structures = Structure.objects.all().select_related('pdb_code', 'protein_conformation__protein__parent__family',
+            'protein_conformation__protein__parent__species', 'structure_type', 'state', 'publication__web_link__web_resource',
+            'signprot_complex__protein', 'signprot_complex__beta_protein', 'signprot_complex__gamma_protein') \
+            .prefetch_related('structureligandinteraction_set__ligand__ligand_type',
+            'structureligandinteraction_set__ligand_role',
+            Prefetch('extra_proteins', queryset=StructureExtraProteins.objects.filter(wt_protein__family__slug__startswith="200") \
+                .select_related('wt_protein'))) \
+            .order_by('publication_date', 'pdb_code__index')
+
+        for structure in structures:
+            protein = structure.protein_conformation.protein.parent
+            row = {
+                'pdb_code': structure.pdb_code.index,
+                'protein': protein.entry_name,
+                'family': protein.family.slug,
+                'species': protein.species.latin_name,
+                'preferred_chain': structure.preferred_chain,
+                'resolution': float(structure.resolution),
+                'publication_date': structure.publication_date.isoformat(),
+                'type': structure.structure_type.name,
+                'state': structure.state.name,
+                'distance': float(structure.distance) if structure.distance is not None else None,
+                'publication': structure.publication.web_link.__str__() if structure.publication else None,
+                'representative': structure.representative,
+            }
+
+            # annotated ligands, one list entry per ligand
+            ligands = [i for i in structure.structureligandinteraction_set.all() if i.annotated]
+            row['ligand_names'] = [i.ligand.name or None for i in ligands]
+            row['ligand_types'] = [i.ligand.ligand_type.name if i.ligand.ligand_type else None for i in ligands]
+            row['ligand_functions'] = [i.ligand_role.name if i.ligand_role else None for i in ligands]
+            row['ligand_pdb'] = [i.ligand.pdbe or None for i in ligands]
+            row['ligand_smiles'] = [i.ligand.smiles or None for i in ligands]
+
+            # signalling protein, arrestins take precedence as in the structure API
+            row['signalling_protein_type'] = None
+            row['signalling_protein_entry_names'] = []
+            row['signalling_protein_chains'] = []
+            if structure.signprot_complex:
+                row['signalling_protein_type'] = 'G protein'
+                for entity, chain in [(structure.signprot_complex.protein, structure.signprot_complex.alpha),
+                        (structure.signprot_complex.beta_protein, structure.signprot_complex.beta_chain),
+                        (structure.signprot_complex.gamma_protein, structure.signprot_complex.gamma_chain)]:
+                    if entity:
+                        row['signalling_protein_entry_names'].append(entity.entry_name)
+                        row['signalling_protein_chains'].append(chain)
+            arrestins = structure.extra_proteins.all()
+            if arrestins:
+                row['signalling_protein_type'] = 'Arrestin'
+                row['signalling_protein_entry_names'] = [arrestins[len(arrestins)-1].wt_protein.entry_name]
+                row['signalling_protein_chains'] = [arrestins[len(arrestins)-1].chain]
+
+            yield row
+
+    @classmethod
+    def build(cls, store_dir=None):
+        """Write the export files, replacing a previous version."""
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        rows = list(cls.rows())
+        written = []
+
+        path = os.sep.join([store_dir, cls.files['jsonl']])
+        # fixed mtime, so unchanged content gives an unchanged file (and ETag)
+        with gzip.GzipFile(path + '.tmp', 'wb', mtime=0) as f:
+            for row in rows:
+                f.write((json.dumps(row, separators=(',', ':')) + '\n').encode('utf-8'))
+        written.append('jsonl')
+
+        if pyarrow is not None:
+            list_type = pyarrow.list_(pyarrow.string())
+            types = {'string': pyarrow.string(), 'float': pyarrow.float64(), 'bool': pyarrow.bool_(), 'list': list_type}
+            schema = pyarrow.schema([(name, types[t]) for name, t in COLUMNS])
+            table = pyarrow.Table.from_pydict({name: [row[name] for row in rows] for name, t in COLUMNS}, schema=schema)
+            pyarrow.parquet.write_table(table, os.sep.join([store_dir, cls.files['parquet']]) + '.tmp')
+            written.append('parquet')
+        else:
+            cls.logger.warning('pyarrow is not installed, skipping the Parquet structure export')
+
+        meta = {'built': datetime.datetime.now().isoformat(), 'count': len(rows), 'etags': {}}
+        for export_format in written:
+            path = os.sep.join([store_dir, cls.files[export_format]])
+            meta['etags'][export_format] = file_md5(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+        meta_path = os.sep.join([store_dir, cls.meta_file])
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        cls.logger.info('Exported {} structures to {}'.format(len(rows), store_dir))
+
+    @classmethod
+    def meta(cls, store_dir=None):
+        """Metadata of the current export, or None if it has not been built."""
+        try:
+            with open(os.sep.join([store_dir or cls.store_dir, cls.meta_file])) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def path(cls, export_format, store_dir=None):
+        return os.sep.join([store_dir or cls.store_dir, cls.files[export_format]])
+
+    @classmethod
+    def lines_since(cls, since, store_dir=None):
+        """JSON lines of the structures published on or after since (a date), in order of publication date."""
+        since = since.isoformat()
+        with gzip.open(cls.path('jsonl', store_dir), 'rb') as f:
+            for line in f:
+                if json.loads(line)['publication_date'] >= since:
+                    yield line
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -56,6 +56,7 @@ urlpatterns = [
     url(r'^structure/$', cache_page(3600*24*7)(views.StructureList.as_view()), name='structure-list'),
     url(r'^structure/representative/$', cache_page(3600*24*7)(views.RepresentativeStructureList.as_view()), {'representative': True},
         name='structure-representative-list'),
+    url(r'^structure/export/$', views.StructureExportView.as_view(), name='structure-export'),
     url(r'^structure/protein/(?P<entry_name>[^/]+)/$', views.StructureListProtein.as_view(),
         name='structure-list-protein'),
     url(r'^structure/protein/(?P<entry_name>[^/]+)/representative/$',
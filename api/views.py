@@ -5,6 +5,7 @@ from rest_framework.renderers import JSONRenderer
 from django.template.loader import render_to_string
 
 from django.db.models import Prefetch, Q
+from django.http import FileResponse, HttpResponseNotModified, StreamingHttpResponse
 
 from interaction.models import ResidueFragmentInteraction
 from mutation.models import MutationRaw
@@ -17,6 +18,7 @@ from api.serializers import (ProteinSerializer, ProteinFamilySerializer, Species
                              ResidueExtendedSerializer, StructureLigandInteractionSerializer,
                              MutationSerializer, ReceptorListSerializer)
 from api.renderers import PDBRenderer
+from api.structure_export import StructureExport
 from common.alignment import Alignment
 from common.definitions import AMINO_ACIDS, AMINO_ACID_GROUPS
 from drugs.models import Drugs
@@ -24,6 +26,8 @@ from drugs.models import Drugs
 from io import StringIO
 from Bio.PDB import PDBIO, parse_pdb_header
 from collections import OrderedDict
+import datetime
+import hashlib
 
 # FIXME add
 # getMutations
@@ -324,6 +328,50 @@ class StructureList(views.APIView):
         return Structure.objects.all()
 
 
+class StructureExportView(views.APIView):
+
+    """
+    Get the full list of structures as one file, for mirroring the structure table
+    \n/structure/export/
+    \n?file_format= jsonl (gzipped JSON lines, default) or parquet
+    \n?since={publication_date} only structures published on or after this date (YYYY-MM-DD), as JSON lines
+    \nResponses carry an ETag and are not sent again for a matching If-None-Match header
+    """
+
+    def get(self, request):
+        meta = StructureExport.meta()
+        if meta is None:
+            return Response({'error': 'The structure export has not been built'}, status=503)
+
+        export_format = request.query_params.get('file_format', 'jsonl')
+        if export_format not in meta['etags']:
+            return Response({'error': 'Unknown or unavailable file format: {}'.format(export_format)}, status=400)
+        etag = meta['etags'][export_format]
+
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since = datetime.datetime.strptime(since, '%Y-%m-%d').date()
+            except ValueError:
+                return Response({'error': 'since should be a date (YYYY-MM-DD)'}, status=400)
+            etag = hashlib.md5('{}-{}'.format(meta['etags']['jsonl'], since.isoformat()).encode('utf-8')).hexdigest()
+
+        etag = '"{}"'.format(etag)
+        if_none_match = [t.strip() for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in if_none_match or 'W/' + etag in if_none_match or '*' in if_none_match:
+            response = HttpResponseNotModified()
+        elif since:
+            response = StreamingHttpResponse(StructureExport.lines_since(since), content_type='application/x-ndjson')
+        elif export_format == 'parquet':
+            response = FileResponse(open(StructureExport.path('parquet'), 'rb'), content_type='application/vnd.apache.parquet',
+                as_attachment=True, filename='structures.parquet')
+        else:
+            response = FileResponse(open(StructureExport.path('jsonl'), 'rb'), content_type='application/gzip',
+                as_attachment=True, filename='structures.jsonl.gz')
+        response['ETag'] = etag
+        return response
+
+
 class RepresentativeStructureList(StructureList):
 
     """
@@ -73,7 +73,11 @@ class Command(BaseCommand):
             ['build_blast_database']
         ]
         phase2 = [
+            ['build_coordinate_store'],
+            ['build_diagram_store', {'proc': options['proc']}],
             ['build_structure_angles', {'proc': options['proc']}],
+            ['build_distance_maps'],
+            ['build_template_index'],
             ['build_construct_data'],
             ['update_construct_mutations'],
             ['build_protein_sets'],
@@ -83,9 +87,11 @@ class Command(BaseCommand):
             ['build_residue_sets'],
             ['build_dynamine_annotation', {'proc': options['proc']}],
             ['build_complex_interactions'],
+            ['build_class_aggregates'],
             ['assign_structure_states'],
             ['build_contact_representative'],
             ['build_mammalian_representative'],
+            ['build_structure_export'],
             ['upload_excel_bias_pathways'],
             ['build_text'],
             ['build_release_notes'],
@@ -4,6 +4,7 @@ from django.db import connection
 
 from protein.models import Protein, ProteinSegment
 from residue.models import Residue
+from structure.sequence_search import SequenceIndex
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
@@ -89,4 +90,8 @@ class Command(BaseCommand):
         if os.path.exists(self.tmp_file_path):
             os.unlink(self.tmp_file_path)
 
+        # k-mer index for searches without blastp (structure.sequence_search)
+        self.logger.info("Building sequence index")
+        SequenceIndex.build([(protein.id, protein.entry_name, protein.sequence) for protein in proteins], db_output_path)
+
         self.logger.info("COMPLETED BUILDING BLAST DATABASE" + blast_db_dir)
@@ -43,24 +43,29 @@ class Command(ParseExcel):
 		'''Create citation objects'''
 		with open(self.references_yaml, 'r') as refs_yaml:
 			refs = yaml.load(refs_yaml, Loader=yaml.FullLoader)
-		wr = WebResource.objects.get(slug='doi')
 		pubjournal = None
 
-		# Create main publication first for empty publication cells for non-published tools
+		# Resolve the publications of all DOIs at once
+		publications = Publication.resolve_many([vals['DOI'] for vals in refs.values()])
+
+		# Main publications for empty publication cells for non-published tools
 		for url, vals in refs.items():
 			if vals['Default']=='GPCRdb':
-				main_gpcrdb_pub = Publication.get_or_create_from_doi(vals['DOI'])
+				main_gpcrdb_pub = publications.get(vals['DOI'], False)
 			if vals['Default']=='GproteinDb':
-				main_gproteindb_pub = Publication.get_or_create_from_doi(vals['DOI'])
+				main_gproteindb_pub = publications.get(vals['DOI'], False)
 
 		for url, vals in refs.items():
 			doi = vals['DOI']
 			pub = False
 			if vals['Journal'] in ['Preprint at Research Square', 'Submitted']:
 				pubjournal, created = PublicationJournal.objects.get_or_create(defaults={"name": vals["Journal"], 'slug': slugify(vals['Journal'])}, name__iexact=vals["Journal"])
-				pub = self.create_publication(doi, wr, pubjournal)
+				pub = publications.get(doi)
+				if pub and not pub.journal:
+					pub.journal = pubjournal
+					pub.save()
 			elif len(doi) > 0:
-				pub = Publication.get_or_create_from_doi(vals['DOI'])
+				pub = publications.get(doi, False)
 
 			page = vals['Page']
 			if not pub:
@@ -101,19 +106,3 @@ class Command(ParseExcel):
 			return url.split('https://doi.org/')[1].upper()
 		else:
 			return url.upper()
-
-	def create_publication(self, doi, wr, pubjournal):
-		'''Create WebLink and Publication objects'''
-		if doi!='':
-			try:
-				pub = Publication.objects.get(web_link__index=doi, web_link__web_resource=wr)
-			except Publication.DoesNotExist as e:
-				pub = Publication.get_or_create_from_doi(doi)
-
-				if not pub.journal and pubjournal:
-					pub.journal = pubjournal
-					pub.save()
-				self.logger.info('Created Publication:'+str(pub))
-			return pub
-		else:
-			return None
@@ -104,7 +104,6 @@ class Command(BaseBuild):
             os.mkdir('./static/homology_models')
         if not os.path.exists('./structure/complex_models_zip/'):
             os.mkdir('./structure/complex_models_zip/')
-        open('./structure/homology_models/done_models.txt','w').close()
 
         self.update = options['update']
         self.complex = True
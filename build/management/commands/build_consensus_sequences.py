@@ -7,6 +7,7 @@ from build.management.commands.build_human_proteins import Command as BuildHuman
 from residue.functions import *
 from protein.models import Protein, ProteinConformation, ProteinFamily, ProteinSegment, ProteinSequenceType
 from common.alignment import Alignment
+from common.alignment_store import AlignmentStore
 from alignment.models import AlignmentConsensus
 
 import os
@@ -35,6 +36,8 @@ class Command(BuildHumanProteins):
         parser.add_argument('--signprot', type=str, action='store', dest='signprot', default=False, help='Only run for either G proteins or arrestins')
         parser.add_argument('--input-slug', type=str, action='store', dest='input-slug', default=False, help='Run only on a family slug from ProteinFamily table')
         parser.add_argument('--purge', action='store_true', dest='purge', default=False, help='Purge all consensus data')
+        parser.add_argument('--skip-alignment-store', action='store_true', dest='skip_alignment_store', default=False,
+            help='Do not regenerate the precomputed alignment residue store')
 
     def handle(self, *args, **options):
         try:
@@ -45,6 +48,12 @@ class Command(BuildHumanProteins):
             self.logger.info('CREATING CONSENSUS SEQUENCES')
             self.prepare_input(options['proc'], self.families)
             self.logger.info('COMPLETED CREATING CONSENSUS SEQUENCES')
+
+            # consensus proteins add residues, so the alignment store is regenerated afterwards
+            if not options['skip_alignment_store']:
+                self.logger.info('BUILDING ALIGNMENT STORE')
+                AlignmentStore.build()
+                self.logger.info('COMPLETED BUILDING ALIGNMENT STORE')
         except Exception as msg:
             print(msg)
             self.logger.error(msg)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from common.diagram_store import DiagramStore
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Prerender the snake plots, helix boxes, G protein and arrestin plots of all proteins"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc',
+            type=int,
+            action='store',
+            dest='proc',
+            default=1,
+            help='Number of processes to run')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        DiagramStore.build(proc=options['proc'])
+        print("Built diagram store in {:.1f} seconds".format(time.time() - start))
@@ -2,9 +2,10 @@ from build.management.commands.base_build import Command as BaseBuild
 from build.management.commands.build_ligand_functions import get_ligand_by_id, match_id_via_unichem, get_or_create_ligand, is_float
 from django.conf import settings
 from django.utils.text import slugify
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
-from common.tools import get_or_create_url_cache, fetch_from_web_api
+from common.tools import get_or_create_url_cache, fetch_from_web_api, copy_to_table, reserve_primary_keys
+from common.web_api import fetch_many_from_web_api
 from common.models import WebLink, WebResource, Publication, PublicationJournal
 from ligand.models import Ligand, LigandID, LigandType, LigandVendors, LigandVendorLink, AssayExperiment, Endogenous_GTP, LigandRole
 from protein.models import Protein, Species
@@ -12,6 +13,7 @@ from protein.models import Protein, Species
 import math
 import os
 import statistics
+import time
 import datamol as dm
 import datetime
 import pandas as pd
@@ -411,6 +413,7 @@ class Command(BaseBuild):
     @staticmethod
     def create_model(gtop_endogenous):
         values = ['pki', 'pec50', 'pkd', 'pic50']
+        Command.prefetch_publications(entry['pubmed_ids'] for entry in gtop_endogenous)
 
         human_entries = [entry["target_id"] + "|" + entry["ligand_id"]
                          for entry in gtop_endogenous if entry["interaction_species"] in [None, "None", "", "Human"]]
@@ -830,81 +833,70 @@ class Command(BaseBuild):
         chembl_document_data = pd.read_csv(chembl_document_conversion_file, dtype=str)
 
         publication_array = Command.build_chembl_publications(chembl_document_data)
+        publication_ids = {doi: pub.id for doi, pub in publication_array.items() if pub is not None}
 
-        bioactivity_data = pd.read_csv(bioactivity_input_file, dtype=str)
-
+        # document => DOI, documents missing from the conversion file are looked up once with the ChEMBL API
         url_doc_template = 'https://www.ebi.ac.uk/chembl/api/data/document?document_chembl_id=$index'
-        bioactivity_data.fillna('None', inplace=True)
-        bio_entries = len(bioactivity_data)
-        print("Found", bio_entries, "bioactivities", datetime.datetime.now())
+        # the first row of a document wins, as in the per-row lookup of the conversion file
+        known_documents = chembl_document_data.dropna(subset=['document_chembl_id']).drop_duplicates(
+            subset=['document_chembl_id'], keep='first')
+        document_dois = dict(zip(known_documents['document_chembl_id'], known_documents['doi']))
 
         print("\n#2 Building ChEMBL ligands cache", datetime.datetime.now())
-        # ids = list(bioactivity_data["parent_molecule_chembl_id"].unique())  # not filtering is way faster
-        ligands = list(LigandID.objects.filter(
-            index__startswith="CHEMBL").values_list("ligand_id", "index"))
-        lig_dict = {entry[1]: entry[0] for entry in ligands}
+        lig_dict = dict(LigandID.objects.filter(index__startswith="CHEMBL").values_list("index", "ligand_id"))
 
         print("\n#3 Building ChEMBL proteins cache", datetime.datetime.now())
         # NOTE => might need to switch to Accession as the Entry name changes more frequently
         # If so, keep isoform notations in mind
-        names = list(bioactivity_data["Entry name"].unique())
-        proteins = list(Protein.objects.filter(entry_name__in=names).values_list("pk", "entry_name"))
-        prot_dict = {prot_entry[1]: prot_entry[0] for prot_entry in proteins}
+        prot_dict = dict(Protein.objects.values_list("entry_name", "pk"))
 
         print("\n#4 Building ChEMBL bioactivity entries", datetime.datetime.now())
-        bioacts = []
-        pub_links = []
-        for index, (_, row) in enumerate(bioactivity_data.iterrows()):
-            try:
-                if (row["parent_molecule_chembl_id"] in lig_dict.keys()) and (row["Entry name"] in prot_dict.keys()):
-                    bioacts.append(AssayExperiment())
-                    bioacts[-1].ligand_id = lig_dict[row["parent_molecule_chembl_id"]]
-                    bioacts[-1].protein_id = prot_dict[row["Entry name"]]
-                    bioacts[-1].assay_type = row["assay_type"]
-                    bioacts[-1].assay_description = row["assay_description"]
-                    bioacts[-1].standard_activity_value = row["standard_value"]
-                    bioacts[-1].p_activity_value = row["pchembl_value"]
-                    bioacts[-1].p_activity_ranges = None
-                    bioacts[-1].standard_relation = row["standard_relation"]
-                    bioacts[-1].value_type = row["standard_type"]
-                    bioacts[-1].document_chembl_id = row["document_chembl_id"]
-                    bioacts[-1].source = 'ChEMBL'
-
-                    try:
-                        doi = chembl_document_data.loc[chembl_document_data['document_chembl_id'] == row["document_chembl_id"], 'doi'].iloc[0]
-                    except IndexError:
-                        response = fetch_from_web_api(
-                            url_doc_template, row["document_chembl_id"], cache_dir, xml=True)
-                        doi = response[0][0][4].text
-
-                    if doi is not None:
-                        publication = publication_array[doi]
-                        if publication is not None:
-                            pub_links.append(
-                                [len(bioacts) - 1, publication.id])
-                    # except:
-                    #     pass
-
-                    # BULK insert every X entries or last entry
-                    if (len(bioacts) == Command.bulk_size) or (index == bio_entries - 1):
-                        print('Inserting bulk data')
-                        AssayExperiment.objects.bulk_create(bioacts)
-
-                        for pair in pub_links:
-                            pair[0] = bioacts[pair[0]]
-
-                        data_pub = AssayExperiment.publication.through
-                        data_pub.objects.bulk_create([
-                            data_pub(assayexperiment_id=experiment.pk,
-                                     publication_id=pub_id)
-                            for (experiment, pub_id) in pub_links], ignore_conflicts=True)
-                        print("Inserted", index, "out of",
-                              bio_entries, "bioactivities")
-                        bioacts = []
-                        pub_links = []
-            except KeyError:
+        experiment_fields = ['id', 'ligand', 'protein', 'assay_type', 'assay_description', 'standard_activity_value',
+            'p_activity_value', 'p_activity_ranges', 'standard_relation', 'value_type', 'document_chembl_id', 'source']
+        data_pub = AssayExperiment.publication.through
+        start = time.time()
+        read = inserted = linked = 0
+        # the bioactivities are streamed in chunks, each is matched with dictionary lookups and written with COPY
+        for chunk in pd.read_csv(bioactivity_input_file, dtype=str, chunksize=Command.bulk_size):
+            read += len(chunk)
+            chunk = chunk.fillna('None')
+            chunk['ligand_id'] = chunk['parent_molecule_chembl_id'].map(lig_dict)
+            chunk['protein_id'] = chunk['Entry name'].map(prot_dict)
+            chunk = chunk[chunk['ligand_id'].notna() & chunk['protein_id'].notna()]
+            if chunk.empty:
                 continue
 
+            unknown_documents = [document for document in chunk['document_chembl_id'].unique()
+                if document not in document_dois and document != 'None']
+            for document, response in fetch_many_from_web_api(url_doc_template, unknown_documents, cache_dir,
+                    xml=True).items():
+                document_dois[document] = Command.chembl_document_doi(response)
+            publications = chunk['document_chembl_id'].map(document_dois).map(publication_ids)
+
+            ids = reserve_primary_keys(AssayExperiment, len(chunk))
+            rows = zip(ids, chunk['ligand_id'].astype(int), chunk['protein_id'].astype(int), chunk['assay_type'],
+                chunk['assay_description'], chunk['standard_value'], chunk['pchembl_value'], [None] * len(chunk),
+                chunk['standard_relation'], chunk['standard_type'], chunk['document_chembl_id'], ['ChEMBL'] * len(chunk))
+            links = [(experiment, int(publication)) for experiment, publication in zip(ids, publications)
+                if pd.notna(publication)]
+            with transaction.atomic():
+                inserted += copy_to_table(AssayExperiment, experiment_fields, rows)
+                linked += copy_to_table(data_pub, ['assayexperiment', 'publication'], links)
+
+            elapsed = time.time() - start
+            print("Inserted {} out of {} bioactivities read ({} publication links), {:.0f} rows/s".format(inserted,
+                read, linked, read / elapsed if elapsed else 0))
+
+        print("Inserted {} ChEMBL bioactivities in {:.1f} seconds".format(inserted, time.time() - start))
+
+    @staticmethod
+    def chembl_document_doi(response):
+        """DOI of a ChEMBL document from its ChEMBL API entry, None if it has none"""
+        try:
+            return response[0][0][4].text
+        except (TypeError, IndexError):
+            return None
+
     @staticmethod
     def build_pubchem_vendor_links():
         LigandVendors.objects.all().delete()
@@ -1120,6 +1112,7 @@ class Command(BaseBuild):
     @staticmethod
     def build_gtp_bioactivities(gtp_biodata):
         print("# Start parsing the GTP Dataframe")
+        Command.prefetch_publications(gtp_biodata['pubmed_id'])
         for _, row in gtp_biodata.iterrows():
             receptor = Command.fetch_protein(
                 row['target_id'], 'GtoP', row['target_species'])
@@ -1182,6 +1175,14 @@ class Command(BaseBuild):
                 print("SKIPPING", ligand, row["ligand_id"], "|",
                       receptor, row['target_id'], row['target_species'])
 
+    @staticmethod
+    def prefetch_publications(references):
+        """Resolve the publications of '|' separated lists of PMIDs and DOIs at once, for fetch_publication"""
+        identifiers = [identifier for reference in references if isinstance(reference, str)
+            for identifier in reference.split('|')]
+        for identifier, publication in Publication.resolve_many(identifiers).items():
+            Command.publication_cache[Publication.normalize_identifier(identifier)[0]] = publication
+
     @staticmethod
     def fetch_publication(publication_doi):
         """
@@ -1,7 +1,8 @@
 from build.management.commands.base_build import Command as BaseBuild
 from build.management.commands.build_homology_models_zip import Command as UploadModel
-from django.db.models import Q
+from django.db.models import Q, Count, Avg, Sum
 from django.conf import settings
+from django.utils import timezone
 
 from protein.models import Protein, ProteinConformation, ProteinAnomaly, ProteinState, ProteinSegment, ProteinFamily
 from residue.models import Residue
@@ -35,10 +36,13 @@ import zipfile
 import shutil
 import math
 from copy import deepcopy
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import yaml
 import traceback
 import subprocess
+import socket
+import tempfile
+import time
 
 
 startTime = datetime.now()
@@ -66,6 +70,9 @@ warnings.filterwarnings("ignore")
 class Command(BaseBuild):
     help = 'Build automated chimeric GPCR homology models'
 
+    # running jobs claimed longer ago are taken to be from crashed workers with --resume
+    job_timeout = timedelta(hours=48)
+
     def add_arguments(self, parser):
         super(Command, self).add_arguments(parser=parser)
         parser.add_argument('--update', help='Upload model to GPCRdb, overwrites existing entry', default=False,
@@ -91,6 +98,12 @@ class Command(BaseBuild):
         parser.add_argument('--fast_refinement', help='Chose fastest refinement option in MODELLER', default=False, action='store_true')
         parser.add_argument('--keep_hetatoms', help='Keep hetero atoms from main template, this includes ligands', default=False, action='store_true')
         parser.add_argument('--rerun', help='Skip models with matching zip archives and only run the missing models.', default=False, action='store_true')
+        parser.add_argument('--resume', help='Only run the jobs of the selected models that are not done or failed, e.g. after a crash or to add workers on another machine',
+                            default=False, action='store_true')
+        parser.add_argument('--retry_failed', '--retry-failed', help='Run the failed jobs of the selected models again, and the ones not run yet',
+                            default=False, action='store_true')
+        parser.add_argument('--scratch_dir', help='Directory for the working directories of the jobs (default: system temporary directory)',
+                            default=None, type=str)
 
 
     def handle(self, *args, **options):
@@ -101,7 +114,12 @@ class Command(BaseBuild):
             os.mkdir('./structure/PIR')
         if not os.path.exists('./static/homology_models'):
             os.mkdir('./static/homology_models')
-        open('./structure/homology_models/done_models.txt','w').close()
+        # output directories shared by the working directories of the jobs
+        for zip_path in ['./structure/homology_models_zip/', './structure/complex_models_zip/']:
+            if not os.path.exists(zip_path):
+                os.mkdir(zip_path)
+        self.root = os.getcwd()
+        self.scratch_dir = options['scratch_dir']
         if options['update']:
             self.update = True
         else:
@@ -199,23 +217,15 @@ class Command(BaseBuild):
             self.receptor_list_entry_names = self.receptor_list_entry_names[:5]
 
         # Model building
-        print("receptors to do",len(self.receptor_list))
+        self.jobs = self.queue_jobs(resume=options['resume'] or options['retry_failed'], retry_failed=options['retry_failed'])
+        pending_jobs = list(self.jobs.filter(status=StructureModelJob.PENDING).values_list('pk', flat=True))
+        print("receptors to do",len(pending_jobs),"of",len(self.receptor_list))
         self.processors = options['proc']
-        self.prepare_input(options['proc'], self.receptor_list)
-
-        # Cleanup
-        missing_models = []
-        with open('./structure/homology_models/done_models.txt') as f:
-            for i in f.readlines():
-                if i.split('\n')[0] not in self.receptor_list_entry_names:
-                    missing_models.append(i.split('\n')[0])
-        if len(missing_models)==0:
-            print('All models were run')
-        else:
-            print('Missing models:')
-            print(missing_models)
-#            new_args = shlex.split('/env/bin/python3 manage.py build_homology_models -r {} -p {} -s {}'.format(' '.join(missing_models, options['proc'], options['s'])))
-        os.remove('./structure/homology_models/done_models.txt')
+        run_startTime = timezone.now()
+        self.prepare_input(options['proc'], pending_jobs)
+
+        # Report
+        self.report_jobs(run_startTime)
 
         # Make zip file for archiving
         os.chdir('./structure/')
@@ -233,19 +243,72 @@ class Command(BaseBuild):
             shutil.rmtree('homology_models')
             shutil.rmtree('PIR')
 
+    def queue_jobs(self, resume=False, retry_failed=False):
+        ''' Create the jobs of the selected models in the job table and return them. Without resume, all of them are
+            run again, except those running on a live worker. With resume, done and failed jobs are kept, and running
+            jobs are run again if their worker is gone. With retry_failed, failed jobs are run again as well.
+        '''
+        signprot = self.signprot if self.signprot else ''
+        StructureModelJob.objects.bulk_create([StructureModelJob(protein=r, state=st, complex=self.complex, signprot=signprot)
+                                               for r, st in self.receptor_list], ignore_conflicts=True)
+        selected = set([(r.pk, st) for r, st in self.receptor_list])
+        job_ids = [pk for pk, protein_id, state in StructureModelJob.objects.filter(protein__in=[r for r, st in self.receptor_list],
+                                                                                    complex=self.complex, signprot=signprot).values_list('pk', 'protein_id', 'state')
+                   if (protein_id, state) in selected]
+        jobs = StructureModelJob.objects.filter(pk__in=job_ids)
+
+        # Running jobs of crashed workers: workers on this machine that are gone, or claimed before the timeout
+        stale = self.stale_jobs(jobs)
+        if len(stale)>0:
+            logger.info('Resuming {} jobs of stopped workers'.format(len(stale)))
+            jobs.filter(pk__in=stale, status=StructureModelJob.RUNNING).update(status=StructureModelJob.PENDING)
+
+        if not resume:
+            # jobs still running on a live worker are left to it
+            running = jobs.filter(status=StructureModelJob.RUNNING).count()
+            if running>0:
+                logger.info('Skipping {} jobs running on other workers'.format(running))
+            jobs.exclude(status=StructureModelJob.RUNNING).update(status=StructureModelJob.PENDING, attempts=0)
+            return jobs
+
+        if retry_failed:
+            jobs.filter(status=StructureModelJob.FAILED).update(status=StructureModelJob.PENDING)
+        return jobs
+
+    def stale_jobs(self, jobs):
+        ''' Primary keys of the running jobs whose worker is gone: a process on this machine that no longer exists, or
+            a claim older than job_timeout (workers on other machines).
+        '''
+        hostname = socket.gethostname()
+        stale = []
+        for job in jobs.filter(status=StructureModelJob.RUNNING):
+            host, _, pid = job.worker.rpartition(':')
+            if job.claimed==None or job.claimed<timezone.now()-self.job_timeout:
+                stale.append(job.pk)
+            elif host==hostname and pid.isdigit():
+                try:
+                    os.kill(int(pid), 0)
+                except ProcessLookupError:
+                    stale.append(job.pk)
+                except PermissionError:
+                    pass
+        return stale
+
     def main_func(self, positions, iteration, count, lock):
-        processor_id = round(self.processors*positions[0]/len(self.receptor_list))+1
+        worker = '{}:{}'.format(socket.gethostname(), os.getpid())
         i = 0
-        while count.value<len(self.receptor_list):
+        while True:
+            job = StructureModelJob.claim(worker, self.jobs)
+            if job==None:
+                break
             i += 1
-            with lock:
-                receptor = self.receptor_list[count.value]
-                count.value +=1
+            receptor = [job.protein, job.state]
+            signprot = job.signprot if job.signprot else False
 
             # RERUN: if a model zip file already exists, skip it and move to the next
             if self.rerun:
                 # Init temporary model object for checks regarding signaling protein complexes etc.
-                temp_model_check = HomologyModeling(receptor[0].entry_name, receptor[1], [receptor[1]], iterations=self.modeller_iterations, complex_model=self.complex, signprot=self.signprot, debug=self.debug,
+                temp_model_check = HomologyModeling(receptor[0].entry_name, receptor[1], [receptor[1]], iterations=self.modeller_iterations, complex_model=job.complex, signprot=signprot, debug=self.debug,
                                                   force_main_temp=self.force_main_temp, fast_refinement=self.fast_refinement, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
 
                 path = './structure/complex_models_zip/' if temp_model_check.complex else './structure/homology_models_zip/'
@@ -257,14 +320,83 @@ class Command(BaseBuild):
 
                 # Check if model zip file exists
                 if len(glob.glob(filepath)) > 0:
+                    job.finish(True)
                     continue
 
             mod_startTime = datetime.now()
-            logger.info('Generating model for  \'{}\' ({})... ({} out of {}) (processor:{} count:{})'.format(receptor[0].entry_name, receptor[1],count.value, len(self.receptor_list),processor_id,i))
-            chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug,
-                                       update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
-            chm.run(fast_refinement=self.fast_refinement)
-            logger.info('Model finished for  \'{}\' ({})... (processor:{} count:{}) (Time: {})'.format(receptor[0].entry_name, receptor[1],processor_id,i,datetime.now() - mod_startTime))
+            logger.info('Generating model for  \'{}\' ({})... (job {}, attempt {}) (worker:{} count:{})'.format(receptor[0].entry_name, receptor[1], job.pk, job.attempts, worker, i))
+            scratch = self.job_scratch_dir(job)
+            os.chdir(scratch)
+            try:
+                chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug,
+                                           update=self.update, complex_model=job.complex, signprot=signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms, mutations=self.added_mutations)
+                built = chm.run(fast_refinement=self.fast_refinement)
+            finally:
+                os.chdir(self.root)
+            if built:
+                self.collect_job_output(scratch)
+            if not self.debug:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+            hm = chm.homology_model
+            job.finish(built, (datetime.now() - mod_startTime).total_seconds(), hm.modeller_time if hm else None,
+                       hm.main_structure if hm and isinstance(hm.main_structure, Structure) else None,
+                       self.template_choices(hm) if hm else None, chm.error)
+            logger.info('Model {} for  \'{}\' ({})... (worker:{} count:{}) (Time: {})'.format('finished' if built else 'failed', receptor[0].entry_name, receptor[1], worker, i, datetime.now() - mod_startTime))
+
+    def job_scratch_dir(self, job):
+        ''' Working directory of a job. MODELLER, the PIR files and the model files are written to the working
+            directory, so each job has its own, with the shared output directories and manage.py linked in.
+        '''
+        scratch = tempfile.mkdtemp(prefix='homology_model_{}_'.format(job.pk), dir=self.scratch_dir)
+        os.makedirs(os.sep.join([scratch, 'structure', 'homology_models']))
+        os.makedirs(os.sep.join([scratch, 'structure', 'PIR']))
+        for link in ['logs', 'static', 'manage.py', os.sep.join(['structure', 'homology_models_zip']), os.sep.join(['structure', 'complex_models_zip'])]:
+            os.symlink(os.sep.join([self.root, link]), os.sep.join([scratch, link]))
+        return scratch
+
+    def collect_job_output(self, scratch):
+        ''' Copy the model files of a job to the shared homology_models directory, for the zip archive of the run.
+        '''
+        job_path = os.sep.join([scratch, 'structure', 'homology_models'])
+        for f in os.listdir(job_path):
+            if 'post' not in f:
+                shutil.copy(os.sep.join([job_path, f]), os.sep.join([self.root, 'structure', 'homology_models', f]))
+
+    @staticmethod
+    def template_choices(homology_model):
+        ''' Backbone templates of each segment of a model, as PDB codes.
+        '''
+        templates = OrderedDict()
+        for seg, resis in homology_model.template_source.items():
+            seg_templates = []
+            for gn, temps in resis.items():
+                if temps[0]!=None and str(temps[0]) not in seg_templates:
+                    seg_templates.append(str(temps[0]))
+            if len(seg_templates)>0:
+                templates[seg] = seg_templates
+        return templates
+
+    def report_jobs(self, run_startTime):
+        ''' Print the outcome of the selected models and the throughput of this run.
+        '''
+        statuses = dict(self.jobs.values_list('status').annotate(count=Count('pk')))
+        print('Jobs: '+', '.join(['{} {}'.format(statuses.get(status, 0), status) for status, name in StructureModelJob.STATUSES]))
+        failed = self.jobs.filter(status=StructureModelJob.FAILED).select_related('protein')
+        if len(failed)==0 and statuses.get(StructureModelJob.PENDING, 0)==0 and statuses.get(StructureModelJob.RUNNING, 0)==0:
+            print('All models were run')
+        elif len(failed)>0:
+            print('Failed models (run again with --retry_failed):')
+            print(['{} {}'.format(j.protein.entry_name, j.state) for j in failed])
+
+        finished = self.jobs.filter(status=StructureModelJob.DONE, finished__gte=run_startTime, build_time__isnull=False)
+        stats = finished.aggregate(count=Count('pk'), build_time=Avg('build_time'), modeller_time=Avg('modeller_time'), modeller_total=Sum('modeller_time'))
+        if stats['count']>0:
+            hours = (timezone.now()-run_startTime).total_seconds()/3600
+            print('Built {} models in {:.1f} hours ({:.1f} models per hour), {:.0f} seconds per model of which MODELLER {:.0f} seconds'.format(
+                stats['count'], hours, stats['count']/hours, stats['build_time'], stats['modeller_time'] or 0))
+            main_templates = finished.exclude(main_template=None).values_list('main_template__pdb_code__index').annotate(count=Count('pk')).order_by('-count')
+            print('Main templates: '+', '.join(['{} ({})'.format(pdb, c) for pdb, c in main_templates[:10]]))
 
     def get_states_to_model(self, receptor):
         if self.force_main_temp and self.custom_selection:
@@ -305,6 +437,8 @@ class CallHomologyModeling():
         self.keep_hetatoms = keep_hetatoms
         self.no_remodeling = no_remodeling
         self.mutations = mutations
+        self.homology_model = None
+        self.error = ''
 
 
     def run(self, import_receptor=False, fast_refinement=False):
@@ -318,6 +452,7 @@ class CallHomologyModeling():
 
             Homology_model = HomologyModeling(self.receptor, self.state, [self.state], iterations=self.modeller_iterations, complex_model=self.complex, signprot=self.signprot, debug=self.debug,
                                               force_main_temp=self.force_main_temp, fast_refinement=fast_refinement, keep_hetatoms=self.keep_hetatoms, mutations=self.mutations)
+            self.homology_model = Homology_model
 
             if import_receptor:
                 ihm = ImportHomologyModel(self.receptor, self.signprot)
@@ -476,10 +611,10 @@ class CallHomologyModeling():
                 if self.debug:
                     print('{} homology model uploaded to db'.format(Homology_model.reference_entry_name))
 
-            with open('./structure/homology_models/done_models.txt','a') as f:
-                f.write(self.receptor+'\n')
+            return True
 
         except Exception as msg:
+            self.error = str(msg)
             try:
                 exc_type, exc_obj, exc_tb = sys.exc_info()
                 if self.debug:
@@ -507,14 +642,13 @@ class CallHomologyModeling():
                 elif 'No such residue:' in str(msg):
                     if self.debug:
                         t.pdb_pir_mismatch(Homology_model.main_pdb_array, Homology_model.model_sequence)
-                with open('./structure/homology_models/done_models.txt','a') as f:
-                    f.write(self.receptor+'\n')
             except:
                 try:
                     Protein.objects.get(entry_name=self.receptor)
                 except:
                     logger.error('Invalid receptor name: {}'.format(self.receptor))
                     print('Invalid receptor name: {}'.format(self.receptor))
+            return False
 
 
 class HomologyModeling(object):
@@ -552,6 +686,7 @@ class HomologyModeling(object):
         self.similarity_table_other_states = OrderedDict()
         self.main_structure = None
         self.signprot_complex = None
+        self.modeller_time = 0
         self.main_template_preferred_chain = ''
         self.loop_template_table = OrderedDict()
         self.loops = OrderedDict()
@@ -2780,7 +2915,9 @@ sequence:{uniprot}::::::::
         path = "./structure/homology_models/"
         if not os.path.exists(path):
             os.mkdir(path)
+        modeller_start = time.time()
         a.make()
+        self.modeller_time += time.time() - modeller_start
 
         # Get a list of all successfully built models from a.outputs
         ok_models = [x for x in a.outputs if x['failure'] is None]
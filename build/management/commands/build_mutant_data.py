@@ -81,6 +81,7 @@ class Command(BaseBuild):
             self.logger.info('CREATING MUTANT DATA')
             self.prepare_all_data(options['filename'])
             random.shuffle(self.data_all)
+            self.prefetch_publications()
             self.prepare_input(options['proc'], self.data_all)
             self.logger.info('COMPLETED CREATING MUTANTS')
 
@@ -353,6 +354,31 @@ class Command(BaseBuild):
                 self.data_all += rows
         print(len(self.data_all)," total data points")
 
+    @staticmethod
+    def clean_references(r):
+        try: #fix if it thinks it's float.
+            float(r['reference'])
+            r['reference'] = str(int(r['reference']))
+            float(r['review'])
+            r['review'] = str(int(r['review']))
+        except (ValueError, TypeError):
+            pass
+
+    def prefetch_publications(self):
+        """Resolve the publications of all references and reviews at once, before the rows are split over the
+        processes. References missing afterwards are still resolved one by one in main_func."""
+        identifiers = set()
+        for r in self.data_all:
+            self.clean_references(r)
+            identifiers.add(str(r['reference']))
+            review = str(r['review'])
+            if review.startswith("https://doi.org/"):
+                identifiers.add(review[len("https://doi.org/"):])
+            elif not review.startswith('http'):
+                identifiers.add(review)
+        self.publication_cache.update(Publication.resolve_many(identifiers))
+        self.logger.info('Resolved {} publications'.format(len(self.publication_cache)))
+
     #def create_mutant_data(self, filenames):
     def main_func(self, positions, iteration,count,lock):
         # filenames
@@ -388,13 +414,7 @@ class Command(BaseBuild):
             #     self.logger.info('Parsed '+str(c)+' mutant data entries')
             try:
                 # publication
-                try: #fix if it thinks it's float.
-                    float(r['reference'])
-                    r['reference'] = str(int(r['reference']))
-                    float(r['review'])
-                    r['review'] = str(int(r['review']))
-                except ValueError:
-                    pass
+                self.clean_references(r)
 
                 if r['reference'].isdigit(): #assume pubmed
                     pub_type = 'pubmed'
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.structure_export import StructureExport
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Export the structure table with ligands and signalling proteins for bulk downloads through the API"
+
+    def handle(self, *args, **options):
+        start = time.time()
+        StructureExport.build()
+        print("Built structure export in {:.1f} seconds".format(time.time() - start))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from common.template_store import TemplateIndex
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Build the template selection index used by build_homology_models"
+
+    def handle(self, *args, **options):
+        start = time.time()
+        TemplateIndex.build()
+        print("Built template index in {:.1f} seconds".format(time.time() - start))
@@ -8,8 +8,10 @@ from operator import itemgetter
 import numpy as np
 
 from alignment.functions import prepare_aa_group_preference
-from Bio.Align import substitution_matrices
+from common.alignment_store import AlignmentStore
 from common.definitions import *
+from common.similarity import SimilarityEngine
+from common.template_store import TemplateIndex
 from django.conf import settings
 from django.core.cache import cache, caches
 from django.db.models import Q
@@ -57,7 +59,6 @@ class Alignment:
         self.use_residue_groups = False
         self.ignore_alternative_residue_numbering_schemes = False # set to true if no numbering is to be displayed
         self.residues_to_delete = []
-        self.normalized_scores = OrderedDict()
         self.stats_done = False
         self.zscales = OrderedDict()
 
@@ -327,13 +328,21 @@ class Alignment:
     # AJK: point for optimization - primary bottleneck (#1 cleaning, #2 last for-loop in this function)
     def build_alignment(self):
         """Fetch selected residues from DB and build an alignment."""
-        # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
-        rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
-
+        # Use the precomputed residue store when it covers the selection (alternative numbering schemes are only
+        # available through the ORM)
+        store = AlignmentStore.load()
+        use_store = (store is not None and store.covers(self.proteins)
+                     and (self.ignore_alternative_residue_numbering_schemes or len(self.numbering_schemes) <= 1))
+
+        if use_store:
+            self.number_of_residues_total = store.count(self.proteins, self.segments)
+        else:
+            # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
+            rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
 
-        self.number_of_residues_total = len(rs)
-        if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
-            return "Too large"
+            self.number_of_residues_total = len(rs)
+            if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
+                return "Too large"
 
         # AJK: performance boost -> Internal caching (not for very small alignments)
         # AJK: note -> ideally we would have fully cached alignments and only select the relevant segments afterwards.
@@ -342,7 +351,9 @@ class Alignment:
         #cache_alignments.set(cache_key, 0, 0)
         if self.number_of_residues_total < 2500 or not cache_alignments.has_key(cache_key):
             # fetch segment residues
-            if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
+            if use_store:
+                rs = store.residues_in_segments(self.proteins, self.segments, self.segments_only_alignable)
+            elif not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
                 rs = Residue.objects.filter(
                     protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
                     'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
@@ -354,14 +365,17 @@ class Alignment:
                     'generic_number__scheme', 'display_generic_number__scheme')
 
             # If segment flagged to only include the alignable residues, exclude the ones with no GN
-            for s in self.segments_only_alignable:
-                rs = rs.exclude(protein_segment__slug=s, generic_number=None)
+            if not use_store:
+                for s in self.segments_only_alignable:
+                    rs = rs.exclude(protein_segment__slug=s, generic_number=None)
 
             # fetch individually selected residues (Custom segment)
             crs = {}
             for segment in self.segments:
                 if segment == self.custom_segment_label or self.use_residue_groups:
-                    if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
+                    if use_store:
+                        crs[segment] = store.residues_by_generic_number(self.proteins, self.segments[segment])
+                    elif not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
                         crs[segment] = Residue.objects.filter(
                             generic_number__label__in=self.segments[segment],
                             protein_conformation__in=self.proteins).prefetch_related(
@@ -1040,42 +1054,29 @@ class Alignment:
 
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference."""
+        engine = SimilarityEngine(self.proteins, self.gaps)
+
+        # calculate identity, similarity and similarity score to the reference
+        # normalized: removes columns where reference is gapped, gaps in templates are removed from the specific
+        # pairwise alignment
+        if normalized:
+            counts, self.residues_to_delete = engine.compare_to_normalized(0)
+        else:
+            counts = engine.compare_to(0)
+
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
             if i == 0:
                 continue
+            identity, similarity, similarity_score = self.format_similarity(counts[:, 0, i])
+            self.proteins[i].identity = identity
+            self.proteins[i].similarity = similarity
+            self.proteins[i].similarity_score = similarity_score
 
-            # calculate identity, similarity and similarity score to the reference
-            if not normalized:
-                calc_values = self.pairwise_similarity(self.proteins[0], self.proteins[i])
-                # update the protein
-                if calc_values:
-                    self.proteins[i].identity = calc_values[0]
-                    self.proteins[i].similarity = calc_values[1]
-                    self.proteins[i].similarity_score = calc_values[2]
-            else:
-                self.pairwise_similarity_normalized(self.proteins[0], self.proteins[i])
-
-        # calculate normalized identity, similarity and similarity score, removes columns where reference is gapped, gaps in templates are removed from the specific pairwise alignment
-        if normalized:
-            i = 1
-            for protein_2, values in self.normalized_scores.items():
-                for j in range(0, 3):
-                    for gn in list(values[j].keys()):
-                        if gn in self.residues_to_delete:
-                            del self.normalized_scores[protein_2][j][gn]
-                identities = list(self.normalized_scores[protein_2][0].values())
-                similarities = list(self.normalized_scores[protein_2][1].values())
-                similarity_scores = list(self.normalized_scores[protein_2][2].values())
-                identity = "{:10.0f}".format(sum(identities) / len(identities) * 100)
-                similarity = "{:10.0f}".format(sum(similarities) / len(similarities) * 100)
-                similarity_score = sum(similarity_scores)
-                self.proteins[i].identity = identity
-                self.proteins[i].similarity = similarity
-                self.proteins[i].similarity_score = similarity_score
-                i+=1
+        self.order_by_similarity()
 
-        # order protein list by similarity score
+    def order_by_similarity(self):
+        """Order the proteins (but the reference) by self.order_by and similarity score."""
         ref = self.proteins.pop(0)
         order_by_value = int(getattr(self.proteins[0], self.order_by))
         if order_by_value:
@@ -1083,7 +1084,7 @@ class Alignment:
             self.proteins.sort(key=lambda x: (getattr(x, self.order_by), getattr(x, "similarity_score")), reverse=True)
         self.proteins.insert(0, ref)
 
-    def calculate_similarity_matrix(self):
+    def calculate_similarity_matrix(self, processes=None):
         """Calculate a matrix of sequence identity/similarity for every selected protein."""
         # Init results matrix
         self.similarity_matrix = OrderedDict()
@@ -1092,6 +1093,9 @@ class Alignment:
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': [None] * len(self.proteins)}
 
+        # all pairwise comparisons in one go
+        counts = SimilarityEngine(self.proteins, self.gaps).all_pairs(processes)
+
         # similarity comparisons
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
@@ -1099,7 +1103,7 @@ class Alignment:
 
             for k in range(i+1, len(self.proteins)):
                 # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
+                calc_values = self.format_similarity(counts[:, i, k])
 
                 # Identity
                 value = calc_values[1].strip()
@@ -1213,32 +1217,12 @@ class Alignment:
 
     def pairwise_similarity(self, protein_1, protein_2):
         """Calculate the identity, similarity and similarity score between a pair of proteins."""
-        identityscore = 0
-        similarityscore = 0
-        totalcount = 0
-        totalsimilarity = 0
-        scoring_matrix = substitution_matrices.load("BLOSUM62")
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    totalcount += 1
-                    # identity
-                    if protein_residue == reference_residue:
-                        identityscore += 1
-
-                    # similarity
-                    if not (reference_residue in self.gaps or protein_residue in self.gaps):
-                        pair = (protein_residue, reference_residue)
-                        similarity = self.score_match(pair, scoring_matrix)
-                        totalsimilarity += similarity
-                        if similarity > 0:
-                            similarityscore += 1
-
-
-        # format the calculated values
-        #if identityscore and similarityscore:
+        counts = SimilarityEngine([protein_1, protein_2], self.gaps).compare_to(0)
+        return self.format_similarity(counts[:, 0, 1])
+
+    def format_similarity(self, counts):
+        """Format identity and similarity percentages from counts of identical, similar and compared positions."""
+        identityscore, similarityscore, totalsimilarity, totalcount = [int(x) for x in counts]
         if totalcount:
             identity = "{:10.0f}".format(identityscore / totalcount * 100)
             similarity = "{:10.0f}".format(similarityscore / totalcount * 100)
@@ -1250,54 +1234,19 @@ class Alignment:
             # NOTE returning F results in fatal errors. No aligned residues: return -1
             return "{:10.0f}".format(-1), "{:10.0f}".format(-1), 0
 
-    def pairwise_similarity_normalized(self, protein_1, protein_2):
-        """Calculate the identity, similarity and similarity score between a pair of proteins but delete gaps and normalize.
 
-        Used for finding closest receptor homologue with crystal structure.
-        """
-        identities = OrderedDict()
-        similarities = OrderedDict()
-        similarity_scores = OrderedDict()
-        ref_seq, temp_seq = '',''
-        scoring_matrix = substitution_matrices.load("BLOSUM62")
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                ref_seq+=reference_residue
-                temp_seq+=protein_residue
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    # identity
-                    if protein_residue == reference_residue:
-                        identities[p[0]] = 1
-                    else:
-                        identities[p[0]] = 0
-
-                    # similarity
-                    if reference_residue in self.gaps:
-                        if p[0] not in self.residues_to_delete:
-                            self.residues_to_delete.append(p[0])
-                    elif protein_residue in self.gaps:
-                        del identities[p[0]]
-                        pass
-                    else:
-                        pair = (protein_residue, reference_residue)
-                        similarity = self.score_match(pair, scoring_matrix)
-                        if similarity > 0:
-                            similarities[p[0]] = 1
-                        else:
-                            similarities[p[0]] = 0
-                        similarity_scores[p[0]] = similarity
-                else:
-                    if p[0] not in self.residues_to_delete:
-                        self.residues_to_delete.append(p[0])
-        self.normalized_scores[protein_2] = [identities, similarities, similarity_scores]
+class IndexedProtein:
+    """Stand-in for an aligned protein with its similarity to the reference read from the TemplateIndex."""
+    __slots__ = ('protein', 'identity', 'similarity', 'similarity_score')
 
-    def score_match(self, pair, matrix):
-        if pair not in matrix:
-            return matrix[(tuple(reversed(pair)))]
-        else:
-            return matrix[pair]
+    def __init__(self, protein, identity=None, similarity=None, similarity_score=None):
+        self.protein = protein
+        self.identity = identity
+        self.similarity = similarity
+        self.similarity_score = similarity_score
+
+    def __str__(self):
+        return self.protein.entry_name
 
 
 class AlignedReferenceTemplate(Alignment):
@@ -1344,14 +1293,19 @@ class AlignedReferenceTemplate(Alignment):
         if provide_main_template_structure==None and provide_similarity_table==None:
             self.query_states = query_states
             self.order_by = order_by
-            self.load_reference_protein(self.reference_protein)
-            if only_output_alignment!=None:
-                self.load_proteins([only_output_alignment])
+            # the template table of a model (not its alignment) is looked up in the template index when built
+            if (core_alignment==False and only_output_alignment==None and
+                    set(segments)==set(TemplateIndex.core_segments) and self.load_similarity_from_index()):
+                pass
             else:
-                self.load_proteins_by_structure()
-            self.load_segments(ProteinSegment.objects.filter(slug__in=segments))
-            self.build_alignment()
-            self.calculate_similarity()
+                self.load_reference_protein(self.reference_protein)
+                if only_output_alignment!=None:
+                    self.load_proteins([only_output_alignment])
+                else:
+                    self.load_proteins_by_structure()
+                self.load_segments(ProteinSegment.objects.filter(slug__in=segments))
+                self.build_alignment()
+                self.calculate_similarity()
             self.reference_protein = self.proteins[0]
             self.main_template_protein = None
             self.ordered_proteins = []
@@ -1393,6 +1347,30 @@ class AlignedReferenceTemplate(Alignment):
 
     def load_proteins_by_structure(self):
         """Loads proteins into alignment based on available structures in the database."""
+        self.load_proteins(self.template_proteins())
+
+    def load_similarity_from_index(self):
+        """Sets the proteins of the alignment, with their similarity to the reference, from the TemplateIndex
+        instead of aligning them. Returns False if the index does not cover the reference and its templates."""
+        index = TemplateIndex.load()
+        if index is None:
+            return False
+        # templates in the order of load_proteins
+        templates = sorted(set(self.template_proteins()), key=lambda p: (p.family.slug, p.entry_name))
+        counts = index.similarity_counts(self.reference_protein.entry_name, [p.entry_name for p in templates])
+        if counts is None:
+            return False
+
+        proteins = {}
+        for i, protein in enumerate(templates):
+            proteins[protein.pk] = IndexedProtein(protein, *self.format_similarity(counts[:, i]))
+        self.proteins = [proteins.get(self.reference_protein.pk, IndexedProtein(self.reference_protein))]
+        self.proteins += [proteins[p.pk] for p in templates]
+        self.order_by_similarity()
+        return True
+
+    def template_proteins(self):
+        """Proteins of the template structures of the reference, sets self.structures_data."""
         if self.reference_protein.family.parent.parent.parent.slug=='003':
             template_family = ProteinFamily.objects.get(slug='002')
         elif self.reference_protein.family.parent.parent.parent.slug=='007':
@@ -1415,8 +1393,8 @@ class AlignedReferenceTemplate(Alignment):
                 if main_st.protein_conformation.protein.parent.entry_name in self.main_temp_ban_list:
                     self.main_temp_ban_list.remove(main_st.protein_conformation.protein.parent.entry_name)
             self.structures_data = self.structures_data.exclude(protein_conformation__protein__parent__entry_name__in=self.main_temp_ban_list)
-        self.load_proteins(
-            [Protein.objects.get(id=target.protein_conformation.protein.parent.id) for target in self.structures_data])
+        return [target.protein_conformation.protein.parent for target in
+            self.structures_data.select_related('protein_conformation__protein__parent__family')]
 
     def get_main_template(self):
         """Returns main template structure after checking for matching helix start and end positions."""
@@ -1464,9 +1442,13 @@ class AlignedReferenceTemplate(Alignment):
         temp_list = []
         self.ordered_proteins = [self.proteins[0]]
         similarity_table = OrderedDict()
+        # template structures per protein, in one query
+        protein_structures = OrderedDict()
+        for structure in self.structures_data.select_related('protein_conformation__protein__parent', 'pdb_code'):
+            protein_structures.setdefault(structure.protein_conformation.protein.parent_id, []).append(structure)
         for protein in self.proteins:
             try:
-                matches = self.structures_data.filter(protein_conformation__protein__parent=protein.protein)
+                matches = protein_structures.get(protein.protein.pk, [])
                 for m in matches:
                     if m.protein_conformation.protein.parent==self.reference_protein.protein and int(protein.similarity)==0:
                         continue
@@ -1599,8 +1581,8 @@ class AlignedReferenceTemplate(Alignment):
                                                       display_generic_number__label=dgn(first_after_gn,
                                                                                         struct.protein_conformation))
                     temp_length = alt_first_gn.sequence_number-alt_last_gn.sequence_number-1
-                    alt_seq = Residue.objects.filter(protein_conformation=struct.protein_conformation, protein_segment__slug=self.segment_labels[0])
                     if self.segment_labels[0]=='ECL2' and ref_ECL2!=None:
+                        alt_seq = Residue.objects.filter(protein_conformation=struct.protein_conformation, protein_segment__slug=self.segment_labels[0])
                         alt_ECL2 = self.ECL2_slicer(alt_seq)
                         alt_rota = [x for x in Rotamer.objects.filter(structure=struct, residue__in=alt_ECL2[1]) if x.pdbdata.pdb.startswith('COMPND')==False]
                         if len(alt_rota)==3:
@@ -1617,7 +1599,7 @@ class AlignedReferenceTemplate(Alignment):
                         elif len(ref_ECL2[0])!=len(alt_ECL2[0]) and len(ref_ECL2[2])!=len(alt_ECL2[2]):
                             temp_length1 = -1
                             temp_length2 = -1
-                    elif len(ref_seq)!=len(alt_seq):
+                    elif len(ref_seq)!=self.segment_length(struct, self.segment_labels[0]):
                         continue
                     before_nums = list(range(alt_last_gn.sequence_number-3, alt_last_gn.sequence_number+1))
                     after_nums = list(range(alt_first_gn.sequence_number, alt_first_gn.sequence_number+4))
@@ -1656,14 +1638,8 @@ class AlignedReferenceTemplate(Alignment):
         alt_temps_gn = []
         if self.segment_labels[0]!='ECL2' or self.segment_labels[0]=='ECL2' and x50_ref==True:
             for entry in temp_list:
-                res_list = [i for i in list(Residue.objects.filter(protein_conformation=entry[0].protein_conformation,
-                                                                   protein_segment__slug=self.segment_labels[0]))]
-                for i in res_list:
-                    try:
-                        if i.generic_number.label[-3:]=='x50' and x50_ref==True:
-                            alt_temps_gn.append(entry)
-                    except:
-                        pass
+                if x50_ref==True:
+                    alt_temps_gn += [entry] * self.segment_length(entry[0], self.segment_labels[0], x50=True)
 
         alt_temps = [entry for entry in temp_list if entry[1]==len(ref_seq)]
         sorted_list_gn = sorted(alt_temps_gn, key=lambda x: (-x[2],-x[5],x[3]))
@@ -1703,6 +1679,21 @@ class AlignedReferenceTemplate(Alignment):
             return None
         return similarity_table
 
+    def segment_length(self, structure, segment, x50=False):
+        """Number of residues (or of x50 residues) of a segment of a template structure, from the TemplateIndex
+        when it has been built."""
+        index = TemplateIndex.load()
+        length = index.segment_length(structure.protein_conformation, segment, x50) if index else None
+        if length is None:
+            residues = Residue.objects.filter(protein_conformation=structure.protein_conformation,
+                                              protein_segment__slug=segment)
+            if x50:
+                length = len([r for r in residues.select_related('generic_number')
+                              if r.generic_number and r.generic_number.label[-3:]=='x50'])
+            else:
+                length = residues.count()
+        return length
+
     def ECL2_slicer(self, queryset):
         x50 = queryset.get(generic_number__label='45x50').sequence_number
         queryset_l = list(queryset)
@@ -1871,7 +1862,7 @@ class GProteinAlignment(Alignment):
 
 
 class ClosestReceptorHomolog():
-    """Finds the closest receptor homolog that has a structure. Uses the pairwise_similarity_normalized function that deletes gaps."""
+    """Finds the closest receptor homolog that has a structure. Uses the normalized similarity calculation that deletes gaps."""
     def __init__(self, protein, protein_segments=['TM1','TM2','TM3','TM4','TM5','TM6','TM7','H8'], normalized=True):
         self.protein = protein
         self.protein_segments = protein_segments
@@ -0,0 +1,185 @@
+import logging
+import os
+
+import numpy as np
+
+from django.conf import settings
+from protein.models import ProteinSegment
+from residue.models import Residue, ResidueGenericNumber
+
+
+# one packed record per residue, sorted by protein conformation and sequence number
+RESIDUE_DTYPE = np.dtype([
+    ('protein_conformation', 'i4'),
+    ('sequence_number', 'i4'),
+    ('amino_acid', 'S1'),
+    ('protein_segment', 'i4'),
+    ('generic_number', 'i4'),
+    ('display_generic_number', 'i4'),
+])
+
+
+class StoredResidue:
+    """Lightweight stand-in for a Residue object, as used by Alignment.build_alignment."""
+    __slots__ = ('protein_conformation', 'protein_segment', 'generic_number', 'display_generic_number',
+                 'sequence_number', 'amino_acid')
+
+    def __init__(self, protein_conformation, protein_segment, generic_number, display_generic_number,
+                 sequence_number, amino_acid):
+        self.protein_conformation = protein_conformation
+        self.protein_segment = protein_segment
+        self.generic_number = generic_number
+        self.display_generic_number = display_generic_number
+        self.sequence_number = sequence_number
+        self.amino_acid = amino_acid
+
+    def __str__(self):
+        return self.amino_acid + str(self.sequence_number)
+
+
+class AlignmentStore:
+    """Memory-mapped columnar copy of the residue table, regenerated by build_consensus_sequences.
+
+    Residues of each protein conformation are stored as one contiguous slice of a packed array, so alignments
+    for any protein/segment selection can be assembled by slicing instead of querying the Residue table.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'alignment_store'])
+    residues_file = 'residues.npy'
+    index_file = 'index.npz'
+
+    # loaded store is shared by all alignments within a process and reloaded when the files are rebuilt
+    _instance = None
+
+    logger = logging.getLogger('build')
+
+    def __init__(self, residues, protein_conformations, offsets):
+        self.residues = residues
+        self.protein_conformations = protein_conformations
+        self.offsets = offsets
+        self.slice_lookup = {int(pc): (int(offsets[i]), int(offsets[i+1]))
+            for i, pc in enumerate(protein_conformations)}
+        self.segments = {s.pk: s for s in ProteinSegment.objects.all()}
+        self.segment_ids = {}
+        for s in self.segments.values():
+            self.segment_ids.setdefault(s.slug, []).append(s.pk)
+
+    @classmethod
+    def build(cls, store_dir=None):
+        """Dump all residues into the packed store, replacing a previous version."""
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        rs = Residue.objects.order_by('protein_conformation_id', 'sequence_number').values_list(
+            'protein_conformation_id', 'sequence_number', 'amino_acid', 'protein_segment_id', 'generic_number_id',
+            'display_generic_number_id')
+        num_residues = rs.count()
+
+        residues_path = os.sep.join([store_dir, cls.residues_file])
+        tmp_residues_path = residues_path + '.tmp'
+        residues = np.lib.format.open_memmap(tmp_residues_path, mode='w+', dtype=RESIDUE_DTYPE,
+            shape=(num_residues,))
+
+        protein_conformations = []
+        offsets = []
+        i = 0
+        for pc, sequence_number, amino_acid, segment, gn, dgn in rs.iterator(chunk_size=100000):
+            if not protein_conformations or protein_conformations[-1] != pc:
+                protein_conformations.append(pc)
+                offsets.append(i)
+            residues[i] = (pc, sequence_number, amino_acid.encode('ascii', 'replace') if amino_acid else b'-',
+                segment if segment else -1, gn if gn else -1, dgn if dgn else -1)
+            i += 1
+        offsets.append(i)
+        residues.flush()
+        del residues
+
+        index_path = os.sep.join([store_dir, cls.index_file])
+        tmp_index_path = index_path + '.tmp'
+        with open(tmp_index_path, 'wb') as f:
+            np.savez(f, protein_conformations=np.array(protein_conformations, dtype='i4'),
+                offsets=np.array(offsets, dtype='i8'))
+
+        os.replace(tmp_residues_path, residues_path)
+        os.replace(tmp_index_path, index_path)
+        cls.logger.info('Stored {} residues of {} protein conformations in {}'.format(num_residues,
+            len(protein_conformations), store_dir))
+
+    @classmethod
+    def load(cls, store_dir=None):
+        """Return the shared store, or None if it has not been built."""
+        store_dir = store_dir or cls.store_dir
+        residues_path = os.sep.join([store_dir, cls.residues_file])
+        index_path = os.sep.join([store_dir, cls.index_file])
+        try:
+            mtime = max(os.path.getmtime(residues_path), os.path.getmtime(index_path))
+        except OSError:
+            return None
+
+        if cls._instance is None or cls._instance[0] != (store_dir, mtime):
+            try:
+                residues = np.load(residues_path, mmap_mode='r')
+                with np.load(index_path) as index:
+                    protein_conformations = index['protein_conformations']
+                    offsets = index['offsets']
+            except (OSError, ValueError, KeyError):
+                return None
+
+            # files replaced halfway through a rebuild
+            if len(offsets) == 0 or offsets[-1] != len(residues):
+                return None
+            cls._instance = ((store_dir, mtime), cls(residues, protein_conformations, offsets))
+
+        return cls._instance[1]
+
+    def covers(self, protein_conformations):
+        """Check whether all protein conformations are in the store."""
+        return all(pc.pk in self.slice_lookup for pc in protein_conformations)
+
+    def _select(self, protein_conformations, segment_slugs=None, generic_number_ids=None, only_alignable=[]):
+        """Slice the records of the selected conformations and filter them on segment or generic number."""
+        chunks = []
+        for pc in protein_conformations:
+            start, end = self.slice_lookup[pc.pk]
+            chunks.append(self.residues[start:end])
+        if not chunks:
+            return np.empty(0, dtype=RESIDUE_DTYPE)
+        records = np.concatenate(chunks)
+
+        if segment_slugs is not None:
+            segment_ids = [i for slug in segment_slugs for i in self.segment_ids.get(slug, [])]
+            mask = np.isin(records['protein_segment'], segment_ids)
+            alignable_ids = [i for slug in only_alignable for i in self.segment_ids.get(slug, [])]
+            if alignable_ids:
+                mask &= ~(np.isin(records['protein_segment'], alignable_ids) & (records['generic_number'] < 0))
+            records = records[mask]
+        if generic_number_ids is not None:
+            records = records[np.isin(records['generic_number'], list(generic_number_ids))]
+
+        return records
+
+    def count(self, protein_conformations, segment_slugs):
+        """Number of residues in the selected conformations and segments."""
+        return len(self._select(protein_conformations, segment_slugs))
+
+    def residues_in_segments(self, protein_conformations, segment_slugs, only_alignable=[]):
+        """Residues of the selected conformations and segments, in the same order as the Residue table."""
+        records = self._select(protein_conformations, segment_slugs, only_alignable=only_alignable)
+        return self._rehydrate(protein_conformations, records)
+
+    def residues_by_generic_number(self, protein_conformations, labels):
+        """Residues of the selected conformations with a generic number in labels."""
+        gn_ids = ResidueGenericNumber.objects.filter(label__in=labels).values_list('pk', flat=True)
+        records = self._select(protein_conformations, generic_number_ids=set(gn_ids))
+        return self._rehydrate(protein_conformations, records)
+
+    def _rehydrate(self, protein_conformations, records):
+        pcs = {pc.pk: pc for pc in protein_conformations}
+        gn_ids = np.union1d(records['generic_number'], records['display_generic_number'])
+        gns = ResidueGenericNumber.objects.filter(pk__in=[int(i) for i in gn_ids if i >= 0]).select_related(
+            'scheme', 'protein_segment').in_bulk()
+
+        residues = []
+        for pc, sequence_number, amino_acid, segment, gn, dgn in records.tolist():
+            residues.append(StoredResidue(pcs[pc], self.segments.get(segment), gns.get(gn), gns.get(dgn),
+                sequence_number, amino_acid.decode('ascii')))
+        return residues
@@ -0,0 +1,331 @@
+"""Two-level cache backend: a per-process LRU in front of a shared, sharded store on disk.
+
+Configured in settings.CACHES, e.g.
+
+    'default': {
+        'BACKEND': 'common.cache.TieredCache',
+        'LOCATION': '/tmp/django_cache',
+        'OPTIONS': {'SHARDS': 16, 'MAX_BYTES': 8 * 2**30, 'LOCAL_MAX_BYTES': 128 * 2**20},
+    }
+
+The shared store is a set of SQLite databases (one per shard) in LOCATION, which all processes of the site read
+and write. Values are pickled and compressed (zstd or lz4 when installed, zlib otherwise) and stored under
+versioned keys. Recently used values are also kept in a per-process LRU bounded by their pickled size; as other
+processes may change the shared store, local copies are only trusted for LOCAL_TIMEOUT seconds. The access time
+of shared entries, which the least recently used ones are culled by, is only written when it is older than
+ACCESS_INTERVAL seconds, so reads of hot keys do not all write to the store.
+"""
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from collections import OrderedDict
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# stored value layout version, bumped when the serialization changes so old entries are ignored
+FORMAT_VERSION = 1
+
+
+class Codec:
+    """Compression of pickled values, tagged with one byte so any codec can read back what another wrote."""
+    NONE, ZLIB, ZSTD, LZ4 = b'n', b'z', b's', b'l'
+
+    def __init__(self, name=None, min_size=1024):
+        if name is None:
+            name = 'zstd' if zstandard is not None else 'lz4' if lz4 is not None else 'zlib'
+        if (name == 'zstd' and zstandard is None) or (name == 'lz4' and lz4 is None):
+            raise ValueError('Cache compressor {} is not installed'.format(name))
+        self.name = name
+        self.min_size = min_size
+
+    def compress(self, data):
+        if len(data) < self.min_size:
+            return self.NONE + data
+        if self.name == 'zstd':
+            return self.ZSTD + zstandard.ZstdCompressor(level=3).compress(data)
+        if self.name == 'lz4':
+            return self.LZ4 + lz4.frame.compress(data)
+        return self.ZLIB + zlib.compress(data, 3)
+
+    def decompress(self, data):
+        tag, data = data[:1], data[1:]
+        if tag == self.NONE:
+            return data
+        if tag == self.ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data)
+        if tag == self.LZ4:
+            return lz4.frame.decompress(data)
+        if tag == self.ZLIB:
+            return zlib.decompress(data)
+        raise ValueError('Unknown cache compression tag {!r}'.format(tag))
+
+
+class LocalLRU:
+    """Thread-safe LRU of pickled values, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, data, expires):
+        if len(data) > self.max_bytes // 4:
+            # large values only live in the shared store
+            self.delete(key)
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (expires, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= len(entry[1])
+        return True
+
+
+class SharedStore:
+    """Size-bounded key-value store in a set of SQLite databases, shared by all processes."""
+
+    schema = 'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL, ' \
+        'size INTEGER NOT NULL, accessed REAL NOT NULL)'
+
+    # check the shard size after writing this fraction of its maximum size
+    cull_fraction = 0.05
+
+    def __init__(self, location, shards, max_bytes, access_interval=60):
+        self.location = location
+        self.shards = shards
+        self.max_shard_bytes = max_bytes // shards
+        self.access_interval = access_interval
+        self.local = threading.local()
+        self.written = [0] * shards
+
+    def shard(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % self.shards
+
+    def connection(self, shard):
+        # connections can not be shared by threads or inherited by forked processes
+        connections = getattr(self.local, 'connections', None)
+        if connections is None or self.local.pid != os.getpid():
+            connections = self.local.connections = {}
+            self.local.pid = os.getpid()
+        if shard not in connections:
+            os.makedirs(self.location, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.location, 'shard_{:02d}.sqlite'.format(shard)), timeout=30,
+                isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA mmap_size=268435456')
+            connection.execute(self.schema)
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            connections[shard] = connection
+        return connections[shard]
+
+    def get(self, key):
+        shard = self.shard(key)
+        row = self.connection(shard).execute('SELECT value, expires, accessed FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None, None
+        value, expires, accessed = row
+        now = time.time()
+        if expires is not None and expires <= now:
+            self.delete(key)
+            return None, None
+        if accessed <= now - self.access_interval:
+            # culling only needs the access order to within the interval
+            self.connection(shard).execute('UPDATE cache SET accessed = ? WHERE key = ? AND accessed <= ?',
+                (now, key, now - self.access_interval))
+        return value, expires
+
+    def set(self, key, value, expires, only_new=False):
+        shard = self.shard(key)
+        connection = self.connection(shard)
+        now = time.time()
+        if only_new:
+            connection.execute('DELETE FROM cache WHERE key = ? AND expires IS NOT NULL AND expires <= ?', (key, now))
+            added = connection.execute('INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?, ?)',
+                (key, value, expires, len(value), now)).rowcount == 1
+        else:
+            connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)', (key, value, expires, len(value), now))
+            added = True
+
+        self.written[shard] += len(value)
+        if self.written[shard] >= self.max_shard_bytes * self.cull_fraction:
+            self.written[shard] = 0
+            self.cull(shard)
+        return added
+
+    def touch(self, key, expires):
+        return self.connection(self.shard(key)).execute('UPDATE cache SET expires = ? WHERE key = ?',
+            (expires, key)).rowcount == 1
+
+    def delete(self, key):
+        return self.connection(self.shard(key)).execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount == 1
+
+    def clear(self):
+        for shard in range(self.shards):
+            self.connection(shard).execute('DELETE FROM cache')
+
+    def cull(self, shard):
+        """Drop expired entries, then the least recently used ones until the shard is below 90% of its size."""
+        connection = self.connection(shard)
+        connection.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+        size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if size <= self.max_shard_bytes:
+            return
+        target = size - int(self.max_shard_bytes * 0.9)
+        removed = 0
+        keys = []
+        for key, entry_size in connection.execute('SELECT key, size FROM cache ORDER BY accessed'):
+            keys.append((key,))
+            removed += entry_size
+            if removed >= target:
+                break
+        connection.executemany('DELETE FROM cache WHERE key = ?', keys)
+
+
+class TieredCache(BaseCache):
+    """Django cache backend combining a per-process LocalLRU with a SharedStore, see the module documentation."""
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.local = LocalLRU(options.get('LOCAL_MAX_BYTES', 64 * 2**20))
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 60)
+        self.shared = SharedStore(location, options.get('SHARDS', 8), options.get('MAX_BYTES', 4 * 2**30),
+            options.get('ACCESS_INTERVAL', 60))
+        self.codec = Codec(options.get('COMPRESSOR'), options.get('COMPRESS_MIN_SIZE', 1024))
+        self.pickle_protocol = pickle.HIGHEST_PROTOCOL
+        self.metrics_lock = threading.Lock()
+        self.metrics = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'sets': 0}
+
+    def make_key(self, key, version=None):
+        # the storage format version is part of every key
+        return 'v{}:{}'.format(FORMAT_VERSION, super().make_key(key, version))
+
+    def count(self, metric):
+        with self.metrics_lock:
+            self.metrics[metric] += 1
+
+    def stats(self):
+        """Hit and miss counts of this process, with the overall hit rate."""
+        with self.metrics_lock:
+            stats = dict(self.metrics)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else None
+        return stats
+
+    def local_expiry(self, expires):
+        local_expires = time.time() + self.local_timeout
+        return local_expires if expires is None else min(expires, local_expires)
+
+    def _get(self, key):
+        """Pickled value for a full key, or None."""
+        data = self.local.get(key)
+        if data is not None:
+            self.count('local_hits')
+            return data
+        value, expires = self.shared.get(key)
+        if value is None:
+            self.count('misses')
+            return None
+        self.count('shared_hits')
+        data = self.codec.decompress(value)
+        self.local.set(key, data, self.local_expiry(expires))
+        return data
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data = self._get(key)
+        if data is None:
+            return default
+        return pickle.loads(data)
+
+    def _set(self, key, value, timeout, only_new=False):
+        data = pickle.dumps(value, self.pickle_protocol)
+        expires = self.get_backend_timeout(timeout)
+        if expires is not None and expires <= time.time():
+            # a timeout of zero or less expires the key right away
+            self.local.delete(key)
+            self.shared.delete(key)
+            return False
+        added = self.shared.set(key, self.codec.compress(data), expires, only_new=only_new)
+        if added:
+            self.local.set(key, data, self.local_expiry(expires))
+            self.count('sets')
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._set(key, value, timeout, only_new=True)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.local.delete(key)
+        return self.shared.touch(key, self.get_backend_timeout(timeout))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.local.delete(key)
+        return self.shared.delete(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._get(key) is not None
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
@@ -0,0 +1,215 @@
+from django.conf import settings
+from django.db import connection
+from django.utils.safestring import mark_safe
+
+from common.diagrams_arrestin import DrawArrestinPlot
+from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
+from common.diagrams_gprotein import DrawGproteinPlot
+
+from collections import namedtuple, OrderedDict
+from multiprocessing import Pool
+
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+
+# bumped when the diagram code changes, so all diagrams are rendered again
+RENDER_VERSION = 1
+
+# diagram variants and the arguments they are drawn with
+VARIANTS = OrderedDict([
+    ('snakeplot', (DrawSnakePlot, {})),
+    ('snakeplot_nobuttons', (DrawSnakePlot, {'nobuttons': 1})),
+    ('helixbox', (DrawHelixBox, {})),
+    ('helixbox_nobuttons', (DrawHelixBox, {'nobuttons': 1})),
+    ('gprotein', (DrawGproteinPlot, {})),
+    ('arrestin', (DrawArrestinPlot, {})),
+])
+
+# residue data the diagrams are drawn from, in place of Residue objects
+DiagramSegment = namedtuple('DiagramSegment', ['slug', 'category'])
+DiagramLabel = namedtuple('DiagramLabel', ['label'])
+DiagramResidue = namedtuple('DiagramResidue', ['sequence_number', 'amino_acid', 'protein_segment', 'generic_number',
+    'display_generic_number'])
+
+
+def diagram_variants(family_slug):
+    """Diagrams shown for a protein: G proteins (100) and arrestins (200) have their own, all others are receptors."""
+    if family_slug.startswith('100'):
+        return ['gprotein']
+    if family_slug.startswith('200'):
+        return ['arrestin']
+    return ['snakeplot', 'snakeplot_nobuttons', 'helixbox', 'helixbox_nobuttons']
+
+
+def residue_hash(entry_name, protein_class, residues):
+    """Hash of everything a diagram of the protein is drawn from."""
+    data = [RENDER_VERSION, entry_name, protein_class, [[r.sequence_number, r.amino_acid,
+        list(r.protein_segment) if r.protein_segment else None, r.generic_number.label if r.generic_number else None,
+        r.display_generic_number.label if r.display_generic_number else None] for r in residues]]
+    return hashlib.md5(json.dumps(data, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def render_diagrams(item):
+    """Draw and compress the diagram variants of one protein (run in the worker processes of DiagramStore.build)."""
+    key, entry_name, protein_class, residues, variants = item
+    blobs = {}
+    errors = []
+    for variant in variants:
+        diagram_class, kwargs = VARIANTS[variant]
+        try:
+            svg = str(diagram_class(residues, protein_class, entry_name, **kwargs))
+        except Exception as msg:
+            # left out of the store, so the page draws (and reports) it as before
+            errors.append('{} {}: {}'.format(entry_name, variant, msg))
+            continue
+        blobs[variant] = zlib.compress(svg.encode('utf-8'), 6)
+    return key, blobs, errors
+
+
+class DiagramStore:
+    """Prerendered protein diagrams (snake plots, helix boxes, G protein and arrestin plots), written by
+    build_diagram_store.
+
+    Diagrams are compressed and packed into one file, keyed by a hash of the residue data they were drawn from, so
+    a rebuild only draws the proteins whose residues changed.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'diagrams'])
+    blobs_file = 'diagrams.bin'
+    index_file = 'index.json'
+
+    _instance = None
+
+    logger = logging.getLogger('build')
+
+    def __init__(self, blobs_path, proteins, blobs):
+        self.blobs_path = blobs_path
+        self.proteins = proteins
+        self.blobs = blobs
+
+    @classmethod
+    def diagram_residues(cls, proteins):
+        """Residue data of the given proteins (id: entry name), as lists of DiagramResidue in sequence order."""
+        from residue.models import Residue
+
+        residues = {pk: [] for pk in proteins}
+        for values in Residue.objects.filter(protein_conformation__protein__in=list(proteins)) \
+                .order_by('sequence_number').values_list('protein_conformation__protein_id', 'sequence_number',
+                'amino_acid', 'protein_segment__slug', 'protein_segment__category', 'generic_number__label',
+                'display_generic_number__label').iterator(chunk_size=10000):
+            pk, sequence_number, amino_acid, segment_slug, category, generic_number, display_generic_number = values
+            residues[pk].append(DiagramResidue(sequence_number, amino_acid,
+                DiagramSegment(segment_slug, category) if segment_slug is not None else None,
+                DiagramLabel(generic_number) if generic_number is not None else None,
+                DiagramLabel(display_generic_number) if display_generic_number is not None else None))
+        return residues
+
+    @classmethod
+    def build(cls, store_dir=None, proc=1, chunk_size=200):
+        """Render the diagrams of all proteins with residues, reusing unchanged ones of a previous version."""
+        from protein.models import Protein, ProteinFamily
+
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        blobs_path = os.sep.join([store_dir, cls.blobs_file])
+        index_path = os.sep.join([store_dir, cls.index_file])
+
+        previous = cls.load(store_dir)
+
+        # protein classes (the families just below the root) without a query per protein
+        families = {pk: (parent, name) for pk, parent, name in ProteinFamily.objects.values_list('pk', 'parent_id', 'name')}
+        def protein_class(family):
+            while families[families[family][0]][0] is not None:
+                family = families[family][0]
+            return families[family][1]
+
+        proteins = list(Protein.objects.filter(proteinconformation__residue__isnull=False).distinct() \
+            .order_by('entry_name').values_list('pk', 'entry_name', 'family_id', 'family__slug'))
+
+        index = {}
+        blobs = {}
+        reused = rendered = 0
+        # the worker processes only draw, they do not use the database connection of this one
+        connection.close()
+        with open(blobs_path + '.tmp', 'wb') as f, Pool(proc) as pool:
+            def store(key, variant_blobs):
+                blobs[key] = {}
+                for variant, blob in variant_blobs.items():
+                    blobs[key][variant] = [f.tell(), len(blob)]
+                    f.write(blob)
+
+            for start in range(0, len(proteins), chunk_size):
+                chunk = proteins[start:start+chunk_size]
+                residues = cls.diagram_residues({pk: entry_name for pk, entry_name, family, slug in chunk})
+
+                items = []
+                for pk, entry_name, family, slug in chunk:
+                    klass = protein_class(family)
+                    key = residue_hash(entry_name, klass, residues[pk])
+                    index[entry_name] = key
+                    if key in blobs:
+                        continue
+                    if previous is not None and key in previous.blobs:
+                        store(key, {variant: previous.read(key, variant) for variant in previous.blobs[key]})
+                        reused += 1
+                    else:
+                        items.append((key, entry_name, klass, residues[pk], diagram_variants(slug)))
+
+                for key, variant_blobs, errors in pool.imap_unordered(render_diagrams, items):
+                    store(key, variant_blobs)
+                    rendered += 1
+                    for error in errors:
+                        cls.logger.warning('Could not draw diagram of {}'.format(error))
+
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'proteins': index, 'blobs': blobs}, f)
+
+        os.replace(blobs_path + '.tmp', blobs_path)
+        os.replace(index_path + '.tmp', index_path)
+        cls.logger.info('Stored diagrams of {} proteins in {} ({} drawn, {} reused)'.format(len(index), store_dir,
+            rendered, reused))
+
+    @classmethod
+    def load(cls, store_dir=None):
+        """Return the shared store, or None if it has not been built."""
+        store_dir = store_dir or cls.store_dir
+        blobs_path = os.sep.join([store_dir, cls.blobs_file])
+        index_path = os.sep.join([store_dir, cls.index_file])
+        try:
+            mtime = max(os.path.getmtime(blobs_path), os.path.getmtime(index_path))
+        except OSError:
+            return None
+
+        if cls._instance is None or cls._instance[0] != (store_dir, mtime):
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                return None
+            cls._instance = ((store_dir, mtime), cls(blobs_path, index['proteins'], index['blobs']))
+
+        return cls._instance[1]
+
+    def covers(self, entry_name, variant):
+        key = self.proteins.get(entry_name)
+        return key is not None and variant in self.blobs[key]
+
+    def read(self, key, variant):
+        offset, length = self.blobs[key][variant]
+        with open(self.blobs_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get(self, entry_name, variant):
+        return mark_safe(zlib.decompress(self.read(self.proteins[entry_name], variant)).decode('utf-8'))
+
+
+def get_diagram(protein, variant):
+    """Diagram of a protein from the store when available, None otherwise."""
+    store = DiagramStore.load()
+    if store is not None and store.covers(protein.entry_name, variant):
+        return store.get(protein.entry_name, variant)
+    return None
@@ -1,5 +1,60 @@
 ﻿from math import cos, sin, tan, pi, sqrt, pow
 import string, time, math, random
+from bisect import bisect_right
+from functools import lru_cache
+
+import numpy as np
+
+@lru_cache(maxsize=16)
+def bezier_steps(step):
+    """Curve positions 0, step, 2*step, ... up to 1, accumulated as in a stepping loop (plus the first one past 1)."""
+    positions = []
+    pos = 0
+    while pos <= 1:
+        positions.append(pos)
+        pos += step
+    positions.append(pos)
+    return positions
+
+@lru_cache(maxsize=256)
+def _bezier_samples(p0,p1,p2,step,p3,p4):
+    t = np.array(bezier_steps(step)[:-1], dtype=float)
+
+    def bezier(p0,p1,p2):
+        i1 = [p0[0]+(p1[0]-p0[0])*t,p0[1]+(p1[1]-p0[1])*t]
+        i2 = [p1[0]+(p2[0]-p1[0])*t,p1[1]+(p2[1]-p1[1])*t]
+        return [i1[0]+(i2[0]-i1[0])*t,i1[1]+(i2[1]-i1[1])*t]
+
+    def bezier_high(p0,p1,p2,p3):
+        i1 = bezier(p0,p1,p2)
+        i2 = bezier(p1,p2,p3)
+        return [i1[0]+(i2[0]-i1[0])*t,i1[1]+(i2[1]-i1[1])*t]
+
+    if p3 is None:
+        xy = bezier(p0,p1,p2)
+    elif p4 is None:
+        xy = bezier_high(p0,p1,p2,p3)
+    else:
+        i1 = bezier_high(p0,p1,p2,p3)
+        i2 = bezier_high(p1,p2,p3,p4)
+        xy = [i1[0]+(i2[0]-i1[0])*t,i1[1]+(i2[1]-i1[1])*t]
+
+    # length along the curve before each sample, accumulated in order
+    dx = np.diff(xy[0], prepend=p0[0])
+    dy = np.diff(xy[1], prepend=p0[1])
+    lengths = np.concatenate([[0], np.cumsum(np.sqrt(dx**2 + dy**2))]).tolist()
+
+    return bezier_steps(step), xy[0].tolist(), xy[1].tolist(), lengths
+
+def bezier_samples(p0,p1,p2,step,p3=False,p4=False):
+    """
+    Points and lengths along a (quadratic to quartic) Bezier curve, sampled at each step of its position.
+
+    All samples are computed at once, the curves are cached as the same ones are walked for every residue on them.
+    """
+    p3 = None if p3==False else tuple(p3)
+    p4 = None if p4==False or p3 is None else tuple(p4)
+    return _bezier_samples(tuple(p0),tuple(p1),tuple(p2),step,p3,p4)
 
 def uniqid(prefix='', more_entropy=False):
     m = time.time()
@@ -208,33 +263,13 @@ class Diagram:
     def lengthbezier(self,p0,p1,p2,step,p3=False,p4=False):
         #https://en.wikipedia.org/wiki/B%C3%A9zier_curve
 
-        pos = 0
-        length = 0
-        p = p0
-        while pos <= 1:
+        positions, xs, ys, lengths = bezier_samples(p0,p1,p2,step,p3,p4)
 
-
-            if p3==False:
-                xy = self.bezier(p0,p1,p2,pos)
-            elif p4==False:
-                xy = self.bezier_high(p0,p1,p2,p3,pos)
-            elif p4!=False:
-                xy = self.bezier_high2(p0,p1,p2,p3,p4,pos)
-
-            length += math.sqrt( (xy[0]-p[0])**2 + (xy[1]-p[1])**2 )
-            p = xy
-            pos += step
-
-        return round(length)
+        return round(lengths[-1])
 
     def wherebezier(self,p0,p1,p2,step,stop,p3=False,p4=False):
         #https://en.wikipedia.org/wiki/B%C3%A9zier_curve
 
-        pos = 0
-        length = 0
-        p = p0
-        xy = [0,0]
-
         if stop<0:
             if p3==False:
                 stop = self.lengthbezier(p0,p1,p2,step)+stop
@@ -243,23 +278,14 @@ class Diagram:
             else:
                 stop = self.lengthbezier(p0,p1,p2,step,p3)+stop
 
-        while pos <= 1:
-
-            if length>stop: #stop if it reached the length along the line
-                break
-
-            if p3==False:
-                xy = self.bezier(p0,p1,p2,pos)
-            elif p4==False:
-                xy = self.bezier_high(p0,p1,p2,p3,pos)
-            else:
-                xy = self.bezier_high2(p0,p1,p2,p3,p4,pos)
+        positions, xs, ys, lengths = bezier_samples(p0,p1,p2,step,p3,p4)
 
-            length += math.sqrt( (xy[0]-p[0])**2 + (xy[1]-p[1])**2 )
-            p = xy
-            pos += step
+        # first sample at which the length along the curve exceeds stop, the point before it is returned
+        i = bisect_right(lengths, stop, 0, len(positions)-1)
+        if i == 0:
+            return positions[0],[0,0]
 
-        return pos,xy
+        return positions[i],[xs[i-1],ys[i-1]]
 
 
     #find slope and y-intercept of a line through two points
@@ -1,11 +1,148 @@
 from django.conf import settings
-from django.db import connection
+from django.core.cache import caches
+from django.db import connections
 
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
+import atexit
 import time
 import datetime
 import os
+import queue
+import random
+import re
+import sys
+import threading
 #import uuid
 
+import numpy as np
+
+
+class LogWriter:
+    """
+    Appends log lines from a background thread, so requests do not wait for the disk.
+
+    Lines queued while the writer is busy are written in one go, with each log file opened once per batch.
+    """
+
+    def __init__(self, max_queued=10000, batch_size=1000):
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        atexit.register(self.flush)
+
+    def write(self, path, text):
+        self.start()
+        try:
+            self.queue.put_nowait((path, text))
+        except queue.Full:
+            # the writer can not keep up, write directly rather than dropping lines
+            self.append([(path, text)])
+
+    def start(self):
+        # threads do not survive a fork, each worker process starts its own writer
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='stats-log-writer', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.append(batch)
+
+    def flush(self):
+        """Write the queued lines from the calling thread, e.g. at exit."""
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        self.append(batch)
+
+    @staticmethod
+    def append(batch):
+        lines = defaultdict(list)
+        for path, text in batch:
+            lines[path].append(text)
+        for path, texts in lines.items():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "a") as text_file:
+                    text_file.write(''.join(texts))
+            except OSError as e:
+                print('Could not write to', path, e, file=sys.stderr)
+
+
+class QueryStats:
+    """Database execute wrapper counting the queries of a request and the time spent on them."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start_time
+            self.count += 1
+
+
+class StackSampler(threading.Thread):
+    """
+    Statistical profiler of one thread.
+
+    The stack of the thread is sampled at a fixed interval; identical stacks are counted and can be written in the
+    folded format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='stats-stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append('%s (%s:%d)' % (frame.f_code.co_name, self.short_path(frame.f_code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def folded(self):
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+    @staticmethod
+    def short_path(path):
+        if path.startswith(settings.BASE_DIR):
+            return os.path.relpath(path, settings.BASE_DIR)
+        return path
+
+
+log_writer = LogWriter()
+
 
 class StatsMiddleware:
     """
@@ -13,11 +150,21 @@ class StatsMiddleware:
 
     Each response is timed and the user agent is checked for a bot/crawler tag.
     Slow responses are separately logged and so are errors.
+
+    For each request the number of SQL queries and their total time, the cache hits and misses and the growth of the
+    resident memory of the process while handling it are written to logs/stats_requests.log, which is summarized by
+    the hot paths view. The memory growth includes that of other requests handled by the process at the same time,
+    and is negative when memory was released. A fraction
+    (STATS_PROFILE_RATE) of the requests is sample-profiled, the profiles of the slow ones (slower than
+    STATS_SLOW_REQUEST seconds) are written to logs/profiles/.
     """
 
     def __init__(self, get_response):
         self.get_response = get_response
         # One-time configuration and initialization.
+        self.slow_request = getattr(settings, 'STATS_SLOW_REQUEST', 5)
+        self.profile_rate = getattr(settings, 'STATS_PROFILE_RATE', 0.01)
+        self.profile_interval = getattr(settings, 'STATS_PROFILE_INTERVAL', 0.005)
 
     def __call__(self, request):
         """Handling protwis request logs."""
@@ -27,50 +174,74 @@ class StatsMiddleware:
 #        text_file.write('%s %s %s START %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'),request_id, request.method, request.path ))
 #        text_file.close()
 
+        query_stats = QueryStats()
+        cache_stats = self.cache_stats()
+        start_memory = self.resident_memory()
+
+        sampler = None
+        if self.profile_rate and random.random() < self.profile_rate:
+            sampler = StackSampler(threading.get_ident(), self.profile_interval)
+            sampler.start()
+
         # start timer
         start_time = time.time()
 
         # Handle request
-        response = self.get_response(request)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(query_stats))
+                response = self.get_response(request)
+        finally:
+            if sampler is not None:
+                sampler.stop()
 
         # CODE BELOW is executed after handling the request
         # End timer
         total = time.time() - start_time
+        cache_hits, cache_misses = [after - before for before, after in zip(cache_stats, self.cache_stats())]
+        memory_growth = (self.resident_memory() - start_memory) / 2**20
 
         if settings.DEBUG:
             print(request.path, "Time to execute", round(
-                total, 2), "SQL queries", len(connection.queries))
+                total, 2), "SQL queries", query_stats.count)
 
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         bot_user = self.bot_detection(request)
         log_file = os.path.join(settings.BASE_DIR, "logs/stats.log")
         if bot_user:
             log_file = os.path.join(settings.BASE_DIR, "logs/stats_bots.log")
 
-        text_file = open(log_file, "a")
         if bot_user:
-            text_file.write('%s %s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total, 2),
-                                                     request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path, request.META.get('HTTP_USER_AGENT')))
+            log_writer.write(log_file, '%s %s %s %s %s %s\n' % (timestamp, round(total, 2),
+                                                                request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path, request.META.get('HTTP_USER_AGENT')))
         else:
-            text_file.write('%s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime(
-                "%Y-%m-%d %H:%M:%S"), round(total, 2), request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path))
+            log_writer.write(log_file, '%s %s %s %s %s\n' % (timestamp, round(total, 2),
+                                                             request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path))
 
-        text_file.close()
+        # Request profile, tab separated for the hot paths summary
+        log_writer.write(os.path.join(settings.BASE_DIR, "logs/stats_requests.log"),
+                         '%s\t%.3f\t%s\t%s\t%d\t%.3f\t%d\t%d\t%.1f\t%d\t%s\n' % (timestamp, total, self.route(request), request.method,
+                                                                                 query_stats.count, query_stats.time, cache_hits, cache_misses, memory_growth, bot_user, request.path))
 
 #       # Start/top logger - not needed as we do slow query logging instead
 #        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_start_stop.log"), "a")
 #        text_file.write('%s %s %s FINISH %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'),request_id, round(total,2), request.method, request.path ))
 #        text_file.close()
 
-        # Extended logging of queries that are slower than 5 seconds
-        if total > 5:
+        # Extended logging of queries that are slower than STATS_SLOW_REQUEST (5) seconds
+        if total > self.slow_request:
             log_file = os.path.join(settings.BASE_DIR, "logs/stats_slow.log")
             if bot_user:
                 log_file = os.path.join(
                     settings.BASE_DIR, "logs/stats_slow_bots.log")
-            text_file = open(log_file, "a")
-            text_file.write('%s %s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total, 2),
-                                                     request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path, request.META.get('HTTP_USER_AGENT')))
-            text_file.close()
+            log_writer.write(log_file, '%s %s %s %s %s %s\n' % (timestamp, round(total, 2),
+                                                                request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path, request.META.get('HTTP_USER_AGENT')))
+
+            if sampler is not None and sampler.stacks:
+                profile_file = '%s_%s_%s.folded' % (datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f"), request.method,
+                                                    re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_')[:100])
+                log_writer.write(os.path.join(settings.BASE_DIR, "logs/profiles", profile_file), sampler.folded())
 
         return response
 
@@ -79,10 +250,37 @@ class StatsMiddleware:
         if self.bot_detection(request):
             log_file = os.path.join(settings.BASE_DIR, "logs/errors_bots.log")
 
-        text_file = open(log_file, "a")
-        text_file.write('%s %s - %s %s - %s "%s" "%s"\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), request.method, request.path,
-                                                            request.META.get('HTTP_REFERER'), request.META.get('HTTP_X_FORWARDED_FOR'), request.META.get('HTTP_USER_AGENT'), str(exception)))
-        text_file.close()
+        log_writer.write(log_file, '%s %s - %s %s - %s "%s" "%s"\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), request.method, request.path,
+                                                                       request.META.get('HTTP_REFERER'), request.META.get('HTTP_X_FORWARDED_FOR'), request.META.get('HTTP_USER_AGENT'), str(exception)))
+
+    @staticmethod
+    def route(request):
+        """URL pattern that handled the request, or '-' when none matched."""
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None or not resolver_match.route:
+            return '-'
+        return resolver_match.route.replace('\t', ' ')
+
+    @staticmethod
+    def cache_stats():
+        """Hits and misses so far of the caches of this thread that keep count (see common.cache.TieredCache)."""
+        hits = misses = 0
+        for alias in settings.CACHES:
+            stats = getattr(caches[alias], 'stats', None)
+            if stats is not None:
+                stats = stats()
+                hits += stats['local_hits'] + stats['shared_hits']
+                misses += stats['misses']
+        return hits, misses
+
+    @staticmethod
+    def resident_memory():
+        """Current resident memory of the process in bytes, from /proc/self/statm (0 where unavailable)."""
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return 0
 
     @staticmethod
     def bot_detection(request):
@@ -96,3 +294,53 @@ class StatsMiddleware:
         bot_IDs = ["bot", "slurp", "crawler", "spider", "curl", "facebook", "python"]
         user_agent = request.META.get("HTTP_USER_AGENT", "").lower()
         return any(bot_ID in user_agent for bot_ID in bot_IDs)
+
+
+def hotpaths(log_file=None, max_bytes=32 * 2**20, include_bots=False):
+    """
+    Summarize the request profiles of logs/stats_requests.log per URL pattern.
+
+    Only the last max_bytes of the log are read. Patterns are sorted by the total time spent on them.
+    """
+    log_file = log_file or os.path.join(settings.BASE_DIR, "logs/stats_requests.log")
+    try:
+        with open(log_file, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - max_bytes))
+            lines = f.read().decode('utf-8', 'replace').split('\n')
+    except OSError:
+        return []
+    if size > max_bytes:
+        # first line is most likely cut off
+        lines = lines[1:]
+
+    routes = defaultdict(list)
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) < 11 or (fields[9] == '1' and not include_bots):
+            continue
+        try:
+            routes[fields[2]].append([float(fields[1]), int(fields[4]), float(fields[5]), int(fields[6]), int(fields[7]), float(fields[8])])
+        except ValueError:
+            continue
+
+    summary = []
+    for route, values in routes.items():
+        values = np.array(values)
+        summary.append({
+            'route': route,
+            'count': len(values),
+            'total': round(float(values[:, 0].sum()), 3),
+            'p50': round(float(np.percentile(values[:, 0], 50)), 3),
+            'p95': round(float(np.percentile(values[:, 0], 95)), 3),
+            'max': round(float(values[:, 0].max()), 3),
+            'sql_queries': round(float(values[:, 1].mean()), 1),
+            'sql_time': round(float(values[:, 2].mean()), 3),
+            'cache_hits': round(float(values[:, 3].mean()), 1),
+            'cache_misses': round(float(values[:, 4].mean()), 1),
+            'memory_growth': round(float(values[:, 5].mean()), 1),
+            'memory_growth_max': round(float(values[:, 5].max()), 1),
+        })
+    summary.sort(key=lambda s: s['total'], reverse=True)
+    return summary
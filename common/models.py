@@ -1,13 +1,17 @@
 from django.db import models
 from django.db import IntegrityError
+from django.db.models import Q
+from django.db.models.functions import Lower
 from django.utils.text import slugify
 
-from common.tools import fetch_from_web_api, fetch_from_entrez
+from common.tools import fetch_from_web_api, fetch_from_entrez, fetch_many_from_entrez, search_entrez_dois
+from common.web_api import fetch_many_from_web_api
 
 from Bio import Entrez, Medline
 from string import Template
 import urllib.request,json
 import logging
+import math
 import re
 
 
@@ -103,6 +107,154 @@ class Publication(models.Model):
     def get_or_create_from_pubmed(cls, pmid):
         return cls.get_or_create_from_type(pmid, WebResource.objects.get(slug="pubmed"))
 
+    @staticmethod
+    def normalize_identifier(identifier):
+        """(index, web resource slug) of a DOI or PubMed ID, None if it cannot be used (empty, '0', ISBN)"""
+        if identifier is None or (isinstance(identifier, float) and math.isnan(identifier)):
+            return None
+        identifier = str(identifier).strip()
+        if identifier in ('', '0', 'None', 'nan') or 'ISBN' in identifier:
+            return None
+        try:
+            # PubMed IDs read as numbers
+            identifier = str(int(float(identifier)))
+        except (ValueError, OverflowError):
+            pass
+        return identifier, 'pubmed' if identifier.isdigit() else 'doi'
+
+    @classmethod
+    def resolve_many(cls, identifiers):
+        """Publications of DOIs and PubMed IDs, as {identifier: Publication}; identifiers that cannot be used are left
+        out. Existing publications are loaded in one query, missing ones are created in bulk with their metadata
+        fetched in batches: from PubMed, and for DOIs without a PubMed record from Crossref."""
+        normalized = {}
+        for identifier in identifiers:
+            key = cls.normalize_identifier(identifier)
+            if key:
+                normalized[identifier] = key
+        if not normalized:
+            return {}
+
+        resources = {wr.slug: wr for wr in WebResource.objects.filter(slug__in=['doi', 'pubmed'])}
+
+        # DOIs are matched regardless of case, as in get_or_create_from_type
+        def fold(key):
+            return (key[0].lower(), key[1])
+
+        # index of the web links created for missing entries
+        indices = {}
+        for identifier, key in normalized.items():
+            indices[fold(key)] = key[0]
+            normalized[identifier] = fold(key)
+        wanted = {key for key in normalized.values() if key[1] in resources}
+
+        def load_links():
+            query = Q(pk__in=[])
+            for slug, wr in resources.items():
+                query |= Q(web_resource=wr, lower_index__in=[index for index, s in wanted if s == slug])
+            return {fold((wl.index, wl.web_resource.slug)): wl for wl in WebLink.objects.annotate(
+                lower_index=Lower('index')).filter(query).select_related('web_resource')}
+
+        links = load_links()
+        if len(links) < len(wanted):
+            WebLink.objects.bulk_create([WebLink(index=indices[key], web_resource=resources[key[1]])
+                for key in wanted if key not in links], ignore_conflicts=True)
+            links = load_links()
+
+        def load_publications(web_links):
+            return {fold((pub.web_link.index, pub.web_link.web_resource.slug)): pub for pub in cls.objects.filter(
+                web_link__in=web_links).select_related('web_link__web_resource', 'journal')}
+
+        publications = load_publications(links.values())
+        missing = [key for key in links if key not in publications]
+        if missing:
+            metadata = cls.fetch_metadata(missing)
+            journals = PublicationJournal.get_many([journal for fields, journal in metadata.values() if journal])
+            new_publications = []
+            for key in missing:
+                fields, journal = metadata.get(key, ({}, None))
+                new_publications.append(cls(web_link=links[key], journal=journals[journal[0].lower()] if journal else
+                    None, **fields))
+            cls.objects.bulk_create(new_publications, ignore_conflicts=True)
+            publications.update(load_publications([links[key] for key in missing]))
+
+        return {identifier: publications[key] for identifier, key in normalized.items() if key in publications}
+
+    @classmethod
+    def fetch_metadata(cls, keys):
+        """Publication fields and journal (name, slug) of (index, web resource slug) keys, as {key: (fields,
+        journal)}; keys without metadata are left out."""
+        logger = logging.getLogger('build')
+        dois = [index for index, slug in keys if slug == 'doi']
+        doi_pmids = search_entrez_dois(dois, ['entrez', 'doi'])
+        pmids = [index for index, slug in keys if slug == 'pubmed']
+        records = fetch_many_from_entrez(pmids + list(doi_pmids.values()), ['entrez', 'pmid'])
+
+        metadata = {}
+        for key, pmid in [((pmid, 'pubmed'), pmid) for pmid in pmids] + [((doi, 'doi'), pmid) for doi, pmid in
+                doi_pmids.items()]:
+            try:
+                metadata[key] = cls.pubmed_fields(records[pmid])
+            except Exception as msg:
+                logger.warning('Publication update on pubmed error! Pubmed: {} error {}'.format(pmid, msg))
+
+        crossref_dois = [doi for doi in dois if doi not in doi_pmids]
+        for doi, pub in fetch_many_from_web_api('http://api.crossref.org/works/$index', crossref_dois,
+                ['crossref', 'doi']).items():
+            if not pub:
+                print("Publication not on crossref or Entrez", doi)
+                continue
+            try:
+                metadata[(doi, 'doi')] = cls.crossref_fields(pub)
+            except Exception as msg:
+                logger.warning('Processing data from CrossRef for {} failed: {}'.format(doi, msg))
+        return metadata
+
+    @staticmethod
+    def pubmed_fields(record):
+        """Publication fields and journal (name, slug) of a PubMed (Medline) record"""
+        fields = {'title': record['TI'], 'authors': ', '.join(record['AU'])}
+        # Sometimes 'DA' field does not exist, use alternative
+        fields['year'] = record['DA'][:4] if 'DA' in record else record['DP'][:4]
+        fields['reference'] = ""
+        if 'VI' in record:
+            fields['reference'] += record['VI']
+        if 'PG' in record:
+            fields['reference'] += ":" + record['PG']
+        return fields, (record['JT'], slugify(record['TA']))
+
+    @staticmethod
+    def crossref_fields(pub):
+        """Publication fields and journal (name, slug) of a Crossref work"""
+        fields = {'title': pub['message']['title'][0]}
+        try:
+            fields['year'] = pub['message']['created']['date-parts'][0][0]
+        except:
+            fields['year'] = pub['message']['deposited']['date-parts'][0][0]
+
+        # go from [{'family': 'Gloriam', 'given': 'David E.'}] to ['Gloriam DE']
+        authors = ['{} {}'.format(x['family'], ''.join([y[:1] for y in x['given'].split()]))
+            for x in pub['message']['author']]
+        fields['authors'] = ', '.join(authors)
+
+        # get volume and pages if available
+        reference = {}
+        for f in ['volume', 'page']:
+            if f in pub['message']:
+                reference[f] = pub['message'][f]
+            else:
+                reference[f] = 'X'
+        fields['reference'] = '{}:{}'.format(reference['volume'], reference['page'])
+
+        # Journal name and abbreviation
+        journal = pub['message']['container-title'][0]
+        if "short-container-title" in pub['message'] and len(pub['message']['short-container-title']) != 0 and len(pub['message']['short-container-title'][0])>0:
+            # not all records have the journal abbreviation
+            journal_abbr = pub['message']['short-container-title'][0]
+        else:
+            journal_abbr = slugify(journal)
+        return fields, (journal, journal_abbr)
+
     #http://www.ncbi.nlm.nih.gov/pubmed/?term=10.1124%2Fmol.107.040097&report=xml&format=text
     # use NCBI instead to correct year published (journal year)
 
@@ -133,34 +285,9 @@ class Publication(models.Model):
         if pub:
             # update record
             try:
-                self.title = pub['message']['title'][0]
-                try:
-                    self.year = pub['message']['created']['date-parts'][0][0]
-                except:
-                    self.year = pub['message']['deposited']['date-parts'][0][0]
-
-                # go from [{'family': 'Gloriam', 'given': 'David E.'}] to ['Gloriam DE']
-                authors = ['{} {}'.format(x['family'], ''.join([y[:1] for y in x['given'].split()]))
-                    for x in pub['message']['author']]
-                self.authors = ', '.join(authors)
-
-                # get volume and pages if available
-                reference = {}
-                fields = ['volume', 'page']
-                for f in fields:
-                    if f in pub['message']:
-                        reference[f] = pub['message'][f]
-                    else:
-                        reference[f] = 'X'
-                self.reference = '{}:{}'.format(reference['volume'], reference['page'])
-
-                # Journal name and abbreviation
-                journal = pub['message']['container-title'][0]
-                if "short-container-title" in pub['message'] and len(pub['message']['short-container-title']) != 0 and len(pub['message']['short-container-title'][0])>0:
-                    # not all records have the journal abbreviation
-                    journal_abbr = pub['message']['short-container-title'][0]
-                else:
-                    journal_abbr = slugify(journal)
+                fields, (journal, journal_abbr) = self.crossref_fields(pub)
+                for field, value in fields.items():
+                    setattr(self, field, value)
 
                 try:
                     self.journal, created = PublicationJournal.objects.get_or_create(defaults={"name": journal, 'slug': journal_abbr}, name__iexact=journal)
@@ -183,26 +310,16 @@ class Publication(models.Model):
         cache_dir = ['entrez', 'pmid']
         record = fetch_from_entrez(index, cache_dir)
         try:
-            self.title = record['TI']
-            self.authors = ', '.join(record['AU'])
-            try:
-                self.year = record['DA'][:4]
-            except:
-                # Sometimes 'DA' field does not exist, use alternative
-                self.year = record['DP'][:4]
+            fields, (journal, journal_slug) = self.pubmed_fields(record)
+            for field, value in fields.items():
+                setattr(self, field, value)
 
             try:
-                self.journal, created = PublicationJournal.objects.get_or_create(defaults={"name": record['JT'], 'slug': slugify(record['TA'])}, name__iexact=record['JT'])
+                self.journal, created = PublicationJournal.objects.get_or_create(defaults={"name": journal, 'slug': journal_slug}, name__iexact=journal)
             except PublicationJournal.DoesNotExist:
-                j = PublicationJournal(slug=slugify(record['TA']), name=record['JT'])
+                j = PublicationJournal(slug=journal_slug, name=journal)
                 j.save()
                 self.journal = j
-
-            self.reference = ""
-            if 'VI' in record:
-                self.reference += record['VI']
-            if 'PG' in record:
-                self.reference += ":" + record['PG']
         except Exception as msg:
             logger.warning('Publication update on pubmed error! Pubmed: {} error {}'.format(index, msg))
 
@@ -217,6 +334,22 @@ class PublicationJournal(models.Model):
     class Meta():
         db_table = 'publication_journal'
 
+    @classmethod
+    def get_many(cls, journals):
+        """Journals of (name, slug) pairs by lower case name, the missing ones are created in bulk"""
+        wanted = {name.lower(): (name, slug) for name, slug in journals}
+
+        def load():
+            return {journal.name.lower(): journal for journal in cls.objects.annotate(lower_name=Lower('name')).filter(
+                lower_name__in=list(wanted))}
+
+        found = load() if wanted else {}
+        if len(found) < len(wanted):
+            cls.objects.bulk_create([cls(name=name, slug=slug) for key, (name, slug) in wanted.items()
+                if key not in found], ignore_conflicts=True)
+            found = load()
+        return found
+
 
 class ReleaseNotes(models.Model):
     date = models.DateField()
@@ -1,4 +1,6 @@
-﻿from django.conf import settings
+﻿from django.apps import apps
+from django.conf import settings
+from django.db import models
 
 from protein.models import Species
 from protein.models import ProteinSource
@@ -39,6 +41,31 @@ class SimpleSelection:
     def __str__(self):
         return str(self.__dict__)
 
+    # selection attributes holding lists of SelectionItem objects
+    item_lists = ['reference', 'targets', 'segments', 'species', 'pref_g_proteins', 'g_proteins', 'annotation',
+        'numbering_schemes']
+
+    def to_session(self):
+        """Compact, JSON serializable representation of the selection, with the selected objects as IDs"""
+        data = {key: [item.to_session() for item in getattr(self, key)] for key in self.item_lists}
+        data['tree_settings'] = self.tree_settings
+        data['site_residue_groups'] = self.site_residue_groups
+        data['active_site_residue_group'] = self.active_site_residue_group
+        return data
+
+    @classmethod
+    def from_session(cls, data):
+        """Restore a selection from to_session data. The selected objects are only fetched when first used, with one
+        query per model for the whole selection"""
+        selection = cls.__new__(cls)
+        loader = SelectionItemLoader()
+        for key in cls.item_lists:
+            setattr(selection, key, [SelectionItem.from_session(item, loader) for item in data[key]])
+        selection.tree_settings = data['tree_settings']
+        selection.site_residue_groups = data['site_residue_groups']
+        selection.active_site_residue_group = data['active_site_residue_group']
+        return selection
+
 
 class Selection(SimpleSelection):
     """A class that extends SimpleSelection, and adds methods to process the selection (these methods can not be
@@ -112,7 +139,7 @@ class Selection(SimpleSelection):
         group_id = False
         delete_group = False
         for selection_object in selection:
-            if (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id) and 
+            if (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id) and 
                 'site_residue_group' in selection_object.properties and
                 selection_object.properties['site_residue_group']):
                 group_id = selection_object.properties['site_residue_group']
@@ -120,7 +147,7 @@ class Selection(SimpleSelection):
 
         # loop through selected objects and remove the one that matches the subtype and ID
         for selection_object in selection:
-            if not (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id)):
+            if not (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id)):
                 updated_selection.append(selection_object)
                 
                 # check group ID
@@ -176,8 +203,83 @@ class SelectionItem:
         self.item = selection_object
         self.properties = properties
 
+    @property
+    def item(self):
+        if self._ref is not None:
+            self._loader.load()
+        return self._item
+
+    @item.setter
+    def item(self, selection_object):
+        self._item = selection_object
+        self._ref = None
+        self._loader = None
+
+    @property
+    def item_id(self):
+        """ID of the selected object, without fetching it"""
+        if self._ref is not None:
+            return self._ref[1]
+        return self._item.id
+
+    def ref(self):
+        """Model and primary key of the selected object, or the object itself if it is not a model instance"""
+        if self._ref is not None:
+            return self._ref
+        if isinstance(self._item, models.Model):
+            return (self._item._meta.label, self._item.pk)
+        return self._item
+
+    def to_session(self):
+        ref = self.ref()
+        if not isinstance(ref, tuple):
+            raise TypeError('Selected object {!r} is not a model instance'.format(ref))
+        return [self.type, ref[0], ref[1], self.properties]
+
+    @classmethod
+    def from_session(cls, data, loader):
+        selection_type, label, pk, properties = data
+        item = cls.__new__(cls)
+        item.type = selection_type
+        item.type_title = selection_type.replace('_', ' ').capitalize()
+        item.properties = properties
+        item._item = None
+        item._ref = (label, pk)
+        item._loader = loader
+        loader.pending.append(item)
+        return item
+
+    def __setstate__(self, state):
+        # selections pickled before the item was a property
+        if 'item' in state:
+            state['_item'] = state.pop('item')
+            state['_ref'] = state['_loader'] = None
+        self.__dict__.update(state)
+
     def __str__(self):
-        return str(self.__dict__)
+        return str({'type': self.type, 'type_title': self.type_title, 'item': self.item, 'properties': self.properties})
 
     def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
\ No newline at end of file
+        return (self.type == other.type and self.ref() == other.ref() and self.properties == other.properties)
+
+
+class SelectionItemLoader:
+    """Fetches the objects of SelectionItems restored from a session, with one query per model"""
+    def __init__(self):
+        self.pending = []
+
+    def load(self):
+        pending, self.pending = self.pending, []
+        pks = {}
+        for item in pending:
+            if item._ref is not None:
+                pks.setdefault(item._ref[0], set()).add(item._ref[1])
+        objects = {}
+        for label, model_pks in pks.items():
+            for pk, obj in apps.get_model(label).objects.in_bulk(list(model_pks)).items():
+                objects[(label, pk)] = obj
+        for item in pending:
+            if item._ref is not None:
+                # objects removed from the database since they were selected are None
+                item._item = objects.get(item._ref)
+                item._ref = item._loader = None
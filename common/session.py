@@ -0,0 +1,81 @@
+"""Session serialization and storage of large per-session results.
+
+SessionSerializer stores sessions as JSON. Selections are stored in their compact form (see
+SimpleSelection.to_session), other values that do not survive a round trip through JSON unchanged (model instances,
+tuples, dictionaries with integer keys etc.) are pickled, so existing views can keep storing them. Sessions written
+by the pickle serializer are still read.
+
+Large derived data, like sequence signatures, should not be stored in the session itself but with store_result, which
+returns a key to keep in the session instead.
+"""
+from django.contrib.sessions.serializers import PickleSerializer
+from django.core.cache import cache
+from django.conf import settings
+
+from common.selection import SimpleSelection
+
+import base64
+import hashlib
+import json
+import pickle
+
+
+class SessionSerializer:
+    """Django session serializer, set as SESSION_SERIALIZER"""
+    selection_tag = '__selection__'
+    pickle_tag = '__pickle__'
+
+    def dumps(self, obj):
+        return json.dumps({key: self.encode(value) for key, value in obj.items()}, separators=(',', ':')).encode('latin-1')
+
+    def loads(self, data):
+        if not data.startswith(b'{'):
+            # session written by the pickle serializer
+            return PickleSerializer().loads(data)
+        return {key: self.decode(value) for key, value in json.loads(data.decode('latin-1')).items()}
+
+    def encode(self, value):
+        if isinstance(value, SimpleSelection):
+            try:
+                # subclasses (Selection) are stored as SimpleSelection, as the pickle serializer would after exporter()
+                return {self.selection_tag: value.to_session()}
+            except TypeError:
+                pass
+        elif self.json_safe(value):
+            return value
+        return {self.pickle_tag: base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).decode('ascii')}
+
+    def decode(self, value):
+        if isinstance(value, dict) and len(value) == 1:
+            if self.selection_tag in value:
+                return SimpleSelection.from_session(value[self.selection_tag])
+            if self.pickle_tag in value:
+                return pickle.loads(base64.b64decode(value[self.pickle_tag]))
+        return value
+
+    def json_safe(self, value):
+        """Whether the value is read back from JSON as it is"""
+        if isinstance(value, dict) and len(value) == 1 and (self.selection_tag in value or self.pickle_tag in value):
+            return False
+        try:
+            return json.loads(json.dumps(value)) == value
+        except (TypeError, ValueError):
+            return False
+
+
+def store_result(data, timeout=None):
+    """Keep data (any picklable object) in the cache for the duration of a session and return its key. Identical data
+    is stored once."""
+    data_bytes = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    key = 'session_result_' + hashlib.sha1(data_bytes).hexdigest()
+    timeout = timeout or settings.SESSION_COOKIE_AGE
+    if not cache.add(key, data, timeout):
+        cache.touch(key, timeout)
+    return key
+
+
+def get_result(key):
+    """Data stored with store_result, or None if the key is unknown or expired"""
+    if not key:
+        return None
+    return cache.get(key)
@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Bio.Align import substitution_matrices
+
+
+# above this number of sequences the all-vs-all comparison is spread over a process pool
+POOL_THRESHOLD = 400
+
+# maximum number of cells (rows x rows x positions) scored at once, bounds memory use per block
+BLOCK_CELLS = 2 ** 23
+
+_blosum62 = None
+
+
+def get_blosum62():
+    """Load BLOSUM62 once per process."""
+    global _blosum62
+    if _blosum62 is None:
+        _blosum62 = substitution_matrices.load("BLOSUM62")
+    return _blosum62
+
+
+class SimilarityEngine:
+    """Scores identity, similarity and BLOSUM62 score between all rows of an alignment in NumPy.
+
+    The aligned rows are encoded once as an integer matrix (proteins x positions). Scores are looked up in a small
+    symbol x symbol table built from BLOSUM62, so every comparison is a handful of array operations.
+    """
+
+    def __init__(self, proteins, gaps=['-', '_']):
+        rows = []
+        for protein in proteins:
+            rows.append([position[2] for segment in proteins[0].alignment for position in protein.alignment[segment]])
+
+        self.symbols = sorted(set(aa for row in rows for aa in row) | set(gaps))
+        lookup = {aa: i for i, aa in enumerate(self.symbols)}
+        self.codes = np.array([[lookup[aa] for aa in row] for row in rows], dtype=np.int16).reshape(len(rows), -1)
+        self.labels = [position[0] for segment in proteins[0].alignment for position in proteins[0].alignment[segment]]
+
+        is_gap = np.array([aa in gaps for aa in self.symbols])
+        self.gaps = is_gap[self.codes]
+        self.table = self.scoring_table(self.symbols, is_gap)
+
+    @staticmethod
+    def scoring_table(symbols, is_gap):
+        """BLOSUM62 scores for all symbol pairs; gaps score 0 and unknown residues are scored as X."""
+        matrix = get_blosum62()
+        letters = [aa if aa in matrix.alphabet else 'X' for aa in symbols]
+        table = np.zeros((len(symbols), len(symbols)), dtype=np.int16)
+        for i, a in enumerate(letters):
+            for j, b in enumerate(letters):
+                if not (is_gap[i] or is_gap[j]):
+                    table[i, j] = matrix[a, b]
+        return table
+
+    def compare_to(self, index=0):
+        """Counts of identical and similar positions, score sum and compared positions for each row against one row."""
+        return score_block(self.codes[index:index+1], self.gaps[index:index+1], self.codes, self.gaps, self.table)
+
+    def compare_to_normalized(self, index=0):
+        """Like compare_to, but only counting positions where both sequences have a residue.
+
+        Returns the counts and the labels of positions where the reference row is gapped.
+        """
+        keep = ~self.gaps[index]
+        codes = self.codes[:, keep]
+        gaps = self.gaps[:, keep]
+        counts = score_block(codes[index:index+1], np.zeros((1, codes.shape[1]), dtype=bool), codes, gaps,
+            self.table)
+        # the compared positions are those where both sequences have a residue
+        counts[3] = (~gaps).sum(axis=1)[None, :]
+        removed = [label for label, k in zip(self.labels, keep) if not k]
+        return counts, removed
+
+    def all_pairs(self, processes=None):
+        """Counts for every pair of rows as four (n x n) arrays."""
+        n, length = self.codes.shape
+        block_size = max(1, BLOCK_CELLS // max(1, n * length))
+        blocks = [(start, min(n, start + block_size)) for start in range(0, n, block_size)]
+
+        if processes is None:
+            processes = min(os.cpu_count() or 1, 8) if n > POOL_THRESHOLD else 1
+
+        results = np.zeros((4, n, n), dtype=np.int32)
+        if processes > 1 and len(blocks) > 1:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                    initargs=(self.codes, self.gaps, self.table)) as executor:
+                for (start, end), counts in zip(blocks, executor.map(_score_rows, blocks)):
+                    results[:, start:end] = counts
+        else:
+            for start, end in blocks:
+                results[:, start:end] = score_block(self.codes[start:end], self.gaps[start:end], self.codes,
+                    self.gaps, self.table)
+        return results
+
+
+def score_block(codes_a, gaps_a, codes_b, gaps_b, table):
+    """Compare every row of a against every row of b.
+
+    Returns an array (4 x rows_a x rows_b) with identical positions, similar positions, score sum and number of
+    positions where not both rows are gapped.
+    """
+    both_gaps = gaps_a[:, None, :] & gaps_b[None, :, :]
+    no_gaps = ~gaps_a[:, None, :] & ~gaps_b[None, :, :]
+    scores = table[codes_a[:, None, :], codes_b[None, :, :]]
+
+    counts = np.empty((4, len(codes_a), len(codes_b)), dtype=np.int32)
+    counts[0] = ((codes_a[:, None, :] == codes_b[None, :, :]) & ~both_gaps).sum(axis=2)
+    counts[1] = ((scores > 0) & no_gaps).sum(axis=2)
+    counts[2] = scores.sum(axis=2, dtype=np.int32)
+    counts[3] = (~both_gaps).sum(axis=2)
+    return counts
+
+
+_worker_data = None
+
+
+def _init_worker(codes, gaps, table):
+    global _worker_data
+    _worker_data = (codes, gaps, table)
+
+
+def _score_rows(block):
+    codes, gaps, table = _worker_data
+    start, end = block
+    return score_block(codes[start:end], gaps[start:end], codes, gaps, table)
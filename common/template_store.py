@@ -0,0 +1,177 @@
+import logging
+import os
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Q
+from protein.models import Protein, ProteinFamily, ProteinSegment
+from residue.models import Residue
+from structure.models import Structure
+
+
+class TemplateIndex:
+    """Template selection index for homology modeling, written by build_template_index.
+
+    Holds the sequence similarity of every receptor to every template receptor (a receptor with annotated
+    structures) over the core segments, as AlignedReferenceTemplate calculates it for each model, and the number of
+    residues (and of x50 residues) of every segment of every structure. The similarities are calculated for all
+    receptors of a class at once with SimilarityEngine, so template tables are lookups instead of an alignment of
+    the receptor with all templates.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'template_index'])
+    index_file = 'index.npz'
+
+    # segments the main templates are chosen by, see build_homology_models.run_alignment
+    core_segments = ['TM1', 'ICL1', 'TM2', 'ECL1', 'TM3', 'ICL2', 'TM4', 'TM5', 'TM6', 'TM7', 'H8']
+    classes = ['001', '002', '003', '004', '005', '006', '007']
+
+    # receptors aligned with the templates at once
+    chunk_size = 50
+
+    _instance = None
+
+    logger = logging.getLogger('build')
+
+    def __init__(self, receptors, templates, counts, conformations, segments, segment_lengths, segment_x50s):
+        self.receptors = {name: i for i, name in enumerate(receptors)}
+        self.templates = {name: i for i, name in enumerate(templates)}
+        self.counts = counts
+        self.conformations = {int(pc): i for i, pc in enumerate(conformations)}
+        self.segments = {slug: i for i, slug in enumerate(segments)}
+        self.segment_lengths = segment_lengths
+        self.segment_x50s = segment_x50s
+
+    @staticmethod
+    def template_families(class_family):
+        """Families of the templates of the receptors of a class, as in
+        AlignedReferenceTemplate.load_proteins_by_structure"""
+        if class_family.slug == '003':
+            template_family = ProteinFamily.objects.get(slug='002')
+        elif class_family.slug == '007':
+            template_family = ProteinFamily.objects.get(slug='001')
+        else:
+            template_family = class_family
+        if class_family.name == 'Class B2 (Adhesion)':
+            return [template_family, class_family]
+        return [template_family]
+
+    @classmethod
+    def build(cls, store_dir=None):
+        """Write the index for all receptors, replacing a previous version."""
+        from common.alignment import Alignment
+        from common.similarity import SimilarityEngine, score_block
+
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        structures = Structure.objects.filter(annotated=True)
+        templates = sorted(set(structures.exclude(protein_conformation__protein__parent=None)
+            .values_list('protein_conformation__protein__parent__entry_name', flat=True)))
+        template_lookup = {name: i for i, name in enumerate(templates)}
+        receptors = list(Protein.objects.filter(parent__isnull=True, accession__isnull=False,
+            family__slug__regex=r'^({})_'.format('|'.join(cls.classes))).select_related('family')
+            .order_by('entry_name'))
+        receptor_lookup = {p.entry_name: i for i, p in enumerate(receptors)}
+
+        # identical positions, similar positions, score sum and compared positions, as in SimilarityEngine
+        counts = np.zeros((4, len(receptors), len(templates)), dtype=np.int32)
+        counts[3] = -1
+        segments = ProteinSegment.objects.filter(slug__in=cls.core_segments)
+        for class_family in ProteinFamily.objects.filter(slug__in=cls.classes):
+            families = cls.template_families(class_family)
+            family_query = Q(pk__in=[])
+            for family in families:
+                family_query |= Q(protein_conformation__protein__parent__family__parent__parent__parent=family)
+            class_templates = list(Protein.objects.filter(entry_name__in=set(structures.filter(family_query)
+                .values_list('protein_conformation__protein__parent__entry_name', flat=True))))
+            class_receptors = [p for p in receptors if p.family.slug.startswith(class_family.slug + '_')]
+            if not class_templates or not class_receptors:
+                continue
+
+            for start in range(0, len(class_receptors), cls.chunk_size):
+                a = Alignment()
+                a.load_proteins(class_receptors[start:start+cls.chunk_size] + class_templates)
+                a.load_segments(segments)
+                if a.build_alignment() == 'Too large':
+                    cls.logger.error('Alignment of {} receptors with the templates of {} is too large'.format(
+                        cls.chunk_size, class_family))
+                    continue
+                # positions gapped in both sequences are not compared, so the other rows of the alignment do not
+                # change the counts of a receptor and a template
+                rows = {p.protein.entry_name: i for i, p in enumerate(a.proteins)}
+                engine = SimilarityEngine(a.proteins, a.gaps)
+                r_rows = [rows[p.entry_name] for p in class_receptors[start:start+cls.chunk_size]
+                    if p.entry_name in rows]
+                t_rows = [rows[p.entry_name] for p in class_templates if p.entry_name in rows]
+                if not r_rows or not t_rows:
+                    continue
+                block = score_block(engine.codes[r_rows], engine.gaps[r_rows], engine.codes[t_rows],
+                    engine.gaps[t_rows], engine.table)
+                r_index = [receptor_lookup[a.proteins[i].protein.entry_name] for i in r_rows]
+                t_index = [template_lookup[a.proteins[i].protein.entry_name] for i in t_rows]
+                counts[:, np.array(r_index)[:, None], np.array(t_index)[None, :]] = block
+            cls.logger.info('Indexed templates of {} receptors of {}'.format(len(class_receptors), class_family))
+
+        # residues and x50 residues per segment of each structure
+        conformations = sorted(set(structures.values_list('protein_conformation_id', flat=True)))
+        conformation_lookup = {pc: i for i, pc in enumerate(conformations)}
+        segment_slugs = list(ProteinSegment.objects.order_by('slug').values_list('slug', flat=True).distinct())
+        segment_lookup = {slug: i for i, slug in enumerate(segment_slugs)}
+        segment_lengths = np.zeros((len(conformations), len(segment_slugs)), dtype=np.int16)
+        segment_x50s = np.zeros((len(conformations), len(segment_slugs)), dtype=np.int16)
+        rs = Residue.objects.filter(protein_conformation_id__in=conformations).exclude(protein_segment=None) \
+            .values_list('protein_conformation_id', 'protein_segment__slug', 'generic_number__label')
+        for pc, segment, label in rs.iterator(chunk_size=100000):
+            segment_lengths[conformation_lookup[pc], segment_lookup[segment]] += 1
+            if label and label[-3:] == 'x50':
+                segment_x50s[conformation_lookup[pc], segment_lookup[segment]] += 1
+
+        index_path = os.sep.join([store_dir, cls.index_file])
+        with open(index_path + '.tmp', 'wb') as f:
+            np.savez(f, receptors=np.array([p.entry_name for p in receptors], dtype=str),
+                templates=np.array(templates, dtype=str), counts=counts,
+                conformations=np.array(conformations, dtype=np.int64), segments=np.array(segment_slugs, dtype=str),
+                segment_lengths=segment_lengths, segment_x50s=segment_x50s)
+        os.replace(index_path + '.tmp', index_path)
+        cls.logger.info('Indexed {} receptors, {} templates and {} structures in {}'.format(len(receptors),
+            len(templates), len(conformations), store_dir))
+
+    @classmethod
+    def load(cls, store_dir=None):
+        """Return the shared index, or None if it has not been built."""
+        store_dir = store_dir or cls.store_dir
+        index_path = os.sep.join([store_dir, cls.index_file])
+        try:
+            mtime = os.path.getmtime(index_path)
+        except OSError:
+            return None
+
+        if cls._instance is None or cls._instance[0] != (store_dir, mtime):
+            try:
+                with np.load(index_path) as data:
+                    index = cls(*[data[key] for key in ['receptors', 'templates', 'counts', 'conformations',
+                        'segments', 'segment_lengths', 'segment_x50s']])
+            except (OSError, ValueError, KeyError):
+                return None
+            cls._instance = ((store_dir, mtime), index)
+
+        return cls._instance[1]
+
+    def similarity_counts(self, receptor, templates):
+        """Counts (as from SimilarityEngine) of a receptor and each of the templates (entry names), None if any of
+        them is not in the index"""
+        if receptor not in self.receptors or any(t not in self.templates for t in templates):
+            return None
+        counts = self.counts[:, self.receptors[receptor], [self.templates[t] for t in templates]]
+        if (counts[3] < 0).any():
+            return None
+        return counts
+
+    def segment_length(self, protein_conformation, segment, x50=False):
+        """Number of residues (or of x50 residues) of a segment of a structure, None if it is not in the index"""
+        i = self.conformations.get(protein_conformation.pk)
+        if i is None or segment not in self.segments:
+            return None
+        lengths = self.segment_x50s if x50 else self.segment_lengths
+        return int(lengths[i, self.segments[segment]])
@@ -1,3 +1,304 @@
-from django.test import TestCase
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 
-# Create your tests here.
+from common.alignment import AlignedReferenceTemplate
+from common.cache import SharedStore
+from common.models import Publication, WebLink, WebResource
+from common.session import get_result, store_result
+from common.similarity import SimilarityEngine
+from common.template_store import TemplateIndex
+from common.web_api import ResponseCache, fetch_many_from_web_api
+from protein.models import (Protein, ProteinConformation, ProteinFamily, ProteinSegment, ProteinSequenceType,
+                            ProteinSource, ProteinState, Species)
+from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme
+from structure.models import Structure, StructureType
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Local web API: /entry/<index> returns {"index": <index>}, unknown indices are 404 and slow ones do not
+    respond within a second"""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        index = self.path.rsplit('/', 1)[-1]
+        if index.startswith('unknown'):
+            self.send_error(404)
+            return
+        if index.startswith('slow'):
+            time.sleep(1)
+            return
+        body = json.dumps({'index': index}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WebApiTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/entry/$index'.format(self.server.server_port)
+        StubHandler.requests = []
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.settings = override_settings(BUILD_CACHE_DIR=self.cache_dir.name,
+            WEB_API_CACHE=os.path.join(self.cache_dir.name, 'web_api.sqlite3'),
+            WEB_API_RATE_LIMITS={'default': (2, 1000)})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        ResponseCache._instances.clear()
+        self.cache_dir.cleanup()
+
+    def test_fetch_and_cache(self):
+        indices = ['P{}'.format(i) for i in range(20)] + ['unknown1']
+        entries = fetch_many_from_web_api(self.url, indices, ['test', 'entries'])
+        self.assertEqual(entries['P7'], {'index': 'P7'})
+        self.assertIs(entries['unknown1'], False)
+        self.assertEqual(len(StubHandler.requests), 21)
+
+        # cached entries are read without requests, failed ones are tried again
+        entries = fetch_many_from_web_api(self.url, indices, ['test', 'entries'])
+        self.assertEqual(entries['P19'], {'index': 'P19'})
+        self.assertEqual(len(StubHandler.requests), 22)
+
+    def test_offline(self):
+        fetch_many_from_web_api(self.url, ['P1'], ['test', 'entries'])
+        with override_settings(WEB_API_OFFLINE=True):
+            entries = fetch_many_from_web_api(self.url, ['P1', 'P2'], ['test', 'entries'])
+        self.assertEqual(entries, {'P1': {'index': 'P1'}, 'P2': False})
+        self.assertEqual(len(StubHandler.requests), 1)
+
+    @mock.patch('common.web_api.RETRY_DELAY', 0)
+    @mock.patch('common.web_api.MAX_TRIES', 2)
+    def test_timeout(self):
+        start = time.monotonic()
+        with override_settings(WEB_API_TIMEOUT=0.2):
+            entries = fetch_many_from_web_api(self.url, ['slow1'], ['test', 'entries'])
+        # both tries give up before the server responds
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(entries, {'slow1': False})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ExpiredResultTest(SimpleTestCase):
+    """Views reading a signature stored with store_result after the cache entry was evicted"""
+
+    signature = {'common_positions': {}, 'diff_matrix': [], 'numbering_schemes': [], 'common_segments': {}}
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.key = store_result(self.signature)
+        cache.delete(self.key)
+
+    def session(self, **values):
+        session = SessionStore()
+        session.update(values)
+        return session
+
+    def test_evicted(self):
+        self.assertIsNone(get_result(self.key))
+
+    def test_signprot_signature_match(self):
+        from signprot.views import IMSignatureMatch, render_IMSigMat, SIGNATURE_EXPIRED
+
+        request = self.factory.post('/signprot/matrix/sigmat/', {'pos[]': ['adrb2_human']})
+        request.session = self.session(signature=self.key)
+        response = IMSignatureMatch(request)
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(json.loads(response.content), {'error': SIGNATURE_EXPIRED})
+
+        request = self.factory.get('/signprot/matrix/render_sigmat/')
+        request.session = self.session(signature=self.key, ss_pos=['adrb2_human'])
+        response = render_IMSigMat(request)
+        self.assertEqual(response.status_code, 410)
+
+    def test_seqsign_signature_match(self):
+        from seqsign import views
+
+        # without the selections the signature is calculated from, the user starts again
+        request = self.factory.get('/seqsign/render_signature_match_scores/0')
+        request.session = self.session(signature=self.key)
+        response = views.render_signature_match_scores(request, '0')
+        self.assertEqual(response.status_code, 302)
+
+        # with them, the signature is calculated and stored again
+        request.session = self.session(signature=self.key, targets_pos={'targets': [1]}, selection={'targets': [2]})
+        with mock.patch.object(views, 'SequenceSignature') as signature, \
+                mock.patch.object(views, 'SignatureMatch') as signature_match, \
+                mock.patch.object(views, 'get_proteins_from_selection'), \
+                mock.patch.object(views, 'render') as render:
+            signature.return_value.prepare_session_data.return_value = self.signature
+            views.render_signature_match_scores(request, '0')
+        signature.return_value.setup_alignments_from_selection.assert_called_once_with({'targets': [1]}, {'targets': [2]})
+        self.assertEqual(signature_match.call_args[0][:4], ({}, [], {}, []))
+        self.assertEqual(get_result(request.session['signature']), self.signature)
+        render.assert_called_once()
+
+
+class SharedStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SharedStore(self.directory.name, 1, 2**20, access_interval=60)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def accessed(self, key):
+        return self.store.connection(0).execute('SELECT accessed FROM cache WHERE key = ?', (key,)).fetchone()[0]
+
+    def test_access_time(self):
+        self.store.set('key', b'value', None)
+        written = self.accessed('key')
+        # hits within the interval do not write
+        self.assertEqual(self.store.get('key'), (b'value', None))
+        self.assertEqual(self.accessed('key'), written)
+
+        self.store.connection(0).execute('UPDATE cache SET accessed = ?', (written - 120,))
+        self.assertEqual(self.store.get('key'), (b'value', None))
+        self.assertGreaterEqual(self.accessed('key'), written)
+
+
+class ResolvePublicationsTest(TestCase):
+
+    def setUp(self):
+        self.doi = WebResource.objects.create(slug='doi', url='https://dx.doi.org/$index')
+        self.pubmed = WebResource.objects.create(slug='pubmed', url='http://www.ncbi.nlm.nih.gov/pubmed/$index')
+        self.existing = Publication.objects.create(web_link=WebLink.objects.create(index='10.1000/abc',
+            web_resource=self.doi), title='Existing')
+
+    @mock.patch.object(Publication, 'fetch_metadata')
+    def test_resolve_many(self, fetch_metadata):
+        fetch_metadata.return_value = {('12345', 'pubmed'): ({'title': 'New', 'year': 2020}, None)}
+        publications = Publication.resolve_many(['10.1000/ABC', 12345.0, '12345', 'ISBN 123', ''])
+
+        # DOIs match regardless of case, PubMed IDs read as numbers are the same publication
+        self.assertEqual(publications['10.1000/ABC'], self.existing)
+        self.assertEqual(publications[12345.0], publications['12345'])
+        self.assertEqual(publications['12345'].title, 'New')
+        self.assertEqual(publications['12345'].web_link.web_resource, self.pubmed)
+        self.assertEqual(set(publications), {'10.1000/ABC', 12345.0, '12345'})
+        fetch_metadata.assert_called_once_with([('12345', 'pubmed')])
+        self.assertEqual(WebLink.objects.count(), 2)
+
+        # resolved again without fetching or creating anything
+        self.assertEqual(Publication.resolve_many(['12345'])['12345'], publications['12345'])
+        self.assertEqual(fetch_metadata.call_count, 1)
+
+
+class TemplateIndexTest(TestCase):
+    """Receptors of one class with residues in two helices and a loop between them. Only the first two have
+    structures (templates), the last one has a longer loop than the others and is aligned with the templates in the
+    index, but not in the template table of a model."""
+    # sequences of TM1 (1x49-1x51), ICL1 and TM2 (2x49-2x51), gaps are missing residues
+    receptors = [
+        ('tmpa_human', 'LAV', 'KR', 'GLI'),
+        ('tmpb_human', '-VF', 'KRPE', 'ALI'),
+        ('ref_human', 'IAF', 'RRE', 'GV-'),
+        ('long_human', 'LLV', 'KRPEGSA', 'SAI'),
+    ]
+
+    def setUp(self):
+        ResidueNumberingScheme.objects.create(slug='gpcrdb', short_name='GPCRdb', name='GPCRdb')
+        family = None
+        for level, slug in enumerate(['001', '001_001', '001_001_001', '001_001_001_001']):
+            family = ProteinFamily.objects.create(parent=family, slug=slug, name='Class A' if level == 0 else slug)
+        species = Species.objects.create(latin_name='Homo sapiens', common_name='Human')
+        source = ProteinSource.objects.create(name='SWISSPROT')
+        sequence_type = ProteinSequenceType.objects.create(slug='wt', name='Wild-type')
+        state = ProteinState.objects.create(slug='inactive', name='Inactive')
+        structure_type = StructureType.objects.create(slug='x-ray-diffraction', name='X-ray diffraction')
+        pdb = WebResource.objects.create(slug='pdb', url='http://www.rcsb.org/pdb/explore/explore.do?structureId=$index')
+
+        scheme = ResidueNumberingScheme.objects.get(slug='gpcrdb')
+        segments = [ProteinSegment.objects.create(slug=slug, name=slug, category='helix' if slug[:2] == 'TM' else 'loop',
+            fully_aligned=slug[:2] == 'TM', proteinfamily='GPCR') for slug in ['TM1', 'ICL1', 'TM2']]
+        numbers = {segment.slug: [ResidueGenericNumber.objects.create(scheme=scheme, protein_segment=segment,
+            label='{}x{}'.format(segment.slug[2], n)) for n in [49, 50, 51]] for segment in segments[::2]}
+
+        self.proteins = {}
+        for i, (entry_name, tm1, icl1, tm2) in enumerate(self.receptors):
+            protein = Protein.objects.create(family=family, species=species, source=source, sequence_type=sequence_type,
+                residue_numbering_scheme=scheme, entry_name=entry_name, accession='P0000{}'.format(i), name=entry_name,
+                sequence=(tm1 + icl1 + tm2).replace('-', ''))
+            conformation = ProteinConformation.objects.create(protein=protein, state=state)
+            residues = [(segments[0], numbers['TM1'][j], aa) for j, aa in enumerate(tm1)]
+            residues += [(segments[1], None, aa) for aa in icl1]
+            residues += [(segments[2], numbers['TM2'][j], aa) for j, aa in enumerate(tm2)]
+            Residue.objects.bulk_create([Residue(protein_conformation=conformation, protein_segment=segment,
+                generic_number=number, display_generic_number=number, sequence_number=n+1, amino_acid=aa)
+                for n, (segment, number, aa) in enumerate(residues) if aa != '-'])
+            self.proteins[entry_name] = protein
+
+            if i < 2:
+                # structures are of the constructs, children of the receptors
+                construct = Protein.objects.create(parent=protein, family=family, species=species, source=source,
+                    sequence_type=sequence_type, entry_name='{}_construct'.format(entry_name), name=entry_name,
+                    sequence=protein.sequence)
+                Structure.objects.create(protein_conformation=ProteinConformation.objects.create(protein=construct,
+                    state=state), structure_type=structure_type, state=state, preferred_chain='A', resolution=2.5,
+                    publication_date=datetime.date(2020, 1, 1), pdb_code=WebLink.objects.create(web_resource=pdb,
+                    index='{}AB{}'.format(i+1, i+1)))
+
+        self.directory = tempfile.TemporaryDirectory()
+        TemplateIndex.build(self.directory.name)
+
+    def tearDown(self):
+        TemplateIndex._instance = None
+        self.directory.cleanup()
+
+    def template_table(self):
+        a = AlignedReferenceTemplate()
+        a.reference_protein = self.proteins['ref_human']
+        a.query_states = ['Inactive']
+        a.order_by = 'similarity'
+        a.revise_xtal = None
+        a.force_main_temp = False
+        a.main_temp_ban_list = []
+        return a
+
+    def test_similarity_counts(self):
+        index = TemplateIndex.load(self.directory.name)
+        self.assertEqual(list(index.receptors), sorted(p[0] for p in self.receptors))
+        self.assertEqual(list(index.templates), ['tmpa_human', 'tmpb_human'])
+        self.assertIsNone(index.similarity_counts('ref_human', ['long_human']))
+
+        # the same alignment path as AlignedReferenceTemplate.run_hommod_alignment without an index
+        aligned = self.template_table()
+        aligned.load_reference_protein(aligned.reference_protein)
+        aligned.load_proteins_by_structure()
+        aligned.load_segments(ProteinSegment.objects.filter(slug__in=TemplateIndex.core_segments))
+        aligned.build_alignment()
+        engine_counts = SimilarityEngine(aligned.proteins, aligned.gaps).compare_to(0)[:, 0, 1:]
+        templates = [p.protein.entry_name for p in aligned.proteins[1:]]
+        self.assertEqual(templates, ['tmpa_human', 'tmpb_human'])
+        self.assertEqual(index.similarity_counts('ref_human', templates).tolist(), engine_counts.tolist())
+
+        aligned.calculate_similarity()
+        indexed = self.template_table()
+        with mock.patch.object(TemplateIndex, 'store_dir', self.directory.name):
+            self.assertTrue(indexed.load_similarity_from_index())
+        self.assertEqual(indexed.proteins[0].protein, aligned.proteins[0].protein)
+        self.assertEqual([(p.protein, p.identity, p.similarity, p.similarity_score) for p in indexed.proteins[1:]],
+            [(p.protein, p.identity, p.similarity, p.similarity_score) for p in aligned.proteins[1:]])
@@ -1,23 +1,18 @@
 from django.conf import settings
 from django.utils.text import slugify
 from django.core.cache import cache
+from django.db import connection
 
 import os
 import yaml
 import time
 import logging
 import urllib
-from urllib.parse import quote
 from urllib.request import urlopen
-from urllib.error import HTTPError
 import hashlib
-import json
-import gzip
-from io import BytesIO
-from string import Template
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 from Bio import Entrez, Medline
-import xml.etree.ElementTree as etree
-from http.client import HTTPException
 
 
 def save_to_cache(path, file_id, data):
@@ -45,81 +40,10 @@ def create_cache_dirs(path):
         os.chmod(intermediate_path, 0o777)
 
 def fetch_from_web_api(url, index, cache_dir=False, xml=False, raw=False):
-    logger = logging.getLogger('build')
-
-    # slugify the index for the cache filename (some indices have symbols not allowed in file names (e.g. /))
-    index_slug= slugify(index)
-    cache_file_path = '{}/{}'.format('/'.join(cache_dir), index_slug)
-
-    # try fetching from cache
-    if cache_dir:
-        # d = cache.get(cache_file_path)
-        d = fetch_from_cache(cache_dir, index_slug)
-        if d:
-            logger.info('Fetched {} from cache'.format(cache_file_path))
-            return d
-
-    # if nothing is found in the cache, use the web API
-    full_url = Template(url).substitute(index=quote(str(index), safe=''))
-    logger.info('Fetching {}'.format(full_url))
-    tries = 0
-    max_tries = 5
-    while tries < max_tries:
-        if tries > 0:
-            logger.warning('Failed fetching {}, retrying'.format(full_url))
-
-        try:
-            req = urlopen(full_url)
-            if full_url[-2:]=='gz' and xml:
-                try:
-                    buf = BytesIO( req.read())
-                    f = gzip.GzipFile(fileobj=buf)
-                    data = f.read()
-                    d = etree.fromstring(data)
-                except:
-                    return False
-            elif xml:
-                try:
-                    d = etree.fromstring(req.read().decode('UTF-8'))
-                except:
-                    return False
-            elif raw:
-                try:
-                    d = req.read().decode('UTF-8')
-                except:
-                    return False
-            else:
-                d = json.loads(req.read().decode('UTF-8'))
-        except HTTPError as e:
-            tries += 1
-            if e.code == 404:
-                logger.warning('Failed fetching {}, 404 - does not exist'.format(full_url))
-                tries = max_tries #skip more tries
-                return False
-            elif e.code == 400:
-                logger.warning('Failed fetching {}, 400 - does not exist'.format(full_url))
-                tries = max_tries #skip more tries
-                return False
-            else:
-                time.sleep(2)
-        except HTTPException as e:
-            tries += 1
-            time.sleep(2)
-        except urllib.error.URLError as e:
-            # Catches 101 network is unreachable -- I think it's auto limiting feature
-            tries +=1
-            time.sleep(2)
-        else:
-            # save to cache
-            if cache_dir:
-                save_to_cache(cache_dir, index_slug, d)
-                # cache.set(cache_file_path, d, 60*60*24*7) #7 days
-                logger.info('Saved entry for {} in cache'.format(cache_file_path))
-            return d
-
-    # give up if the lookup fails 5 times
-    logger.error('Failed fetching {} {} times, giving up'.format(full_url, max_tries))
-    return False
+    """Entry of a web API (JSON, an XML element or raw text), False if it could not be fetched. Responses are cached
+    when cache_dir is given; see common.web_api, also for fetching many entries at once."""
+    from common.web_api import fetch_many_from_web_api
+    return fetch_many_from_web_api(url, [index], cache_dir, xml=xml, raw=raw)[index]
 
 def get_or_create_url_cache(url, validity = -1):
     # Hash the url
@@ -196,6 +120,66 @@ def fetch_from_entrez(index, cache_dir=''):
             logger.info('Saved entry for {} in cache'.format(cache_file_path))
             return d
 
+def fetch_many_from_entrez(indices, cache_dir='', batch_size=200):
+    """PubMed records (Medline) of several PMIDs as {index: record}, fetched with one efetch per batch_size PMIDs.
+    PMIDs without a record are left out."""
+    logger = logging.getLogger('build')
+
+    records = {}
+    missing = []
+    for index in dict.fromkeys(str(index) for index in indices):
+        d = fetch_from_cache(cache_dir, slugify(index)) if cache_dir else None
+        if d:
+            records[index] = d
+        else:
+            missing.append(index)
+
+    Entrez.email = 'info@gpcrdb.org'
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start+batch_size]
+        logger.info('Fetching {} records from Entrez'.format(len(batch)))
+        try:
+            handle = Entrez.efetch(db="pubmed", id=','.join(batch), rettype="medline", retmode="text")
+            fetched = list(Medline.parse(handle))
+        except Exception as msg:
+            logger.warning('Failed fetching {} records from Entrez: {}'.format(len(batch), msg))
+            continue
+        for d in fetched:
+            if d.get('PMID') in batch:
+                records[d['PMID']] = d
+                if cache_dir:
+                    save_to_cache(cache_dir, slugify(d['PMID']), d)
+    return records
+
+def search_entrez_dois(dois, cache_dir=''):
+    """PMIDs of DOIs as {doi: pmid}, searched in PubMed by a pool of threads within the limits of the NCBI host (see
+    common.web_api). DOIs not found in PubMed are left out."""
+    from common.web_api import HostLimiter
+    logger = logging.getLogger('build')
+    limiter = HostLimiter.get('https://eutils.ncbi.nlm.nih.gov/')
+
+    def search(doi):
+        d = fetch_from_cache(cache_dir, slugify(doi)) if cache_dir else None
+        if d:
+            return d
+        try:
+            Entrez.email = 'info@gpcrdb.org'
+            with limiter:
+                record = Entrez.read(Entrez.esearch(db='pubmed', retmax=1, term=doi))
+            pmid = record['IdList'][0]
+        except Exception as msg:
+            logger.info('No PubMed record of {}: {}'.format(doi, msg))
+            return None
+        if cache_dir:
+            save_to_cache(cache_dir, slugify(doi), pmid)
+        return pmid
+
+    dois = list(dict.fromkeys(dois))
+    if not dois:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(dois), getattr(settings, 'WEB_API_WORKERS', 8))) as pool:
+        return {doi: pmid for doi, pmid in zip(dois, pool.map(search, dois)) if pmid}
+
 def urlopen_with_retry(url, data = None, retries = 5, sleeptime = 5):
     logger = logging.getLogger('build')
 
@@ -214,3 +198,48 @@ def urlopen_with_retry(url, data = None, retries = 5, sleeptime = 5):
             return response
         elif retry == retries:
             return False
+
+def copy_value(value):
+    """Format a value for the PostgreSQL COPY text format."""
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    else:
+        return str(value)
+
+def copy_to_table(model, fields, rows, chunk_size=100000):
+    """Write rows (tuples in the order of fields) into the table of a model using PostgreSQL COPY.
+
+    Much faster than bulk_create for large numbers of rows, but no primary keys are returned.
+    """
+    table = model._meta.db_table
+    columns = ', '.join(['"{}"'.format(model._meta.get_field(field).column) for field in fields])
+    sql = 'COPY "{}" ({}) FROM STDIN'.format(table, columns)
+
+    count = 0
+    buffer = StringIO()
+    with connection.cursor() as cursor:
+        for row in rows:
+            buffer.write('\t'.join([copy_value(value) for value in row]) + '\n')
+            count += 1
+            if count % chunk_size == 0:
+                buffer.seek(0)
+                cursor.copy_expert(sql, buffer)
+                buffer = StringIO()
+        if buffer.tell():
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+    return count
+
+def reserve_primary_keys(model, count):
+    """Take count primary keys from the sequence of the table of a model, for rows written with copy_to_table that
+    need to be referenced (e.g. by many-to-many links)."""
+    if not count:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+            [model._meta.db_table, model._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
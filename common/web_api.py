@@ -0,0 +1,220 @@
+"""Fetching of web API entries for the build commands, concurrently and with a shared response cache.
+
+Responses are stored as received (compressed, see common.cache.Codec) in a single SQLite database,
+settings.WEB_API_CACHE, under the SHA-1 of their URL, and parsed (JSON, XML or raw text) when read. Entries cached by
+earlier versions as YAML files in BUILD_CACHE_DIR are still read when the database has no entry for a URL.
+
+Requests to a host are limited in number at a time and per second, as set in settings.WEB_API_RATE_LIMITS (host:
+(concurrent requests, requests per second), 'default' for other hosts). A request that gets no response within
+settings.WEB_API_TIMEOUT seconds fails and is tried again. With settings.WEB_API_OFFLINE, only cached entries are
+returned and nothing is fetched.
+
+URL templates have an $index placeholder, as for fetch_from_web_api, so the entries of a local HTTP server can be
+fetched in tests, e.g. 'http://127.0.0.1:8000/entry/$index'.
+"""
+from django.conf import settings
+from django.utils.text import slugify
+
+from common.cache import Codec
+from common.tools import fetch_from_cache
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from string import Template
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote, urlsplit
+from urllib.request import urlopen
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as etree
+
+
+logger = logging.getLogger('build')
+
+DEFAULT_RATE_LIMITS = {'default': (4, 10)}
+DEFAULT_TIMEOUT = 30
+
+MAX_TRIES = 5
+RETRY_DELAY = 2
+
+
+class ResponseCache:
+    """Web API responses in a SQLite database, keyed by the SHA-1 of their URL"""
+
+    _instances = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.codec = Codec()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, namespace TEXT, '
+            'url TEXT, fetched REAL, body BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_namespace ON responses (namespace)')
+
+    @classmethod
+    def get(cls, path=None):
+        """Return the shared cache of a process (connections are not shared with forked processes)"""
+        path = path or getattr(settings, 'WEB_API_CACHE', os.sep.join([settings.BUILD_CACHE_DIR, 'web_api.sqlite3']))
+        key = (path, os.getpid())
+        if key not in cls._instances:
+            cls._instances[key] = cls(path)
+        return cls._instances[key]
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def read_many(self, urls):
+        """Cached response bodies of URLs (url: bytes), URLs without an entry are left out"""
+        keys = {self.key(url): url for url in urls}
+        bodies = {}
+        items = list(keys)
+        with self.lock:
+            # SQLite limits the number of query parameters
+            for start in range(0, len(items), 500):
+                batch = items[start:start+500]
+                rows = self.connection.execute('SELECT key, body FROM responses WHERE key IN ({})'.format(
+                    ','.join('?' * len(batch))), batch).fetchall()
+                for key, body in rows:
+                    bodies[keys[key]] = self.codec.decompress(body)
+        return bodies
+
+    def write(self, url, body, namespace=''):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, namespace, url, fetched, body) VALUES '
+                '(?, ?, ?, ?, ?)', (self.key(url), namespace, url, time.time(), self.codec.compress(body)))
+
+    def purge(self, namespace=None):
+        """Delete the entries of a namespace (cache_dir of the callers joined by '/'), or all of them"""
+        with self.lock:
+            if namespace is None:
+                self.connection.execute('DELETE FROM responses')
+            else:
+                self.connection.execute('DELETE FROM responses WHERE namespace = ?', (namespace,))
+
+
+class HostLimiter:
+    """Limits of the requests to one host: the number at a time and the number started per second"""
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, concurrency, rate):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    @classmethod
+    def get(cls, url):
+        host = urlsplit(url).netloc
+        with cls._instances_lock:
+            if host not in cls._instances:
+                limits = getattr(settings, 'WEB_API_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+                concurrency, rate = limits.get(host, limits.get('default', DEFAULT_RATE_LIMITS['default']))
+                cls._instances[host] = cls(concurrency, rate)
+            return cls._instances[host]
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+
+
+def request(url):
+    """Body of a URL, None if it does not exist (400/404) or could not be fetched after MAX_TRIES tries"""
+    limiter = HostLimiter.get(url)
+    timeout = getattr(settings, 'WEB_API_TIMEOUT', DEFAULT_TIMEOUT)
+    for tries in range(MAX_TRIES):
+        if tries > 0:
+            logger.warning('Failed fetching {}, retrying'.format(url))
+            time.sleep(RETRY_DELAY * tries)
+        try:
+            with limiter:
+                return urlopen(url, timeout=timeout).read() #nosec
+        except HTTPError as e:
+            if e.code in (400, 404):
+                logger.warning('Failed fetching {}, {} - does not exist'.format(url, e.code))
+                return None
+        except (HTTPException, URLError, OSError):
+            # Catches 101 network is unreachable -- often a rate limit of the server
+            # and timeouts (socket.timeout is an OSError) of the connection or the response
+            pass
+
+    logger.error('Failed fetching {} {} times, giving up'.format(url, MAX_TRIES))
+    return None
+
+
+def parse(body, url, xml=False, raw=False):
+    """Response body as returned by fetch_from_web_api: an XML element, text or JSON, False if it cannot be read"""
+    try:
+        if xml:
+            if url[-2:] == 'gz':
+                body = gzip.decompress(body)
+            return etree.fromstring(body.decode('UTF-8'))
+        elif raw:
+            return body.decode('UTF-8')
+        return json.loads(body.decode('UTF-8'))
+    except (ValueError, OSError, etree.ParseError):
+        return False
+
+
+def fetch_many_from_web_api(url, indices, cache_dir=False, xml=False, raw=False, workers=None):
+    """Entries of a web API for several indices at once, as {index: entry} with the entries as returned by
+    fetch_from_web_api (False if it could not be fetched). Uncached entries are fetched by a pool of threads within
+    the limits of their host; responses are cached when cache_dir is given."""
+    indices = list(dict.fromkeys(indices))
+    urls = {index: Template(url).substitute(index=quote(str(index), safe='')) for index in indices}
+    namespace = '/'.join(cache_dir) if cache_dir else ''
+    cache = ResponseCache.get() if cache_dir else None
+    offline = getattr(settings, 'WEB_API_OFFLINE', False)
+
+    entries = {}
+    missing = []
+    bodies = cache.read_many(urls.values()) if cache else {}
+    for index in indices:
+        if urls[index] in bodies:
+            entries[index] = parse(bodies[urls[index]], urls[index], xml, raw)
+            continue
+        if cache_dir:
+            # entry cached as YAML by earlier versions
+            legacy = fetch_from_cache(cache_dir, slugify(index))
+            if legacy:
+                entries[index] = legacy
+                continue
+        if offline:
+            entries[index] = False
+        else:
+            missing.append(index)
+
+    if missing:
+        logger.info('Fetching {} entries of {}'.format(len(missing), url))
+        workers = workers or getattr(settings, 'WEB_API_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as pool:
+            for index, body in zip(missing, pool.map(request, [urls[index] for index in missing])):
+                entry = parse(body, urls[index], xml, raw) if body is not None else False
+                # only readable responses are cached, as failed lookups are retried next time
+                if cache and entry is not False:
+                    cache.write(urls[index], body, namespace)
+                entries[index] = entry
+
+    return entries
@@ -0,0 +1,86 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import struct
+import time
+import zlib
+
+
+# a compressed archive member: raw deflate data with the CRC and size of the original content
+ZipEntry = namedtuple('ZipEntry', ['name', 'crc', 'size', 'data'])
+
+# zip format limits without the ZIP64 extensions
+MAX_SIZE = 0xFFFFFFFF
+MAX_ENTRIES = 0xFFFF
+
+
+def deflate(name, content, level=6):
+    """Compress the content (str or bytes) of one archive member."""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(content) + compressor.flush()
+    return ZipEntry(name, zlib.crc32(content) & 0xFFFFFFFF, len(content), data)
+
+
+def dos_timestamp(timestamp=None):
+    t = time.localtime(timestamp)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 4) | t.tm_mday
+
+
+def stream_zip(entries, threads=4):
+    """Generate a zip archive chunk by chunk, e.g. as the content of a StreamingHttpResponse.
+
+    entries is an iterable of ZipEntry objects (already compressed), (name, content) tuples or functions returning a
+    ZipEntry; the latter two are run in a thread pool. Only a few entries ahead of the one being sent are compressed,
+    so the archive is never held in memory as a whole.
+    """
+    mod_time, mod_date = dos_timestamp()
+    central_directory = []
+    offset = 0
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        entries = iter(entries)
+        exhausted = False
+        while pending or not exhausted:
+            # keep the pool busy with the next entries
+            while not exhausted and len(pending) < threads * 2:
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if isinstance(entry, ZipEntry):
+                    pending.append(entry)
+                elif callable(entry):
+                    pending.append(executor.submit(entry))
+                else:
+                    pending.append(executor.submit(deflate, *entry))
+            if not pending:
+                break
+
+            entry = pending.popleft()
+            if not isinstance(entry, ZipEntry):
+                entry = entry.result()
+
+            name = entry.name.encode('utf-8')
+            # bit 11: file name is UTF-8
+            flags = 0x800 if any(c > 127 for c in name) else 0
+            if entry.size > MAX_SIZE or len(entry.data) > MAX_SIZE or offset > MAX_SIZE \
+                    or len(central_directory) >= MAX_ENTRIES:
+                raise ValueError('Archive too large for the zip format without ZIP64')
+
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, 8, mod_time, mod_date, entry.crc,
+                len(entry.data), entry.size, len(name), 0)
+            central_directory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, 8, mod_time,
+                mod_date, entry.crc, len(entry.data), entry.size, len(name), 0, 0, 0, 0, 0o100644 << 16, offset) + name)
+
+            yield header + name
+            yield entry.data
+            offset += len(header) + len(name) + len(entry.data)
+
+    directory = b''.join(central_directory)
+    yield directory
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central_directory), len(central_directory), len(directory),
+        offset, 0)
@@ -0,0 +1,370 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max
+
+from contactnetwork.models import Interaction
+from interaction.models import ResidueFragmentInteraction
+from mutation.models import MutationExperiment
+from protein.models import Protein
+from residue.models import Residue
+from structure.models import Structure
+
+from collections import defaultdict, OrderedDict
+
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+
+
+# bumped when the aggregates change, so all classes are computed again
+AGGREGATES_VERSION = 1
+
+# cache lifetime of aggregates computed on request, when the store has not been built
+CACHE_TIMEOUT = 3600 * 24 * 7
+
+
+def gpcrdb_number_comparator(e1, e2):
+    t1 = e1.split('x')
+    t2 = e2.split('x')
+
+    if e1 == e2:
+        return 0
+
+    if t1[0] == t2[0]:
+        if t1[1] < t2[1]:
+            return -1
+        else:
+            return 1
+
+    if t1[0] < t2[0]:
+        return -1
+    else:
+        return 1
+
+
+def amino_acid_pair_conservation(gpcr_class, forced_class_a):
+    """Conservation (% of human wild type receptors of the class) of amino acids and amino acid pairs per GN"""
+    sum_proteins = Protein.objects.filter(family__slug__startswith=gpcr_class,sequence_type__slug='wt',species__common_name='Human').count()
+    residues = Residue.objects.filter(protein_conformation__protein__family__slug__startswith=gpcr_class,
+                                      protein_conformation__protein__sequence_type__slug='wt',
+                                      protein_conformation__protein__species__common_name='Human',
+
+                ).exclude(generic_number=None).values('pk','sequence_number','generic_number__label','amino_acid','protein_conformation__protein__entry_name','display_generic_number__label').all()
+    r_pair_lookup = defaultdict(lambda: defaultdict(lambda: set()))
+    for r in residues:
+        # use the class specific generic number
+        r['display_generic_number__label'] = re.sub(r'\.[\d]+', '', r['display_generic_number__label'])
+        if forced_class_a:
+            r_pair_lookup[r['generic_number__label']][r['amino_acid']].add(r['protein_conformation__protein__entry_name'])
+        else:
+            r_pair_lookup[r['display_generic_number__label']][r['amino_acid']].add(r['protein_conformation__protein__entry_name'])
+    class_pair_lookup = {}
+
+    gen_keys = sorted(r_pair_lookup.keys(), key=functools.cmp_to_key(gpcrdb_number_comparator))
+    for i,gen1 in enumerate(gen_keys):
+        v1 = r_pair_lookup[gen1]
+        temp_score_dict = []
+        for aa, protein in v1.items():
+            temp_score_dict.append([aa,len(protein)/sum_proteins])
+
+        most_freq_aa = sorted(temp_score_dict.copy(), key = lambda x: -x[1])[0]
+        class_pair_lookup[gen1] = most_freq_aa
+        for gen2 in gen_keys[i:]:
+            if gen1 == gen2:
+                continue
+            v2 = r_pair_lookup[gen2]
+            coord = '{},{}'.format(gen1,gen2)
+            for aa1 in v1.keys():
+                p1 = v1[aa1]
+                class_pair_lookup[gen1+aa1] = round(100*len(p1)/sum_proteins)
+                for aa2 in v2.keys():
+                    pair = '{}{}'.format(aa1,aa2)
+                    p2 = v2[aa2]
+                    p = p1.intersection(p2)
+                    if p:
+                        class_pair_lookup[coord+pair] = round(100*len(p)/sum_proteins)
+    return class_pair_lookup
+
+
+def class_ligand_interactions(gpcr_class, forced_class_a):
+    """Number of receptors of the class with ligand interactions per GN"""
+    class_interactions = ResidueFragmentInteraction.objects.filter(
+        structure_ligand_pair__structure__protein_conformation__protein__family__slug__startswith=gpcr_class, structure_ligand_pair__annotated=True
+    ).exclude(
+        rotamer__residue__generic_number=None
+    ).values_list(
+        'structure_ligand_pair__structure__protein_conformation__protein__family__slug',
+        'rotamer__residue__generic_number__label',
+    ).distinct()
+
+    ligand_interactions = {}
+    for p, label in class_interactions:
+        if forced_class_a:
+            gn = label
+        else:
+            gn = re.sub(r'\.[\d]+', '', label)
+        ligand_interactions.setdefault(gn, set()).add(p)
+    return {key: len(value) for key, value in ligand_interactions.items()}
+
+
+def class_complex_interactions(gpcr_class, forced_class_a):
+    """Number of receptors of the class with interactions with other proteins (G proteins, arrestins) per GN"""
+    interactions = Interaction.objects.filter(
+        interacting_pair__referenced_structure__protein_conformation__protein__family__slug__startswith=gpcr_class
+    ).exclude(
+        interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
+    ).exclude(
+        specific_type='water-mediated'
+    ).values_list(
+        'interacting_pair__referenced_structure__protein_conformation__protein__family__slug',
+        'interacting_pair__res1__generic_number__label',
+        'interacting_pair__res1__display_generic_number__label',
+    ).distinct()
+
+    complex_interactions = {}
+    for p, label, display_label in interactions:
+        if forced_class_a:
+            gn = label
+        else:
+            gn = re.sub(r'\.[\d]+', '', display_label)
+        complex_interactions.setdefault(gn, set()).add(p)
+    return {key: len(value) for key, value in complex_interactions.items()}
+
+
+def class_mutation_positions(gpcr_class, forced_class_a):
+    """Number of receptors of the class with mutations of more than 5 fold effect per GN"""
+    class_mutations_q = MutationExperiment.objects.filter(protein__family__slug__startswith=gpcr_class
+    ).exclude(
+        residue__generic_number=None
+    ).values_list(
+        'protein__family__slug',
+        'foldchange',
+        'residue__generic_number__label',
+        'residue__display_generic_number__label',
+    )
+
+    class_mutations = {}
+    for p, foldchange, label, display_label in class_mutations_q:
+        if abs(foldchange)>5:
+            if forced_class_a:
+                gn = label
+            else:
+                gn = re.sub(r'\.[\d]+', '', display_label)
+            class_mutations.setdefault(gn, set()).add(p)
+    return {key: len(value) for key, value in class_mutations.items()}
+
+
+def all_pdbs_aa_pairs():
+    """Structures (lower case PDB codes) per amino acid pair of all interacting GN pairs (class A numbering)"""
+    # To save less, first figure out all possible interaction pairs
+    pos_interactions = list(Interaction.objects.all(
+    ).values_list(
+        'interacting_pair__res1__generic_number__label',
+        'interacting_pair__res2__generic_number__label',
+    ).filter(interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')).distinct())
+
+    all_interaction_pairs = set()
+    all_interaction_residues = set()
+    for i in pos_interactions:
+        all_interaction_pairs.add('{},{}'.format(i[0],i[1]))
+        all_interaction_residues.add(i[0])
+        all_interaction_residues.add(i[1])
+    all_interaction_residues = sorted(list(all_interaction_residues), key=functools.cmp_to_key(gpcrdb_number_comparator))
+
+    all_pdbs = list(Structure.objects.all().values_list('pdb_code__index', flat=True))
+    all_pdbs = [x.lower() for x in all_pdbs]
+    residues = Residue.objects.filter(protein_conformation__protein__entry_name__in=all_pdbs).exclude(generic_number=None).values_list(
+                'generic_number__label','amino_acid','protein_conformation__protein__entry_name')
+
+    interaction_residues = set(all_interaction_residues)
+    r_pair_lookup = defaultdict(lambda: defaultdict(lambda: set()))
+    for label, amino_acid, entry_name in residues:
+        if label in interaction_residues:
+            r_pair_lookup[label][amino_acid].add(entry_name)
+
+    pdbs_pairs = {}
+    for i,gen1 in enumerate(all_interaction_residues):
+        for gen2 in all_interaction_residues[i:]:
+            if gen1 == gen2:
+                continue
+            coord = '{},{}'.format(gen1,gen2)
+            if coord not in all_interaction_pairs:
+                continue
+            v1 = r_pair_lookup[gen1]
+            v2 = r_pair_lookup[gen2]
+            for aa1 in v1.keys():
+                for aa2 in v2.keys():
+                    p = list(v1[aa1].intersection(v2[aa2]))
+                    if p:
+                        if coord not in pdbs_pairs:
+                            pdbs_pairs[coord] = {}
+                        pdbs_pairs[coord]['{}{}'.format(aa1,aa2)] = p
+    return pdbs_pairs
+
+
+# aggregates computed per class (and numbering), cached under '<name>_<class>_<forced_class_a>'
+CLASS_AGGREGATES = OrderedDict([
+    ('amino_acid_pair_conservation', amino_acid_pair_conservation),
+    ('class_ligand_interactions', class_ligand_interactions),
+    ('class_complex_interactions', class_complex_interactions),
+    ('class_mutation_positions', class_mutation_positions),
+])
+
+
+def gpcr_classes():
+    """Slugs of the receptor classes with structures"""
+    return sorted(set(Structure.objects.values_list(
+        'protein_conformation__protein__parent__family__parent__parent__parent__slug', flat=True)) - {None})
+
+
+def fingerprint(sources):
+    """Hash of the data of (queryset, fields) sources: the number and largest id of the rows, which change when rows
+    are added or removed, and a checksum of the fields of the rows, which changes when rows are modified"""
+    data = [AGGREGATES_VERSION]
+    for queryset, fields in sources:
+        checksum = hashlib.md5()
+        for row in queryset.order_by('pk').values_list('pk', *fields).iterator(chunk_size=10000):
+            checksum.update(repr(row).encode('utf-8'))
+        data.append(list(queryset.aggregate(count=Count('pk'), last=Max('pk')).values()) + [checksum.hexdigest()])
+    return hashlib.md5(json.dumps(data).encode('utf-8')).hexdigest()
+
+
+def class_fingerprint(gpcr_class):
+    """Fingerprint of the data the aggregates of a class are computed from"""
+    return fingerprint([
+        (Residue.objects.filter(protein_conformation__protein__family__slug__startswith=gpcr_class,
+            protein_conformation__protein__sequence_type__slug='wt',
+            protein_conformation__protein__species__common_name='Human').exclude(generic_number=None),
+            ['amino_acid', 'generic_number__label', 'display_generic_number__label',
+            'protein_conformation__protein__entry_name']),
+        (ResidueFragmentInteraction.objects.filter(
+            structure_ligand_pair__structure__protein_conformation__protein__family__slug__startswith=gpcr_class,
+            structure_ligand_pair__annotated=True),
+            ['structure_ligand_pair__structure__protein_conformation__protein__family__slug',
+            'rotamer__residue__generic_number__label']),
+        (Interaction.objects.filter(
+            interacting_pair__referenced_structure__protein_conformation__protein__family__slug__startswith=gpcr_class),
+            ['specific_type', 'interacting_pair__res1__generic_number__label',
+            'interacting_pair__res1__display_generic_number__label', 'interacting_pair__res1__protein_conformation_id',
+            'interacting_pair__res2__protein_conformation_id']),
+        (MutationExperiment.objects.filter(protein__family__slug__startswith=gpcr_class),
+            ['protein__family__slug', 'foldchange', 'residue__generic_number__label',
+            'residue__display_generic_number__label']),
+    ])
+
+
+def all_structures_fingerprint():
+    """Fingerprint of the data all_pdbs_aa_pairs is computed from"""
+    return fingerprint([
+        (Structure.objects.all(), ['pdb_code__index']),
+        (Interaction.objects.all(), ['interacting_pair__res1__generic_number__label',
+            'interacting_pair__res2__generic_number__label']),
+        (Residue.objects.filter(protein_conformation__protein__entry_name__in=[pdb.lower() for pdb in
+            Structure.objects.values_list('pdb_code__index', flat=True)]).exclude(generic_number=None),
+            ['generic_number__label', 'amino_acid', 'protein_conformation__protein__entry_name']),
+    ])
+
+
+class ClassAggregateStore():
+    """Class level aggregates of the interaction browser, written by build_class_aggregates.
+
+    The aggregates of each class (see CLASS_AGGREGATES), with class specific and with class A numbering, are stored in
+    one compressed JSON file together with a fingerprint of the data they are computed from, so a rebuild only
+    computes the classes that changed. The amino acid pairs of all structures (all_pdbs_aa_pairs) are stored in the
+    same way.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'class_aggregates'])
+    all_structures = 'all_pdbs_aa_pairs'
+
+    _files = {}
+
+    logger = logging.getLogger('build')
+
+    @classmethod
+    def path(cls, name, store_dir=None):
+        return os.sep.join([store_dir or cls.store_dir, '{}.json.gz'.format(name)])
+
+    @classmethod
+    def read(cls, name, store_dir=None):
+        """Contents of a store file, or None if it has not been built."""
+        path = cls.path(name, store_dir)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        if path not in cls._files or cls._files[path][0] != mtime:
+            try:
+                with gzip.open(path, 'rt') as f:
+                    contents = json.load(f)
+            except (OSError, ValueError):
+                return None
+            cls._files[path] = (mtime, contents)
+
+        return cls._files[path][1]
+
+    @classmethod
+    def write(cls, name, contents, store_dir=None):
+        path = cls.path(name, store_dir)
+        with gzip.open(path + '.tmp', 'wt') as f:
+            json.dump(contents, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def build(cls, store_dir=None, full=False):
+        """Compute the aggregates of the classes whose data changed since the previous build (all with full)."""
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        computed = []
+        for gpcr_class in gpcr_classes():
+            key = class_fingerprint(gpcr_class)
+            previous = cls.read(gpcr_class, store_dir)
+            if not full and previous is not None and previous['fingerprint'] == key:
+                continue
+
+            aggregates = {}
+            for forced_class_a in [False, True]:
+                aggregates[str(forced_class_a)] = {name: function(gpcr_class, forced_class_a)
+                    for name, function in CLASS_AGGREGATES.items()}
+            cls.write(gpcr_class, {'fingerprint': key, 'aggregates': aggregates}, store_dir)
+            computed.append(gpcr_class)
+
+        key = all_structures_fingerprint()
+        previous = cls.read(cls.all_structures, store_dir)
+        if full or previous is None or previous['fingerprint'] != key:
+            cls.write(cls.all_structures, {'fingerprint': key, 'aggregates': all_pdbs_aa_pairs()}, store_dir)
+            computed.append(cls.all_structures)
+
+        cls.logger.info('Stored class aggregates in {} (computed: {})'.format(store_dir, ', '.join(computed) or 'none'))
+
+    @classmethod
+    def get(cls, name, gpcr_class=None, forced_class_a=False, store_dir=None):
+        """A stored aggregate of a class (all_pdbs_aa_pairs without class), None if it has not been built."""
+        contents = cls.read(gpcr_class if gpcr_class is not None else cls.all_structures, store_dir)
+        if contents is None:
+            return None
+        if gpcr_class is None:
+            return contents['aggregates']
+        return contents['aggregates'][str(bool(forced_class_a))].get(name)
+
+
+def class_aggregate(name, gpcr_class=None, forced_class_a=False):
+    """An aggregate of a class (or all_pdbs_aa_pairs), from the store when built, otherwise computed and cached."""
+    data = ClassAggregateStore.get(name, gpcr_class, forced_class_a)
+    if data is not None:
+        return data
+
+    if gpcr_class is None:
+        cache_key = name
+    else:
+        cache_key = '{}_{}_{}'.format(name, gpcr_class, forced_class_a)
+    data = cache.get(cache_key)
+    if not data:
+        data = all_pdbs_aa_pairs() if gpcr_class is None else CLASS_AGGREGATES[name](gpcr_class, forced_class_a)
+        cache.set(cache_key, data, CACHE_TIMEOUT)
+    return data
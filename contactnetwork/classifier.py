@@ -0,0 +1,306 @@
+from contactnetwork.interaction import *
+from contactnetwork.residue import *
+
+import numpy
+
+
+class InteractionClassifier:
+    """Classifies the interactions of all candidate residue pairs of a structure at once.
+
+    The atoms of all residues are collected in coordinate/atom-type arrays and every atom combination of every
+    pair is expanded into one flat array, so the distance and angle criteria of InteractingPair are evaluated
+    with NumPy instead of per pair and per atom in Python. The result contains the same CI subclasses and
+    interaction levels as InteractingPair.compute_interactions.
+    """
+
+    def __init__(self, residue_pairs):
+        self.residue_pairs = list(residue_pairs)
+
+        # unique residues, atoms stored residue by residue in the order of child_list
+        self.residues = []
+        residue_index = {}
+        self.pair_residues = numpy.zeros((len(self.residue_pairs), 2), dtype=int)
+        for p, pair in enumerate(self.residue_pairs):
+            for j, res in enumerate(pair):
+                if id(res) not in residue_index:
+                    residue_index[id(res)] = len(self.residues)
+                    self.residues.append(res)
+                self.pair_residues[p, j] = residue_index[id(res)]
+
+        self.atoms = []
+        self.atom_start = numpy.zeros(len(self.residues), dtype=int)
+        self.atom_count = numpy.zeros(len(self.residues), dtype=int)
+        atom_index = {}
+        for r, res in enumerate(self.residues):
+            self.atom_start[r] = len(self.atoms)
+            self.atom_count[r] = len(res.child_list)
+            for atom in res.child_list:
+                atom_index[id(atom)] = len(self.atoms)
+                self.atoms.append(atom)
+        self.atom_index = atom_index
+
+        self.coords = numpy.array([atom.coord for atom in self.atoms], dtype=numpy.float32).reshape(-1, 3)
+        self.names = numpy.array([atom.name for atom in self.atoms], dtype=object)
+
+        # atom types
+        self.carbons = numpy.array([atom.element in ('C', 'S') for atom in self.atoms], dtype=bool)
+        self.vdw_radii = numpy.array([VDW_RADII.get(atom.element, numpy.nan) for atom in self.atoms], dtype=float)
+
+        self.charged = numpy.zeros(len(self.atoms), dtype=bool)
+        self.donors = numpy.zeros(len(self.atoms), dtype=bool)
+        self.acceptors = numpy.zeros(len(self.atoms), dtype=bool)
+        self.cations = numpy.zeros(len(self.atoms), dtype=bool)
+        for res in self.residues:
+            for name in get_charged_atom_names(res):
+                self.charged[atom_index[id(res[name])]] = True
+            for name in get_pos_charged_atom_names(res):
+                self.cations[atom_index[id(res[name])]] = True
+            if is_hbd(res):
+                for name in get_hbond_donor_references(res):
+                    if name in res.child_dict:
+                        self.donors[atom_index[id(res[name])]] = True
+            if is_hba(res):
+                for name in get_hbond_acceptors(res):
+                    if name in res.child_dict:
+                        self.acceptors[atom_index[id(res[name])]] = True
+
+        # residue types
+        self.pos_charged = numpy.array([is_pos_charged(res) for res in self.residues], dtype=bool)
+        self.neg_charged = numpy.array([is_neg_charged(res) for res in self.residues], dtype=bool)
+        self.aromatic = numpy.array([is_aromatic_aa(res) for res in self.residues], dtype=bool)
+
+        # aromatic rings: residue, ring number, center and normal
+        ring_residues, ring_numbers, centers, normals = [], [], [], []
+        for r, res in enumerate(self.residues):
+            if self.aromatic[r]:
+                for n, (center, normal) in enumerate(get_ring_descriptors(res)):
+                    ring_residues.append(r)
+                    ring_numbers.append(n + 1)
+                    centers.append(center)
+                    normals.append(normal)
+        self.ring_residues = numpy.array(ring_residues, dtype=int)
+        self.ring_numbers = numpy.array(ring_numbers, dtype=int)
+        self.ring_centers = numpy.array(centers, dtype=numpy.float32).reshape(-1, 3)
+        self.ring_normals = numpy.array(normals, dtype=numpy.float32).reshape(-1, 3)
+
+    def classify(self):
+        """Return the list of interactions (CI objects) of each residue pair, in the order of the residue pairs."""
+        interactions = [[] for pair in self.residue_pairs]
+        if not self.residue_pairs:
+            return interactions
+
+        res1 = self.pair_residues[:, 0]
+        res2 = self.pair_residues[:, 1]
+        pairs, atoms1, atoms2 = self.expand(numpy.arange(len(self.residue_pairs)), self.atom_start[res1],
+            self.atom_count[res1], self.atom_start[res2], self.atom_count[res2])
+        distances = numpy.linalg.norm(self.coords[atoms1] - self.coords[atoms2], axis=1)
+
+        # same order as InteractingPair.compute_interactions
+        hits = []
+        hits += self.ionic_interactions(pairs, atoms1, atoms2, distances)
+        hits += self.hbond_interactions(pairs, atoms1, atoms2, distances)
+        hits += self.aromatic_interactions()
+        hits += self.hydrophobic_interactions(pairs, atoms1, atoms2, distances)
+        hits += self.van_der_waals_interactions(pairs, atoms1, atoms2, distances)
+
+        for interaction_class, hit_pairs, names1, names2 in hits:
+            for p, name1, name2 in zip(hit_pairs.tolist(), names1, names2):
+                interactions[p].append(interaction_class(name1, name2))
+        return interactions
+
+    @staticmethod
+    def expand(pairs, start1, count1, start2, count2):
+        """All combinations of the items of two ranges per pair, the first range varying slowest."""
+        sizes = count1 * count2
+        offsets = numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        local = numpy.arange(sizes.sum()) - offsets
+        repeated_count2 = numpy.repeat(count2, sizes)
+        return (numpy.repeat(pairs, sizes), numpy.repeat(start1, sizes) + local // repeated_count2,
+            numpy.repeat(start2, sizes) + local % repeated_count2)
+
+    def ionic_interactions(self, pairs, atoms1, atoms2, distances):
+        res1 = self.pair_residues[pairs, 0]
+        res2 = self.pair_residues[pairs, 1]
+        opposite = (self.pos_charged[res1] & self.neg_charged[res2]) | (self.neg_charged[res1] & self.pos_charged[res2])
+        hit = opposite & self.charged[atoms1] & self.charged[atoms2] & (distances <= 4.5)
+
+        pos_first = self.pos_charged[res1[hit]]
+        return [(PosNegIonicInteraction, pairs[hit][pos_first], self.names[atoms1[hit][pos_first]],
+                    self.names[atoms2[hit][pos_first]]),
+                (NegPosIonicInteraction, pairs[hit][~pos_first], self.names[atoms1[hit][~pos_first]],
+                    self.names[atoms2[hit][~pos_first]])]
+
+    def hbond_interactions(self, pairs, atoms1, atoms2, distances):
+        donor_acceptor = self.donors[atoms1] & self.acceptors[atoms2]
+        acceptor_donor = self.acceptors[atoms1] & self.donors[atoms2]
+
+        # strict H-bonds: within 3.5A and a proper angle at the placed hydrogen
+        strict_da = donor_acceptor & (distances <= 3.5)
+        strict_da[strict_da] = self.verify_hbond_angles(atoms1[strict_da], atoms2[strict_da])
+        strict_ad = acceptor_donor & (distances <= 3.5)
+        strict_ad[strict_ad] = self.verify_hbond_angles(atoms2[strict_ad], atoms1[strict_ad])
+
+        # loose H-bonds within 4A only for residue pairs without a strict H-bond
+        found = numpy.zeros(len(self.residue_pairs), dtype=bool)
+        found[pairs[strict_da | strict_ad]] = True
+        loose = ~found[pairs] & (distances <= 4)
+        loose_da = donor_acceptor & loose
+        loose_ad = acceptor_donor & loose
+
+        return [(HydrogenBondDAInteraction, pairs[strict_da], self.names[atoms1[strict_da]], self.names[atoms2[strict_da]]),
+                (HydrogenBondADInteraction, pairs[strict_ad], self.names[atoms1[strict_ad]], self.names[atoms2[strict_ad]]),
+                (LooseHydrogenBondDAInteraction, pairs[loose_da], self.names[atoms1[loose_da]], self.names[atoms2[loose_da]]),
+                (LooseHydrogenBondADInteraction, pairs[loose_ad], self.names[atoms1[loose_ad]], self.names[atoms2[loose_ad]])]
+
+    def verify_hbond_angles(self, donors, acceptors):
+        """Vectorized InteractingPair.verify_hbond_angle for arrays of donor and acceptor atom indices."""
+        valid = numpy.zeros(len(donors), dtype=bool)
+        if not len(donors):
+            return valid
+
+        # one row per hydrogen placement (donor set) of each donor-acceptor combination
+        rows, p1, p3, secondary, angles, lengths = [], [], [], [], [], []
+        for i, (donor, acceptor) in enumerate(zip(donors.tolist(), acceptors.tolist())):
+            atom = self.atoms[donor]
+            hbd_residue = atom.get_parent()
+            for donor_set in get_hbond_donor_references(hbd_residue)[atom.name]:
+                if donor_set[0] not in hbd_residue.child_dict:
+                    continue
+                if len(donor_set) == 4:
+                    if donor_set[3] not in hbd_residue.child_dict:
+                        continue
+                    # backbone nitrogen - the previous residue is looked up with Residue.has_id, which checks the
+                    # atom names of the residue and never matches, so these placements are skipped as before
+                    if atom.name == 'N':
+                        continue
+                    p3.append(self.atom_index[id(hbd_residue.child_dict[donor_set[3]])])
+                else:
+                    # freely rotating donor, take acceptor as reference
+                    p3.append(acceptor)
+                rows.append(i)
+                p1.append(self.atom_index[id(hbd_residue.child_dict[donor_set[0]])])
+                secondary.append(len(donor_set) == 4)
+                angles.append(donor_set[1])
+                lengths.append(donor_set[2])
+        if not rows:
+            return valid
+
+        rows = numpy.array(rows, dtype=int)
+        p1 = self.coords[numpy.array(p1, dtype=int)]
+        p2 = self.coords[donors[rows]]
+        p3 = self.coords[numpy.array(p3, dtype=int)]
+        acceptor = self.coords[acceptors[rows]]
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # calculate optimal H-bonding vector to acceptor
+            d = unit_vectors(p2 - p1)
+            t = (d * (p3 - p1)).sum(axis=1)
+            p4 = p1 + t[:, None] * d
+            best_vector = unit_vectors(p3 - p4)
+            best_vector[numpy.array(secondary)] *= -1
+
+            angle = numpy.radians(numpy.array(angles) - 90)
+            x = numpy.abs(numpy.cos(angle) * numpy.array(lengths)).astype(numpy.float32)
+            y = numpy.abs(numpy.sin(angle) * numpy.array(lengths)).astype(numpy.float32)
+            hydrogen = p2 + y[:, None] * d + x[:, None] * best_vector
+
+            # check angle
+            ok = 180 - numpy.degrees(angles_between(hydrogen - p2, acceptor - hydrogen)) >= 120
+
+        valid[rows[ok]] = True
+        return valid
+
+    def aromatic_interactions(self):
+        counts = self.aromatic[self.pair_residues].sum(axis=1)
+        hits = []
+
+        # pi-cation, in both directions
+        for switch in (False, True):
+            aromatic = self.pair_residues[:, 1 if switch else 0]
+            cation = self.pair_residues[:, 0 if switch else 1]
+            selected = numpy.flatnonzero((counts == 1) & self.aromatic[aromatic] & self.pos_charged[cation])
+            pairs, rings, atoms = self.expand(selected, *self.ring_ranges(aromatic[selected]),
+                self.atom_start[cation[selected]], self.atom_count[cation[selected]])
+            keep = self.cations[atoms]
+            pairs, rings, atoms = pairs[keep], rings[keep], atoms[keep]
+
+            vectors = self.coords[atoms] - self.ring_centers[rings]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                hit = (numpy.linalg.norm(vectors, axis=1) <= 6.6) & \
+                    (numpy.degrees(plane_normal_angles(self.ring_normals[rings], vectors)) <= 30)
+            ring_names = self.ring_names(rings[hit])
+            if switch:
+                hits.append((CationPiInteraction, pairs[hit], ring_names, self.names[atoms[hit]]))
+            else:
+                hits.append((PiCationInteraction, pairs[hit], self.names[atoms[hit]], ring_names))
+
+        # ring-ring interactions
+        selected = numpy.flatnonzero(counts == 2)
+        pairs, rings1, rings2 = self.expand(selected, *self.ring_ranges(self.pair_residues[selected, 0]),
+            *self.ring_ranges(self.pair_residues[selected, 1]))
+        c1, c2 = self.ring_centers[rings1], self.ring_centers[rings2]
+        n1, n2 = self.ring_normals[rings1], self.ring_normals[rings2]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            distances = numpy.linalg.norm(c1 - c2, axis=1)
+            # the plane normal is compared to the ring center (not its normal), as in face_to_face_interactions
+            face_to_face = (distances <= 4.4) & (numpy.degrees(plane_normal_angles(n1, c2)) <= 30)
+            tilted = (distances <= 5.5) & (numpy.degrees(plane_normal_angles(n1, n2)) > 30)
+            edge_to_face = tilted & (numpy.abs(90 - numpy.degrees(plane_normal_angles(n1, c2 - c1))) <= 30)
+            face_to_edge = tilted & (numpy.abs(90 - numpy.degrees(plane_normal_angles(n2, c1 - c2))) <= 30)
+        # face_to_face_interactions and edge_to_face_interactions do not report back, so the loose aromatic
+        # interactions are always added
+        loose = distances <= 5.5
+
+        hits.append((FaceToFaceInteraction, pairs[face_to_face], self.ring_names(rings1[face_to_face]),
+            self.ring_names(rings2[face_to_face])))
+        hits.append((EdgeToFaceInteraction, pairs[edge_to_face], self.ring_names(rings1[edge_to_face]),
+            self.ring_names(rings2[edge_to_face])))
+        hits.append((FaceToEdgeInteraction, pairs[face_to_edge], self.ring_names(rings2[face_to_edge]),
+            self.ring_names(rings1[face_to_edge])))
+        hits.append((LooseAromaticInteraction, pairs[loose], self.ring_names(rings1[loose]),
+            self.ring_names(rings2[loose])))
+        return hits
+
+    def ring_ranges(self, residues):
+        """Start and number of rings of each residue in the ring arrays."""
+        start = numpy.searchsorted(self.ring_residues, residues, side='left')
+        end = numpy.searchsorted(self.ring_residues, residues, side='right')
+        return start, end - start
+
+    def ring_names(self, rings):
+        return ["RN" + str(n) for n in self.ring_numbers[rings].tolist()]
+
+    def hydrophobic_interactions(self, pairs, atoms1, atoms2, distances):
+        hit = self.carbons[atoms1] & self.carbons[atoms2] & (distances <= 4.5)
+        return [(HydrophobicInteraction, pairs[hit], self.names[atoms1[hit]], self.names[atoms2[hit]])]
+
+    def van_der_waals_interactions(self, pairs, atoms1, atoms2, distances):
+        with numpy.errstate(invalid='ignore'):
+            hit = distances <= (self.vdw_radii[atoms1] + self.vdw_radii[atoms2]) * VDW_TRESHOLD_FACTOR
+        return [(VanDerWaalsInteraction, pairs[hit], self.names[atoms1[hit]], self.names[atoms2[hit]])]
+
+
+def classify_interacting_pairs(residue_pairs, db_residue_pairs, structure):
+    """Create the InteractingPair of each residue pair, classified in one batch."""
+    interactions = InteractionClassifier(residue_pairs).classify()
+    pairs = []
+    for (res1, res2), (dbres1, dbres2), pair_interactions in zip(residue_pairs, db_residue_pairs, interactions):
+        pair = InteractingPair(res1, res2, dbres1, dbres2, structure, classify=False)
+        pair.interactions = pair_interactions
+        pairs.append(pair)
+    return pairs
+
+
+# Row-wise unit vectors
+def unit_vectors(vectors):
+    return vectors / numpy.linalg.norm(vectors, axis=1)[:, None]
+
+
+# Row-wise angles between two sets of vectors
+def angles_between(v1, v2):
+    return numpy.arccos(numpy.clip((unit_vectors(v1) * unit_vectors(v2)).sum(axis=1), -1.0, 1.0))
+
+
+# Row-wise acute angles between two sets of vectors
+def plane_normal_angles(v1, v2):
+    return numpy.minimum(angles_between(v1, v2), angles_between(v1, -v2))
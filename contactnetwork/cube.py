@@ -2,6 +2,7 @@ from Bio.PDB import Selection, PDBParser
 from Bio.PDB.NeighborSearch import NeighborSearch
 
 from contactnetwork.interaction import *
+from contactnetwork.classifier import classify_interacting_pairs
 from contactnetwork.pdb import *
 from contactnetwork.models import *
 from contactnetwork.residue import is_aa
@@ -13,11 +14,55 @@ from structure.models import Structure, StructureExtraProteins
 
 from signprot.models import SignprotComplex
 
+from common.tools import copy_to_table
+
+from django.db import transaction
+
+from collections import OrderedDict
 import copy
+import hashlib
 
 # Distance between residues in peptide
 NUM_SKIP_RESIDUES = 0
 
+def contact_network_hash(struc):
+    """Fingerprint of the coordinates and annotation a contact network is computed from."""
+    content = hashlib.md5(struc.pdb_data.pdb.encode('utf-8'))
+    content.update(struc.preferred_chain.encode('utf-8'))
+
+    # generic numbers of the receptor residues
+    annotation = struc.protein_conformation.residue_set.exclude(generic_number=None) \
+        .order_by('sequence_number').values_list('sequence_number', 'generic_number_id')
+    content.update(str(list(annotation)).encode('utf-8'))
+
+    # coupled signaling protein chains
+    complex_chains = list(SignprotComplex.objects.filter(structure=struc).values_list('alpha', flat=True))
+    complex_chains += list(StructureExtraProteins.objects.filter(structure=struc, category="Arrestin").values_list('chain', flat=True))
+    content.update(str(complex_chains).encode('utf-8'))
+
+    return content.hexdigest()
+
+def save_interacting_pairs(struc, pairs):
+    """Bulk save interacting pairs and their interactions, replacing the existing contact network of a structure."""
+    # merge pairs between the same residues
+    merged = OrderedDict()
+    for pair in pairs:
+        key = (pair.dbres1.pk, pair.dbres2.pk)
+        if key not in merged:
+            merged[key] = []
+        merged[key] += pair.get_interactions()
+
+    with transaction.atomic():
+        InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
+
+        # pairs need their primary keys, the interactions are streamed in with COPY
+        db_pairs = InteractingResiduePair.objects.bulk_create([InteractingResiduePair(res1_id=res1, res2_id=res2,
+            referenced_structure=struc) for res1, res2 in merged])
+        rows = ((i.get_type(), i.get_details(), db_pair.pk, i.atomname_residue1, i.atomname_residue2, i.get_level())
+            for db_pair, interactions in zip(db_pairs, merged.values()) for i in interactions)
+        copy_to_table(Interaction, ['interaction_type', 'specific_type', 'interacting_pair', 'atomname_residue1',
+            'atomname_residue2', 'interaction_level'], rows)
+
 def compute_interactions(pdb_name,save_to_db = False):
 
     do_distances = False ## Distance calculation moved to build_structure_angles
@@ -32,12 +77,12 @@ def compute_interactions(pdb_name,save_to_db = False):
 
     # Get the pdb structure
     struc = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
-    pdb_io = StringIO(struc.pdb_data.pdb)
+    coordinates = struc.pdb_data.get_coordinates()
     # Get the preferred chain
     preferred_chain = struc.preferred_chain.split(',')[0]
 
     # Get the Biopython structure for the PDB
-    s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', pdb_io)[0]
+    s = coordinates.to_structure('ref')[0]
     #s = pdb_get_structure(pdb_name)[0]
     chain = s[preferred_chain]
     #return classified, distances
@@ -79,7 +124,8 @@ def compute_interactions(pdb_name,save_to_db = False):
         all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(pair[0].id[1] - pair[1].id[1]) > NUM_SKIP_RESIDUES]
 
         # For each pair of interacting residues, determine the type of interaction
-        interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres[res_pair[1].id[1]], struc) for res_pair in all_aa_neighbors if not is_water(res_pair[0]) and not is_water(res_pair[1]) ]
+        residue_pairs = [res_pair for res_pair in all_aa_neighbors if not is_water(res_pair[0]) and not is_water(res_pair[1])]
+        interactions = classify_interacting_pairs(residue_pairs, [(dbres[res_pair[0].id[1]], dbres[res_pair[1].id[1]]) for res_pair in residue_pairs], struc)
 
         # Split unto classified and unclassified.
         classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
@@ -98,8 +144,7 @@ def compute_interactions(pdb_name,save_to_db = False):
 
             # Workaround for fused receptor - signaling proteins constructs
             if signprot_chain == preferred_chain:
-                pdb_io = StringIO(struc.pdb_data.pdb)
-                s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', pdb_io)[0]
+                s = coordinates.to_structure('ref')[0]
 
             # Get all GPCR residue atoms based on preferred chain
             gpcr_atom_list = [ atom for residue in Selection.unfold_entities(s[preferred_chain], 'R') if is_aa(residue) and residue.get_id()[1] in dbres \
@@ -129,7 +174,8 @@ def compute_interactions(pdb_name,save_to_db = False):
                             for match_res in ns_sign.search(gpcr_atom.coord, 4.5, "R")}
 
             # Find interactions
-            interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres_sign[res_pair[1].id[1]], struc) for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign ]
+            residue_pairs = [res_pair for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign]
+            interactions = classify_interacting_pairs(residue_pairs, [(dbres[res_pair[0].id[1]], dbres_sign[res_pair[1].id[1]]) for res_pair in residue_pairs], struc)
 
             # Filter unclassified interactions
             classified_complex = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
@@ -190,9 +236,6 @@ def compute_interactions(pdb_name,save_to_db = False):
     if save_to_db:
 
         if do_interactions:
-            # Delete previous for faster load in
-            InteractingResiduePair.objects.filter(referenced_structure=struc).all().delete()
-
             # bulk_pair = []
             # for d in distances:
             #     pair = InteractingResiduePair(res1=d[0], res2=d[1], referenced_structure=struc)
@@ -238,12 +281,8 @@ def compute_interactions(pdb_name,save_to_db = False):
                                 # HACK: store water ID as part of first atom name
                                 interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
 
-            for p in classified:
-                p.save_into_database()
-
-        if do_complexes:
-            for pair in classified_complex:
-                pair.save_into_database()
+        # Replace previous contact network in one go
+        save_interacting_pairs(struc, classified + classified_complex)
 
         # if do_distances:
         #     # Distance.objects.filter(structure=struc).all().delete()
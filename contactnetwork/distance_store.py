@@ -0,0 +1,171 @@
+from django.conf import settings
+
+from residue.models import Residue
+from structure.models import Structure
+
+import logging
+import os
+
+import numpy as np
+
+
+class DistanceMapStore():
+    """Memory-mapped (structure x GN x GN) distance maps for all structures, written by build_distance_maps.
+
+    For each distance type (CA, CB and helix center) the upper triangle of every structure's GN x GN distance map
+    is stored in one 3-D array, together with a (structure x GN) mask of the GNs present in each structure.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'distance_maps'])
+    index_file = 'index.npz'
+    distance_types = (('CA', 'distance'), ('CB', 'distance_cb'), ('HC', 'distance_helix_center'))
+
+    # GN prefixes left out of the TM distance maps (H8 and loops)
+    excluded_prefixes = ['8x', '12x', '23x', '34x', '45x']
+
+    _instance = None
+
+    logger = logging.getLogger('build')
+
+    def __init__(self, maps, pdbs, gns, presence):
+        self.maps = maps
+        self.pdbs = {pdb: i for i, pdb in enumerate(pdbs)}
+        self.gns = {gn: i for i, gn in enumerate(gns)}
+        self.presence = presence
+
+    @classmethod
+    def map_file(cls, distance_type):
+        return 'maps_{}.npy'.format(distance_type)
+
+    @classmethod
+    def build(cls, store_dir=None):
+        """Write the distance maps of all structures, replacing a previous version."""
+        from contactnetwork.distances import load_packed_distances
+
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        structures = list(Structure.objects.all().order_by('pdb_code__index').values_list('pk', 'pdb_code__index',
+            'protein_conformation_id'))
+        pdbs = [s[1] for s in structures]
+
+        # GNs present in each structure
+        rs = Residue.objects.filter(protein_conformation_id__in=[s[2] for s in structures]) \
+            .exclude(generic_number=None) \
+            .values_list('protein_conformation_id', 'generic_number__label')
+        for prefix in cls.excluded_prefixes:
+            rs = rs.exclude(generic_number__label__startswith=prefix)
+        structure_gns = {}
+        for pconf, label in rs:
+            structure_gns.setdefault(pconf, set()).add(label)
+
+        gns = sorted(set.union(set(), *structure_gns.values()))
+        gn_lookup = {gn: i for i, gn in enumerate(gns)}
+
+        presence = np.zeros((len(structures), len(gns)), dtype=bool)
+        for i, s in enumerate(structures):
+            for label in structure_gns.get(s[2], []):
+                presence[i, gn_lookup[label]] = True
+
+        maps = {}
+        for distance_type, field in cls.distance_types:
+            maps[distance_type] = np.lib.format.open_memmap(os.sep.join([store_dir, cls.map_file(distance_type) + '.tmp']),
+                mode='w+', dtype=np.float32, shape=(len(structures), len(gns), len(gns)))
+
+        for i, s in enumerate(structures):
+            for packed in load_packed_distances([s[0]], [t for t, field in cls.distance_types]):
+                res1, res2 = packed.pairs(cls.excluded_prefixes, gn_lookup)
+                gn_indices = np.array([gn_lookup.get(gn, -1) for gn in packed.gns.tolist()], dtype=int)
+                # keep the upper triangle, as in the original per-structure maps
+                a = np.minimum(gn_indices[res1], gn_indices[res2])
+                b = np.maximum(gn_indices[res1], gn_indices[res2])
+                for distance_type, field in cls.distance_types:
+                    values = packed.distances(res1, res2, distance_type)
+                    present = ~np.isnan(values)
+                    maps[distance_type][i, a[present], b[present]] = values[present]
+
+            if i % 100 == 0:
+                cls.logger.info('Stored distance maps for {} of {} structures'.format(i, len(structures)))
+
+        for distance_type, field in cls.distance_types:
+            maps[distance_type].flush()
+        del maps
+
+        index_path = os.sep.join([store_dir, cls.index_file])
+        with open(index_path + '.tmp', 'wb') as f:
+            np.savez(f, pdbs=np.array(pdbs), gns=np.array(gns), presence=presence)
+
+        for distance_type, field in cls.distance_types:
+            map_path = os.sep.join([store_dir, cls.map_file(distance_type)])
+            os.replace(map_path + '.tmp', map_path)
+        os.replace(index_path + '.tmp', index_path)
+        cls.logger.info('Stored distance maps for {} structures and {} GNs in {}'.format(len(pdbs), len(gns), store_dir))
+
+    @classmethod
+    def load(cls, store_dir=None):
+        """Return the shared store, or None if it has not been built."""
+        store_dir = store_dir or cls.store_dir
+        paths = [os.sep.join([store_dir, cls.index_file])]
+        paths += [os.sep.join([store_dir, cls.map_file(t)]) for t, field in cls.distance_types]
+        try:
+            mtime = max(os.path.getmtime(path) for path in paths)
+        except OSError:
+            return None
+
+        if cls._instance is None or cls._instance[0] != (store_dir, mtime):
+            try:
+                with np.load(paths[0]) as index:
+                    pdbs = list(index['pdbs'])
+                    gns = list(index['gns'])
+                    presence = index['presence']
+                maps = {t: np.load(path, mmap_mode='r') for (t, field), path in zip(cls.distance_types, paths[1:])}
+            except (OSError, ValueError, KeyError):
+                return None
+
+            # files replaced halfway through a rebuild
+            if any(m.shape != (len(pdbs), len(gns), len(gns)) for m in maps.values()):
+                return None
+            cls._instance = ((store_dir, mtime), cls(maps, pdbs, gns, presence))
+
+        return cls._instance[1]
+
+    def covers(self, pdbs):
+        """Check whether all PDBs are in the store."""
+        return all(pdb in self.pdbs for pdb in pdbs)
+
+    def distance_maps(self, pdbs, gns, distance_type='CA'):
+        """Distance maps (pdbs x gns x gns) and GN presence (pdbs x gns), GNs without data are empty."""
+        rows = np.array([self.pdbs[pdb] for pdb in pdbs], dtype=int)
+        known = np.array([gn in self.gns for gn in gns], dtype=bool)
+        columns = np.array([self.gns[gn] for gn in gns if gn in self.gns], dtype=int)
+
+        maps = np.zeros((len(rows), len(gns), len(gns)), dtype=np.float32)
+        # one indexing step, so only the selected cells of the memory-mapped maps are read
+        maps[np.ix_(np.arange(len(rows)), known, known)] = self.maps[distance_type][np.ix_(rows, columns, columns)]
+        presence = np.zeros((len(rows), len(gns)), dtype=bool)
+        presence[:, known] = self.presence[np.ix_(rows, columns)]
+        return maps, presence
+
+    def distance_matrix(self, pdbs, gns, normalize=True, distance_type='CA'):
+        """Structure x structure distance matrix over the GNs both structures have in common."""
+        maps, presence = self.distance_maps(pdbs, gns, distance_type)
+
+        if normalize:
+            average = maps.sum(axis=0) / len(pdbs)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                maps = np.nan_to_num(maps / average)
+
+        # only the upper triangle holds data
+        upper = np.triu_indices(len(gns), 1)
+        values = maps[:, upper[0], upper[1]]
+        pair_presence = presence[:, upper[0]] & presence[:, upper[1]]
+
+        distance_matrix = np.full((len(pdbs), len(pdbs)), 0.0)
+        for i in range(len(pdbs) - 1):
+            shared = pair_presence[i+1:] & pair_presence[i]
+            distance = (np.absolute(values[i+1:] - values[i]) * shared).sum(axis=1, dtype=np.float64)
+            shared_gns = (presence[i+1:] & presence[i]).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distance_matrix[i, i+1:] = distance * distance / (shared_gns * shared_gns)
+            distance_matrix[i+1:, i] = distance_matrix[i, i+1:]
+
+        return distance_matrix
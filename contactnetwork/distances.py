@@ -4,13 +4,200 @@ from django.core.cache import cache
 
 from structure.models import Structure
 from contactnetwork.models import *
+from contactnetwork.distance_store import DistanceMapStore
 from residue.models import Residue, ResidueGenericNumber
 
 from collections import OrderedDict
 
+import math
+
 import numpy as np
 
 
+# GNs left out of the TM distances (H8 and loops), pairs with a GN containing one of these are excluded
+TM_EXCLUDED = ['8x', '12x', '23x', '34x', '45x']
+
+
+class PackedDistances():
+    """Distances of one structure, from its StructureDistances row.
+
+    Pairs are the upper triangle of the GN x GN matrix (in the order of np.triu_indices) and are labelled gn1_gn2,
+    like the gns_pair of Distance. Pairs are selected as (i, j) arrays of GN indices.
+    """
+    distance_types = {'CA': 'distance', 'CB': 'distance_cb', 'HC': 'distance_helix_center'}
+
+    def __init__(self, structure_id, pdb, gns, amino_acids, values):
+        self.structure_id = structure_id
+        self.pdb = pdb
+        self.gns = np.array(gns.split(), dtype=str)
+        self.amino_acids = np.array(list(amino_acids), dtype=str)
+        self.index = {gn: i for i, gn in enumerate(self.gns.tolist())}
+        self.values = values
+
+    def pairs(self, excluded=None, gns=None, partner=None):
+        """Pairs without a GN containing one of the excluded strings, with both GNs in gns when given, and with the
+        partner GN when given"""
+        keep = np.ones(len(self.gns), dtype=bool)
+        for part in excluded or []:
+            keep &= np.char.find(self.gns, part) < 0
+        if gns is not None:
+            keep &= np.isin(self.gns, list(gns))
+        i, j = np.triu_indices(len(self.gns), 1)
+        selected = keep[i] & keep[j]
+        if partner is not None:
+            selected &= (self.gns[i] == partner) | (self.gns[j] == partner)
+        return i[selected], j[selected]
+
+    def find(self, gns_pairs):
+        """Pairs of the structure among the given gn1_gn2 labels"""
+        found = []
+        for label in gns_pairs:
+            gn1, sep, gn2 = label.partition('_')
+            i, j = self.index.get(gn1), self.index.get(gn2)
+            if i is not None and j is not None and i < j:
+                found.append((i, j))
+        if not found:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        i, j = np.array(found).T
+        return i, j
+
+    def labels(self, i, j):
+        return np.char.add(np.char.add(self.gns[i], '_'), self.gns[j])
+
+    def distances(self, i, j, distance_type='CA'):
+        """Distances (A) of the pairs, NaN where there is none"""
+        n = len(self.gns)
+        return self.values[distance_type][i * n - i * (i + 1) // 2 + j - i - 1]
+
+
+def load_packed_distances(structures, distance_types=('CA',)):
+    """PackedDistances of the structures (a queryset, Structure objects or ids), ordered by PDB code. Only the given
+    distance types are read."""
+    fields = [PackedDistances.distance_types[distance_type] for distance_type in distance_types]
+    rows = StructureDistances.objects.filter(structure__in=structures).order_by('structure__pdb_code__index') \
+        .values_list('structure_id', 'structure__pdb_code__index', 'gns', 'amino_acids', *fields)
+    return [PackedDistances(pk, pdb, gns, amino_acids, {distance_type: StructureDistances.unpack(data)
+        for distance_type, data in zip(distance_types, values)}) for pk, pdb, gns, amino_acids, *values in rows]
+
+
+def pair_distances(packed, distance_type='CA', excluded=None, gns=None):
+    """Labels, distances (A) and PDB codes of all pairs with a distance, over the given PackedDistances"""
+    labels, values, pdbs = [], [], []
+    for structure in packed:
+        i, j = structure.pairs(excluded, gns)
+        distances = structure.distances(i, j, distance_type)
+        present = ~np.isnan(distances)
+        labels.append(structure.labels(i[present], j[present]))
+        values.append(distances[present])
+        pdbs.append(np.full(present.sum(), structure.pdb))
+    if not labels:
+        return np.zeros(0, dtype=str), np.zeros(0), np.zeros(0, dtype=str)
+    return np.concatenate(labels), np.concatenate(values), np.concatenate(pdbs)
+
+
+def group_by_pair(labels, *columns):
+    """Values of the columns per pair label, as {label: [column values, ...]}"""
+    if not len(labels):
+        return {}
+    keys, inverse = np.unique(labels, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse))[:-1]
+    grouped = [np.split(column[order], splits) for column in columns]
+    return {key: [column[k] for column in grouped] for k, key in enumerate(keys.tolist())}
+
+
+def distance_values(structures, gns_pairs=None, partner=None, distance_type='CA'):
+    """Distances of the structures in the form of Distance.objects.values() rows, with the distance scaled by
+    distance_scaling_factor. Only the gns_pairs when given, and only the pairs with the partner GN when given."""
+    rows = []
+    for structure in load_packed_distances(structures, [distance_type]):
+        if gns_pairs is not None:
+            i, j = structure.find(gns_pairs)
+        else:
+            i, j = structure.pairs()
+        if partner is not None:
+            selected = (structure.gns[i] == partner) | (structure.gns[j] == partner)
+            i, j = i[selected], j[selected]
+        distances = structure.distances(i, j, distance_type)
+        for label, distance, aa1, aa2 in zip(structure.labels(i, j).tolist(), distances.tolist(),
+                structure.amino_acids[i].tolist(), structure.amino_acids[j].tolist()):
+            if not math.isnan(distance):
+                rows.append({'structure__pk': structure.structure_id, 'structure__pdb_code__index': structure.pdb,
+                    'gns_pair': label, 'distance': int(round(distance * distance_scaling_factor)),
+                    'res1__amino_acid': aa1, 'res2__amino_acid': aa2})
+    return rows
+
+
+class PairStatistics():
+    """Sufficient statistics (count, sum and sum of squares) of the distances per pair of a DistanceTable, for a group
+    of structures.
+
+    Statistics are added and subtracted like the groups of structures they are computed from, so the statistics of
+    overlapping groups share the sums of the structures they have in common.
+    """
+    def __init__(self, count, total, squares):
+        self.count = count
+        self.total = total
+        self.squares = squares
+
+    def __add__(self, other):
+        return PairStatistics(self.count + other.count, self.total + other.total, self.squares + other.squares)
+
+    def __sub__(self, other):
+        return PairStatistics(self.count - other.count, self.total - other.total, self.squares - other.squares)
+
+    def mean(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.total / self.count
+
+    def variance(self):
+        """Population variance (as StdDev/Variance in the database)"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.maximum(self.squares / self.count - self.mean()**2, 0)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+
+class DistanceTable():
+    """Distances (A) of a set of structures as a (structure x pair) array, NaN where a structure has no distance.
+
+    Each row holds the contribution of one structure to the statistics of a group (1, d and d^2 per pair), so the
+    statistics of any group of the structures are sums over rows.
+    """
+    def __init__(self, pdbs, labels, values):
+        self.pdbs = pdbs
+        self.labels = labels
+        self.values = values
+        self.rows = {pdb: i for i, pdb in enumerate(pdbs)}
+
+    @classmethod
+    def load(cls, structures, distance_type='CA', excluded=None, gns=None):
+        packed = load_packed_distances(structures, [distance_type])
+        labels, values, pdbs = pair_distances(packed, distance_type, excluded, gns)
+        keys, columns = np.unique(labels, return_inverse=True)
+
+        pdb_list = np.array([structure.pdb for structure in packed], dtype=str)
+        order = np.argsort(pdb_list)
+        rows = order[np.searchsorted(pdb_list, pdbs, sorter=order)] if len(pdbs) else np.zeros(0, dtype=int)
+
+        table = np.full((len(packed), len(keys)), np.nan)
+        table[rows, columns] = values
+        return cls(pdb_list.tolist(), keys, table)
+
+    def statistics(self, pdbs):
+        """PairStatistics of the structures (PDB codes) of the table among pdbs"""
+        values = self.values[[self.rows[pdb] for pdb in pdbs if pdb in self.rows]]
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0)
+        return PairStatistics(present.sum(axis=0), values.sum(axis=0), (values**2).sum(axis=0))
+
+    def pair_values(self, column, pdbs):
+        """Distances of one pair for the structures among pdbs that have it, as {pdb: distance}"""
+        return {pdb: float(self.values[self.rows[pdb], column]) for pdb in pdbs
+            if pdb in self.rows and not np.isnan(self.values[self.rows[pdb], column])}
+
+
 class Distances():
     """A class to do distances"""
     def __init__(self):
@@ -51,15 +238,9 @@ class Distances():
         # temp_buffers = 500MB
         # sudo /etc/init.d/postgresql restart
 
-        ds = list(Distance.objects.filter(structure__in=self.structures) \
-                            .values('gns_pair').annotate(arr=ArrayAgg('distance')).values_list('gns_pair','arr'))
-        # #print(ds)
-        # print(ds.query)
-        # print(len(ds))
-        # for i,d in enumerate(ds):
-        #     print(d)
-        #     if i>100:
-        #         break
+        labels, values, pdbs = pair_distances(load_packed_distances(self.structures))
+        ds = [(label, (distances * distance_scaling_factor).round().astype(int).tolist())
+            for label, (distances,) in group_by_pair(labels, values).items()]
         self.data = ds
         self.stats = {}
         self.stats_list = []
@@ -80,24 +261,20 @@ class Distances():
         # temp_buffers = 500MB
         # sudo /etc/init.d/postgresql restart
         ds_with_key = {}
-        if with_arr:
-            ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                            .values('gns_pair') \
-                            .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance'), dis = Count('distance'),arr=ArrayAgg('distance'),arr2=ArrayAgg('structure__pdb_code__index'),arr3=ArrayAgg('gns_pair')).values_list('gns_pair','mean','std','c','dis','arr','arr2','arr3').filter(c__gte=int(0.8*len(self.structures))))
-            for i,d in enumerate(ds):
-                ds[i] = list(ds[i])
-                ds[i][1] = ds[i][1] / distance_scaling_factor
-                ds[i][2] = ds[i][2] / distance_scaling_factor
-                ds[i][5] = [x / distance_scaling_factor for x in ds[i][5]]
-                ds[i][3] = d[2]/d[1]
-                ds_with_key[d[0]] = ds[i]
-        else:
-            ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                            .values('gns_pair') \
-                            .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance')).values_list('gns_pair','mean','std','c').filter(c__gte=int(len(self.structures)*0.8)))
-            for i,d in enumerate(ds):
-                ds[i] += (d[2]/d[1],)
-                ds_with_key[d[0]] = ds[i]
+        labels, values, pdbs = pair_distances(load_packed_distances(self.structures), excluded=TM_EXCLUDED)
+        ds = []
+        for label, (distances, label_pdbs) in group_by_pair(labels, values, pdbs).items():
+            if len(distances) < int(0.8*len(self.structures)):
+                continue
+            # statistics of the scaled distances, with the population SD (as StdDev)
+            scaled = distances * distance_scaling_factor
+            mean, std = float(scaled.mean()), float(scaled.std())
+            if with_arr:
+                ds.append([label, mean / distance_scaling_factor, std / distance_scaling_factor, std/mean,
+                    len(distances), distances.tolist(), label_pdbs.tolist(), [label] * len(distances)])
+            else:
+                ds.append((label, mean, std, len(distances), std/mean))
+            ds_with_key[label] = ds[-1]
         # # print(ds.query)
         # print(ds[1])
         # Assume that dispersion is always 4
@@ -343,41 +520,14 @@ class Distances():
         self.stats_window_key = stats_window_key
 
     def fetch_distances(self):
-        ds = Distance.objects.filter(structure__in=self.structures).all().values_list('distance','gns_pair')
-        self.data = {}
-        for d in ds:
-            label = d[1]
-            if label not in self.data:
-                self.data[label] = []
-            self.data[label].append(d[0]/distance_scaling_factor)
+        labels, values, pdbs = pair_distances(load_packed_distances(self.structures))
+        self.data = {label: distances.tolist() for label, (distances,) in group_by_pair(labels, values).items()}
 
     def fetch_distances_tm(self, distance_type = "CA"):
-#                .filter(gn1__in=self.filter_gns).filter(gn2__in=self.filter_gns) \
-        # ds = Distance.objects.filter(structure__in=self.structures) \
-        #         .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x')
-
-        if distance_type == "HC":
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance_helix_center','gns_pair')
-        elif distance_type == "CB":
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance_cb','gns_pair')
-        else:
-            ds = Distance.objects.filter(structure__in=self.structures) \
-                .exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
-                .values_list('distance','gns_pair')
-
-        if self.filtered_gns:
-            ds = ds.filter(gn1__in=self.filter_gns).filter(gn2__in=self.filter_gns) \
-
-        self.data = {}
-        for d in ds:
-            label = d[1]
-            if label not in self.data:
-                self.data[label] = []
-            self.data[label].append(d[0]/distance_scaling_factor)
+        gns = self.filter_gns if self.filtered_gns else None
+        labels, values, pdbs = pair_distances(load_packed_distances(self.structures, [distance_type]), distance_type,
+            TM_EXCLUDED, gns)
+        self.data = {label: distances.tolist() for label, (distances,) in group_by_pair(labels, values).items()}
 
     def calculate(self):
         self.stats = {}
@@ -400,6 +550,11 @@ class Distances():
         # common GNs
         common_gn = self.fetch_common_gns_tm()
 
+        # Use the precomputed distance maps when all structures are covered
+        store = DistanceMapStore.load()
+        if store is not None and store.covers(self.pdbs):
+            return store.distance_matrix(self.pdbs, common_gn, normalize)
+
 #            .filter(label__in=self.filter_gns) \
         all_gns = ResidueGenericNumber.objects.filter(scheme__slug='gpcrdb')\
             .exclude(label__startswith='8x') \
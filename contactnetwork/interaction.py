@@ -12,14 +12,16 @@ class InteractingPair:
     NUM_SKIP_BB_INTERACTIONS = 4
 
     'Common base class for all interactions'
-    def __init__(self, res1, res2, dbres1, dbres2, structure):
+    def __init__(self, res1, res2, dbres1, dbres2, structure, classify=True):
         self.res1 = res1
         self.res2 = res2
         self.dbres1 = dbres1
         self.dbres2 = dbres2
         self.structure = structure
         self.interactions = []
-        self.compute_interactions()
+        # pairs classified in batch (see contactnetwork.classifier) get their interactions assigned afterwards
+        if classify:
+            self.compute_interactions()
 
     def add_interactions(self, interaction):
         self.interactions.append(interaction)
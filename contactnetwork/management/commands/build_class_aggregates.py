@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from contactnetwork.aggregate_store import ClassAggregateStore
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Build the class level aggregates of the interaction browser (conservation, ligand and complex interactions, mutations)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Recompute all classes, also the unchanged ones')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        ClassAggregateStore.build(full=options['full'])
+        print("Built class aggregates in {:.1f} seconds".format(time.time() - start))
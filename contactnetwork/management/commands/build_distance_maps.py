@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from contactnetwork.distance_store import DistanceMapStore
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Build the memory-mapped per-structure distance maps used for structure clustering"
+
+    def handle(self, *args, **options):
+        start = time.time()
+        DistanceMapStore.build()
+        print("Built distance maps in {:.1f} seconds".format(time.time() - start))
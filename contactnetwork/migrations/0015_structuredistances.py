@@ -0,0 +1,30 @@
+# Generated by Django 3.1.7 on 2026-10-17 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0040_delete_structurecomplexprotein'),
+        ('contactnetwork', '0014_contactnetworkbuild'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureDistances',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gns', models.TextField()),
+                ('amino_acids', models.TextField()),
+                ('distance', models.BinaryField()),
+                ('distance_cb', models.BinaryField()),
+                ('distance_helix_center', models.BinaryField()),
+                ('structure', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='packed_distances', to='structure.structure')),
+            ],
+            options={
+                'db_table': 'structure_distances',
+            },
+        ),
+    ]
@@ -7,6 +7,10 @@ import statistics
 
 distance_scaling_factor = 10000
 
+# packed distances are stored as uint16 in steps of 1/500 A (up to 131 A), the largest value marks missing distances
+packed_distance_scale = 500
+packed_distance_missing = 65535
+
 class InteractingResiduePair(models.Model):
     referenced_structure = models.ForeignKey('structure.Structure', on_delete=models.CASCADE)
     res1 = models.ForeignKey('residue.Residue', related_name='residue1', on_delete=models.CASCADE)
@@ -23,6 +27,17 @@ class InteractingResiduePair(models.Model):
         db_table = 'interacting_residue_pair'
 
 
+class ContactNetworkBuild(models.Model):
+    # fingerprint of the coordinates and residue annotation the contact network was computed from
+    structure = models.OneToOneField('structure.Structure', on_delete=models.CASCADE)
+    content_hash = models.CharField(max_length=32)
+    build_time = models.FloatField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta():
+        db_table = 'contact_network_build'
+
+
 class Interaction(models.Model):
     interacting_pair = models.ForeignKey('contactnetwork.InteractingResiduePair', on_delete=models.CASCADE)
     interaction_type = models.CharField(max_length=100)
@@ -75,6 +90,36 @@ class Distance(models.Model):
     class Meta():
         db_table = 'distance'
 
+
+class StructureDistances(models.Model):
+    # distances between all residues with a generic number of a structure, as the upper triangle of the GN x GN
+    # matrix per distance type, in units of 1/packed_distance_scale A (see contactnetwork.distances.PackedDistances)
+    structure = models.OneToOneField('structure.Structure', related_name='packed_distances', on_delete=models.CASCADE)
+    gns = models.TextField()
+    amino_acids = models.TextField()
+    distance = models.BinaryField()
+    distance_cb = models.BinaryField()
+    distance_helix_center = models.BinaryField()
+
+    @staticmethod
+    def pack(distances):
+        """uint16 bytes of distances (A), values without a distance (NaN) are packed_distance_missing"""
+        distances = np.asarray(distances, dtype=np.float64)
+        packed = np.minimum(np.round(distances * packed_distance_scale), packed_distance_missing - 1)
+        packed[np.isnan(distances)] = packed_distance_missing
+        return packed.astype('<u2').tobytes()
+
+    @staticmethod
+    def unpack(data):
+        """Distances (A) of packed bytes, NaN where there is no distance"""
+        packed = np.frombuffer(data, dtype='<u2')
+        distances = packed / float(packed_distance_scale)
+        distances[packed == packed_distance_missing] = np.nan
+        return distances
+
+    class Meta():
+        db_table = 'structure_distances'
+
 def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, standard_deviation = False, split_by_amino_acid = False):
     ## Returned dataset is in ClassA GNs...
     matrix = {}
@@ -84,8 +129,8 @@ def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, st
         # Never get SD when only looking at a single pdb...
         standard_deviation = False
 
-    ds = list(Distance.objects.filter(structure__pdb_code__index__in=[ pdb.upper() for pdb in pdbs], gns_pair__in=interaction_keys) \
-                         .values('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
+    from contactnetwork.distances import distance_values
+    ds = distance_values(Structure.objects.filter(pdb_code__index__in=[ pdb.upper() for pdb in pdbs]), interaction_keys)
     if not normalized:
         for d in ds:
             if split_by_amino_acid:
@@ -1,3 +1,119 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from Bio.PDB.StructureBuilder import StructureBuilder
+
+from contactnetwork.classifier import InteractionClassifier
+from contactnetwork.distance_store import DistanceMapStore
+from contactnetwork.interaction import InteractingPair
+
+import numpy
+
+
+# side chain atoms per amino acid
+SIDE_CHAINS = {
+    'ALA': 'CB', 'ARG': 'CB CG CD NE CZ NH1 NH2', 'ASN': 'CB CG OD1 ND2', 'ASP': 'CB CG OD1 OD2',
+    'CYS': 'CB SG', 'GLN': 'CB CG CD OE1 NE2', 'GLU': 'CB CG CD OE1 OE2', 'GLY': '',
+    'HIS': 'CB CG ND1 CD2 CE1 NE2', 'ILE': 'CB CG1 CG2 CD1', 'LEU': 'CB CG CD1 CD2', 'LYS': 'CB CG CD CE NZ',
+    'MET': 'CB CG SD CE', 'PHE': 'CB CG CD1 CD2 CE1 CE2 CZ', 'PRO': 'CB CG CD', 'SER': 'CB OG',
+    'THR': 'CB OG1 CG2', 'TRP': 'CB CG CD1 CD2 NE1 CE2 CE3 CZ2 CZ3 CH2', 'TYR': 'CB CG CD1 CD2 CE1 CE2 CZ OH',
+    'VAL': 'CB CG1 CG2',
+}
+
+
+def interaction_set(interactions):
+    return sorted((i.__class__.__name__, i.get_type(), i.get_details(), i.atomname_residue1, i.atomname_residue2,
+        i.get_level()) for i in interactions)
+
+
+class InteractionClassifierTest(SimpleTestCase):
+
+    def densely_packed_chain(self, seed, num_residues=120, box=14.0):
+        """Chain of randomly placed residues, packed closely enough to cover all interaction types."""
+        random = numpy.random.RandomState(seed)
+        builder = StructureBuilder()
+        builder.init_structure('test')
+        builder.init_model(0)
+        builder.init_chain('A')
+        builder.init_seg(' ')
+        resnames = sorted(SIDE_CHAINS)
+        for i in range(1, num_residues + 1):
+            resname = resnames[random.randint(len(resnames))]
+            builder.init_residue(resname, ' ', i, ' ')
+            atom_names = ['N', 'CA', 'C', 'O'] + SIDE_CHAINS[resname].split()
+            # incomplete side chains
+            if random.rand() < 0.1 and len(atom_names) > 5:
+                atom_names.pop(random.randint(4, len(atom_names)))
+            center = random.uniform(0, box, 3)
+            for name in atom_names:
+                builder.init_atom(name, (center + random.normal(0, 1.5, 3)).astype('f'), 0, 1, ' ', name,
+                    element=name[0])
+        return list(builder.get_structure()[0]['A'])
+
+    def test_same_as_per_pair(self):
+        for seed in range(4):
+            residues = self.densely_packed_chain(seed)
+            pairs = [(res1, res2) for i, res1 in enumerate(residues) for res2 in residues[i+1:]
+                if res1['CA'] - res2['CA'] < 9]
+
+            batch = InteractionClassifier(pairs).classify()
+            self.assertEqual(len(batch), len(pairs))
+            for (res1, res2), interactions in zip(pairs, batch):
+                expected = InteractingPair(res1, res2, None, None, None).get_interactions()
+                self.assertEqual(interaction_set(interactions), interaction_set(expected))
+
+    def test_no_pairs(self):
+        self.assertEqual(InteractionClassifier([]).classify(), [])
+
+
+class DistanceMapStoreTest(SimpleTestCase):
+
+    def random_store(self, seed, num_structures=6, num_gns=12):
+        """Store of random distance maps; structures lack some GNs, pairs of present GNs have a distance"""
+        random = numpy.random.RandomState(seed)
+        gns = ['{}x{}'.format(1 + i // 4, 50 + i % 4) for i in range(num_gns)]
+        presence = random.rand(num_structures, num_gns) > 0.2
+        maps = random.uniform(4, 30, (num_structures, num_gns, num_gns)).astype(numpy.float32)
+        maps *= presence[:, :, None] & presence[:, None, :]
+        maps = numpy.triu(maps, 1)
+        pdbs = ['PDB{}'.format(i) for i in range(num_structures)]
+        return DistanceMapStore({'CA': maps}, pdbs, gns, presence), maps, pdbs, gns
+
+    def per_structure_distance_matrix(self, maps, presence, gns, common_gn, normalize=True):
+        """Distance matrix as calculated per structure by Distances.get_distance_matrix"""
+        gn_indices = numpy.array([gns.index(gn) for gn in common_gn])
+        pdb_distance_maps = [m[gn_indices, :][:, gn_indices].astype(numpy.float64) for m in maps]
+        pdb_gns = [[gn for gn, present in zip(gns, p) if present] for p in presence]
+        if normalize:
+            average = sum(m / len(maps) for m in pdb_distance_maps)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                pdb_distance_maps = [numpy.nan_to_num(m / average) for m in pdb_distance_maps]
+
+        distance_matrix = numpy.full((len(maps), len(maps)), 0.0)
+        for i in range(len(maps)):
+            for j in range(i+1, len(maps)):
+                shared = sorted(set(common_gn).intersection(pdb_gns[i]).intersection(pdb_gns[j]))
+                indices = numpy.array([common_gn.index(gn) for gn in shared])
+                distance = numpy.sum(numpy.absolute(pdb_distance_maps[i][indices, :][:, indices] -
+                    pdb_distance_maps[j][indices, :][:, indices]))
+                distance_matrix[i, j] = distance_matrix[j, i] = distance * distance / (len(indices) * len(indices))
+        return distance_matrix
+
+    def test_distance_maps(self):
+        store, maps, pdbs, gns = self.random_store(0)
+        selected = [pdbs[4], pdbs[1], pdbs[2]]
+        query = [gns[7], gns[2], 'unknown', gns[9]]
+        result, presence = store.distance_maps(selected, query)
+        for i, pdb in enumerate(selected):
+            for j, gn1 in enumerate(query):
+                self.assertEqual(presence[i, j], gn1 in gns and store.presence[pdbs.index(pdb), gns.index(gn1)])
+                for k, gn2 in enumerate(query):
+                    expected = maps[pdbs.index(pdb), gns.index(gn1), gns.index(gn2)] if 'unknown' not in (gn1, gn2) else 0
+                    self.assertEqual(result[i, j, k], expected)
+
+    def test_same_as_per_structure(self):
+        for seed in range(4):
+            store, maps, pdbs, gns = self.random_store(seed)
+            common_gn = gns[1:-1]
+            for normalize in (True, False):
+                expected = self.per_structure_distance_matrix(maps, store.presence, gns, common_gn, normalize)
+                numpy.testing.assert_allclose(store.distance_matrix(pdbs, common_gn, normalize), expected, rtol=1e-5)
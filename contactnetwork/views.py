@@ -16,6 +16,7 @@ import copy
 
 from contactnetwork.models import *
 from contactnetwork.distances import *
+from contactnetwork.aggregate_store import class_aggregate
 from contactnetwork.functions import *
 from structure.models import Structure, StructureVectors, StructureExtraProteins
 from structure.templatetags.structure_extras import *
@@ -38,7 +39,6 @@ import numpy as np
 import pandas as pd
 import scipy.cluster.hierarchy as sch
 import scipy.spatial.distance as ssd
-import time
 import hashlib
 import operator
 
@@ -543,7 +543,6 @@ def PdbTableData(request):
 @csrf_exempt
 def InteractionBrowserData(request):
 
-    start_time = time.time()
     def gpcrdb_number_comparator(e1, e2):
             t1 = e1.split('x')
             t2 = e2.split('x')
@@ -713,150 +712,11 @@ def InteractionBrowserData(request):
 
     # data = None
     if data==None:
-        cache_key = 'amino_acid_pair_conservation_{}_{}'.format(gpcr_class,forced_class_a)
-        print('Before getting class cache',time.time()-start_time)
-        class_pair_lookup = cache.get(cache_key)
-        print('After getting class cache',time.time()-start_time)
-        # class_pair_lookup=None
-        if class_pair_lookup==None or len(class_pair_lookup)==0:
-            # Class pair conservation
-            sum_proteins = Protein.objects.filter(family__slug__startswith=gpcr_class,sequence_type__slug='wt',species__common_name='Human').count()
-            residues = Residue.objects.filter(protein_conformation__protein__family__slug__startswith=gpcr_class,
-                                              protein_conformation__protein__sequence_type__slug='wt',
-                                              protein_conformation__protein__species__common_name='Human',
-
-                        ).exclude(generic_number=None).values('pk','sequence_number','generic_number__label','amino_acid','protein_conformation__protein__entry_name','display_generic_number__label').all()
-            r_pair_lookup = defaultdict(lambda: defaultdict(lambda: set()))
-            for r in residues:
-                # use the class specific generic number
-                r['display_generic_number__label'] = re.sub(r'\.[\d]+', '', r['display_generic_number__label'])
-                if forced_class_a:
-                    r_pair_lookup[r['generic_number__label']][r['amino_acid']].add(r['protein_conformation__protein__entry_name'])
-                else:
-                    r_pair_lookup[r['display_generic_number__label']][r['amino_acid']].add(r['protein_conformation__protein__entry_name'])
-            class_pair_lookup = {}
-
-            gen_keys = sorted(r_pair_lookup.keys(), key=functools.cmp_to_key(gpcrdb_number_comparator))
-            for i,gen1 in enumerate(gen_keys):
-                v1 = r_pair_lookup[gen1]
-                temp_score_dict = []
-                for aa, protein in v1.items():
-                    temp_score_dict.append([aa,len(protein)/sum_proteins])
-
-                most_freq_aa = sorted(temp_score_dict.copy(), key = lambda x: -x[1])[0]
-                class_pair_lookup[gen1] = most_freq_aa
-                for gen2 in gen_keys[i:]:
-                    if gen1 == gen2:
-                        continue
-                    pairs = {}
-                    v2 = r_pair_lookup[gen2]
-                    coord = '{},{}'.format(gen1,gen2)
-                    for aa1 in v1.keys():
-                        p1 = v1[aa1]
-                        class_pair_lookup[gen1+aa1] = round(100*len(p1)/sum_proteins)
-                        for aa2 in v2.keys():
-                            pair = '{}{}'.format(aa1,aa2)
-                            p2 = v2[aa2]
-                            p = p1.intersection(p2)
-                            if p:
-                                class_pair_lookup[coord+pair] = round(100*len(p)/sum_proteins)
-            cache.set(cache_key, class_pair_lookup, 3600 * 24 * 7)
-
-        ### Fetch class ligand / G-protein interactions for snakeplot colouring
-        cache_key = 'class_ligand_interactions_{}_{}'.format(gpcr_class,forced_class_a)
-        class_ligand_interactions = cache.get(cache_key)
-        # class_ligand_interactions=None
-        if class_ligand_interactions==None or len(class_ligand_interactions)==0:
-            class_interactions = ResidueFragmentInteraction.objects.filter(
-                structure_ligand_pair__structure__protein_conformation__protein__family__slug__startswith=gpcr_class, structure_ligand_pair__annotated=True).prefetch_related(
-                'rotamer__residue__generic_number',
-                'rotamer__residue__display_generic_number',
-                'structure_ligand_pair__structure__protein_conformation__protein__family')
-
-            class_ligand_interactions = {}
-            for i in class_interactions:
-                p = i.structure_ligand_pair.structure.protein_conformation.protein.family.slug
-                if i.rotamer.residue.generic_number:
-
-                    display_gn = re.sub(r'\.[\d]+', '', i.rotamer.residue.generic_number.label)
-                    if forced_class_a:
-                        gn = i.rotamer.residue.generic_number.label
-                    else:
-                        gn = display_gn
-
-                else:
-                    continue
-                if gn not in class_ligand_interactions.keys():
-                    class_ligand_interactions[gn] = set()
-
-                class_ligand_interactions[gn].add(p)
-            class_ligand_interactions = {key: len(value) for key, value in class_ligand_interactions.items()}
-            cache.set(cache_key, class_ligand_interactions, 3600 * 24 * 7)
-
-        cache_key = 'class_complex_interactions_{}_{}'.format(gpcr_class,forced_class_a)
-        class_complex_interactions = cache.get(cache_key)
-        # class_ligand_interactions=None
-        if class_complex_interactions == None or len(class_complex_interactions) == 0:
-
-            interactions = Interaction.objects.filter(
-                interacting_pair__referenced_structure__protein_conformation__protein__family__slug__startswith=gpcr_class
-            ).exclude(
-                interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id') # Filter interactions with other proteins
-            ).distinct(
-            ).exclude(
-                specific_type='water-mediated'
-            ).values(
-                'interaction_type',
-                'interacting_pair__referenced_structure__protein_conformation__protein__family__slug',
-                'interacting_pair__res1__generic_number__label',
-                'interacting_pair__res1__display_generic_number__label',
-                'interacting_pair__res2__pk',
-            )
-
-            class_complex_interactions = {}
-            for i in interactions:
-                p = i['interacting_pair__referenced_structure__protein_conformation__protein__family__slug']
-
-                display_gn = re.sub(r'\.[\d]+', '', i['interacting_pair__res1__display_generic_number__label'])
-                if forced_class_a:
-                    gn = i['interacting_pair__res1__generic_number__label']
-                else:
-                    gn = display_gn
-
-                if gn not in class_complex_interactions.keys():
-                    class_complex_interactions[gn] = set()
-
-                class_complex_interactions[gn].add(p)
-
-
-            class_complex_interactions = {key: len(value) for key, value in class_complex_interactions.items()}
-            cache.set(cache_key, class_complex_interactions, 3600 * 24 * 7)
-
-        cache_key = 'class_mutation_positions_{}_{}'.format(gpcr_class,forced_class_a)
-        class_mutations = cache.get(cache_key)
-        # class_ligand_interactions=None
-        if class_mutations == None or len(class_mutations) == 0:
-
-            class_mutations_q = MutationExperiment.objects.filter(protein__family__slug__startswith=gpcr_class).prefetch_related('protein__family','protein__parent__family','residue__generic_number','residue__display_generic_number').order_by('foldchange','exp_qual')
-
-            class_mutations = {}
-            for m in class_mutations_q:
-
-                if m.residue.generic_number and abs(m.foldchange)>5:
-                    p = m.protein.family.slug
-                    foldchange = m.foldchange
-                    d_gn = m.residue.display_generic_number.label
-                    gn = m.residue.generic_number.label
-                    display_gn = re.sub(r'\.[\d]+', '', d_gn)
-                    if not forced_class_a:
-                        gn = display_gn
-                    if gn not in class_mutations.keys():
-                        class_mutations[gn] = set()
-
-                    class_mutations[gn].add(p)
-
-            class_mutations = {key: len(value) for key, value in class_mutations.items()}
-            cache.set(cache_key, class_mutations, 3600 * 24 * 7)
+        # Class level aggregates, precomputed by build_class_aggregates
+        class_pair_lookup = class_aggregate('amino_acid_pair_conservation', gpcr_class, forced_class_a)
+        class_ligand_interactions = class_aggregate('class_ligand_interactions', gpcr_class, forced_class_a)
+        class_complex_interactions = class_aggregate('class_complex_interactions', gpcr_class, forced_class_a)
+        class_mutations = class_aggregate('class_mutation_positions', gpcr_class, forced_class_a)
 
         # Get the relevant interactions
         # TODO MAKE SURE ITs only gpcr residues..
@@ -996,69 +856,7 @@ def InteractionBrowserData(request):
         # TODO, check if can be deleted... it is regenerated later with class_specific numbers
         # distinct_gns = list(Residue.objects.filter(protein_conformation__protein__entry_name__in=pdbs).exclude(generic_number=None).values_list('generic_number__label','protein_segment__slug').distinct().order_by())
 
-        all_pdbs_pairs = cache.get("all_pdbs_aa_pairs")
-        # all_pdbs_pairs = None
-        if not all_pdbs_pairs:
-            # To save less, first figure out all possible interaction pairs
-            pos_interactions = list(Interaction.objects.all(
-            ).values_list(
-                'interacting_pair__res1__generic_number__label',
-                'interacting_pair__res2__generic_number__label',
-            ).filter(interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')).distinct())
-
-            all_interaction_pairs = []
-            all_interaction_residues = set()
-            for i in pos_interactions:
-                all_interaction_pairs.append('{},{}'.format(i[0],i[1]))
-                all_interaction_residues.add(i[0])
-                all_interaction_residues.add(i[1])
-            all_interaction_residues = sorted(list(all_interaction_residues), key=functools.cmp_to_key(gpcrdb_number_comparator))
-
-            all_pdbs = list(Structure.objects.all().values_list('pdb_code__index', flat=True))
-            all_pdbs = [x.lower() for x in all_pdbs]
-            #generic_number__label__in=all_interaction_residues)
-            residues = Residue.objects.filter(protein_conformation__protein__entry_name__in=all_pdbs).exclude(generic_number=None).values(
-                        'pk','sequence_number','display_generic_number__label','generic_number__label','amino_acid','protein_conformation__protein__entry_name','protein_segment__slug').all()
-
-            r_lookup = {}
-            r_pair_lookup = defaultdict(lambda: defaultdict(lambda: []))
-            segm_lookup = {}
-            r_presence_lookup = defaultdict(lambda: [])
-            r_class_translate = {}
-
-            for r in residues:
-                if r['generic_number__label'] not in all_interaction_residues:
-                    continue
-                r_lookup[r['pk']] = r
-                r_pair_lookup[r['generic_number__label']][r['amino_acid']].append(r['protein_conformation__protein__entry_name'])
-                r_presence_lookup[r['generic_number__label']].append(r['protein_conformation__protein__entry_name'])
-                segm_lookup[r['generic_number__label']] = r['protein_segment__slug']
-                r['display_generic_number__label'] = re.sub(r'\.[\d]+', '', r['display_generic_number__label'])
-                r_class_translate[r['generic_number__label']] = r['display_generic_number__label']
-
-            gen_keys = sorted(r_pair_lookup.keys(), key=functools.cmp_to_key(gpcrdb_number_comparator))
-            all_pdbs_pairs = {}
-            for i,gen1 in enumerate(all_interaction_residues):
-                for gen2 in all_interaction_residues[i:]:
-                    if gen1 == gen2:
-                        continue
-                    pairs = {}
-                    v1 = r_pair_lookup[gen1]
-                    v2 = r_pair_lookup[gen2]
-                    coord = '{},{}'.format(gen1,gen2)
-                    if coord not in all_interaction_pairs:
-                        continue
-                    for aa1 in v1.keys():
-                        for aa2 in v2.keys():
-                            pair = '{}{}'.format(aa1,aa2)
-                            p1 = set(v1[aa1])
-                            p2 = set(v2[aa2])
-                            p = list(p1.intersection(p2))
-                            if p:
-                                if coord not in all_pdbs_pairs:
-                                    all_pdbs_pairs[coord] = {}
-                                all_pdbs_pairs[coord][pair] = p
-            cache.set("all_pdbs_aa_pairs",all_pdbs_pairs,60*60*24*7) #Cache results
+        all_pdbs_pairs = class_aggregate('all_pdbs_aa_pairs')
         residues = Residue.objects.filter(protein_conformation__protein__entry_name__in=pdbs
                 ).exclude(generic_number=None).values('pk','sequence_number','generic_number__label','amino_acid','protein_conformation__protein__entry_name','protein_segment__slug','display_generic_number__label').all()
         r_lookup = {}
@@ -1111,7 +909,6 @@ def InteractionBrowserData(request):
         # Dict to keep track of which residue numbers are in use
         number_dict = set()
 
-        print('Start going through interactions',time.time()-start_time)
         for i in interactions:
             s = i['interacting_pair__referenced_structure__pk']
             pdb_name = s_lookup[s][1]
@@ -1273,7 +1070,6 @@ def InteractionBrowserData(request):
                         data['missing'][res[0]]['present'].add(pdb)
             data['missing'][res[0]]['present'] = list(data['missing'][res[0]]['present'])
 
-        print('Do Secondary data',time.time()-start_time)
         data['secondary'] = {}
         secondary_dict = {'set1':0 , 'set2':0, 'aa_pairs':OrderedDict()}
         secondary_dict_single = {'set':0 , 'aa_pairs':OrderedDict()}
@@ -1530,7 +1326,6 @@ def InteractionBrowserData(request):
 
 
         ## PREPARE ADDITIONAL DATA (INTERACTIONS AND ANGLES)
-        print('Prepare distance values for',mode,'mode',time.time()-start_time)
         interaction_keys = [k.replace(",","_") for k in data['interactions'].keys()]
         interaction_keys = [v['class_a_gns'].replace(",","_") for k,v in data['interactions'].items()]
         if mode == "double":
@@ -1538,7 +1333,6 @@ def InteractionBrowserData(request):
             group_1_distances = get_distance_averages(data['pdbs1'],s_lookup, interaction_keys,normalized, standard_deviation = False)
             group_2_distances = get_distance_averages(data['pdbs2'],s_lookup, interaction_keys,normalized, standard_deviation = False)
 
-            print('got distance values for',mode,'mode',time.time()-start_time)
             for coord in data['interactions']:
                 distance_coord = coord.replace(",", "_")
                 # Replace coord to ensure using classA as distances are indexed with those
@@ -1548,7 +1342,6 @@ def InteractionBrowserData(request):
                 else:
                     distance_diff = ""
                 data['interactions'][coord]['distance'] = distance_diff
-            print('Done merging distance values for',mode,'mode',time.time()-start_time)
         else:
             group_distances = get_distance_averages(data['pdbs'],s_lookup, interaction_keys,normalized, standard_deviation = True)
             for coord in data['interactions']:
@@ -1563,9 +1356,7 @@ def InteractionBrowserData(request):
 
         # del class_pair_lookup
         # del r_pair_lookup
-        print('Prepare all angles values for',mode,'mode',time.time()-start_time)
         data['all_angles'] = get_all_angles(pdbs_upper,data['pfs'],normalized, forced_class_a = forced_class_a)
-        print('Prepare angles values for',mode,'mode',time.time()-start_time)
 
         if mode == "double":
 
@@ -1574,7 +1365,6 @@ def InteractionBrowserData(request):
             data['all_angles_set1'] = get_all_angles(data['pdbs1'],data['pfs1'],normalized, forced_class_a = forced_class_a)
             data['all_angles_set2'] = get_all_angles(data['pdbs2'],data['pfs2'],normalized, forced_class_a = forced_class_a)
 
-            print('got angles values for',mode,'mode',time.time()-start_time)
             custom_angles = ['a_angle', 'outer_angle', 'phi', 'psi', 'theta', 'tau']
             index_names = {0:'core_distance',1:'a_angle',2:'outer_angle',3:'tau',4:'phi',5:'psi',6: 'sasa',7: 'rsa',8:'theta',9:'hse',10:'tau_angle', 11:'tau', 12:'rotation_angle'}
 
@@ -1641,7 +1431,6 @@ def InteractionBrowserData(request):
                     data['tab4'][gn]['angles_set2'] = [''] * 11
 
 
-            print('Done combining data',mode,'mode',time.time()-start_time)
         else:
 
             # get_angle_averages gets "mean" in case of single pdb
@@ -1736,7 +1525,6 @@ def InteractionBrowserData(request):
                 d['types_count'] = defaultdict(set)
                 for key, val in merged_types_structures:
                     d['types_count'][key].add(val)
-            print('Gotten first set occurance calcs',time.time()-start_time)
 
             set_id = 'set2'
             interactions = list(Interaction.objects.filter(
@@ -1779,7 +1567,6 @@ def InteractionBrowserData(request):
 
                 for key, val in merged_types_structures:
                     d['types_count'][key].add(val)
-            print('Gotten second set occurance calcs',time.time()-start_time)
 
             ## Fill in remaining data
             pdbs1 = data['pdbs1']
@@ -1962,7 +1749,6 @@ def InteractionBrowserData(request):
                 else:
                     d['set']['occurance'] = {'aa1':pdbs1_with_aa1,'aa2':pdbs1_with_aa2,'pair':pdbs1_with_pair}
 
-        print('Prepare distance values for aa/gen for',mode,'mode',time.time()-start_time)
         interaction_keys = [k.replace(",","_") for k in data['interactions'].keys()]
         interaction_keys = [v['class_a_gns'].replace(",","_") for k,v in data['interactions'].items()]
         if mode == "double":
@@ -1972,7 +1758,6 @@ def InteractionBrowserData(request):
 
             group_2_distances = get_distance_averages(data['pdbs2'],s_lookup, interaction_keys,normalized, standard_deviation = False, split_by_amino_acid = True)
 
-            print('got distance values for',mode,'mode',time.time()-start_time)
             for key, d in data['tab2'].items():
                 class_a_key = '{}{}'.format(d['classA'], key[-2:])
                 if class_a_key in group_1_distances and class_a_key in group_2_distances:
@@ -1980,7 +1765,6 @@ def InteractionBrowserData(request):
                 else:
                     distance_diff = ""
                 d['distance'] = distance_diff
-            print('Done merging distance values for',mode,'mode',time.time()-start_time)
         else:
             group_distances = get_distance_averages(data['pdbs'],s_lookup, interaction_keys,normalized, standard_deviation = False, split_by_amino_acid = True)
             for key, d in data['tab2'].items():
@@ -1992,7 +1776,6 @@ def InteractionBrowserData(request):
                 d['distance'] = distance_diff
         # del class_pair_lookup
         # del r_pair_lookup
-        print('calculate angles per gen/aa',time.time()-start_time)
         if mode == "double":
 
             group_1_angles_aa = get_angle_averages(data['pdbs1'],s_lookup, normalized, standard_deviation = False, split_by_amino_acid = True, forced_class_a = forced_class_a)
@@ -2079,7 +1862,6 @@ def InteractionBrowserData(request):
 
 
         #print(data['tab3'])
-        print('calculate tab4',time.time()-start_time)
         del aa_pair_data
         del all_pdbs_pairs
         # del ds
@@ -2180,8 +1962,6 @@ def InteractionBrowserData(request):
         if mode == "double":
             pdbs1_upper = [pdb.upper() for pdb in pdbs1]
             pdbs2_upper = [pdb.upper() for pdb in pdbs2]
-            helical_time = time.time()
-            print("Start helical movements")
             data['tm_movement_2D'] = {}
             # data['tm_movement_2D']["classA_ligands"] = tm_movement_2D(pdbs1_upper, pdbs2_upper, 2, data, r_class_translate_from_classA)
             data['tm_movement_2D']["membrane_mid"] = tm_movement_2D(pdbs1_upper, pdbs2_upper, 3, data, r_class_translate_from_classA)
@@ -2203,28 +1983,22 @@ def InteractionBrowserData(request):
 
             data['tm_movement_2D']["viewbox_size"] = {"diff_x": diff_x, "diff_y" : diff_y}
 
-            print("Helical movement calculations", time.time() - helical_time)
 
         # calculate distance movements
         if mode == "double":
             pdbs1_upper = [pdb.upper() for pdb in pdbs1]
             pdbs2_upper = [pdb.upper() for pdb in pdbs2]
-            print('Start 1')
-            start = time.time()
             dis1 = Distances()
             dis1.load_pdbs(pdbs1_upper)
             dis1.fetch_and_calculate(with_arr = True)
-            print('done fetching set 1',time.time()-start)
             # dis1.calculate_window(list_of_gns)
         #    dis1.calculate()
 
-            start = time.time()
             dis2 = Distances()
             dis2.load_pdbs(pdbs2_upper)
             dis2.fetch_and_calculate(with_arr = True)
             # dis2.calculate_window(list_of_gns)
             #dis2.calculate()
-            print('done fetching set 2',time.time()-start)
 
             diff = OrderedDict()
             from math import sqrt
@@ -2233,7 +2007,6 @@ def InteractionBrowserData(request):
             # for d1 in dis1.stats_window_reduced:
             # for d1 in dis1.stats_window:
 
-            start = time.time()
             total = {}
             common_labels = list(set(dis1.stats_key.keys()).intersection(dis2.stats_key.keys()))
             for label in common_labels:
@@ -2271,8 +2044,6 @@ def InteractionBrowserData(request):
 
             # diff =  OrderedDict(sorted(diff.items(), key=lambda t: -abs(t[1][0])))
             # print(diff)
-            print('done diff',time.time()-start)
-            start = time.time()
             ngl_max_diff = 0
             for gn1 in total.keys():
                 vals = []
@@ -2284,7 +2055,6 @@ def InteractionBrowserData(request):
                 if abs(total[gn1]['avg'])>ngl_max_diff:
                     ngl_max_diff = round(abs(total[gn1]['avg']),1)
 
-            print('done ngl', time.time() - start)
             data['distances'] = total
             data['ngl_max_diff_distance'] = ngl_max_diff
 
@@ -2346,7 +2116,6 @@ def InteractionBrowserData(request):
         else:
             data['pdbs'] = list(data['pdbs'])
         cache.set(hash_cache_key,data,3600*24)
-    print('Done',time.time()-start_time)
 
     return JsonResponse(data)
 
@@ -2458,42 +2227,34 @@ def DistanceDataGroups(request):
                     data['pos_map'][r.sequence_number] = r.amino_acid
                     data['segment_map_full_gn'][r.generic_number.label] = r.protein_segment.slug
 
-    print('Start 1')
-    start = time.time()
-    dis1 = Distances()
-    dis1.load_pdbs(pdbs1)
-    dis1.fetch_and_calculate(with_arr = True)
-    print('done fetching set 1',time.time()-start)
-    # dis1.calculate_window(list_of_gns)
-#    dis1.calculate()
-
-    start = time.time()
-    dis2 = Distances()
-    dis2.load_pdbs(pdbs2)
-    dis2.fetch_and_calculate(with_arr = True)
-    # dis2.calculate_window(list_of_gns)
-    #dis2.calculate()
-    print('done fetching set 2',time.time()-start)
+    structures1 = list(Structure.objects.filter(pdb_code__index__in=pdbs1).values_list('pdb_code__index', flat=True))
+    structures2 = list(Structure.objects.filter(pdb_code__index__in=pdbs2).values_list('pdb_code__index', flat=True))
+    table = DistanceTable.load(Structure.objects.filter(pdb_code__index__in=structures1+structures2), excluded=TM_EXCLUDED)
+
+    # Group statistics are sums over the structures, the structures in both groups are summed once
+    shared = table.statistics(set(structures1) & set(structures2))
+    stats1 = shared + table.statistics(set(structures1) - set(structures2))
+    stats2 = shared + table.statistics(set(structures2) - set(structures1))
+    means1, means2 = stats1.mean(), stats2.mean()
+    stds1, stds2 = stats1.std(), stats2.std()
 
     diff = OrderedDict()
     from math import sqrt
     from scipy import stats
 
-    # for d1 in dis1.stats_window_reduced:
-    # for d1 in dis1.stats_window:
-
-    start = time.time()
     total = {}
-    common_labels = list(set(dis1.stats_key.keys()).intersection(dis2.stats_key.keys()))
-    for label in common_labels:
+    # Pairs with distances in at least 80% of the structures of each group
+    common = (stats1.count > 0) & (stats1.count >= int(0.8*len(structures1))) \
+        & (stats2.count > 0) & (stats2.count >= int(0.8*len(structures2)))
+    for column in np.nonzero(common)[0]:
+        label = table.labels[column]
 
         # Get variables
-        d1, d2 = dis1.stats_key[label],dis2.stats_key[label]
         # Correct decimal
-        mean1, mean2 = d1[1]/100,d2[1]/100
-        std1,std2 = d1[2]/100,d2[2]/100
+        mean1, mean2 = means1[column]/100,means2[column]/100
+        std1,std2 = stds1[column]/100,stds2[column]/100
         var1,var2 = std1**2,std2**2
-        n1, n2 = d1[4],d2[4]
+        n1, n2 = int(stats1.count[column]),int(stats2.count[column])
 
         mean_diff = mean2-mean1
 
@@ -2505,10 +2266,8 @@ def DistanceDataGroups(request):
             total[gn2] = {}
         total[gn1][gn2] = total[gn2][gn1] = round(mean_diff,1)
         # Make easier readable output
-        d1[5] = [x / 100 for x in d1[5]]
-        d2[5] = [x / 100 for x in d2[5]]
-        individual_pdbs_1 = dict(zip(d1[6], d1[5]))
-        individual_pdbs_2 = dict(zip(d2[6], d2[5]))
+        individual_pdbs_1 = {pdb: value / 100 for pdb, value in table.pair_values(column, structures1).items()}
+        individual_pdbs_2 = {pdb: value / 100 for pdb, value in table.pair_values(column, structures2).items()}
 
         if n1>1 and n2>1 and var1>0 and var2>0:
             ## T test to assess seperation of data (only if N>1 and there is variance)
@@ -2522,7 +2281,6 @@ def DistanceDataGroups(request):
 
     diff =  OrderedDict(sorted(diff.items(), key=lambda t: -abs(t[1][0])))
 
-    print('done diff',time.time()-start)
     compared_stats = {}
 
     # Remove differences that seem statistically irrelevant
@@ -2588,7 +2346,6 @@ def DistanceDataGroups(request):
     data['max_diff'] = max_diff
     print(len(data['interactions']),'len data')
     #total = {}
-    start = time.time()
     ngl_max_diff = 0
     for gn1 in total.keys():
         vals = []
@@ -2600,7 +2357,6 @@ def DistanceDataGroups(request):
         if abs(total[gn1]['avg'])>ngl_max_diff:
             ngl_max_diff = round(abs(total[gn1]['avg']),1)
 
-    print('done ngl',time.time()-start)
     data['ngl_data'] = total
     data['ngl_max_diff'] = ngl_max_diff
     print('send json')
@@ -2750,10 +2506,8 @@ def stableResMatrix(pdbs):
     for selclass in ['001', '002', '003', '004', '006']:
         # select all distances to selected residue
         reference = stable_residues[selclass]
-        ds = list(Distance.objects.filter(structure__pdb_code__index__in=pdbs) \
-                                .filter(structure__protein_conformation__protein__family__slug__startswith=selclass) \
-                                .filter(Q(gn1=reference) | Q(gn2=reference)) \
-                                .values('structure__pdb_code__index', 'gns_pair', 'distance'))
+        ds = distance_values(Structure.objects.filter(pdb_code__index__in=pdbs) \
+                                .filter(protein_conformation__protein__family__slug__startswith=selclass), partner=reference)
 
         # create dictionary of all structures and all distances
         for i,d in enumerate(ds):
@@ -3089,16 +2843,13 @@ def DistanceData(request):
 
     dis = Distances()
     dis.load_pdbs(pdbs)
-    start = time.time()
     dis.fetch_and_calculate(with_arr = True)
-    print('done fetching',time.time()-start)
     # dis.calculate_window()
 
     excluded_segment = ['C-term','N-term']
     segments = ProteinSegment.objects.all().exclude(slug__in = excluded_segment)
     proteins =  Protein.objects.filter(protein__entry_name__in=pdbs_lower).distinct().all()
 
-    start = time.time()
     list_of_gns = []
     if len(proteins)>1:
         a = Alignment()
@@ -3132,11 +2883,9 @@ def DistanceData(request):
                     data['pos_map'][r.sequence_number] = r.amino_acid
                     data['segment_map_full_gn'][r.generic_number.label] = r.protein_segment.slug
 
-    print('done alignment',time.time()-start)
     # Dict to keep track of which residue numbers are in use
     number_dict = set()
     max_dispersion = 0
-    start = time.time()
     for d in dis.stats:
         # print(d)
         res1 = d[0].split("_")[0]
@@ -3197,7 +2946,6 @@ def DistanceData(request):
     data['pdbs'] = list(pdbs)
     data['max_dispersion'] = max_dispersion
 
-    print('done data prep',time.time()-start)
     total = {}
     ngl_max_diff = 0
     for i,gn1 in enumerate(list_of_gns):
@@ -3227,6 +2975,36 @@ def DistanceData(request):
     cache.set(cache_key,data,3600*24*7)
     return JsonResponse(data)
 
+def structure_interactions(pdbs):
+    """Interactions of the structures (entry names) as value rows. The rows are cached per structure, so the
+    interactions of any selection are merged from the structures already cached."""
+    fields = [
+        'interacting_pair__referenced_structure__protein_conformation__protein__entry_name',
+        'interacting_pair__res1__amino_acid',
+        'interacting_pair__res2__amino_acid',
+        'interacting_pair__res1__sequence_number',
+        'interacting_pair__res1__generic_number__label',
+        'interacting_pair__res1__protein_segment__slug',
+        'interacting_pair__res2__sequence_number',
+        'interacting_pair__res2__generic_number__label',
+        'interacting_pair__res2__protein_segment__slug',
+        'interaction_type',
+    ]
+    cache_keys = {'interactiondata_structure_{}'.format(pdb): pdb for pdb in set(pdbs)}
+    structure_rows = {cache_keys[key]: rows for key, rows in cache.get_many(list(cache_keys)).items()}
+
+    missing = [pdb for pdb in cache_keys.values() if pdb not in structure_rows]
+    if missing:
+        fetched = {pdb: [] for pdb in missing}
+        for row in Interaction.objects.filter(
+                interacting_pair__referenced_structure__protein_conformation__protein__entry_name__in=missing
+                ).values_list(*fields):
+            fetched[row[0]].append(row)
+        cache.set_many({'interactiondata_structure_{}'.format(pdb): rows for pdb, rows in fetched.items()}, 3600*24)
+        structure_rows.update(fetched)
+
+    return [dict(zip(fields, row)) for rows in structure_rows.values() for row in rows]
+
 # DEPRECATED FUNCTION?
 def InteractionData(request):
     def gpcrdb_number_comparator(e1, e2):
@@ -3276,40 +3054,16 @@ def InteractionData(request):
     except IndexError:
         pass
 
-    segment_filter_res1 = Q()
-    segment_filter_res2 = Q()
-
-    if segments:
-        segment_filter_res1 |= Q(interacting_pair__res1__protein_segment__slug__in=segments)
-        segment_filter_res2 |= Q(interacting_pair__res2__protein_segment__slug__in=segments)
-
-    i_types_filter = Q()
-    if i_types:
-        i_types_filter |= Q(interaction_type__in=i_types)
-
-
     hash_list = [pdbs,i_types,generic]
     hash_cache_key = 'interactiondata_{}'.format(get_hash(hash_list))
     data = cache.get(hash_cache_key)
     if data==None:
 
-        # Get the relevant interactions
-        interactions = Interaction.objects.filter(
-            interacting_pair__referenced_structure__protein_conformation__protein__entry_name__in=pdbs
-        ).values(
-            'interacting_pair__referenced_structure__protein_conformation__protein__entry_name',
-            'interacting_pair__res1__amino_acid',
-            'interacting_pair__res2__amino_acid',
-            'interacting_pair__res1__sequence_number',
-            'interacting_pair__res1__generic_number__label',
-            'interacting_pair__res1__protein_segment__slug',
-            'interacting_pair__res2__sequence_number',
-            'interacting_pair__res2__generic_number__label',
-            'interacting_pair__res2__protein_segment__slug',
-            'interaction_type',
-        ).filter(
-            segment_filter_res1 & segment_filter_res2 & i_types_filter
-        )
+        # Get the relevant interactions, merged from the interactions of each structure
+        interactions = [i for i in structure_interactions(pdbs)
+            if (not segments or (i['interacting_pair__res1__protein_segment__slug'] in segments
+                and i['interacting_pair__res2__protein_segment__slug'] in segments))
+            and (not i_types or i['interaction_type'] in i_types)]
 
         # Interaction type sort - optimize by statically defining interaction type order
         order = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals']
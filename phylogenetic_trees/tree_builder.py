@@ -0,0 +1,228 @@
+"""
+Distance trees of protein alignments, computed in process in place of the PHYLIP programs (seqboot, protdist,
+neighbor and consense).
+
+Distances are Kimura protein distances computed from the one-hot encoded alignment with a matrix product. Trees are
+built by neighbor joining or UPGMA, and bootstrap replicates (resampled alignment columns) are combined into an
+extended majority rule consensus tree. The build commands spread the replicates over a process pool, web requests
+compute them in process. Trees are returned in the Newick format the PHYLIP programs write, and cached by a hash of
+the alignment and options.
+"""
+from django.core.cache import cache
+
+from multiprocessing import Pool
+
+import hashlib
+import json
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger('protwis')
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+GAP = len(AMINO_ACIDS)
+
+# seed of the bootstrap replicates, as given to PHYLIP seqboot
+BOOTSTRAP_SEED = 77
+
+# worker process state of bootstrap_splits, set by init_bootstrap
+_bootstrap = {}
+
+
+def encode_alignment(sequences):
+    """Aligned sequences as a matrix of residue codes (sequences x positions), gaps and unknown residues are GAP"""
+    table = np.full(256, GAP, dtype=np.uint8)
+    for i, aa in enumerate(AMINO_ACIDS):
+        table[ord(aa)] = i
+    return np.array([table[np.frombuffer(sequence.upper().encode('ascii', 'replace'), dtype=np.uint8)]
+        for sequence in sequences])
+
+
+def one_hot(codes):
+    """Residues as a (sequences x positions*20) indicator matrix, gaps are all zero"""
+    matrix = np.zeros((codes.shape[0], codes.shape[1], len(AMINO_ACIDS)), dtype=np.float32)
+    sequence, position = np.nonzero(codes != GAP)
+    matrix[sequence, position, codes[sequence, position]] = 1
+    return matrix.reshape(codes.shape[0], -1)
+
+
+def kimura_distances(residues, present, weights=None):
+    """Kimura protein distances, d = -ln(1 - p - 0.2p^2) with p the fraction of differing residues among the
+    positions where both sequences have one. weights are the number of times each position is counted (bootstrap)."""
+    if weights is None:
+        weights = np.ones(present.shape[1], dtype=np.float32)
+    identical = (residues * np.repeat(weights, len(AMINO_ACIDS))) @ residues.T
+    compared = (present * weights) @ present.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(compared > 0, 1 - identical / compared, 1)
+    # PHYLIP gives up on sequences too different for the model; they are kept at the largest distance instead
+    distances = -np.log(np.maximum(1 - p - 0.2 * p**2, 0.01))
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def neighbor_joining(distances):
+    """Neighbor joining tree of a distance matrix, as nested lists of (subtree, branch length), leaves are indices.
+    The tree is unrooted, with three subtrees at the top like the trees of PHYLIP neighbor."""
+    d = np.array(distances, dtype=np.float64)
+    nodes = list(range(len(d)))
+    m = len(d)
+    while m > 3:
+        r = d[:m, :m].sum(axis=1)
+        q = (m - 2) * d[:m, :m] - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+        length_i = 0.5 * d[i, j] + (r[i] - r[j]) / (2 * (m - 2))
+        length_j = d[i, j] - length_i
+
+        # the joined node takes the place of i, the last node that of j
+        joined = 0.5 * (d[i, :m] + d[j, :m] - d[i, j])
+        nodes[i] = [(nodes[i], length_i), (nodes[j], length_j)]
+        d[i, :m] = joined
+        d[:m, i] = joined
+        d[i, i] = 0
+        m -= 1
+        nodes[j] = nodes[m]
+        d[j, :m+1] = d[m, :m+1]
+        d[:m+1, j] = d[:m+1, m]
+        d[j, j] = 0
+        del nodes[m]
+
+    if m < 3:
+        return [(node, d[0, 1] / 2 if m == 2 else 0) for node in nodes]
+    return [
+        (nodes[0], (d[0, 1] + d[0, 2] - d[1, 2]) / 2),
+        (nodes[1], (d[0, 1] + d[1, 2] - d[0, 2]) / 2),
+        (nodes[2], (d[0, 2] + d[1, 2] - d[0, 1]) / 2),
+    ]
+
+
+def upgma(distances):
+    """UPGMA tree of a distance matrix, as nested lists of (subtree, branch length), rooted with two subtrees."""
+    d = np.array(distances, dtype=np.float64)
+    nodes = list(range(len(d)))
+    sizes = np.ones(len(d))
+    heights = np.zeros(len(d))
+    m = len(d)
+    while m > 1:
+        masked = d[:m, :m] + np.diag(np.full(m, np.inf))
+        i, j = sorted(np.unravel_index(np.argmin(masked), masked.shape))
+        height = d[i, j] / 2
+        joined = (sizes[i] * d[i, :m] + sizes[j] * d[j, :m]) / (sizes[i] + sizes[j])
+        nodes[i] = [(nodes[i], height - heights[i]), (nodes[j], height - heights[j])]
+        sizes[i] += sizes[j]
+        heights[i] = height
+        d[i, :m] = joined
+        d[:m, i] = joined
+        d[i, i] = 0
+        m -= 1
+        nodes[j], sizes[j], heights[j] = nodes[m], sizes[m], heights[m]
+        d[j, :m+1] = d[m, :m+1]
+        d[:m+1, j] = d[:m+1, m]
+        d[j, j] = 0
+        del nodes[m]
+    return nodes[0] if isinstance(nodes[0], list) else [(nodes[0], 0)]
+
+
+def tree_splits(tree, count):
+    """Bipartitions of the leaves made by the internal branches of a tree, as bit masks of the side without leaf 0"""
+    everything = (1 << count) - 1
+    splits = set()
+
+    def leaves(node):
+        if not isinstance(node, list):
+            return 1 << node
+        mask = 0
+        for child, length in node:
+            mask |= leaves(child)
+        split = everything ^ mask if mask & 1 else mask
+        if 1 < bin(split).count('1') < count - 1:
+            splits.add(split)
+        return mask
+
+    for child, length in tree:
+        leaves(child)
+    return splits
+
+
+def consensus_tree(split_counts, count):
+    """Extended majority rule consensus of the splits (mask: number of trees), as nested lists of (subtree, number of
+    trees with the branch); leaves have the number of trees as branch length, as in the trees of PHYLIP consense."""
+    total = split_counts.pop(None)
+    clades = []
+    for mask, support in sorted(split_counts.items(), key=lambda x: (-x[1], bin(x[0]).count('1'), x[0])):
+        # compatible splits are nested in or disjoint from every chosen one
+        if all(mask & clade == 0 or mask & clade == mask or mask & clade == clade for clade, s in clades):
+            clades.append((mask, support))
+
+    # the smallest clades are built first, each takes the leaves and clades it contains
+    subtrees = {1 << i: (i, float(total)) for i in range(count)}
+    for mask, support in sorted(clades, key=lambda x: bin(x[0]).count('1')):
+        children = [subtree for child_mask, subtree in subtrees.items() if child_mask & mask == child_mask]
+        for child_mask in [child_mask for child_mask in subtrees if child_mask & mask == child_mask]:
+            del subtrees[child_mask]
+        subtrees[mask] = (children, float(support))
+    return [subtrees[mask] for mask in sorted(subtrees)]
+
+
+def newick(tree, names, length_format='{:.5f}'):
+    """Newick text of a tree from the functions above"""
+    def node(subtree, length):
+        if isinstance(subtree, list):
+            text = '(' + ','.join(node(child, child_length) for child, child_length in subtree) + ')'
+        else:
+            text = names[subtree]
+        return '{}:{}'.format(text, length_format.format(length))
+    return '(' + ','.join(node(subtree, length) for subtree, length in tree) + ');\n'
+
+
+def init_bootstrap(codes, upgma_tree):
+    _bootstrap['residues'] = one_hot(codes)
+    _bootstrap['present'] = (codes != GAP).astype(np.float32)
+    _bootstrap['upgma'] = upgma_tree
+
+
+def bootstrap_splits(seed):
+    """Splits of the tree of one bootstrap replicate (run in the worker processes of build_tree)"""
+    present = _bootstrap['present']
+    rng = np.random.default_rng(seed)
+    weights = np.bincount(rng.integers(0, present.shape[1], present.shape[1]), minlength=present.shape[1])
+    distances = kimura_distances(_bootstrap['residues'], present, weights.astype(np.float32))
+    tree = upgma(distances) if _bootstrap['upgma'] else neighbor_joining(distances)
+    return tree_splits(tree, present.shape[0])
+
+
+def build_tree(names, sequences, bootstrap=0, upgma_tree=False, processes=1):
+    """Newick tree of aligned sequences. With bootstrap replicates, the tree is their consensus and the branch
+    lengths are the number of replicates with the branch. With more than one process, the replicates are computed
+    in a process pool."""
+    key = 'phylogenetic_tree_' + hashlib.sha1(json.dumps([names, sequences, bootstrap, bool(upgma_tree)])
+        .encode('utf-8')).hexdigest()
+    tree = cache.get(key)
+    if tree is not None:
+        return tree
+
+    codes = encode_alignment(sequences)
+    if not bootstrap:
+        distances = kimura_distances(one_hot(codes), (codes != GAP).astype(np.float32))
+        tree = newick(upgma(distances) if upgma_tree else neighbor_joining(distances), names)
+    else:
+        seeds = [BOOTSTRAP_SEED + replicate for replicate in range(bootstrap)]
+        split_counts = {None: bootstrap}
+        if processes > 1:
+            with Pool(processes, initializer=init_bootstrap, initargs=(codes, upgma_tree)) as pool:
+                replicates = pool.imap_unordered(bootstrap_splits, seeds, chunksize=max(1, bootstrap // (4*processes)))
+                for splits in replicates:
+                    for mask in splits:
+                        split_counts[mask] = split_counts.get(mask, 0) + 1
+        else:
+            init_bootstrap(codes, upgma_tree)
+            for seed in seeds:
+                for mask in bootstrap_splits(seed):
+                    split_counts[mask] = split_counts.get(mask, 0) + 1
+        tree = newick(consensus_tree(split_counts, len(names)), names, '{:.1f}')
+
+    cache.set(key, tree, 60*60*24*7)
+    return tree
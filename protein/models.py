@@ -1,6 +1,7 @@
 ﻿from common.diagrams_arrestin import DrawArrestinPlot
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
 from common.diagrams_gprotein import DrawGproteinPlot
+from common.diagram_store import get_diagram
 from django.db import models
 from residue.models import (Residue, ResidueDataPoint, ResidueDataType,
                             ResidueGenericNumberEquivalent,
@@ -43,26 +44,44 @@ class Protein(models.Model):
         return tmp.name
 
     def get_helical_box(self):
+        diagram = get_diagram(self, 'helixbox')
+        if diagram is not None:
+            return diagram
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
         return DrawHelixBox(residuelist,self.get_protein_class(),str(self))
 
     def get_snake_plot(self):
+        diagram = get_diagram(self, 'snakeplot')
+        if diagram is not None:
+            return diagram
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
         return DrawSnakePlot(residuelist,self.get_protein_class(),str(self))
 
     def get_helical_box_no_buttons(self):
+        diagram = get_diagram(self, 'helixbox_nobuttons')
+        if diagram is not None:
+            return diagram
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
         return DrawHelixBox(residuelist,self.get_protein_class(),str(self), nobuttons=1)
 
     def get_snake_plot_no_buttons(self):
+        diagram = get_diagram(self, 'snakeplot_nobuttons')
+        if diagram is not None:
+            return diagram
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
         return DrawSnakePlot(residuelist,self.get_protein_class(),str(self), nobuttons=1)
 
     def get_gprotein_plot(self):
+        diagram = get_diagram(self, 'gprotein')
+        if diagram is not None:
+            return diagram
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
         return DrawGproteinPlot(residuelist,self.get_protein_class(),str(self))
 
     def get_arrestin_plot(self):
+        diagram = get_diagram(self, 'arrestin')
+        if diagram is not None:
+            return diagram
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
         return DrawArrestinPlot(residuelist,self.get_protein_class(),str(self))
 
@@ -91,7 +91,8 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = '/protwis/media/protwis'
 
 # Serializer
-SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
+# JSON with compact selections, see common/session.py
+SESSION_SERIALIZER = 'common.session.SessionSerializer'
 SESSION_COOKIE_AGE = 86400 #Expire cookies and session after 24 hrs
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH' : False,
@@ -181,20 +182,55 @@ if DEBUG:
        }
     }
 
+# Request statistics, see common/middleware/stats.py
+# requests slower than this (seconds) are logged separately
+STATS_SLOW_REQUEST = 5
+# fraction of the requests that are sample-profiled, profiles of slow requests are written to logs/profiles/
+STATS_PROFILE_RATE = 0.01
+STATS_PROFILE_INTERVAL = 0.005
+
+# Local BLAST searches, see structure.functions.BlastWorkerPool
+# blastp processes run at the same time (per database and process), and the most sequences searched by one of them
+BLAST_WORKERS = 2
+BLAST_BATCH_SIZE = 50
+
+# processes computing the bootstrap replicates of phylogenetic trees in the build commands (web requests compute
+# them in process), and the most sequences x bootstrap replicates of a tree requested on the website,
+# see phylogenetic_trees/tree_builder.py
+PHYLOGENETIC_TREE_PROCESSES = 4
+PHYLOGENETIC_TREE_MAX_SIZE = 20000
+
+# web API lookups of the build commands, see common/web_api.py
+# responses are cached in WEB_API_CACHE (BUILD_CACHE_DIR/web_api.sqlite3 if not set); with WEB_API_OFFLINE only
+# cached entries are used. Rate limits are host: (concurrent requests, requests per second), the timeout is the
+# seconds a request waits for a response before it fails
+WEB_API_OFFLINE = False
+WEB_API_WORKERS = 8
+WEB_API_TIMEOUT = 30
+WEB_API_RATE_LIMITS = {
+    'default': (4, 10),
+    'eutils.ncbi.nlm.nih.gov': (1, 3),
+}
+
 #CACHE
+# per-process LRU in front of a shared store on disk, see common/cache.py
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache.TieredCache',
         'LOCATION': '/tmp/django_cache',
         'OPTIONS': {
-            'MAX_ENTRIES': 10000000
+            'SHARDS': 16,
+            'MAX_BYTES': 16 * 2**30,
+            'LOCAL_MAX_BYTES': 128 * 2**20,
         }
     },
     'alignments': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache.TieredCache',
         'LOCATION': '/tmp/django_cache_alignments',
         'OPTIONS': {
-            'MAX_ENTRIES': 1000
+            'SHARDS': 4,
+            'MAX_BYTES': 4 * 2**30,
+            'LOCAL_MAX_BYTES': 64 * 2**20,
         }
     }
 }
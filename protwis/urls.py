@@ -9,6 +9,7 @@ urlpatterns = [
     url(r'^', include('home.urls')),
     url(r'^services/', include('api.urls')),
     url(r'^admin/', admin.site.urls),
+    url(r'^stats/hotpaths/?$', views.hotpaths, name='hotpaths'),
     url(r'^common/', include('common.urls')),
     url(r'^protein/', include('protein.urls')),
     url(r'^family/', include('family.urls')),
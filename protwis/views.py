@@ -1,8 +1,11 @@
 # Imports
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.template import Context, loader
 
+from common.middleware import stats
+
 
 ##
 # Handle 404 Errors
@@ -25,4 +28,13 @@ def error500(request):
         print(e)
         context = {}
 
-    return HttpResponse(content=template.render(context), content_type='text/html; charset=utf-8', status=500)
\ No newline at end of file
+    return HttpResponse(content=template.render(context), content_type='text/html; charset=utf-8', status=500)
+
+@staff_member_required
+def hotpaths(request):
+    """Response time percentiles per URL pattern, from the request profiles of StatsMiddleware."""
+    include_bots = request.GET.get('bots') == '1'
+    summary = stats.hotpaths(include_bots=include_bots)
+    if request.GET.get('sort') in ('count', 'p50', 'p95', 'max', 'sql_queries', 'sql_time'):
+        summary.sort(key=lambda s: s[request.GET['sort']], reverse=True)
+    return JsonResponse({'hotpaths': summary}, json_dumps_params={'indent': 1})
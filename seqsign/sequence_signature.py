@@ -1182,6 +1182,7 @@ class SignatureMatch():
                     self.residue_to_feat['-'].add(fidx)
 
         self._find_norm()
+        self._prepare_scoring()
         if protein_set_pos:
             self.scores_pos, self.signatures_pos, self.scored_proteins_pos = self.score_protein_set(self.protein_set_pos, signprot)
         if protein_set_neg:
@@ -1271,17 +1272,118 @@ class SignatureMatch():
         self.signature_consensus = signature
 
 
-    def score_protein_class(self, pclass_slug='001', signprot=False):
+    def _prepare_scoring(self):
+        """
+        Precompute the signature feature of each relevant position and the score of every residue at it, so
+        proteins are scored with a single lookup instead of per position.
+        """
+
+        feature_abbreviations = list(AMINO_ACID_GROUPS.keys())
+        feature_names = list(AMINO_ACID_GROUP_NAMES.values())
+
+        # residue codes: the amino acids, unknown residues and missing residues
+        self.residue_letters = list(AMINO_ACIDS.keys()) + ['X', '-']
+        self.residue_codes = dict([(x, i) for i, x in enumerate(AMINO_ACIDS.keys())])
+        self.unknown_code = len(AMINO_ACIDS)
+        self.missing_code = len(AMINO_ACIDS) + 1
+
+        self.signature_maps = OrderedDict()
+        self.score_positions = []
+        features = []
+        for segment in self.relevant_segments:
+            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
+            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            self.signature_maps[segment] = signature_map
+            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
+                feat = signature_map[idx]
+                features.append(feat)
+                self.score_positions.append((segment, pos, feature_abbreviations[feat], feature_names[feat],
+                    self.signature_matrix_filtered[segment][feat][idx]))
+        self.position_index = dict([(x[1], i) for i, x in enumerate(self.score_positions)])
+
+        # score and display color of each residue code at each position
+        self.score_table = np.zeros((len(self.score_positions), len(self.residue_letters)))
+        self.color_table = np.full(self.score_table.shape, 'white', dtype=object)
+        for i, ((segment, pos, feat_abr, feat_name, val), feat) in enumerate(zip(self.score_positions, features)):
+            for code, aa in enumerate(self.residue_letters[:self.missing_code]):
+                if aa in self.residue_codes and feat in self.residue_to_feat[aa]:
+                    # a receptor having a positive property scores
+                    self.score_table[i, code] = max(val, 0)
+                    self.color_table[i, code] = "#808080" if val > 0 else "white"
+                else:
+                    # so does a receptor NOT having a negative property
+                    self.score_table[i, code] = max(-val, 0)
+                    self.color_table[i, code] = "white" if val > 0 else "#808080"
+            if feat_name == 'Gap':
+                self.score_table[i, self.missing_code] = val
+                self.color_table[i, self.missing_code] = "#808080" if val > 0 else "white"
+
+    def residue_matrix(self, pcfs):
+        """
+        Residue codes at the relevant positions (protein conformations x positions) of the given protein conformation
+        ids, loaded in one query.
+        """
+
+        rows = dict([(x, i) for i, x in enumerate(pcfs)])
+        codes = np.full((len(pcfs), len(self.score_positions)), self.missing_code, dtype=np.int16)
+        resi = Residue.objects.filter(
+            protein_conformation__in=pcfs,
+            generic_number__label__in=list(self.position_index.keys())
+            ).values_list('protein_conformation_id', 'generic_number__label', 'amino_acid')
+        for pcf, label, amino_acid in resi:
+            codes[rows[pcf], self.position_index[label]] = self.residue_codes.get(amino_acid, self.unknown_code)
+        return codes
+
+    def score_conformations(self, pcfs, codes=None):
+        """
+        Score the protein conformations, returns the scores (score, normalized score), signature matches and
+        conformations sorted by score as in score_protein_set.
+        """
+
+        if codes is None:
+            codes = self.residue_matrix([x.pk for x in pcfs])
+        positions = np.arange(len(self.score_positions))
+        scores = self.score_table[positions, codes].sum(axis=1) if len(self.score_positions) else np.zeros(len(pcfs))
 
-        start = time.time()
         protein_scores = {}
-        protein_signature_match = {}
+        for pcf, score in zip(pcfs, scores):
+            protein_scores[pcf] = (score/100, score/self.norm*100 if self.norm else 0.0)
+        protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
+        protein_signatures = OrderedDict()
+        rows = dict([(x.pk, i) for i, x in enumerate(pcfs)])
+        for pcf in protein_report:
+            protein_signatures[pcf] = self.signature_match(codes[rows[pcf.pk]])
+        return (protein_report, protein_signatures, list(protein_report.keys()))
+
+    def signature_match(self, codes):
+        """
+        Signature positions with the residues of one protein, by segment: feature, feature name, value, color,
+        amino acid and generic number.
+        """
+
+        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
+        for i, ((segment, pos, feat_abr, feat_name, val), code) in enumerate(zip(self.score_positions, codes)):
+            consensus_match[segment].append([
+                feat_abr,
+                feat_name,
+                val,
+                self.color_table[i, code],
+                self.residue_letters[code],
+                pos
+                ])
+        return consensus_match
+
+    def score_protein_class(self, pclass_slug='001', signprot=False, all_species=False):
+
+        start = time.time()
         class_proteins = Protein.objects.filter(
-            species__common_name='Human',
             family__slug__startswith=pclass_slug
             ).exclude(
                 id__in=[x.id for x in self.protein_set]
                 )
+        # score the human receptors or, optionally, the orthologs of all species
+        if not all_species:
+            class_proteins = class_proteins.filter(species__common_name='Human')
 
         if signprot:
             complex_objs = SignprotComplex.objects.prefetch_related('structure__protein_conformation__protein').values_list('structure__protein_conformation__protein__parent_id', flat=True)
@@ -1295,43 +1397,14 @@ class SignatureMatch():
                 protein__sequence_type__slug='wt'
             ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein','protein__family__parent','protein__species')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=class_a_pcf,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in class_a_pcf:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf, resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
+        self.protein_report, self.protein_signatures, self.scored_proteins = self.score_conformations(list(class_a_pcf))
         end = time.time()
-        self.protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        for prot in self.protein_report.items():
-            self.protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        self.scored_proteins = list(self.protein_report.keys())
         print("Total time: ", end - start)
 
 
     def score_protein_set(self, protein_set, signprot=False):
 
         start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
 
         seq_type_slug=['wt']
         if signprot:
@@ -1345,155 +1418,27 @@ class SignatureMatch():
                 protein__sequence_type__slug__in=seq_type_slug
                 ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=pcfs,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in pcfs:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf,resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
+        result = self.score_conformations(list(pcfs))
         end = time.time()
-        protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        protein_signatures = OrderedDict()
-        for prot in protein_report.items():
-            protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        scored_proteins = list(protein_report.keys())
         print("Total time: ", end - start)
 
-        return (protein_report, protein_signatures, scored_proteins)
+        return result
 
-    def score_protein(self, pcf,resi_dict_all):
-        prot_score = 0.0
-        #norm = 0.0
-        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
+    def score_protein(self, pcf, resi_dict_all=None):
+        """
+        Score one protein conformation, with its residues (by generic number) from resi_dict_all when given.
+        """
 
         if resi_dict_all == None or pcf.pk not in resi_dict_all:
-            relevant_gns_total = []
-            for segment in  self.relevant_segments:
-                for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                    relevant_gns_total.append(pos)
-            resi = Residue.objects.filter(
-                protein_conformation=pcf,
-                generic_number__label__in=relevant_gns_total
-                ).prefetch_related('generic_number')
-            resi_dict = {}
-            for r in resi:
-                if r.generic_number:
-                    resi_dict[r.generic_number.label] = r
+            codes = self.residue_matrix([pcf.pk])
         else:
-            resi_dict = resi_dict_all[pcf.pk]
-        for segment in self.relevant_segments:
-            tmp = []
-            # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
-            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
-            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
-
-            #norm += np.sum(np.amax(self.signature_matrix_filtered[segment], axis=0))
-
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                feat = signature_map[idx]
-                feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
-                feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
-                val = self.signature_matrix_filtered[segment][feat][idx]
-                if pos in resi_dict:
-                    res = resi_dict[pos]
-                    if feat in self.residue_to_feat[res.amino_acid]:
-                        if val > 0:
-                            prot_score += val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            #"green",
-                            "#808080",
-                            res.amino_acid, pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                res.amino_acid,
-                                pos
-                                ])
-                    else:
-                        #David doesn't want the negative values in the score
-                        # prot_score -= val
-                        if val < 0:
-                            prot_score -= val #if a receptor does NOT have the negative property, add the score
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            res.amino_acid,
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                # "green",
-                                "#808080",
-                                res.amino_acid,
-                                pos
-                                ])
-                else:
-                    if feat_name == 'Gap':
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "green",
-                            "#808080",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-                        prot_score += val
-                    else:
-                        #David doesn't want the negative values in the score
-                        #prot_score -= val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-            consensus_match[segment] = tmp
-        return (prot_score/100, prot_score/self.norm*100, consensus_match)
+            codes = np.full((1, len(self.score_positions)), self.missing_code, dtype=np.int16)
+            for label, res in resi_dict_all[pcf.pk].items():
+                if label in self.position_index:
+                    codes[0, self.position_index[label]] = self.residue_codes.get(res.amino_acid, self.unknown_code)
+        protein_report, protein_signatures, scored_proteins = self.score_conformations([pcf], codes)
+        score, nscore = protein_report[pcf]
+        return (score, nscore, protein_signatures[pcf])
 
 def signature_score_excel(workbook, scores, protein_signatures, signature_filtered, relevant_gn, relevant_segments, numbering_schemes, scores_positive=None, scores_negative=None, signatures_positive=None, signatures_negative=None):
 
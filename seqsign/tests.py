@@ -0,0 +1,100 @@
+from django.test import SimpleTestCase
+
+from common.definitions import AMINO_ACID_GROUPS, AMINO_ACID_GROUP_NAMES
+from seqsign.sequence_signature import SignatureMatch
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Residue():
+    def __init__(self, amino_acid):
+        self.amino_acid = amino_acid
+
+
+class Conformation():
+    def __init__(self, pk):
+        self.pk = pk
+
+
+def loop_score(match, resi_dict):
+    """Score and signature match of one protein, as calculated per position before scoring was vectorized"""
+    prot_score = 0.0
+    consensus_match = OrderedDict([(x, []) for x in match.relevant_segments])
+    for segment in match.relevant_segments:
+        signature_map = np.absolute(match.signature_matrix_filtered[segment]).argmax(axis=0)
+        signature_map = match._assign_preferred_features(signature_map, segment, match.signature_matrix_filtered)
+        for idx, pos in enumerate(match.relevant_gn[match.schemes[0][0]][segment].keys()):
+            feat = signature_map[idx]
+            feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
+            feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
+            val = match.signature_matrix_filtered[segment][feat][idx]
+            if pos in resi_dict:
+                amino_acid = resi_dict[pos].amino_acid
+                if feat in match.residue_to_feat[amino_acid]:
+                    if val > 0:
+                        prot_score += val
+                    color = "#808080" if val > 0 else "white"
+                else:
+                    if val < 0:
+                        prot_score -= val
+                    color = "white" if val > 0 else "#808080"
+            else:
+                amino_acid = '-'
+                if feat_name == 'Gap':
+                    prot_score += val
+                    color = "#808080" if val > 0 else "white"
+                else:
+                    color = "white"
+            consensus_match[segment].append([feat_abr, feat_name, val, color, amino_acid, pos])
+    return (prot_score/100, prot_score/match.norm*100, consensus_match)
+
+
+class SignatureMatchTest(SimpleTestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(7)
+        segments = OrderedDict([('TM1', None), ('TM2', None)])
+        self.positions = OrderedDict([(segment, ['{}x{}'.format(segment[-1], 40 + i) for i in range(8)])
+            for segment in segments])
+        common_positions = {'gpcrdb': OrderedDict([(segment, OrderedDict([(gn, i) for i, gn in enumerate(gns)]))
+            for segment, gns in self.positions.items()])}
+        difference_matrix = OrderedDict([(segment, random.randint(-100, 100, (len(AMINO_ACID_GROUPS), 8)).astype(float))
+            for segment in segments])
+        self.match = SignatureMatch(common_positions, [('gpcrdb',)], segments, difference_matrix, cutoff=40)
+
+        # aligned residues of the proteins, '-' are gaps
+        alignment = [
+            'MLVAYWFG' + 'TSNQDEKR',
+            'ILVAYWF-' + 'TSNQDEKH',
+            '--------' + 'CPGAALIV',
+            'GGGGGGGG' + '--------',
+            'RKHDENQS' + 'AVLIMFWY',
+        ]
+        self.conformations = [Conformation(i) for i in range(len(alignment))]
+        self.residues = {}
+        for conformation, sequence in zip(self.conformations, alignment):
+            gns = self.positions['TM1'] + self.positions['TM2']
+            self.residues[conformation.pk] = dict([(gn, Residue(aa)) for gn, aa in zip(gns, sequence) if aa != '-'])
+
+    def test_same_as_loop(self):
+        self.assertTrue(len(self.match.score_positions) > 0)
+        for conformation in self.conformations:
+            score, nscore, signature_match = self.match.score_protein(conformation, self.residues)
+            expected = loop_score(self.match, self.residues[conformation.pk])
+            self.assertAlmostEqual(score, expected[0])
+            self.assertAlmostEqual(nscore, expected[1])
+            self.assertEqual(signature_match, expected[2])
+
+    def test_ranking(self):
+        codes = np.array([[self.match.residue_codes.get(self.residues[c.pk][pos].amino_acid, self.match.unknown_code)
+            if pos in self.residues[c.pk] else self.match.missing_code for segment, pos, abr, name, val in
+            self.match.score_positions] for c in self.conformations])
+        protein_report, protein_signatures, scored = self.match.score_conformations(self.conformations, codes)
+
+        expected = dict([(c, loop_score(self.match, self.residues[c.pk])) for c in self.conformations])
+        self.assertEqual(scored, sorted(self.conformations, key=lambda c: expected[c][0], reverse=True))
+        for c in self.conformations:
+            self.assertAlmostEqual(protein_report[c][0], expected[c][0])
+            self.assertEqual(protein_signatures[c], expected[c][2])
@@ -5,6 +5,7 @@ from django.http import HttpResponse
 
 from alignment.functions import get_proteins_from_selection
 from common.selection import Selection
+from common.session import store_result, get_result
 #from common.views import AbsTargetSelection
 from common.views import AbsTargetSelectionTable
 from common.views import AbsSegmentSelection
@@ -178,7 +179,7 @@ def render_signature(request):
 
     # save for later
     # signature_map = feats_delta.argmax(axis=0)
-    request.session['signature'] = signature.prepare_session_data()
+    request.session['signature'] = store_result(signature.prepare_session_data())
     request.session.modified = True
 
     return_html = render(
@@ -277,13 +278,24 @@ def render_signature_excel(request):
 
 def render_signature_match_scores(request, cutoff):
 
-    signature_data = request.session.get('signature')
+    signature_data = get_result(request.session.get('signature'))
 
     # targets set #1
     ss_pos = request.session.get('targets_pos', False)
     # targets set #2
     ss_neg = request.session.get('selection', False)
 
+    if signature_data is None:
+        # the stored signature has expired, calculate it again from the selections
+        if not ss_pos or not ss_neg:
+            return redirect('/seqsign/')
+        signature = SequenceSignature()
+        signature.setup_alignments_from_selection(ss_pos, ss_neg)
+        signature.calculate_signature()
+        signature_data = signature.prepare_session_data()
+        request.session['signature'] = store_result(signature_data)
+        request.session.modified = True
+
     signature_match = SignatureMatch(
         signature_data['common_positions'],
         signature_data['numbering_schemes'],
@@ -14,6 +14,7 @@ from common import definitions
 from common.diagrams_gpcr import DrawSnakePlot
 from common.diagrams_gprotein import DrawGproteinPlot
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
+from common.session import store_result, get_result
 from common.views import AbsTargetSelection
 from contactnetwork.models import InteractingResiduePair
 from mutation.models import MutationExperiment
@@ -34,6 +35,9 @@ from collections import Counter, OrderedDict
 from copy import deepcopy
 from statistics import mean
 
+# message of the signature match views when the signature of the session is no longer cached
+SIGNATURE_EXPIRED = 'The calculated signature has expired, please calculate the signature again.'
+
 
 class BrowseSelection(AbsTargetSelection):
     step = 1
@@ -1428,7 +1432,7 @@ def IMSequenceSignature(request):
         'feat': grouped_features,
     }
 
-    request.session['signature'] = signature.prepare_session_data()
+    request.session['signature'] = store_result(signature.prepare_session_data())
     request.session.modified = True
 
     return JsonResponse(res, safe=False)
@@ -1436,7 +1440,9 @@ def IMSequenceSignature(request):
 @method_decorator(csrf_exempt)
 def IMSignatureMatch(request):
     '''Take the signature stored in the session and query the db'''
-    signature_data = request.session.get('signature')
+    signature_data = get_result(request.session.get('signature'))
+    if signature_data is None:
+        return JsonResponse({'error': SIGNATURE_EXPIRED}, status=410)
     ss_pos = get_entry_names(request)
     cutoff = request.POST.get('cutoff')
     effector = request.POST.get('filtering_particle')
@@ -1482,8 +1488,10 @@ def IMSignatureMatch(request):
 @method_decorator(csrf_exempt)
 def render_IMSigMat(request):
     # signature_match = request.session.get('signature_match')
-    signature_data = request.session.get('signature')
+    signature_data = get_result(request.session.get('signature'))
     ss_pos = request.session.get('ss_pos')
+    if signature_data is None or not ss_pos:
+        return HttpResponse(SIGNATURE_EXPIRED, status=410)
     #cutoff = request.session.get('cutoff')
 
     pos_set = Protein.objects.filter(entry_name__in=ss_pos).select_related('residue_numbering_scheme', 'species')
@@ -660,6 +660,9 @@ const run_sig_match = function() {
       yadcf.exResetAllFilters(sigmatch_table);
     },
     error(jqXHR, exception) {
+      if (jqXHR.status === 410 && jqXHR.responseJSON) {
+        alert(jqXHR.responseJSON.error);
+      }
       console.log(jqXHR);
       console.log(exception);
     },
@@ -9,6 +9,7 @@ from protein.models import Protein, ProteinSegment
 from residue.models import Residue
 from structure.functions import BlastSearch, MappedResidue, StructureSeqNumOverwrite
 from structure.sequence_parser import *
+from structure.sequence_search import SequenceSearch
 
 import Bio.PDB.Polypeptide as polypeptide
 import os,logging
@@ -39,8 +40,8 @@ class GenericNumbering(object):
         self.pdb_seq = {} #Seq('')
         # list of uniprot ids returned from blast
         self.prot_id_list = []
-        #setup for local blast search
-        self.blast = BlastSearch(blast_path=blast_path, blastdb=blastdb,top_results=top_results)
+        #setup for local search, in process with BLAST as fallback
+        self.blast = SequenceSearch(blast_path=blast_path, blastdb=blastdb,top_results=top_results)
 
         # calling sequence parser
         if sequence_parser:
@@ -210,10 +211,9 @@ class GenericNumbering(object):
 
     def assign_generic_numbers(self):
 
-        alignments = {}
-        #blast search goes first, looping through all the chains
-        for chain in self.pdb_seq.keys():
-            alignments[chain] = self.blast.run(self.pdb_seq[chain])
+        #blast search goes first, all the chains in one batch
+        chains = list(self.pdb_seq.keys())
+        alignments = dict(zip(chains, self.blast.run_batch([self.pdb_seq[chain] for chain in chains])))
 
         #map the results onto pdb sequence for every sequence pair from blast
         for chain in self.pdb_seq.keys():
@@ -0,0 +1,276 @@
+import logging
+import os
+
+import numpy as np
+
+from Bio.PDB.PDBExceptions import PDBConstructionException
+from Bio.PDB.StructureBuilder import StructureBuilder
+from django.conf import settings
+
+
+# one record per ATOM/HETATM line, atom and residue names are kept as in the PDB columns
+ATOM_DTYPE = np.dtype([
+    ('model', 'i2'),
+    ('hetero', '?'),
+    ('serial', 'i4'),
+    ('name', 'S4'),
+    ('altloc', 'S1'),
+    ('resname', 'S3'),
+    ('chain', 'S1'),
+    ('resseq', 'i4'),
+    ('icode', 'S1'),
+    ('xyz', 'f4', (3,)),
+    ('occupancy', 'f4'),
+    ('bfactor', 'f4'),
+    ('segid', 'S4'),
+    ('element', 'S2'),
+    ('charge', 'S2'),
+])
+
+ATOM_FORMAT = '{:6s}{:>5d} {:4s}{:1s}{:3s} {:1s}{:>4d}{:1s}   {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}      {:<4s}{:>2s}{:2s}'
+
+
+def parse_pdb_atoms(pdb):
+    """Read the ATOM and HETATM records of a PDB file (text) into an array of ATOM_DTYPE."""
+    lines = []
+    models = []
+    model = 0
+    for line in pdb.split('\n'):
+        if line.startswith('ATOM') or line.startswith('HETATM'):
+            lines.append(line.rstrip('\r').ljust(80))
+            models.append(model)
+        elif line.startswith('ENDMDL'):
+            model += 1
+
+    atoms = np.zeros(len(lines), dtype=ATOM_DTYPE)
+    if not lines:
+        return atoms
+
+    def column(start, end):
+        return np.array([line[start:end] for line in lines])
+
+    def number(start, end, dtype):
+        values = column(start, end)
+        values[np.char.strip(values) == ''] = '0'
+        return values.astype(dtype)
+
+    atoms['model'] = models
+    atoms['hetero'] = column(0, 6) == 'HETATM'
+    atoms['serial'] = number(6, 11, 'i4')
+    atoms['name'] = np.char.encode(column(12, 16))
+    atoms['altloc'] = np.char.encode(np.char.strip(column(16, 17)))
+    atoms['resname'] = np.char.encode(column(17, 20))
+    atoms['chain'] = np.char.encode(np.char.strip(column(21, 22)))
+    atoms['resseq'] = number(22, 26, 'i4')
+    atoms['icode'] = np.char.encode(np.char.strip(column(26, 27)))
+    atoms['xyz'] = np.stack([number(30, 38, 'f4'), number(38, 46, 'f4'), number(46, 54, 'f4')], axis=1)
+    atoms['occupancy'] = number(54, 60, 'f4')
+    atoms['bfactor'] = number(60, 66, 'f4')
+    atoms['segid'] = np.char.encode(np.char.strip(column(72, 76)))
+    atoms['element'] = np.char.encode(np.char.strip(column(76, 78)))
+    atoms['charge'] = np.char.encode(np.char.strip(column(78, 80)))
+    return atoms
+
+
+class StructureCoordinates:
+    """Atoms of one PDB entry with filtered views.
+
+    The atoms are a slice of the memory-mapped CoordinateStore (or parsed from text when not stored); filters only
+    narrow down an index into it, so no atom data is copied until it is read.
+    """
+
+    def __init__(self, atoms, index=None):
+        self.base = atoms
+        self.index = index
+
+    @property
+    def atoms(self):
+        if self.index is None:
+            return self.base
+        return self.base[self.index]
+
+    def __len__(self):
+        return len(self.base) if self.index is None else len(self.index)
+
+    def filter(self, mask):
+        """View of the atoms for which mask (over the atoms of this view) is True."""
+        positions = np.flatnonzero(mask)
+        if self.index is not None:
+            positions = self.index[positions]
+        return StructureCoordinates(self.base, positions)
+
+    def _field(self, field):
+        return self.base[field] if self.index is None else self.base[field][self.index]
+
+    def chain(self, chain):
+        return self.filter(self._field('chain') == chain.encode())
+
+    def model(self, model=0):
+        return self.filter(self._field('model') == model)
+
+    def is_water(self):
+        return self._field('hetero') & (self._field('resname') == b'HOH')
+
+    def waters(self):
+        return self.filter(self.is_water())
+
+    def without_waters(self):
+        return self.filter(~self.is_water())
+
+    def ligand(self, resname):
+        return self.filter(self._field('hetero') & (self._field('resname') == resname.encode()))
+
+    def keep_ligands(self, resnames):
+        """Remove all hetero groups except waters and the given ligands."""
+        resnames = [r.encode() for r in resnames]
+        other = self._field('hetero') & ~self.is_water() & ~np.isin(self._field('resname'), resnames)
+        return self.filter(~other)
+
+    def to_pdb(self):
+        """Serialize the atoms as PDB ATOM/HETATM records."""
+        lines = []
+        for model, hetero, serial, name, altloc, resname, chain, resseq, icode, xyz, occupancy, bfactor, segid, \
+                element, charge in self.atoms.tolist():
+            lines.append(ATOM_FORMAT.format('HETATM' if hetero else 'ATOM', serial, name.decode(), altloc.decode(),
+                resname.decode(), chain.decode(), resseq, icode.decode(), xyz[0], xyz[1], xyz[2], occupancy,
+                bfactor, segid.decode(), element.decode(), charge.decode()).rstrip())
+        return '\n'.join(lines)
+
+    def to_structure(self, structure_id):
+        """Build a Bio.PDB structure, like PDBParser(PERMISSIVE=True) would from the PDB text."""
+        builder = StructureBuilder()
+        builder.init_structure(structure_id)
+
+        current_model = current_segid = current_chain = current_residue = None
+        for model, hetero, serial, name, altloc, resname, chain, resseq, icode, xyz, occupancy, bfactor, segid, \
+                element, charge in self.atoms.tolist():
+            resname = resname.decode().strip()
+            if hetero:
+                hetero_flag = 'W' if resname in ('HOH', 'WAT') else 'H_' + resname
+            else:
+                hetero_flag = ' '
+            residue_id = (hetero_flag, resseq, icode.decode() or ' ')
+
+            if model != current_model:
+                builder.init_model(model)
+                current_model = model
+                current_segid = current_chain = current_residue = None
+            if segid != current_segid:
+                builder.init_seg(segid.decode().ljust(4))
+                current_segid = segid
+            if chain != current_chain:
+                builder.init_chain(chain.decode() or ' ')
+                current_chain = chain
+                current_residue = None
+            if (residue_id, resname) != current_residue:
+                current_residue = (residue_id, resname)
+                try:
+                    builder.init_residue(resname, *residue_id)
+                except PDBConstructionException:
+                    pass
+
+            fullname = name.decode()
+            try:
+                # occupancy and B-factor have two decimals in the PDB format
+                builder.init_atom(fullname.strip(), np.array(xyz, 'f'), round(bfactor, 2), round(occupancy, 2),
+                    altloc.decode() or ' ', fullname, serial, element.decode().upper() or None)
+            except PDBConstructionException:
+                pass
+
+        return builder.get_structure()
+
+
+class CoordinateStore:
+    """Memory-mapped archive of the atoms of all PdbData entries, written by build_coordinate_store.
+
+    The atoms of each entry are one contiguous slice of a packed array, indexed by PdbData id.
+    """
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'coordinates'])
+    atoms_file = 'atoms.npy'
+    index_file = 'index.npz'
+
+    _instance = None
+
+    logger = logging.getLogger('build')
+
+    def __init__(self, atoms, pdb_data_ids, offsets):
+        self.atoms = atoms
+        self.slice_lookup = {int(pk): (int(offsets[i]), int(offsets[i+1])) for i, pk in enumerate(pdb_data_ids)}
+
+    @classmethod
+    def build(cls, store_dir=None):
+        """Parse all PdbData entries into the packed store, replacing a previous version."""
+        from structure.models import PdbData
+
+        store_dir = store_dir or cls.store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        atoms_path = os.sep.join([store_dir, cls.atoms_file])
+        index_path = os.sep.join([store_dir, cls.index_file])
+
+        # atoms are appended entry by entry, the array header is written afterwards
+        pdb_data_ids = []
+        offsets = [0]
+        with open(atoms_path + '.raw', 'wb') as f:
+            for pk, pdb in PdbData.objects.order_by('pk').values_list('pk', 'pdb').iterator(chunk_size=100):
+                atoms = parse_pdb_atoms(pdb)
+                f.write(atoms.tobytes())
+                pdb_data_ids.append(pk)
+                offsets.append(offsets[-1] + len(atoms))
+
+        raw = np.memmap(atoms_path + '.raw', dtype=ATOM_DTYPE, mode='r', shape=(offsets[-1],)) if offsets[-1] else \
+            np.zeros(0, dtype=ATOM_DTYPE)
+        atoms = np.lib.format.open_memmap(atoms_path + '.tmp', mode='w+', dtype=ATOM_DTYPE, shape=(offsets[-1],))
+        atoms[:] = raw
+        atoms.flush()
+        del atoms, raw
+        os.remove(atoms_path + '.raw')
+
+        with open(index_path + '.tmp', 'wb') as f:
+            np.savez(f, pdb_data_ids=np.array(pdb_data_ids, dtype='i4'), offsets=np.array(offsets, dtype='i8'))
+
+        os.replace(atoms_path + '.tmp', atoms_path)
+        os.replace(index_path + '.tmp', index_path)
+        cls.logger.info('Stored {} atoms of {} PDB entries in {}'.format(offsets[-1], len(pdb_data_ids), store_dir))
+
+    @classmethod
+    def load(cls, store_dir=None):
+        """Return the shared store, or None if it has not been built."""
+        store_dir = store_dir or cls.store_dir
+        atoms_path = os.sep.join([store_dir, cls.atoms_file])
+        index_path = os.sep.join([store_dir, cls.index_file])
+        try:
+            mtime = max(os.path.getmtime(atoms_path), os.path.getmtime(index_path))
+        except OSError:
+            return None
+
+        if cls._instance is None or cls._instance[0] != (store_dir, mtime):
+            try:
+                atoms = np.load(atoms_path, mmap_mode='r')
+                with np.load(index_path) as index:
+                    pdb_data_ids = index['pdb_data_ids']
+                    offsets = index['offsets']
+            except (OSError, ValueError, KeyError):
+                return None
+
+            # files replaced halfway through a rebuild
+            if len(offsets) == 0 or offsets[-1] != len(atoms):
+                return None
+            cls._instance = ((store_dir, mtime), cls(atoms, pdb_data_ids, offsets))
+
+        return cls._instance[1]
+
+    def covers(self, pdb_data_id):
+        return pdb_data_id in self.slice_lookup
+
+    def get(self, pdb_data_id):
+        start, end = self.slice_lookup[pdb_data_id]
+        return StructureCoordinates(self.atoms[start:end])
+
+
+def get_coordinates(pdb_data):
+    """Coordinates of a PdbData entry, from the store when available and parsed from its text otherwise."""
+    store = CoordinateStore.load()
+    if store is not None and store.covers(pdb_data.pk):
+        return store.get(pdb_data.pk)
+    return StructureCoordinates(parse_pdb_atoms(pdb_data.pdb))
@@ -1,4 +1,8 @@
 ﻿from Bio.Blast import NCBIXML, NCBIWWW
+try:
+    from Bio.Blast.Record import Alignment as BlastAlignment, HSP as BlastHSP
+except ImportError:
+    from Bio.Blast.NCBIXML import Alignment as BlastAlignment, HSP as BlastHSP
 from Bio.PDB import PDBParser, PDBIO
 from Bio.PDB.PDBIO import Select
 import Bio.PDB.Polypeptide as polypeptide
@@ -10,7 +14,9 @@ except:
     from Bio.PDB import rotaxis
 
 from django.conf import settings
+from django.core.cache import cache
 from common.alignment import Alignment
+from common.similarity import get_blosum62
 from common.tools import urlopen_with_retry
 from common.models import WebResource, WebLink, Publication
 from protein.models import Protein, ProteinSegment, ProteinConformation, ProteinState
@@ -21,7 +27,13 @@ from signprot.models import SignprotStructure
 
 from subprocess import Popen, PIPE
 from io import StringIO
+from concurrent.futures import Future
+import glob
+import hashlib
 import os
+import queue
+import threading
+import time
 import sys
 import tempfile
 import logging
@@ -43,7 +55,11 @@ ATOM_FORMAT_STRING="%s%5i %-4s%c%3s %c%4i%c   %8.3f%8.3f%8.3f%s%6.2f      %4s%2s
 #==============================================================================
 # I have put it into separate class for the sake of future uses
 class BlastSearch(object):
+    """Local BLAST search against a protwis BLAST database.
 
+    Searches go through a BlastWorkerPool, which runs the sequences of concurrent callers in shared blastp processes,
+    and their results are cached by sequence and database version.
+    """
 
     def __init__ (self, blast_path='blastp',
         blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1):
@@ -59,30 +75,176 @@ class BlastSearch(object):
     #alignments
     def run (self, input_seq):
 
-        output = []
-        #Windows has problems with Popen and PIPE
-        if sys.platform == 'win32':
-            tmp = tempfile.NamedTemporaryFile()
-            logger.debug("Running Blast with sequence: {}".format(input_seq))
-            tmp.write(bytes(str(input_seq) + '\n', 'latin1'))
-            tmp.seek(0)
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, stdin=tmp,
-                stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate()
+        return self.run_batch([input_seq])[0]
+
+    def run_batch(self, input_seqs):
+        """Search several sequences at once, returns a list of results as from run() in the same order"""
+        sequences = [str(seq).strip() for seq in input_seqs]
+
+        # cached results are invalidated when the database is rebuilt
+        try:
+            db_version = str(max(os.path.getmtime(path) for path in glob.glob(self.blastdb + '.*')))
+        except ValueError:
+            db_version = ''
+        keys = {seq: 'blast_' + hashlib.sha1('\t'.join([self.blastdb, db_version, seq]).encode('utf-8')).hexdigest()
+            for seq in set(sequences) if seq}
+        hits = cache.get_many(list(keys.values())) if keys else {}
+
+        rows = {seq: hits[key] for seq, key in keys.items() if key in hits}
+        missing = [seq for seq in keys if seq not in rows]
+        if missing:
+            # raises BlastError when blastp fails, before anything is cached
+            found = BlastWorkerPool.get(self.blast_path, self.blastdb).search(missing)
+            cache.set_many({keys[seq]: found[seq] for seq in missing}, 60*60*24*7)
+            rows.update(found)
+
+        return [blast_alignments(rows[seq], self.top_results) if seq else [] for seq in sequences]
+#==============================================================================
+
+class BlastError(Exception):
+    """blastp failed (exit status or error output), e.g. when the database is missing or incomplete"""
+
+
+# tabular output fields of blastp (-outfmt 6), one row per HSP, grouped by hit in order of score
+BLAST_FIELDS = ['qseqid', 'sseqid', 'stitle', 'slen', 'evalue', 'bitscore', 'score', 'length', 'nident', 'positive',
+    'gaps', 'qstart', 'qend', 'sstart', 'send', 'qseq', 'sseq']
+
+
+def run_blastp(blast_path, blastdb, sequences):
+    """Search the sequences with one blastp process, returns the tabular result rows for each sequence. Raises
+    BlastError when blastp fails, so that no results are returned (or cached) for the sequences."""
+    fasta = ''.join('>q{}\n{}\n'.format(i, seq) for i, seq in enumerate(sequences))
+    logger.debug("Running Blast with {} sequences".format(len(sequences)))
+    blast = Popen([blast_path, '-db', blastdb, '-outfmt', ' '.join(['6'] + BLAST_FIELDS)], universal_newlines=True,
+        stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    (blast_out, blast_err) = blast.communicate(input=fasta)
+
+    if blast.returncode != 0 or len(blast_err) != 0:
+        logger.error("Blast failed with exit status {}: {}".format(blast.returncode, blast_err.strip()))
+        raise BlastError(blast_err.strip() or 'blastp exited with status {}'.format(blast.returncode))
+    rows = {seq: [] for seq in sequences}
+    for line in blast_out.splitlines():
+        values = line.split('\t')
+        if len(values) != len(BLAST_FIELDS):
+            continue
+        rows[sequences[int(values[0][1:])]].append(values[1:])
+    return rows
+
+
+def blast_alignments(rows, top_results):
+    """Result rows of one query as (hit_id, alignment) tuples of the top hits, like the Bio.Blast XML parser gives"""
+    output = []
+    for sseqid, stitle, slen, evalue, bitscore, score, length, nident, positive, gaps, qstart, qend, sstart, send, \
+            qseq, sseq in rows:
+        if not output or output[-1][0] != sseqid:
+            if len(output) == top_results:
+                break
+            aln = BlastAlignment()
+            aln.hit_id = sseqid
+            # the title can start with the sequence id, depending on the BLAST version
+            aln.hit_def = stitle[len(sseqid)+1:] if stitle.startswith(sseqid + ' ') else stitle
+            aln.title = '{} {}'.format(aln.hit_id, aln.hit_def)
+            aln.length = int(slen)
+            output.append((sseqid, aln))
+        hsp = BlastHSP()
+        hsp.score = float(score)
+        hsp.bits = float(bitscore)
+        hsp.expect = float(evalue)
+        hsp.identities = int(nident)
+        hsp.positives = int(positive)
+        hsp.gaps = int(gaps)
+        hsp.align_length = int(length)
+        hsp.query = qseq
+        hsp.query_start = int(qstart)
+        hsp.query_end = int(qend)
+        hsp.sbjct = sseq
+        hsp.sbjct_start = int(sstart)
+        hsp.sbjct_end = int(send)
+        hsp.match = blast_midline(qseq, sseq)
+        output[-1][1].hsps.append(hsp)
+    return output
+
+
+def blast_midline(query, sbjct):
+    """Middle line of a BLAST alignment: identities, + for other positive BLOSUM62 scores"""
+    matrix = get_blosum62()
+    midline = []
+    for q, s in zip(query, sbjct):
+        if q == s and q != '-':
+            midline.append(q)
+        elif q in matrix.alphabet and s in matrix.alphabet and matrix[q][s] > 0:
+            midline.append('+')
         else:
-            #Rest of the world:
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, shell=True,
-                stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate(input=str(input_seq))
-
-        if len(blast_err) != 0:
-            logger.debug(blast_err)
-        if blast_out!='\n':
-            result = NCBIXML.read(StringIO(blast_out))
-            for aln in result.alignments[:self.top_results]:
-                logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
-                output.append((aln.hit_id, aln))
-        return output
+            midline.append(' ')
+    return ''.join(midline)
+
+
+class BlastWorkerPool(object):
+    """A bounded number of worker threads running blastp for all BlastSearch objects on one database.
+
+    Sequences submitted while the workers are busy (by concurrent requests or a batch search) are searched together in
+    one blastp process, so the database is opened once per batch instead of once per sequence.
+    """
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, blast_path, blastdb, workers=None, batch_size=None, batch_wait=0.01):
+        self.blast_path = blast_path
+        self.blastdb = blastdb
+        self.workers = workers or getattr(settings, 'BLAST_WORKERS', 2)
+        self.batch_size = batch_size or getattr(settings, 'BLAST_BATCH_SIZE', 50)
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.pid = None
+
+    @classmethod
+    def get(cls, blast_path, blastdb):
+        with cls.pools_lock:
+            if (blast_path, blastdb) not in cls.pools:
+                cls.pools[(blast_path, blastdb)] = cls(blast_path, blastdb)
+            return cls.pools[(blast_path, blastdb)]
+
+    def start(self):
+        # threads do not survive a fork, e.g. into the processes of a build command
+        with self.lock:
+            if self.pid != os.getpid():
+                self.threads = []
+                self.pid = os.getpid()
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name='blast-worker', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def search(self, sequences):
+        """Result rows for each of the (distinct) sequences"""
+        self.start()
+        futures = {}
+        for seq in sequences:
+            futures[seq] = Future()
+            self.queue.put((seq, futures[seq]))
+        return {seq: future.result() for seq, future in futures.items()}
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            try:
+                rows = run_blastp(self.blast_path, self.blastdb, list(OrderedDict.fromkeys(seq for seq, future in batch)))
+            except Exception as e:
+                for seq, future in batch:
+                    future.set_exception(e)
+                continue
+            for seq, future in batch:
+                future.set_result(rows[seq])
 #==============================================================================
 
 class BlastSearchOnline(object):
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from structure.coordinates import CoordinateStore
+
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Build the memory-mapped atom coordinate store of all PDB entries"
+
+    def handle(self, *args, **options):
+        start = time.time()
+        CoordinateStore.build()
+        print("Built coordinate store in {:.1f} seconds".format(time.time() - start))
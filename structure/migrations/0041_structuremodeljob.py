@@ -0,0 +1,39 @@
+# Generated by Django 3.1.7 on 2026-10-17 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0016_auto_20220225_1650'),
+        ('structure', '0040_delete_structurecomplexprotein'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureModelJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(max_length=100)),
+                ('complex', models.BooleanField(default=False)),
+                ('signprot', models.CharField(blank=True, default='', max_length=100)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('worker', models.CharField(blank=True, default='', max_length=200)),
+                ('claimed', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('build_time', models.FloatField(null=True)),
+                ('modeller_time', models.FloatField(null=True)),
+                ('templates', models.TextField(blank=True, default='')),
+                ('error', models.TextField(blank=True, default='')),
+                ('main_template', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='structure.structure')),
+                ('protein', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.protein')),
+            ],
+            options={
+                'db_table': 'structure_model_job',
+                'unique_together': {('protein', 'state', 'complex', 'signprot')},
+            },
+        ),
+    ]
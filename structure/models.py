@@ -1,10 +1,13 @@
-from django.db import models
+from django.db import models, transaction
 from django.core.cache import cache
+from django.utils import timezone
 
 from io import StringIO
+import json
 from Bio.PDB import PDBIO
 import re
 from protein.models import ProteinCouplings
+from structure.coordinates import get_coordinates
 
 class Structure(models.Model):
     # linked onto the Xtal ProteinConformation, which is linked to the Xtal protein
@@ -60,51 +63,39 @@ class Structure(models.Model):
 
     def get_cleaned_pdb(self, pref_chain=True, remove_waters=True, ligands_to_keep=None, remove_aux=False, aux_range=5.0):
 
+        if pref_chain:
+            # atom records only, served from the coordinate store
+            coordinates = self.pdb_data.get_coordinates()
+            # or 'refined' bit needs rework, it fucks up the extraction
+            if 'refined' not in self.pdb_code.index:
+                coordinates = coordinates.chain(self.preferred_chain[0])
+            if remove_waters:
+                coordinates = coordinates.without_waters()
+            if ligands_to_keep:
+                coordinates = coordinates.keep_ligands(ligands_to_keep)
+            return coordinates.to_pdb()
+
         tmp = []
         for line in self.pdb_data.pdb.split('\n'):
-            save_line = False
-            if pref_chain:
-                # or 'refined' bit needs rework, it fucks up the extraction
-                if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0] or 'refined' in self.pdb_code.index):
-                # if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0]):
-                    save_line = True
-            else:
-                save_line = True
+            save_line = True
             if remove_waters and line.startswith('HET') and line[17:20] == 'HOH':
                 save_line = False
             if ligands_to_keep and line.startswith('HET'):
-                if pref_chain:
-                    if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep and line[21] == self.preferred_chain[0]:
-                        save_line = True
-                    elif line[17:20] != 'HOH':
-                        save_line=False
-                else:
-                    if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
-                        save_line = True
-                    elif line[17:20] != 'HOH':
-                        save_line=False
+                if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
+                    save_line = True
+                elif line[17:20] != 'HOH':
+                    save_line=False
             if save_line:
                 tmp.append(line)
 
         return '\n'.join(tmp)
 
     def get_ligand_pdb(self, ligand):
-
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            if line.startswith('HET') and line[21] == self.preferred_chain[0]:
-                if line[17:20] != 'HOH' and line[17:20] == ligand:
-                    tmp.append(line)
-        return '\n'.join(tmp)
+        return self.pdb_data.get_coordinates().chain(self.preferred_chain[0]).ligand(ligand).to_pdb()
 
     def get_preferred_chain_pdb(self):
-
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
-            if (line.startswith('ATOM') or line.startswith('HET')) and line[21] == self.preferred_chain[0]:
-                tmp.append(line)
-        return '\n'.join(tmp)
+        # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
+        return self.pdb_data.get_coordinates().chain(self.preferred_chain[0]).to_pdb()
 
     class Meta():
         db_table = 'structure'
@@ -171,6 +162,70 @@ class StructureComplexModel(models.Model):
             return 'no evidence'
 
 
+class StructureModelJob(models.Model):
+    """A homology model (or refined structure) to build with build_homology_models. Workers, possibly on several
+    machines, claim pending jobs one at a time, and record the outcome, timings and templates of the model."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    protein = models.ForeignKey('protein.Protein', on_delete=models.CASCADE)
+    state = models.CharField(max_length=100)
+    complex = models.BooleanField(default=False)
+    # entry name of the signaling protein, empty if it is chosen when modeling
+    signprot = models.CharField(max_length=100, default='', blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # host name and process id of the worker of the last attempt
+    worker = models.CharField(max_length=200, default='', blank=True)
+    claimed = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    # seconds of the whole job and of the MODELLER runs of it
+    build_time = models.FloatField(null=True)
+    modeller_time = models.FloatField(null=True)
+    main_template = models.ForeignKey('structure.Structure', null=True, on_delete=models.SET_NULL)
+    # backbone templates of each segment, as JSON
+    templates = models.TextField(default='', blank=True)
+    error = models.TextField(default='', blank=True)
+
+    def __str__(self):
+        return '<StructureModelJob: {} {} {}>'.format(self.protein.entry_name, self.state, self.status)
+
+    class Meta():
+        db_table = 'structure_model_job'
+        unique_together = ('protein', 'state', 'complex', 'signprot')
+
+    @classmethod
+    def claim(cls, worker, jobs):
+        """Mark the first pending job of a queryset as running and return it, None if there are no pending jobs.
+        Rows locked by other workers are skipped, so a job is only claimed once."""
+        with transaction.atomic():
+            job = jobs.select_for_update(skip_locked=True).filter(status=cls.PENDING) \
+                .order_by('pk').first()
+            if job is None:
+                return None
+            job.status = cls.RUNNING
+            job.attempts += 1
+            job.worker = worker
+            job.claimed = timezone.now()
+            job.finished = None
+            job.error = ''
+            job.save(update_fields=['status', 'attempts', 'worker', 'claimed', 'finished', 'error'])
+        return job
+
+    def finish(self, built, build_time=None, modeller_time=None, main_template=None, templates=None, error=''):
+        self.status = self.DONE if built else self.FAILED
+        self.finished = timezone.now()
+        self.build_time = build_time
+        self.modeller_time = modeller_time
+        self.main_template = main_template
+        self.templates = json.dumps(templates) if templates else ''
+        self.error = error or ''
+        self.save()
+
+
 class StatsText(models.Model):
     stats_text = models.TextField()
 
@@ -274,6 +329,10 @@ class PdbData(models.Model):
     def __str__(self):
         return self.pdb
 
+    def get_coordinates(self):
+        """Atom coordinates as a StructureCoordinates object, which skips parsing the PDB text when stored."""
+        return get_coordinates(self)
+
     class Meta():
         db_table = "structure_pdb_data"
 
@@ -231,6 +231,7 @@ class SequenceParser(object):
         bio.pdb reads pdb in the following cascade: model->chain->residue->atom
         """
 
+        peptides = []
         for chain in pdb_struct:
             self.residues[chain.id] = []
             
@@ -241,8 +242,13 @@ class SequenceParser(object):
                 self.residues[chain.id].append(res)
             poly = self.get_chain_peptides(chain.id)
             for peptide in poly:
-                #print("Start: {} Stop: {} Len: {}".format(peptide[0].id[1], peptide[-1].id[1], len(peptide)))
-                self.map_to_wt_blast(chain.id, peptide, None, int(peptide[0].id[1]))
+                peptides.append((chain.id, peptide))
+
+        # one blast search for the peptides of all chains
+        alignments = self.blast.run_batch([self.get_peptide_sequence(peptide) for chain_id, peptide in peptides])
+        for (chain_id, peptide), peptide_alignments in zip(peptides, alignments):
+            #print("Start: {} Stop: {} Len: {}".format(peptide[0].id[1], peptide[-1].id[1], len(peptide)))
+            self.map_to_wt_blast(chain_id, peptide, None, int(peptide[0].id[1]), alignments=peptide_alignments)
 
 
     def get_segments(self):
@@ -318,15 +324,16 @@ class SequenceParser(object):
         return nrc
 
 
-    def map_to_wt_blast(self, chain_id, residues = None, sequence=None, starting_aa = 1, seqres = False):
+    def map_to_wt_blast(self, chain_id, residues = None, sequence=None, starting_aa = 1, seqres = False, alignments = None):
 
-        if residues:
-            seq = self.get_peptide_sequence(residues)
-        elif sequence:
-            seq = sequence
-        else:
-            seq = self.get_chain_sequence(chain_id)
-        alignments = self.blast.run(seq)
+        if alignments is None:
+            if residues:
+                seq = self.get_peptide_sequence(residues)
+            elif sequence:
+                seq = sequence
+            else:
+                seq = self.get_chain_sequence(chain_id)
+            alignments = self.blast.run(seq)
         
         if self.wt_protein_id!=None:
             self.wt = Protein.objects.get(id=self.wt_protein_id)
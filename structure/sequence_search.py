@@ -0,0 +1,236 @@
+from django.conf import settings
+
+from Bio import Align
+
+from common.similarity import get_blosum62
+from structure.functions import BlastSearch, BlastAlignment, BlastHSP, blast_midline
+
+import logging
+import math
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger('protwis')
+
+ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'
+KMER_SIZE = 3
+
+# Karlin-Altschul parameters of BLOSUM62 with gap costs 11/1 (the blastp defaults), for BLAST-like e-values
+KA_LAMBDA = 0.267
+KA_K = 0.041
+
+# letters of the alphabet are coded 0-19, anything else 20
+_codes = np.full(256, len(ALPHABET), dtype=np.uint8)
+for _i, _aa in enumerate(ALPHABET):
+    _codes[ord(_aa)] = _i
+
+
+def encode(sequence):
+    """Sequence as an array of letter codes"""
+    return _codes[np.frombuffer(sequence.upper().encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def kmer_codes(codes):
+    """Code of the k-mer starting at each position (but the last KMER_SIZE-1), -1 where it has an unknown letter"""
+    if len(codes) < KMER_SIZE:
+        return np.zeros(0, dtype=np.int64)
+    kmers = np.zeros(len(codes) - KMER_SIZE + 1, dtype=np.int64)
+    valid = np.ones(len(kmers), dtype=bool)
+    for i in range(KMER_SIZE):
+        window = codes[i:len(codes) - KMER_SIZE + 1 + i]
+        kmers = kmers * len(ALPHABET) + np.minimum(window, len(ALPHABET) - 1)
+        valid &= window < len(ALPHABET)
+    kmers[~valid] = -1
+    return kmers
+
+
+class SequenceIndex:
+    """K-mer index of the sequences of a BLAST database, written next to it by build_blast_database.
+
+    For every k-mer the index lists the sequences containing it, so the entries sharing most k-mers with a query are
+    found with a few array operations.
+    """
+    suffix = '.kmer.npz'
+
+    _instances = {}
+
+    def __init__(self, ids, names, residues, offsets, kmer_offsets, kmer_sequences):
+        self.ids = ids
+        self.names = names
+        self.residues = residues
+        self.offsets = offsets
+        self.kmer_offsets = kmer_offsets
+        self.kmer_sequences = kmer_sequences
+        self.size = int(offsets[-1])
+
+    @classmethod
+    def build(cls, proteins, blastdb):
+        """Write the index of the proteins (id, name, sequence) of a database"""
+        ids, names, sequences = zip(*proteins) if proteins else ([], [], [])
+        sequences = [sequence.upper() for sequence in sequences]
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(sequence) for sequence in sequences])
+
+        # distinct (k-mer, sequence) pairs, sorted by k-mer
+        pairs = []
+        for i, sequence in enumerate(sequences):
+            kmers = np.unique(kmer_codes(encode(sequence)))
+            kmers = kmers[kmers >= 0]
+            pairs.append(kmers * len(sequences) + i)
+        pairs = np.sort(np.concatenate(pairs)) if pairs else np.zeros(0, dtype=np.int64)
+        kmer_offsets = np.searchsorted(pairs // max(len(sequences), 1), np.arange(len(ALPHABET)**KMER_SIZE + 1))
+
+        path = blastdb + cls.suffix
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, ids=np.array(ids, dtype=np.int64), names=np.array(names, dtype=str),
+                residues=np.frombuffer(''.join(sequences).encode('ascii', 'replace'), dtype=np.uint8),
+                offsets=offsets, kmer_offsets=kmer_offsets.astype(np.int64),
+                kmer_sequences=(pairs % max(len(sequences), 1)).astype(np.int32))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, blastdb):
+        """Return the shared index of a database, or None if it has not been built."""
+        path = blastdb + cls.suffix
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        if blastdb not in cls._instances or cls._instances[blastdb][0] != mtime:
+            try:
+                with np.load(path) as data:
+                    index = cls(*[data[key] for key in ['ids', 'names', 'residues', 'offsets', 'kmer_offsets',
+                        'kmer_sequences']])
+            except (OSError, ValueError, KeyError):
+                return None
+            cls._instances[blastdb] = (mtime, index)
+
+        return cls._instances[blastdb][1]
+
+    def sequence(self, i):
+        return self.residues[self.offsets[i]:self.offsets[i+1]].tobytes().decode('ascii')
+
+    def candidates(self, query, count, min_fraction=0.5):
+        """Indices of the (at most count) sequences sharing most k-mers with the query, best first. Only sequences
+        sharing at least min_fraction of the k-mers of the best one are included."""
+        kmers = np.unique(kmer_codes(encode(query)))
+        kmers = kmers[kmers >= 0]
+        if not len(kmers) or not len(self.ids):
+            return np.zeros(0, dtype=np.int64)
+        postings = np.concatenate([self.kmer_sequences[self.kmer_offsets[k]:self.kmer_offsets[k+1]] for k in kmers])
+        shared = np.bincount(postings, minlength=len(self.ids))
+        if count < len(shared):
+            top = np.argpartition(-shared, count)[:count]
+        else:
+            top = np.arange(len(shared))
+        # sequences sharing far fewer k-mers than the best ones are not among the closest entries
+        top = top[shared[top] >= max(1, min_fraction * shared.max())]
+        return top[np.lexsort((top, -shared[top]))]
+
+
+class SequenceSearch(object):
+    """Search of the closest entries of a protwis BLAST database, without running blastp.
+
+    Candidates found through the SequenceIndex of the database are aligned to the query with a Smith-Waterman
+    alignment (BLOSUM62, gap costs 11/1 as in blastp). Results have the form of BlastSearch results, so they can be
+    mapped in the same way. Queries are searched with BlastSearch when the database has no index, or when the query
+    has no k-mers in common with any entry.
+    """
+
+    def __init__(self, blast_path='blastp',
+        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1, candidates=10,
+        max_expect=10):
+
+        self.blast = BlastSearch(blast_path=blast_path, blastdb=blastdb, top_results=top_results)
+        self.blastdb = blastdb
+        self.top_results = top_results
+        # number of k-mer candidates aligned to the query
+        self.candidates = max(candidates, top_results)
+        self.max_expect = max_expect
+        self.aligner = Align.PairwiseAligner(mode='local', substitution_matrix=get_blosum62(), open_gap_score=-11,
+            extend_gap_score=-1)
+
+    def run(self, input_seq):
+
+        return self.run_batch([input_seq])[0]
+
+    def run_batch(self, input_seqs):
+        """Search several sequences at once, returns a list of results as from run() in the same order"""
+        sequences = [str(seq).strip().upper() for seq in input_seqs]
+        index = SequenceIndex.load(self.blastdb)
+        if index is None:
+            logger.debug('No sequence index of {}, searching with BLAST'.format(self.blastdb))
+            return self.blast.run_batch(sequences)
+
+        results = [self.search(index, seq) if seq else [] for seq in sequences]
+        fallback = [i for i, result in enumerate(results) if result is None]
+        if fallback:
+            for i, result in zip(fallback, self.blast.run_batch([sequences[i] for i in fallback])):
+                results[i] = result
+        return results
+
+    def search(self, index, query):
+        """Alignments of the closest entries of the index, or None if the query shares no k-mers with them"""
+        candidates = index.candidates(query, self.candidates)
+        if not len(candidates):
+            return None
+
+        # letters outside of BLOSUM62 are aligned as unknown residues
+        alphabet = set(get_blosum62().alphabet)
+        query = ''.join(aa if aa in alphabet else 'X' for aa in query)
+        scored = []
+        for i in candidates:
+            sbjct = ''.join(aa if aa in alphabet else 'X' for aa in index.sequence(i))
+            # the scores are only needed to choose the alignments to return
+            score = -self.aligner.score(query, sbjct) if len(candidates) > self.top_results else 0
+            scored.append((score, int(i), sbjct))
+        scored.sort()
+
+        output = []
+        for score, i, sbjct in scored[:self.top_results]:
+            hsp = self.hsp(self.aligner.align(query, sbjct)[0], query, sbjct, index.size)
+            if hsp.expect > self.max_expect:
+                break
+            aln = BlastAlignment()
+            aln.hit_id = str(index.ids[i])
+            aln.hit_def = str(index.names[i])
+            aln.title = '{} {}'.format(aln.hit_id, aln.hit_def)
+            aln.length = len(sbjct)
+            aln.hsps.append(hsp)
+            output.append((aln.hit_id, aln))
+        return output
+
+    def hsp(self, alignment, query, sbjct, database_size):
+        """BLAST HSP record of a local alignment"""
+        coordinates = alignment.coordinates
+        query_parts = []
+        sbjct_parts = []
+        for (q_start, s_start), (q_end, s_end) in zip(coordinates.T[:-1], coordinates.T[1:]):
+            if q_start == q_end:
+                query_parts.append('-' * (s_end - s_start))
+            else:
+                query_parts.append(query[q_start:q_end])
+            if s_start == s_end:
+                sbjct_parts.append('-' * (q_end - q_start))
+            else:
+                sbjct_parts.append(sbjct[s_start:s_end])
+
+        hsp = BlastHSP()
+        hsp.query = ''.join(query_parts)
+        hsp.sbjct = ''.join(sbjct_parts)
+        hsp.match = blast_midline(hsp.query, hsp.sbjct)
+        hsp.query_start = int(coordinates[0, 0]) + 1
+        hsp.query_end = int(coordinates[0, -1])
+        hsp.sbjct_start = int(coordinates[1, 0]) + 1
+        hsp.sbjct_end = int(coordinates[1, -1])
+        hsp.align_length = len(hsp.query)
+        hsp.identities = sum(1 for q, s in zip(hsp.query, hsp.sbjct) if q == s and q != '-')
+        hsp.positives = len(hsp.match) - hsp.match.count(' ')
+        hsp.gaps = hsp.query.count('-') + hsp.sbjct.count('-')
+        hsp.score = float(alignment.score)
+        hsp.bits = (KA_LAMBDA * hsp.score - math.log(KA_K)) / math.log(2)
+        hsp.expect = len(query) * database_size * 2 ** -hsp.bits
+        return hsp
@@ -1,3 +1,302 @@
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+from protein.models import Protein, ProteinFamily, ProteinSequenceType, ProteinSource, Species
+from structure.functions import BlastError, BlastSearch, BlastWorkerPool, SubstructureSelector
+from structure.models import StructureModelJob
+from structure.sequence_search import SequenceIndex, SequenceSearch
+
+from Bio.PDB import PDBIO, PDBParser
+
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipIf, skipUnless
+
+import json
+import os
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import zlib
+
+try:
+    import modeller
+except ImportError:
+    modeller = None
+
+
+# sequences of the test database (id, name, sequence)
+PROTEINS = [
+    (1, 'adrb2_human', 'MGQPGNGSAFLLAPNRSHAPDHDVTQQRDEVWVVGMGIVMSLIVLAIVFGNVLVITAIAKFERLQTVTNYFITSLACADLVMGLAVVPFGAAHILMK'),
+    (2, 'adrb1_human', 'MGAGVLVLGASEPGNLSSAAPLPDGAATAARLLVPASPPASLLPPASESPEPLSQQWTAGMGLLMALIVLLIVAGNVLVIVAIAKTPRLQTLTNLFIMSLASADLVMGLLVVPFGATIVVWG'),
+    (3, 'oprm_human', 'MDSSAAPTNASNCTDALAYSSCSPAPSPGSWVNLSHLDGNLSDPCGPNRTDLGGRDSLCPPTGSPSMITAITIMALYSIVCVVGLFGNFLVMYVIVRYTKMKTATNIYIFNLALADALATSTLPF'),
+    (4, 'cnr1_human', 'MKSILDGLADTTFRTITTDLLYVGSNDIQYEDIKGDMASKLGYFPQKFPLTSFRGSPFQEKMTAGDNPQLVPADQVNITEFYNKSLSSFKENEENIQCGENFMDIECFMVLNPSQQLAIAVLSLTLGTFTVLENLLVLCVILHSRSLRCRPSYHFIGSLAVADLLGSVIFVYSFIDFHVFHRKDSRNVFLFKLGGVTASFTASVGSLFLTAIDRYISIHRPLAYKRIVTRPKAVVAFCLMWTIAIVIAVLPLLGWNCEKLQSVCSDIFPHIDETYLMFWIGVTSVLLLFIVYAYMYILWKAHSHAVRMIQRGTQKSIIIHTSEDGKVQVTRPDQARMDIRLAKTLVLILVVLIICWGPLLAIMVYDVFGKMNKLIKTVFAFCSMLCLLNSTVNPIIYALRSKDLRHAFRSMFPSCEGTAQPLDNSMGDSDCLHKHANNAASVHRAAESCIKSTVKIAKVTMSVSTDTSAEAL'),
+]
+
+
+class SequenceSearchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.blastdb = os.path.join(self.directory.name, 'protwis_blastdb')
+        SequenceIndex.build(PROTEINS, self.blastdb)
+
+    def tearDown(self):
+        SequenceIndex._instances.clear()
+        self.directory.cleanup()
+
+    def test_index(self):
+        index = SequenceIndex.load(self.blastdb)
+        self.assertEqual(list(index.ids), [p[0] for p in PROTEINS])
+        self.assertEqual([index.sequence(i) for i in range(len(PROTEINS))], [p[2] for p in PROTEINS])
+        self.assertEqual(index.candidates(PROTEINS[2][2][20:90], 2)[0], 2)
+
+    def test_search(self):
+        search = SequenceSearch(blastdb=self.blastdb, top_results=2)
+        # part of adrb2 with two substitutions
+        query = PROTEINS[0][2][30:90]
+        query = query[:10] + 'W' + query[11:40] + 'P' + query[41:]
+        result = search.run(query)
+
+        hit_id, alignment = result[0]
+        self.assertEqual(hit_id, '1')
+        self.assertEqual(alignment.hit_def, 'adrb2_human')
+        hsp = alignment.hsps[0]
+        self.assertEqual((hsp.query_start, hsp.query_end), (1, 60))
+        self.assertEqual((hsp.sbjct_start, hsp.sbjct_end), (31, 90))
+        self.assertEqual(hsp.identities, 58)
+        self.assertEqual(hsp.gaps, 0)
+        self.assertEqual(hsp.sbjct, PROTEINS[0][2][30:90])
+
+        # entries sharing far fewer k-mers are not aligned
+        self.assertEqual(len(result), 1)
+
+    def test_blast_fallback(self):
+        search = SequenceSearch(blastdb=self.blastdb)
+        blast_result = [('9', mock.Mock())]
+        with mock.patch.object(search.blast, 'run_batch', return_value=[blast_result]) as run_batch:
+            # no k-mers in common with the entries: only this query is searched with BLAST
+            results = search.run_batch([PROTEINS[3][2][100:160], 'WWWWWWWWWW'])
+        run_batch.assert_called_once_with(['WWWWWWWWWW'])
+        self.assertEqual(results[0][0][0], '4')
+        self.assertIs(results[1], blast_result)
+
+        # without an index all queries are searched with BLAST
+        search = SequenceSearch(blastdb=os.path.join(self.directory.name, 'other_blastdb'))
+        with mock.patch.object(search.blast, 'run_batch', return_value=[blast_result]) as run_batch:
+            self.assertEqual(search.run(PROTEINS[0][2]), blast_result)
+        run_batch.assert_called_once_with([PROTEINS[0][2]])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BlastSearchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.blastdb = os.path.join(self.directory.name, 'protwis_blastdb')
+
+    def tearDown(self):
+        BlastWorkerPool.pools.clear()
+        self.directory.cleanup()
+
+    def blastp(self, script):
+        """Stand-in blastp executable running a shell script"""
+        path = os.path.join(self.directory.name, 'blastp')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\ncat > /dev/null\n' + script + '\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def test_failed_search(self):
+        for script in ['echo "BLAST Database error: No alias or index file found" >&2; exit 2', 'exit 1',
+                'echo "Error: database is incomplete" >&2']:
+            search = BlastSearch(blast_path=self.blastp(script), blastdb=self.blastdb)
+            with self.assertRaises(BlastError):
+                search.run(PROTEINS[0][2])
+
+        # the failed searches are not cached
+        search = BlastSearch(blast_path=self.blastp('exit 0'), blastdb=self.blastdb)
+        self.assertEqual(search.run(PROTEINS[0][2]), [])
+
+
+# two models of two chains, with a water in the selected range
+PDB = '''MODEL        1
+ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00  0.00           N
+ATOM      2  CA  ALA A   1      11.639   6.071  -5.147  1.00  0.00           C
+ATOM      3  N   GLY A   2      12.560   7.231  -4.842  1.00  0.00           N
+ATOM      4  CA  GLY A   2      13.011   7.298  -3.460  1.00  0.00           C
+ATOM      5  N   SER A   3      14.120   8.001  -3.100  1.00  0.00           N
+TER       6      SER A   3
+ATOM      7  N   LEU B   2       1.104   2.134  -1.504  1.00  0.00           N
+ATOM      8  CA ALEU B   2       1.639   2.071  -1.147  0.50  0.00           C
+ATOM      9  CA BLEU B   2       1.739   2.171  -1.247  0.50  0.00           C
+HETATM   10  O   HOH B   1       5.000   5.000   5.000  1.00  0.00           O
+TER      11      LEU B   2
+ENDMDL
+MODEL        2
+ATOM      1  N   ALA A   1      21.104   6.134  -6.504  1.00  0.00           N
+ATOM      2  CA  ALA A   1      21.639   6.071  -5.147  1.00  0.00           C
+ENDMDL
+END
+'''
+
+
+class SubstructureDownloadTest(SimpleTestCase):
+
+    def entry_text(self, entry):
+        return zlib.decompress(entry.data, -15).decode('utf-8')
+
+    def test_same_as_parsed_model(self):
+        from structure.views import substructure_zip_entry
+
+        for residues in [[1, 2], [3], [7]]:
+            selector = SubstructureSelector({'TM1': residues}, SimpleNamespace(helices=[1], substructures=[]))
+            expected = StringIO()
+            io = PDBIO()
+            io.set_structure(PDBParser(QUIET=True).get_structure('test', StringIO(PDB))[0])
+            io.save(expected, selector)
+
+            pdb = self.entry_text(substructure_zip_entry('test.pdb', PDB, selector))
+            self.assertEqual(pdb, expected.getvalue())
+        # nothing selected
+        self.assertEqual(pdb.strip(), 'END')
+
+
+def create_proteins(count):
+    family = ProteinFamily.objects.create(slug='001', name='Class A')
+    species = Species.objects.create(latin_name='Homo sapiens', common_name='Human')
+    source = ProteinSource.objects.create(name='SWISSPROT')
+    sequence_type = ProteinSequenceType.objects.create(slug='wt', name='Wild-type')
+    return [Protein.objects.create(family=family, species=species, source=source, sequence_type=sequence_type,
+                                   entry_name=entry_name, name=entry_name, sequence=sequence)
+            for pk, entry_name, sequence in PROTEINS[:count]]
+
+
+class StructureModelJobTest(TestCase):
+
+    def setUp(self):
+        self.jobs = [StructureModelJob.objects.create(protein=p, state='Inactive') for p in create_proteins(3)]
+        self.queryset = StructureModelJob.objects.all()
+
+    def test_claim(self):
+        self.jobs[0].status = StructureModelJob.DONE
+        self.jobs[0].save()
+        job = StructureModelJob.claim('host:1', self.queryset)
+        self.assertEqual(job.pk, self.jobs[1].pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, StructureModelJob.RUNNING)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.worker, 'host:1')
+        self.assertIsNotNone(job.claimed)
+        self.assertEqual(StructureModelJob.claim('host:2', self.queryset).pk, self.jobs[2].pk)
+        self.assertIsNone(StructureModelJob.claim('host:3', self.queryset))
+
+    def test_finish(self):
+        job = StructureModelJob.claim('host:1', self.queryset)
+        job.finish(True, build_time=12.5, modeller_time=10.0, templates={'TM1': '2rh1'})
+        job.refresh_from_db()
+        self.assertEqual(job.status, StructureModelJob.DONE)
+        self.assertEqual(job.build_time, 12.5)
+        self.assertEqual(json.loads(job.templates), {'TM1': '2rh1'})
+        self.assertIsNotNone(job.finished)
+
+        job = StructureModelJob.claim('host:1', self.queryset)
+        job.finish(False, error='No template')
+        job.refresh_from_db()
+        self.assertEqual(job.status, StructureModelJob.FAILED)
+        self.assertEqual(job.templates, '')
+        self.assertEqual(job.error, 'No template')
+
+
+@skipUnless(connection.features.has_select_for_update_skip_locked, 'the database does not lock rows')
+class StructureModelJobLockTest(TransactionTestCase):
+
+    def test_claim_skips_locked(self):
+        jobs = [StructureModelJob.objects.create(protein=p, state='Inactive') for p in create_proteins(2)]
+        locked, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            with transaction.atomic():
+                list(StructureModelJob.objects.select_for_update().filter(pk=jobs[0].pk))
+                locked.set()
+                release.wait(10)
+            connection.close()
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            job = StructureModelJob.claim('host:1', StructureModelJob.objects.all())
+            self.assertEqual(job.pk, jobs[1].pk)
+        finally:
+            release.set()
+            thread.join()
+
+
+@skipIf(modeller is None, 'MODELLER is not installed')
+class QueueJobsTest(TestCase):
+
+    def setUp(self):
+        from build.management.commands.build_homology_models import Command
+        self.command = Command()
+        self.command.receptor_list = [(p, 'Inactive') for p in create_proteins(4)]
+        self.command.complex = False
+        self.command.signprot = False
+        self.jobs = list(self.command.queue_jobs())
+        self.live_worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def set_status(self, job, status, worker='', claimed=None):
+        StructureModelJob.objects.filter(pk=job.pk).update(status=status, attempts=1, worker=worker, claimed=claimed)
+
+    def statuses(self):
+        return [StructureModelJob.objects.get(pk=job.pk).status for job in self.jobs]
+
+    def dead_worker(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return '{}:{}'.format(socket.gethostname(), process.pid)
+
+    def test_create(self):
+        self.assertEqual(len(self.jobs), 4)
+        self.assertEqual(self.statuses(), [StructureModelJob.PENDING]*4)
+        self.assertEqual(len(self.command.queue_jobs()), 4)
+        self.assertEqual(StructureModelJob.objects.count(), 4)
+
+    def test_rerun(self):
+        self.set_status(self.jobs[0], StructureModelJob.DONE)
+        self.set_status(self.jobs[1], StructureModelJob.FAILED)
+        self.set_status(self.jobs[2], StructureModelJob.RUNNING, self.live_worker, timezone.now())
+        self.set_status(self.jobs[3], StructureModelJob.RUNNING, self.dead_worker(), timezone.now())
+        self.command.queue_jobs()
+        self.assertEqual(self.statuses(), [StructureModelJob.PENDING, StructureModelJob.PENDING,
+                                           StructureModelJob.RUNNING, StructureModelJob.PENDING])
+        self.assertEqual(StructureModelJob.objects.get(pk=self.jobs[0].pk).attempts, 0)
+
+    def test_resume(self):
+        self.set_status(self.jobs[0], StructureModelJob.DONE)
+        self.set_status(self.jobs[1], StructureModelJob.FAILED)
+        self.set_status(self.jobs[2], StructureModelJob.RUNNING, 'otherhost:1', timezone.now())
+        self.set_status(self.jobs[3], StructureModelJob.RUNNING, 'otherhost:2',
+                        timezone.now()-self.command.job_timeout-timedelta(hours=1))
+        self.command.queue_jobs(resume=True)
+        self.assertEqual(self.statuses(), [StructureModelJob.DONE, StructureModelJob.FAILED,
+                                           StructureModelJob.RUNNING, StructureModelJob.PENDING])
+
+    def test_resume_dead_worker(self):
+        self.set_status(self.jobs[0], StructureModelJob.RUNNING, self.live_worker, timezone.now())
+        self.set_status(self.jobs[1], StructureModelJob.RUNNING, self.dead_worker(), timezone.now())
+        self.set_status(self.jobs[2], StructureModelJob.RUNNING, '', None)
+        self.command.queue_jobs(resume=True)
+        self.assertEqual(self.statuses()[:3], [StructureModelJob.RUNNING, StructureModelJob.PENDING,
+                                               StructureModelJob.PENDING])
+
+    def test_retry_failed(self):
+        self.set_status(self.jobs[0], StructureModelJob.DONE)
+        self.set_status(self.jobs[1], StructureModelJob.FAILED)
+        self.command.queue_jobs(resume=True, retry_failed=True)
+        self.assertEqual(self.statuses()[:2], [StructureModelJob.DONE, StructureModelJob.PENDING])
+        self.assertEqual(StructureModelJob.objects.get(pk=self.jobs[1].pk).attempts, 1)
@@ -1,7 +1,8 @@
 from django.shortcuts import render
 from django.conf import settings
 from django.views.generic import TemplateView, View
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.core.cache import cache
 from django.db.models import Count, Q, Prefetch, TextField
 from django.db.models.functions import Concat
 from django import forms
@@ -11,6 +12,7 @@ from django.shortcuts import redirect
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
 from protein.models import ProteinSegment
 from structure.models import Structure, StructureModel, StructureComplexModel, StructureExtraProteins, StructureVectors, StructureModelRMSD
+from structure.coordinates import StructureCoordinates, parse_pdb_atoms
 from structure.functions import CASelector, SelectionParser, GenericNumbersSelector, SubstructureSelector, ModelRotamer
 from structure.assign_generic_numbers_gpcr import GenericNumbering, GenericNumberingFromDB
 from structure.structural_superposition import ProteinSuperpose,FragmentSuperpose
@@ -25,6 +27,7 @@ from common.selection import Selection, SelectionItem
 from common.extensions import MultiFileField
 from common.models import ReleaseNotes
 from common.alignment import Alignment, GProteinAlignment
+from common.zipstream import deflate, stream_zip
 from residue.models import Residue
 
 import io
@@ -40,6 +43,7 @@ import zipfile
 import json
 
 from copy import deepcopy
+from functools import partial
 from io import StringIO, BytesIO
 from collections import OrderedDict
 from Bio.PDB import PDBIO, PDBParser
@@ -560,9 +564,7 @@ def ServeUprightPdbDiagram(request, pdbname):
 		center_axis = json.loads(sv.center_axis)
 
 	# Load structure
-	parser = PDBParser(QUIET=True)
-	with io.StringIO(structure.pdb_data.pdb) as f:
-		struct = parser.get_structure(structure.pdb_code.index, f)
+	struct = structure.pdb_data.get_coordinates().to_structure(structure.pdb_code.index)
 
 	# Neutral references
 	translation_neutral = np.array((0, 0, 0), 'f')
@@ -2295,36 +2297,57 @@ class PDBDownload(View):
 			return HttpResponseRedirect('/structure/pdb_segment_selection')
 
 		if self.kwargs['substructure'] == 'full':
-			out_stream = request.session['cleaned_structures']
+			# already compressed by PDBClean, sent as is
+			archive = request.session['cleaned_structures'].getvalue()
+			content = (archive[i:i + 65536] for i in range(0, len(archive), 65536)) if len(archive) > 0 else None
 
 		elif self.kwargs['substructure'] == 'custom':
 			simple_selection = request.session.get('selection', False)
 			selection = Selection()
 			if simple_selection:
 				selection.importer(simple_selection)
-			io = PDBIO()
+			parsed_selection = SelectionParser(selection)
 			zipf_in = zipfile.ZipFile(request.session['cleaned_structures'], 'r')
-			out_stream = BytesIO()
-			zipf_out = zipfile.ZipFile(out_stream, 'w', zipfile.ZIP_DEFLATED)
+			entries = []
 			for name in zipf_in.namelist():
-				tmp = StringIO()
-				io.set_structure(PDBParser(QUIET=True).get_structure(name, StringIO(zipf_in.read(name).decode('utf-8')))[0])
-				io.save(tmp, SubstructureSelector(request.session['substructure_mapping'][name], parsed_selection=SelectionParser(selection)))
-				zipf_out.writestr(name, tmp.getvalue())
-
+				selector = SubstructureSelector(request.session['substructure_mapping'][name], parsed_selection=parsed_selection)
+				entries.append(partial(substructure_zip_entry, name, zipf_in.read(name).decode('utf-8'), selector))
 			zipf_in.close()
-			zipf_out.close()
+			content = stream_zip(entries) if entries else None
 
-		if len(out_stream.getvalue()) > 0:
-			response = HttpResponse(content_type="application/zip")
+		if content is not None:
+			response = StreamingHttpResponse(content, content_type="application/zip")
 			if hommods == False:
 				response['Content-Disposition'] = 'attachment; filename="pdb_structures.zip"'
 			else:
 				response['Content-Disposition'] = 'attachment; filename="GPCRDB_homology_models.zip"'
-			response.write(out_stream.getvalue())
 
 		return response
 
+
+def substructure_zip_entry(name, pdb, selector):
+	"Compressed PDB file of the first model with only the residues accepted by a SubstructureSelector"
+	coordinates = StructureCoordinates(parse_pdb_atoms(pdb)).model(0)
+	# only the atoms of the selected residues are built into a structure, PDBIO writes the same file either way
+	selected = coordinates.filter(np.isin(coordinates.atoms['resseq'], selector.residues))
+	if len(selected):
+		coordinates = selected
+	out_stream = StringIO()
+	io = PDBIO()
+	io.set_structure(coordinates.to_structure(name)[0])
+	io.save(out_stream, selector)
+	return deflate(name, out_stream.getvalue())
+
+
+def cached_pdb_zip_entry(name, pdb_data):
+	"Compressed PDB file of a model, compressed once and then reused from the cache"
+	cache_name = 'zip_entry_pdb_data_{}'.format(pdb_data.pk)
+	entry = cache.get(cache_name)
+	if entry is None:
+		entry = deflate(name, pdb_data.pdb)
+		cache.set(cache_name, entry, 60*60*24*7) # cache a week
+	return entry._replace(name=name)
+
 #==============================================================================
 def ConvertStructuresToProteins(request):
 	"For alignment from structure browser"
@@ -2417,13 +2440,11 @@ def HommodDownload(request):
 	"Download selected homology models in zip file"
 	pks = request.GET['ids'].split(',')
 
-	hommodels = [StructureModel.objects.get(pk=pk) for pk in pks]
+	hommodels = StructureModel.objects.filter(pk__in=pks).select_related('pdb_data', 'stats_text', 'main_template__pdb_code',
+		'protein__family', 'protein__parent', 'state')
 
-	zip_io = BytesIO()
-	with zipfile.ZipFile(zip_io, mode='w', compression=zipfile.ZIP_DEFLATED) as backup_zip:
-		for hommod in hommodels:
-			io = StringIO(hommod.pdb_data.pdb)
-			stats_text = StringIO(hommod.stats_text.stats_text)
+	def entries():
+		for hommod in hommodels.iterator(chunk_size=50):
 			if not hommod.protein.accession:
 				mod_name = 'Class{}_{}_{}_refined_{}_{}_GPCRDB.pdb'.format(class_dict[hommod.protein.family.slug[:3]], hommod.protein.parent.entry_name,
 																   hommod.main_template.pdb_code.index, hommod.state.name, hommod.version)
@@ -2434,24 +2455,22 @@ def HommodDownload(request):
 																		  hommod.state.name, hommod.main_template.pdb_code.index, hommod.version)
 				stat_name = 'Class{}_{}_{}_{}_{}_GPCRDB.templates.csv'.format(class_dict[hommod.protein.family.slug[:3]], hommod.protein.entry_name,
 																		  hommod.state.name, hommod.main_template.pdb_code.index, hommod.version)
-			backup_zip.writestr(mod_name, io.getvalue())
-			backup_zip.writestr(stat_name, stats_text.getvalue())
+			yield partial(cached_pdb_zip_entry, mod_name, hommod.pdb_data)
+			yield (stat_name, hommod.stats_text.stats_text)
 
-	response = HttpResponse(zip_io.getvalue(), content_type='application/x-zip-compressed')
+	response = StreamingHttpResponse(stream_zip(entries()), content_type='application/x-zip-compressed')
 	response['Content-Disposition'] = 'attachment; filename=%s' % 'GPCRDB_homology_models' + ".zip"
-	response['Content-Length'] = zip_io.tell()
 	return response
 
 def ComplexmodDownload(request):
 	"Download selected complex homology models in zip file"
 	pks = request.GET['ids'].split(',')
 
-	hommodels = StructureComplexModel.objects.filter(pk__in=pks).prefetch_related('receptor_protein__family','main_template__pdb_code').all()
-	zip_io = BytesIO()
-	with zipfile.ZipFile(zip_io, mode='w', compression=zipfile.ZIP_DEFLATED) as backup_zip:
-		for hommod in hommodels:
-			io = StringIO(hommod.pdb_data.pdb)
-			stats_text = StringIO(hommod.stats_text.stats_text)
+	hommodels = StructureComplexModel.objects.filter(pk__in=pks).select_related('pdb_data', 'stats_text', 'main_template__pdb_code',
+		'receptor_protein__family', 'receptor_protein__parent', 'sign_protein')
+
+	def entries():
+		for hommod in hommodels.iterator(chunk_size=50):
 			if not hommod.receptor_protein.accession:
 				mod_name = 'Class{}_{}-{}_{}_refined_{}_GPCRDB.pdb'.format(class_dict[hommod.receptor_protein.family.slug[:3]], hommod.receptor_protein.parent.entry_name,
 																   hommod.sign_protein.entry_name, hommod.main_template.pdb_code.index, hommod.version)
@@ -2462,11 +2481,11 @@ def ComplexmodDownload(request):
 																   hommod.sign_protein.entry_name, hommod.main_template.pdb_code.index, hommod.version)
 				stat_name = 'Class{}_{}-{}_{}_{}_GPCRDB.templates.csv'.format(class_dict[hommod.receptor_protein.family.slug[:3]], hommod.receptor_protein.entry_name,
 																   hommod.sign_protein.entry_name, hommod.main_template.pdb_code.index, hommod.version)
-			backup_zip.writestr(mod_name, io.getvalue())
-			backup_zip.writestr(stat_name, stats_text.getvalue())
-	response = HttpResponse(zip_io.getvalue(), content_type='application/x-zip-compressed')
+			yield partial(cached_pdb_zip_entry, mod_name, hommod.pdb_data)
+			yield (stat_name, hommod.stats_text.stats_text)
+
+	response = StreamingHttpResponse(stream_zip(entries()), content_type='application/x-zip-compressed')
 	response['Content-Disposition'] = 'attachment; filename=%s' % 'GPCRDB_complex_homology_models' + ".zip"
-	response['Content-Length'] = zip_io.tell()
 	return response
 
 def SingleModelDownload(request, modelname, fullness, state=None, csv=False):
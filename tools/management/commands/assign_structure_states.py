@@ -1,8 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.contrib.postgres.aggregates import ArrayAgg
-from django.db.models import Max, Min
 
-from contactnetwork.distances import Distance, Distances
+from contactnetwork.distances import Distances, distance_values
 from contactnetwork.models import distance_scaling_factor
 from protein.models import ProteinFamily, ProteinState
 from residue.models import Residue
@@ -68,11 +67,9 @@ class Command(BaseCommand):
                 class_pair_inactives['005'] = ["2x47_6x37", 1000] #D PLACEHOLDER
                 class_pair_inactives['006'] = ["2x44_6x31", 13] #F
 
-                inactive_ids = list(Distance.objects.filter(distance__lt=class_pair_inactives[slug[0]][1]*distance_scaling_factor) \
-                                    .filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                    .filter(structure__pdb_code__index__in=structure_ids) \
-                                    .exclude(structure__pdb_code__index__in=active_ids) \
-                                    .values_list("structure__pdb_code__index"))
+                inactive_ids = [(d["structure__pdb_code__index"],) for d in distance_values(Structure.objects.filter(pdb_code__index__in=structure_ids) \
+                                    .exclude(pdb_code__index__in=active_ids), [class_pair_inactives[slug[0]][0]]) \
+                                    if d["distance"] < class_pair_inactives[slug[0]][1]*distance_scaling_factor]
 
                 inactive_ids = [x[0] for x in inactive_ids if x[0][0].isnumeric()]
 
@@ -147,18 +144,12 @@ class Command(BaseCommand):
 
                     # Percentage score for TM2-TM6 opening
                     #range_distance = Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                    range_distance = Distance.objects.filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .aggregate(Max('distance'), Min('distance'))
-
-                    min_open = range_distance['distance__min']
-                    max_open = range_distance['distance__max']
-
                     #distances = list(Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                    distances = list(Distance.objects.filter(gns_pair=class_pair_inactives[slug[0]][0]) \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .distinct("gns_pair", "structure") \
-                                        .values_list("structure__pdb_code__index", "distance"))
+                    distances = [(d["structure__pdb_code__index"], d["distance"]) for d in distance_values(Structure.objects.filter(pdb_code__index__in=structure_ids), \
+                                        [class_pair_inactives[slug[0]][0]])]
+
+                    min_open = min([d[1] for d in distances], default=None)
+                    max_open = max([d[1] for d in distances], default=None)
 
                     opening_percentage = {}
                     for entry in distances:
@@ -221,16 +212,12 @@ class Command(BaseCommand):
                         struct.gprot_bound_likeness = gprot_likeness
                         struct.save()
                 elif len(structure_ids) > 0:
-                    distances = list(Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                                        .filter(structure__pdb_code__index__in=structure_ids) \
-                                        .distinct("gns_pair", "structure") \
-                                        .values_list("structure__pdb_code__index", "distance"))
-
-                    range_distance = Distance.objects.filter(gn1="2x46").filter(gn2="6x37") \
-                                        .aggregate(Max('distance'), Min('distance'))
+                    distances = [(d["structure__pdb_code__index"], d["distance"]) for d in distance_values(Structure.objects.filter(pdb_code__index__in=structure_ids), \
+                                        ["2x46_6x37"])]
 
-                    min_open = range_distance['distance__min']
-                    max_open = range_distance['distance__max']
+                    all_distances = [d["distance"] for d in distance_values(Structure.objects.all(), ["2x46_6x37"])]
+                    min_open = min(all_distances, default=None)
+                    max_open = max(all_distances, default=None)
                     for entry in distances:
                         # Percentage score
                         percentage = int(round((entry[1]-min_open)/(max_open-min_open)*100))
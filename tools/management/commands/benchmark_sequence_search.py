@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from Bio.PDB import PDBParser
+import Bio.PDB.Polypeptide as polypeptide
+
+from structure.functions import BlastError, blast_alignments, run_blastp
+from structure.models import Structure
+from structure.sequence_search import SequenceIndex, SequenceSearch
+
+from io import StringIO
+import logging
+import os
+import time
+
+import numpy as np
+
+
+class Command(BaseCommand):
+
+    help = "Compares the in-process sequence search with BLAST on the preferred chains of all structures."
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--blastdb', default=os.sep.join([settings.STATICFILES_DIRS[0], 'blast',
+            'protwis_gpcr_blastdb']), help='BLAST database, with the index written by build_blast_database')
+        parser.add_argument('--limit', type=int, default=None, help='Number of structures to compare')
+
+    def handle(self, *args, **options):
+        index = SequenceIndex.load(options['blastdb'])
+        if index is None:
+            print("No sequence index of {}, run build_blast_database first".format(options['blastdb']))
+            return
+
+        search = SequenceSearch(blastdb=options['blastdb'])
+
+        structures = Structure.objects.all().select_related('pdb_code', 'pdb_data').order_by('pdb_code__index')
+        if options['limit']:
+            structures = structures[:options['limit']]
+
+        agree, differ, fallback = 0, [], 0
+        search_times, blast_times = [], []
+        for structure in structures:
+            sequence = self.chain_sequence(structure)
+            if not sequence:
+                continue
+
+            start = time.time()
+            hits = search.search(index, sequence)
+            search_times.append(time.time() - start)
+            # blastp is run directly, as BlastSearch would return cached results
+            start = time.time()
+            try:
+                blast_rows = run_blastp(search.blast.blast_path, options['blastdb'], [sequence])
+            except BlastError as msg:
+                print("BLAST search returned an error - exiting: {}".format(msg))
+                return
+            blast_times.append(time.time() - start)
+            blast_hits = blast_alignments(blast_rows[sequence], 1)
+
+            if hits is None:
+                fallback += 1
+                continue
+            top = hits[0][0] if hits else None
+            blast_top = blast_hits[0][0] if blast_hits else None
+            if top == blast_top:
+                agree += 1
+            else:
+                differ.append((structure.pdb_code.index, top, blast_top))
+
+        total = agree + len(differ) + fallback
+        if not total:
+            print("No structures to compare")
+            return
+        for pdb_code, top, blast_top in differ:
+            print("DIFFERENT", pdb_code, top, blast_top)
+        print("Chains compared: {}, same top hit: {} ({:.1%}), different: {}, searched with BLAST: {}".format(total,
+            agree, agree / total, len(differ), fallback))
+        for name, times in [('In-process', search_times), ('BLAST', blast_times)]:
+            print("{} search: median {:.1f} ms, 95th percentile {:.1f} ms".format(name,
+                np.percentile(times, 50) * 1000, np.percentile(times, 95) * 1000))
+
+    def chain_sequence(self, structure):
+        """Sequence of the preferred chain of a structure"""
+        try:
+            pdb_structure = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(structure.pdb_data.pdb))[0]
+            chain = pdb_structure[structure.preferred_chain[0]]
+        except (KeyError, IndexError, ValueError) as msg:
+            self.logger.warning("Could not read the preferred chain of {}: {}".format(structure.pdb_code.index, msg))
+            return ''
+        return ''.join([polypeptide.three_to_one(res.resname.replace('HID', 'HIS')) for res in chain
+            if polypeptide.is_aa(res.resname.replace('HID', 'HIS'), standard=True)])
@@ -1,14 +1,12 @@
-from Bio.Blast import NCBIXML
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from datetime import date
 from dateutil.relativedelta import relativedelta
-from io import StringIO
 import logging, os
 import requests
-from subprocess import Popen, PIPE
 
+from structure.functions import BlastSearch, BlastError
 from structure.models import Structure
 
 class Command(BaseCommand):
@@ -78,25 +76,25 @@ class Command(BaseCommand):
                 print("Incorrect response from RCSB web services - exiting")
                 return
 
-        # BLAST against local BLAST database
-        blast = Popen('%s -db %s -outfmt 5 -evalue 0.001 -max_target_seqs 1' % ('blastp',
-            os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_human_bundle_blastdb'])),
-            universal_newlines=True, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        (blast_out, blast_err) = blast.communicate(input=str(fasta_results))
-
-        pdb_list = []
-        if len(blast_err) != 0:
+        # BLAST against local BLAST database, all sequences in one batch
+        queries = list(grouped(fasta_results.splitlines(), 2))
+        blast = BlastSearch(blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_human_bundle_blastdb']),
+            top_results=1)
+        try:
+            blast_results = blast.run_batch([sequence for header, sequence in queries])
+        except BlastError:
             print("BLAST search returned an error - exiting")
             return
-        elif blast_out!='\n':
-            # Process results and remove structures already present in GPCRdb
-            blast_results = NCBIXML.parse(StringIO(blast_out))
-            for result in blast_results:
-                if len(result.alignments)>=1 and Structure.objects.filter(pdb_code__index=result.query[:4]).count() == 0:
-                    top_hit = result.alignments[0].hsps[0]
-                    if top_hit.score > 100:
-                        print("HIT", "{0:>7}{1:>8}".format(top_hit.score, round(top_hit.expect,5)), result.query)
-                        pdb_list.append(result.query.split('_')[0])
+
+        # Process results and remove structures already present in GPCRdb
+        pdb_list = []
+        for (header, sequence), alignments in zip(queries, blast_results):
+            query = header[1:]
+            if len(alignments)>=1 and Structure.objects.filter(pdb_code__index=query[:4]).count() == 0:
+                top_hit = alignments[0][1].hsps[0]
+                if top_hit.score > 100 and top_hit.expect <= 0.001:
+                    print("HIT", "{0:>7}{1:>8}".format(top_hit.score, round(top_hit.expect,5)), query)
+                    pdb_list.append(query.split('_')[0])
         return pdb_list
 
 def grouped(iterable, n):
@@ -1,26 +1,31 @@
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, transaction
 
 import contactnetwork.pdb as pdb
+from common.tools import copy_to_table
 from structure.models import Structure, StructureVectors
 from residue.models import Residue
-from angles.models import ResidueAngle as Angle
-from contactnetwork.models import Distance, distance_scaling_factor
+from angles.models import ResidueAngle as Angle, StructureAnglesBuild
+from contactnetwork.models import Distance, StructureDistances
 
 import Bio.PDB
 import copy
 import freesasa
+import hashlib
 import io
 import logging
 import math
 import subprocess
 import os
 import re
+import tempfile
+import time
 import traceback
 
 import numpy as np
 import scipy.stats as stats
 
+from scipy.spatial.distance import pdist
 from scipy.spatial.transform import Rotation as R
 from collections import OrderedDict
 from sklearn.decomposition import PCA
@@ -34,7 +39,17 @@ HSE  = True
 extra_pca = True
 print_pdb = False
 GN_only = False
-incremental_update = False
+
+# bumped when the calculations change, so all structures are computed again
+ANGLES_VERSION = 2
+
+# DSSP input files are written to memory when possible
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# columns of the rows written with COPY
+ANGLE_FIELDS = ['residue', 'structure', 'a_angle', 'b_angle', 'outer_angle', 'hse', 'sasa', 'rsa', 'phi', 'psi',
+    'tau_angle', 'theta', 'tau', 'rotation_angle', 'core_distance', 'midplane_distance', 'mid_distance', 'ss_dssp',
+    'ss_stride', 'chi1', 'chi2', 'chi3', 'chi4', 'chi5', 'missing_atoms']
 
 # atom name dictionary
 # Based on https://github.com/fomightez/structurework/blob/master/spartan_fixer/SPARTAN08_Fixer_standalone.py
@@ -216,6 +231,42 @@ class NonHetSelect(Bio.PDB.Select):
     def accept_residue(self, residue):
         return 1 if residue.id[0] == " " else 0
 
+def structure_angles_hash(reference, db_reslist):
+    """Fingerprint of the coordinates and annotation the angles and distances of a structure are computed from."""
+    content = hashlib.md5(str(ANGLES_VERSION).encode('utf-8'))
+    content.update(reference.pdb_data.pdb.encode('utf-8'))
+    content.update(reference.preferred_chain.encode('utf-8'))
+    content.update(str(reference.protein_conformation.state_id).encode('utf-8'))
+
+    # residues and their generic numbers
+    annotation = sorted([(r.sequence_number, r.amino_acid, r.generic_number.label if r.generic_number else None)
+        for r in db_reslist])
+    content.update(str(annotation).encode('utf-8'))
+
+    return content.hexdigest()
+
+def angle_row(ref,res,a1,a2,rsa,hse,phi,psi,theta,tau,ss_dssp,ss_stride,outer,tau_angle,chi_angles,missing,asa,distance,midpoint_distance,mid_membrane_distance,rotation_angle):
+    """Row of ANGLE_FIELDS from the values collected for one residue, angles in radians are converted to degrees"""
+    if asa != None:
+        asa = round(asa,1)
+    if outer != None:
+        outer = round(np.rad2deg(outer),3)
+    if phi != None:
+        phi = round(np.rad2deg(phi),3)
+    if psi != None:
+        psi = round(np.rad2deg(psi),3)
+    if rsa != None:
+        rsa = round(rsa,1)
+    if theta != None:
+        theta = round(np.rad2deg(theta),3)
+    if tau != None:
+        tau = round(np.rad2deg(tau),3)
+    if tau_angle != None:
+        tau_angle = round(np.rad2deg(tau_angle),3)
+    return (res.pk, ref.pk, a1, a2, outer, hse, asa, rsa, phi, psi, tau_angle, theta, tau, rotation_angle, distance,
+        mid_membrane_distance, midpoint_distance, ss_dssp, ss_stride, chi_angles[0], chi_angles[1], chi_angles[2],
+        chi_angles[3], chi_angles[4], missing)
+
 class Command(BaseCommand):
 
     help = "Command to calculate all angles for residues in each TM helix."
@@ -266,6 +317,16 @@ class Command(BaseCommand):
             dest='proc',
             default=2,
             help='Number of processes to run')
+        parser.add_argument('--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Recompute all structures, also the unchanged ones')
+        parser.add_argument('--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Purge all angles, distances and structure vectors before rebuilding (implies --full)')
 
     def load_pdb_var(self, pdb_code, var):
         """
@@ -278,16 +339,18 @@ class Command(BaseCommand):
 
 
     def handle(self, *args, **options):
-        if incremental_update:
-            done_structures = Angle.objects.values('structure_id').distinct()
-            # TODO add filter here for non-processed structures
-            self.references = Structure.objects.all().exclude(id__in=done_structures).prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
-        else:
+        self.full = options['full'] or options['purge']
+        if options['purge']:
             Angle.objects.all().delete()
-            Distance.objects.all().delete()
+            Distance.truncate()
+            StructureDistances.objects.all().delete()
             StructureVectors.objects.all().delete()
+            StructureAnglesBuild.objects.all().delete()
             print("All Angle, Distance, and StructureVector data cleaned")
-            self.references = Structure.objects.all().prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
+
+        # fingerprints of the previous build, unchanged structures are skipped
+        self.built = dict(StructureAnglesBuild.objects.values_list('structure_id', 'content_hash'))
+        self.references = Structure.objects.all().prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
 
         # DEBUG for a specific PDB
         # self.references = Structure.objects.filter(pdb_code__index="2RH1").prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
@@ -517,7 +580,6 @@ class Command(BaseCommand):
         #######################################################################
 
         failed = []
-        dblist = []
 
         # Get all structures
         #references = Structure.objects.filter(protein_conformation__protein__family__slug__startswith="001").prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
@@ -557,22 +619,30 @@ class Command(BaseCommand):
             pdb_code = reference.pdb_code.index
 #            print(pdb_code)
 
+            content_hash = structure_angles_hash(reference, res_dict[pdb_code])
+            if not self.full and self.built.get(reference.pk) == content_hash:
+                continue
+            current = time.time()
+            dblist = []
+
             try:
-                structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                structure = reference.pdb_data.get_coordinates().to_structure(pdb_code)
                 pchain = structure[0][preferred_chain]
                 state_id = reference.protein_conformation.state.id
 
-                # DSSP
-                filename = "{}_temp.pdb".format(pdb_code)
-                pdbio = Bio.PDB.PDBIO()
-                pdbio.set_structure(pchain)
-                pdbio.save(filename, NonHetSelect())
-                if os.path.exists("/env/bin/dssp"):
-                    dssp = Bio.PDB.DSSP(structure[0], filename, dssp='/env/bin/dssp')
-                elif os.path.exists("/env/bin/mkdssp"):
-                    dssp = Bio.PDB.DSSP(structure[0], filename, dssp='/env/bin/mkdssp')
-                elif os.path.exists("/usr/local/bin/mkdssp"):
-                    dssp = Bio.PDB.DSSP(structure[0], filename, dssp='/usr/local/bin/mkdssp')
+                # DSSP, the input file is written to the scratch directory (in memory)
+                with tempfile.NamedTemporaryFile('w', suffix='.pdb', prefix=pdb_code, dir=SCRATCH_DIR) as f:
+                    pdbio = Bio.PDB.PDBIO()
+                    pdbio.set_structure(pchain)
+                    pdbio.save(f, NonHetSelect())
+                    f.flush()
+                    filename = f.name
+                    if os.path.exists("/env/bin/dssp"):
+                        dssp = Bio.PDB.DSSP(structure[0], filename, dssp='/env/bin/dssp')
+                    elif os.path.exists("/env/bin/mkdssp"):
+                        dssp = Bio.PDB.DSSP(structure[0], filename, dssp='/env/bin/mkdssp')
+                    elif os.path.exists("/usr/local/bin/mkdssp"):
+                        dssp = Bio.PDB.DSSP(structure[0], filename, dssp='/usr/local/bin/mkdssp')
 
                 # DISABLED STRIDE - selected DSSP 3 over STRIDE
 #                try:
@@ -588,9 +658,6 @@ class Command(BaseCommand):
 #                except OSError:
 #                   print(pdb_code, " - STRIDE ERROR - ", e)
 
-                # CLEANUP
-                os.remove(filename)
-
                 #######################################################################
                 ###################### prepare and evaluate query #####################
 
@@ -1168,9 +1235,7 @@ class Command(BaseCommand):
                 c_vector = np.array2string(center_vector[0] - center_vector[1], separator=',')
                 translation = np.array2string(-1*center_vector[0], separator=',')
 
-                StructureVectors.objects.filter(structure = reference).all().delete()
                 sv = StructureVectors(structure = reference, translation = str(translation), center_axis = str(c_vector))
-                sv.save()
 
                 # TODO:
                 # FIX RESIDUE ORDER
@@ -1222,28 +1287,21 @@ class Command(BaseCommand):
                 # print("pseudo mid, pos=[", center_tm1[0], ",", center_tm1[1], ",", center_tm1[2] ,"];")
                 # print(rotation_angles[key_tm1])
 
-                # triangular matrix for distances
-                up_ind = np.triu_indices(len(gns_ca_list), 1)
-                bulk_distances = []
-
-                for i1, i2 in zip(up_ind[0], up_ind[1]):
-                    key1 = gns_ids_list[i1]
-                    key2 = gns_ids_list[i2]
-                    res1 = full_resdict[str(key1)]
-                    res2 = full_resdict[str(key2)]
-
-                    ca_dist = int(np.linalg.norm(gns_ca_list[key1] - gns_ca_list[key2])*distance_scaling_factor)
-                    cb_dist = int(np.linalg.norm(gns_cb_list[key1] - gns_cb_list[key2])*distance_scaling_factor)
-                    center_dist = None
-                    if key1 in gns_center_list and key2 in gns_center_list:
-                        center_dist = int(np.linalg.norm(gns_center_list[key1] - gns_center_list[key2])*distance_scaling_factor)
-
-                    # residues in gn_reslist, structure in structure
-                    distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=res1.generic_number.label, gn2=res2.generic_number.label, gns_pair='_'.join([res1.generic_number.label, res2.generic_number.label]), structure=reference)
-                    bulk_distances.append(distance)
-
-                # Bulk insert
-                Distance.objects.bulk_create(bulk_distances, batch_size=5000)
+                # triangular matrix for distances, packed per distance type
+                distance_ids = [resid for resid in gns_ids_list if resid in gns_ca_list]
+                distance_residues = [full_resdict[str(resid)] for resid in distance_ids]
+                ca_coordinates = np.array([gns_ca_list[resid] for resid in distance_ids], dtype=float).reshape(-1, 3)
+                cb_coordinates = np.array([gns_cb_list[resid] for resid in distance_ids], dtype=float).reshape(-1, 3)
+                helix_center_coordinates = np.array([gns_center_list[resid] if resid in gns_center_list else [np.nan]*3
+                    for resid in distance_ids], dtype=float).reshape(-1, 3)
+
+                # residues in gn_reslist, structure in structure
+                packed_distances = StructureDistances(structure=reference,
+                    gns=' '.join([res.generic_number.label for res in distance_residues]),
+                    amino_acids=''.join([res.amino_acid or 'X' for res in distance_residues]),
+                    distance=StructureDistances.pack(pdist(ca_coordinates)),
+                    distance_cb=StructureDistances.pack(pdist(cb_coordinates)),
+                    distance_helix_center=StructureDistances.pack(pdist(helix_center_coordinates)))
 
                 ### ANGLES
                 # Center axis to helix axis to CA
@@ -1257,7 +1315,7 @@ class Command(BaseCommand):
 
                 ### freeSASA (only for TM bundle)
                 # SASA calculations - results per atom
-                clean_structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                clean_structure = reference.pdb_data.get_coordinates().to_structure(pdb_code)
                 clean_pchain = clean_structure[0][preferred_chain]
 
                 # PTM residues give an FreeSASA error - remove
@@ -1373,6 +1431,9 @@ class Command(BaseCommand):
                             hselist[residue_id]] + \
                             dihedrals[residue_id] + \
                             [asa_list[residue_id], core_distances[residue_id], midpoint_distances[residue_id], mid_membrane_distances[residue_id], rotation_angles[residue_id]])
+
+                # Replace the previous results of the structure in one go
+                self.save_structure(reference, sv, packed_distances, dblist, content_hash, time.time() - current)
             except Exception as e:
                 print(pdb_code, " - ERROR - ", e)
                 failed.append(pdb_code)
@@ -1399,34 +1460,30 @@ class Command(BaseCommand):
 #            std = stats.t.cdf(std_test, df=std_len)
 #            dblist[i].append(0.501 if np.isnan(std) else std)
 
+        if failed:
+            print("Failed structures:", ", ".join(failed))
+
+    def save_structure(self, reference, structure_vectors, packed_distances, dblist, content_hash, build_time):
+        """Replace the structure vectors, distances and angles of a structure, and store its fingerprint."""
         # structure, residue, A-angle, B-angle, RSA, HSE, "PHI", "PSI", "THETA", "TAU", "SS_DSSP", "SS_STRIDE", "OUTER", "TAU_ANGLE", "CHI", "MISSING", "ASA", "DISTANCE", "ROTATION_ANGLE"
-        object_list = []
-        for ref,res,a1,a2,rsa,hse,phi,psi,theta,tau,ss_dssp,ss_stride,outer,tau_angle,chi_angles,missing,asa,distance,midpoint_distance,mid_membrane_distance,rotation_angle in dblist:
+        angle_rows = []
+        for values in dblist:
             try:
-                if asa != None:
-                    asa = round(asa,1)
-                if outer != None:
-                    outer = round(np.rad2deg(outer),3)
-                if phi != None:
-                    phi = round(np.rad2deg(phi),3)
-                if psi != None:
-                    psi = round(np.rad2deg(psi),3)
-                if rsa != None:
-                    rsa = round(rsa,1)
-                if theta != None:
-                    theta = round(np.rad2deg(theta),3)
-                if tau != None:
-                    tau = round(np.rad2deg(tau),3)
-                if tau_angle != None:
-                    tau_angle = round(np.rad2deg(tau_angle),3)
-                object_list.append(Angle(residue=res, a_angle=a1, b_angle=a2, structure=ref, sasa=asa, rsa=rsa, hse=hse, phi=phi, psi=psi, theta=theta, tau=tau, tau_angle=tau_angle, chi1=chi_angles[0], chi2=chi_angles[1], chi3=chi_angles[2], chi4=chi_angles[3], chi5=chi_angles[4], missing_atoms=missing, ss_dssp=ss_dssp, ss_stride=ss_stride, outer_angle=outer, core_distance=distance, mid_distance=midpoint_distance, midplane_distance=mid_membrane_distance, rotation_angle=rotation_angle))
+                angle_rows.append(angle_row(*values))
             except Exception as e:
                 print(e)
-                print([ref,res,a1,a2,rsa,hse,phi,psi,theta,tau,ss_dssp,ss_stride,outer,tau_angle,asa,distance,midpoint_distance,mid_membrane_distance])
-
-        print("created list")
-        print(len(object_list))
-
-        # Store the results
-        # faster than updating: deleting and recreating
-        Angle.objects.bulk_create(object_list,batch_size=5000)
+                print(values)
+
+        with transaction.atomic():
+            StructureVectors.objects.filter(structure=reference).delete()
+            # distances of earlier builds, one row per residue pair
+            Distance.objects.filter(structure=reference).delete()
+            StructureDistances.objects.filter(structure=reference).delete()
+            Angle.objects.filter(structure=reference).delete()
+
+            structure_vectors.save()
+            packed_distances.save()
+            copy_to_table(Angle, ANGLE_FIELDS, angle_rows)
+            StructureAnglesBuild.objects.update_or_create(structure=reference,
+                defaults={'content_hash': content_hash, 'build_time': build_time})
+        print(reference.pdb_code.index, len(angle_rows), "angles", len(packed_distances.gns.split()), "GNs with distances", round(build_time, 1))
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.db import connection
 from protein.models import *
 from common.tools import fetch_from_web_api
+from common.web_api import fetch_many_from_web_api
 from Bio import pairwise2
 
 from structure.functions import BlastSearch
@@ -240,12 +241,13 @@ class Command(BaseCommand):
             except:
                 #print('No file for',p,' So no sequence for',ts)
                 missing_sequences += len(ts)
+            transcript_sequences = fetch_many_from_web_api(url_ensembl_seq, ts, cache_dir_seq)
             for t in ts:
                 if not t in lmb_sequences:
                     #print('missing ',t,'in',"{}_nonstrict_transcripts.fa".format(p))
                     missing_sequences += 1
 
-                seq = fetch_from_web_api(url_ensembl_seq, t,cache_dir_seq)['seq']
+                seq = transcript_sequences[t]['seq']
                 sequences_lookup[seq].append([t,p])
                 if t in lmb_sequences:
                     if seq!=lmb_sequences[t]:
@@ -1,132 +1,83 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.core.management import call_command
+from build.management.commands.base_build import Command as BaseBuild
 
-from django.conf import settings
 from django.db import connection
-from django.utils.text import slugify
-from django.db import IntegrityError
-from contactnetwork.cube import compute_interactions
+from django.db.models.functions import Length
+from contactnetwork.cube import compute_interactions, contact_network_hash
 from contactnetwork.models import *
-import contactnetwork.interaction as ci
 
-from residue.models import ResidueGenericNumber, ResidueNumberingScheme, Residue, ResidueGenericNumberEquivalent
+from structure.models import Structure
 
+import logging
+import time
 
-from structure.models import (Structure, StructureType, StructureSegment, StructureStabilizingAgent,PdbData,
-    Rotamer, StructureSegmentModeling, StructureCoordinates, StructureCoordinatesDescription, StructureEngineering,
-    StructureEngineeringDescription, Fragment)
 
+class Command(BaseBuild):
 
-import os, time
-import yaml
-from interaction.views import runcalculation,parsecalculation
-from multiprocessing import Queue, Process, Value, Lock
+    help = "Rebuild the contact networks of all structures, by default only of structures whose coordinates or annotation changed"
 
-class Command(BaseCommand):
+    logger = logging.getLogger(__name__)
 
-    help = "Output all uniprot mappings"
-
-    update = True
-    purge = True
-    processes = 8
-
-    def prepare_input(self, proc, items, iteration=1):
-        q = Queue()
-        procs = list()
-        num_items = len(items)
-        num = Value('i', 0)
-        lock = Lock()
-
-        if not num_items:
-            return False
-
-        # make sure not to use more jobs than proteins (chunk size will be 0, which is not good)
-        if proc > num_items:
-            proc = num_items
-
-        chunk_size = int(num_items / proc)
-        connection.close()
-        for i in range(0, proc):
-            first = chunk_size * i
-            if i == proc - 1:
-                last = False
-            else:
-                last = chunk_size * (i + 1)
-    
-            p = Process(target=self.main_func, args=([(first, last), iteration,num,lock]))
-            procs.append(p)
-            p.start()
-
-        for p in procs:
-            p.join()
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc',
+            type=int,
+            action='store',
+            dest='proc',
+            default=8,
+            help='Number of processes to run')
+        parser.add_argument('--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Recompute all contact networks, also for unchanged structures')
+        parser.add_argument('--purge',
+            action='store_true',
+            dest='purge',
+            default=False,
+            help='Purge all contact networks before rebuilding (implies --full)')
 
     def purge_contact_network(self):
-
         InteractingResiduePair.truncate()
-        Distance.truncate()
         Interaction.truncate()
+        ContactNetworkBuild.objects.all().delete()
 
-    def build_contact_network(self,s,pdb_code):
-        interacting_pairs, distances  = compute_interactions(pdb_code, save_to_db=True)
+    def handle(self, *args, **options):
+        self.full = options['full'] or options['purge']
+        if options['purge']:
+            self.purge_contact_network()
 
+        # fingerprints of the previous build
+        self.built = dict(ContactNetworkBuild.objects.values_list('structure_id', 'content_hash'))
 
-    def handle(self, *args, **options):
+        # largest structures first, so the slow ones do not end up last in the queue
+        self.structures = list(Structure.objects.annotate(length=Length('protein_conformation__protein__sequence')) \
+            .order_by('-length').values_list('pk', 'pdb_code__index'))
+        print(len(self.structures), 'structures')
 
-        self.ss = Structure.objects.all()
-        self.structure_data_dir = os.sep.join([settings.DATA_DIR, 'structure_data', 'structures'])
-        if self.purge:
-            self.purge_contact_network()
-        print(len(self.ss),'structures')
-        self.prepare_input(self.processes, self.ss)
-
-        # for s in Structure.objects.all():
-        #   self.purge_contact_network(s)
-        #   self.build_contact_network(s,s.pdb_code.index)
-
-    def main_func(self, positions, iteration,count,lock):
-        # filenames
-        # if not positions[1]:
-        #     filenames = self.filenames[positions[0]:]
-        # else:
-        #     filenames = self.filenames[positions[0]:positions[1]]
-        ss = self.ss
-        while count.value<len(ss):
+        # workers claim one structure at a time from the shared counter
+        self.prepare_input(options['proc'], self.structures)
+
+    def main_func(self, positions, iteration, count, lock):
+        while count.value < len(self.structures):
             with lock:
-                if count.value<len(ss):
-                    s = ss[count.value]
-                    count.value +=1
-                    # print(s, count.value)
-                else:
-                    break 
-
-            source_file_path = os.sep.join([self.structure_data_dir, s.pdb_code.index.upper() + ".yaml"])
-            if os.path.isfile(source_file_path):
-                with open(source_file_path, 'r') as f:
-                    sd = yaml.load(f, Loader=yaml.FullLoader)
-                    
-            peptide_chain = ""
-            if 'ligand' in sd and sd['ligand'] and sd['ligand']!='None':
-                if isinstance(sd['ligand'], list):
-                    ligands = sd['ligand']
+                if count.value < len(self.structures):
+                    pk, pdb_code = self.structures[count.value]
+                    count.value += 1
                 else:
-                    ligands = [sd['ligand']]
-                for ligand in ligands:
-                    peptide_chain = ""
-                    if 'chain' in ligand:
-                        peptide_chain = ligand['chain']
-            
-            # self.purge_contact_network(s)
-            current = time.time()
-            if self.update:
-                if Distance.objects.filter(structure=s).count():
-                    print(s,'already done - skipping')
-                    continue
+                    break
+
             try:
-                self.build_contact_network(s,s.pdb_code.index)
-                print(s,"Contact Network",time.time()-current)
-            except:
-                print(s,'Failed contact network')
-            # current = time.time()
-            #runcalculation(s.pdb_code.index,peptide_chain)
-            #parsecalculation(s.pdb_code.index,False)
-            #print(s,"Ligand Interactions",time.time()-current)
\ No newline at end of file
+                s = Structure.objects.select_related('pdb_data', 'protein_conformation').get(pk=pk)
+                content_hash = contact_network_hash(s)
+                if not self.full and self.built.get(pk) == content_hash:
+                    continue
+
+                current = time.time()
+                compute_interactions(pdb_code, save_to_db=True)
+                build_time = time.time() - current
+                ContactNetworkBuild.objects.update_or_create(structure=s,
+                    defaults={'content_hash': content_hash, 'build_time': build_time})
+                print(pdb_code, "Contact Network", build_time)
+            except Exception as msg:
+                print(pdb_code, 'Failed contact network')
+                self.logger.error('Failed contact network for {}: {}'.format(pdb_code, msg))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Bio.PDB import Selection, PDBParser
+from Bio.PDB.NeighborSearch import NeighborSearch
+
+from contactnetwork.classifier import InteractionClassifier
+from contactnetwork.interaction import InteractingPair
+from contactnetwork.residue import is_aa
+from structure.models import Structure
+
+from io import StringIO
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Compare the batch interaction classifier with the per-pair classification on reference structures"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pdb', nargs='+', dest='pdb', default=['5NX2', '5WB1', '5L7D', '5X93', '5WS3', '5XRA'],
+            help='PDB codes of the reference structures')
+
+    def handle(self, *args, **options):
+        failed = 0
+        for pdb_code in options['pdb']:
+            try:
+                struc = Structure.objects.select_related('pdb_data').get(pdb_code__index=pdb_code.upper())
+            except Structure.DoesNotExist:
+                print(pdb_code, 'not found')
+                continue
+
+            s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(struc.pdb_data.pdb))[0]
+            chain = s[struc.preferred_chain.split(',')[0]]
+            ns = NeighborSearch(Selection.unfold_entities(chain, 'A'))
+            pairs = [pair for pair in ns.search_all(6.6, "R") if is_aa(pair[0]) and is_aa(pair[1])]
+
+            current = time.time()
+            expected = [InteractingPair(res1, res2, None, None, struc).get_interactions() for res1, res2 in pairs]
+            per_pair_time = time.time() - current
+
+            current = time.time()
+            batch = InteractionClassifier(pairs).classify()
+            batch_time = time.time() - current
+
+            mismatches = [pair for pair, a, b in zip(pairs, expected, batch) if self.summary(a) != self.summary(b)]
+            print(pdb_code, len(pairs), 'pairs', per_pair_time, 'per pair', batch_time, 'batch', len(mismatches),
+                'mismatches')
+            for res1, res2 in mismatches[:10]:
+                print('   ', res1.get_resname(), res1.id[1], res2.get_resname(), res2.id[1])
+            failed += len(mismatches) > 0
+
+        if failed:
+            raise CommandError('{} structures with differing interactions'.format(failed))
+
+    @staticmethod
+    def summary(interactions):
+        return sorted((i.__class__.__name__, i.get_type(), i.get_details(), i.atomname_residue1, i.atomname_residue2,
+            i.get_level()) for i in interactions)